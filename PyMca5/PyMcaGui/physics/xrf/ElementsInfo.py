@@ -107,7 +107,7 @@ def elementClicked(self, symbol):
             self.__createInfoWidget(symbol)
         else:
             self.infoText.clear()
-            self.infoText.insertHtml(self.html.gethtml(symbol))
+            self.infoText.insertHtml(self.html.gethtml(symbol, energy=self.energyValue))
         if self.infoWidget.isHidden():
             self.infoWidget.show()
         self.lastElement = symbol
@@ -175,7 +175,7 @@ def __createInfoWidget(self,symbol=""):
         self.infoText = qt.QTextEdit(w)
         self.infoText.setReadOnly(1)
         self.infoText.clear()
-        self.infoText.insertHtml(self.html.gethtml(symbol))
+        self.infoText.insertHtml(self.html.gethtml(symbol, energy=self.energyValue))
         l.addWidget(self.infoText)
         w.show()
         self.infoWidget=frame
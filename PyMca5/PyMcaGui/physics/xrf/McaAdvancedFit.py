@@ -575,11 +575,13 @@ def __showElementMarker(self, dict):
         items = []
         if not (ele in dict):
             return
+        elementTable = Elements.getElementRateTable(ele,
+                                energy=self.mcafit.getExcitationEnergy())
         for rays in dict[ele]:
-            for transition in Elements.Element[ele][rays +" xrays"]:
+            for transition in elementTable[rays + " xrays"]:
                 items.append([transition,
-                              Elements.Element[ele][transition]['energy'],
-                              Elements.Element[ele][transition]['rate']])
+                              elementTable[transition]['energy'],
+                              elementTable[transition]['rate']])
 
         config = self.mcafit.configure()
         xdata  = self.mcafit.xdata * 1.0
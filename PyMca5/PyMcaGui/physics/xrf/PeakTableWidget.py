@@ -92,6 +92,8 @@ def __init__(self, *args,**kw):
 
         self.peaks={}
         self.peaklist=[]
+        # excitation energy for the emission lines (None for all shells)
+        self.energy = kw.get('energy', None)
         if 'peaklist' in kw:
             self.peaklist = kw['peaklist']
         self.build()
@@ -206,12 +208,14 @@ def myslot(self, row, col):
                 options.append('-')
                 energies.append('0.000')
                 emax = 0.0
-                for rays in Elements.Element[ele]['rays']:
-                    for transition in Elements.Element[ele][rays]:
+                rateTable = Elements.getElementRateTable(ele,
+                                                energy=self.energy)
+                for rays in rateTable['rays']:
+                    for transition in rateTable[rays]:
                         options.append("%s (%.5f)" % (transition,
-                                    Elements.Element[ele][transition]['rate']))
-                        energies.append("%.5f " % (Elements.Element[ele][transition]['energy']))
-                        emax = max(emax,Elements.Element[ele][transition]['rate'])
+                                    rateTable[transition]['rate']))
+                        energies.append("%.5f " % (rateTable[transition]['energy']))
+                        emax = max(emax,rateTable[transition]['rate'])
                 energies[0] = "%.5f " % emax
                 #lineitem=qttable.QComboTableItem(self,options)
                 self.peaks[peak]["elementline_item"].insertItems(0, options)
@@ -231,12 +235,14 @@ def myslot(self, row, col):
                 elevalue=self.peaks[peak]["element_item"].currentText()
                 ele = str(elevalue).split()[0]
                 energy = "0.0"
-                for rays in Elements.Element[ele]['rays']:
-                    for transition in Elements.Element[ele][rays]:
+                rateTable = Elements.getElementRateTable(ele,
+                                                energy=self.energy)
+                for rays in rateTable['rays']:
+                    for transition in rateTable[rays]:
                         option = QString("%s (%.5f)" % (transition,
-                                    Elements.Element[ele][transition]['rate']))
+                                    rateTable[transition]['rate']))
                         if option == newvalue:
-                            energy = "%.5f " % (Elements.Element[ele][transition]['energy'])
+                            energy = "%.5f " % (rateTable[transition]['energy'])
                             break
                 if energy == "0.0":
                     _logger.warning("Something is wrong")
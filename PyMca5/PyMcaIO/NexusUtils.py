@@ -274,7 +274,8 @@ def updateDataset(parent, name, data):
     """
     try:
         parent[name] = data
-    except RuntimeError:
+    except (RuntimeError, OSError):
+        # the dataset exists (the exception type depends on h5py's version)
         parent[name][()] = data
 
 
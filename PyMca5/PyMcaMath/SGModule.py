@@ -115,6 +115,24 @@ def getSavitzkyGolay(spectrum, npoints=3, degree=1, order=0):
     result[N:-N] = numpy.convolve(spectrum, coeff, mode='valid')
     return result
 
+def getSavitzkyGolayMultiple(spectra, npoints=3, degree=1, order=0):
+    """
+    Same as getSavitzkyGolay applied along the last axis of spectra
+    """
+    coeff = calc_coeff(npoints, degree, order)
+    N = numpy.size(coeff - 1) // 2
+    if order < 1:
+        result = 1.0 * spectra
+    else:
+        result = 0.0 * spectra
+    n = result.shape[-1]
+    valid = result[..., N:-N]
+    valid[:] = 0.0
+    # numpy.convolve reverses the coefficients
+    for i, c in enumerate(coeff[::-1]):
+        valid += c * spectra[..., i:n - 2 * N + i]
+    return result
+
 def replaceStackWithSavitzkyGolay(stack, npoints=3, degree=1, order=0):
     coeff = calc_coeff(npoints, degree, order)
     N = numpy.size(coeff-1) // 2
@@ -48,6 +48,108 @@ def getSpectrumBackground(spectrum, width, roi_min=None, roi_max=None, smoothing
 
 getSnip1DBackground = getSpectrumBackground
 
+
+def _smooth1dMultiple(data):
+    """
+    In-place equivalent of the smooth1d C function applied to each
+    row of the 2D array data.
+    """
+    size = data.shape[1]
+    if size < 3:
+        return
+    old = data.copy()
+    data[:, 0] = 0.25 * (old[:, 0] + 2 * old[:, 0] + old[:, 1])
+    data[:, 1:-1] = 0.25 * (old[:, :-2] + 2 * old[:, 1:-1] + old[:, 2:])
+    data[:, -1] = 0.25 * old[:, -2] + 0.75 * old[:, -1]
+
+
+def getSavitskyGolayMultiple(spectra, width, dtype=None):
+    """
+    Savitsky-Golay smoothing of all the spectra at once. It gives the same
+    result as calling SpecfitFuns.SavitskyGolay on each individual spectrum.
+
+    :param spectra: 2D array (nSpectra, nChannels)
+    :param width: smoothing width
+    :param dtype: numpy.float64 (default) or numpy.float32
+    :returns: 2D array (nSpectra, nChannels)
+    """
+    if dtype is None:
+        dtype = numpy.float64
+    output = numpy.array(spectra, dtype=dtype, ndmin=2)
+    npoints = int(width)
+    if not (npoints % 2):
+        npoints += 1
+    n = output.shape[1]
+    if (npoints < 3) or (n < npoints):
+        # do not smooth data
+        return output
+
+    # coefficients
+    m = npoints // 2
+    den = float((2 * m - 1) * (2 * m + 1) * (2 * m + 3))
+    coeff = [float(3 * (3 * m * m + 3 * m - 1 - 5 * i * i))
+             for i in range(-m, m + 1)]
+
+    # simple smoothing at the beginning and at the end
+    for j in range(npoints // 3 + 1):
+        _smooth1dMultiple(output[:, :m])
+    for j in range(npoints // 3 + 1):
+        _smooth1dMultiple(output[:, n - m - 1:n - 1])
+
+    # the actual smoothing in the middle (same summation order as in C)
+    # done in blocks of spectra to keep the buffers small
+    data = output.copy()
+    nMiddle = n - 2 * m
+    nBlock = max(1, 16384 // n)
+    dhelp = numpy.empty((nBlock, nMiddle), dtype=dtype)
+    tmp = numpy.empty((nBlock, nMiddle), dtype=dtype)
+    for i in range(0, output.shape[0], nBlock):
+        block = data[i:i + nBlock]
+        k = block.shape[0]
+        bdhelp = dhelp[:k]
+        btmp = tmp[:k]
+        numpy.multiply(coeff[0], block[:, 0:nMiddle], out=bdhelp)
+        for j in range(1, 2 * m + 1):
+            numpy.multiply(coeff[j], block[:, j:nMiddle + j], out=btmp)
+            bdhelp += btmp
+        numpy.divide(bdhelp, den, out=btmp)
+        numpy.copyto(output[i:i + nBlock, m:n - m], btmp,
+                     where=bdhelp > 0.0)
+    return output
+
+
+def getStripBackgroundMultiple(spectra, snip_width, smoothing_width=1,
+                               anchorslist=None, dtype=None):
+    """
+    Strip background of all the spectra at once: Savitsky-Golay smoothing
+    followed by SNIP between consecutive anchors. It gives the same result
+    as doing it spectrum by spectrum.
+
+    :param spectra: 2D array (nSpectra, nChannels)
+    :param snip_width: SNIP width
+    :param smoothing_width: Savitsky-Golay width
+    :param anchorslist: channel indices where the background is split
+    :param dtype: numpy.float64 (default) or numpy.float32. The SNIP
+                  iterations are always done in double precision.
+    :returns: 2D array (nSpectra, nChannels)
+    """
+    background = getSavitskyGolayMultiple(spectra, smoothing_width,
+                                          dtype=dtype)
+    n = background.shape[1]
+    if anchorslist is None:
+        anchorslist = []
+    lastAnchor = 0
+    for anchor in anchorslist:
+        if (anchor > lastAnchor) and (anchor < n):
+            background[:, lastAnchor:anchor] = \
+                snip1d(background[:, lastAnchor:anchor], snip_width, 0)
+            lastAnchor = anchor
+    if lastAnchor < n:
+        background[:, lastAnchor:] = \
+            snip1d(background[:, lastAnchor:], snip_width, 0)
+    return background
+
+
 def subtractSnip1DBackgroundFromStack(stack, width, roi_min=None, roi_max=None,  smoothing=1):
     if roi_min is None:
         roi_min = 0
@@ -47,7 +47,8 @@
 
 def LeastSquaresFit(model, parameters0, data=None, maxiter = 100,constrains=None,
                         weightflag = 0,model_deriv=None,deltachi=None,fulloutput=0,
-                        xdata=None,ydata=None,sigmadata=None,linear=None):
+                        xdata=None,ydata=None,sigmadata=None,linear=None,
+                        model_jacobian=None):
     """
     Typical use:
 
@@ -96,6 +97,11 @@ def LeastSquaresFit(model, parameters0, data=None, maxiter = 100,constrains=None
                       of the fitting parameters, index is the fitting parameter index of which the the derivative has
                       to be provided in the supplied array of x points.
 
+        model_jacobian - function providing at once the derivatives of the fitting function respect to
+                      several fitted parameters. It will be called as model_jacobian(parameters, indices, x)
+                      and it has to return an array of shape (len(indices), len(x)). If provided, it is used
+                      instead of model_deriv in non-linear fits.
+
         linear - Flag to indicate a linear fit instead of a non-linear. Default is non-linear fit (=false)
 
         maxiter - Maximum number of iterations (default is 100)
@@ -146,7 +152,8 @@ def LeastSquaresFit(model, parameters0, data=None, maxiter = 100,constrains=None
                                     fulloutput=fulloutput,
                                     xdata=xdata,
                                     ydata=ydata,
-                                    sigmadata=sigmadata)
+                                    sigmadata=sigmadata,
+                                    model_jacobian=model_jacobian)
         except TypeError:
             print("You should reconsider how to write your function")
             raise TypeError("You should reconsider how to write your function")
@@ -158,7 +165,8 @@ def LeastSquaresFit(model, parameters0, data=None, maxiter = 100,constrains=None
                                 fulloutput=fulloutput,
                                 xdata=xdata,
                                 ydata=ydata,
-                                sigmadata=sigmadata)
+                                sigmadata=sigmadata,
+                                model_jacobian=model_jacobian)
 
 def LinearLeastSquaresFit(model0,parameters0,data0,maxiter,
                                 constrains0,weightflag,model_deriv=None,deltachi=0.01,fulloutput=0,
@@ -286,44 +294,13 @@ def RestreinedLeastSquaresFit(model0,parameters0,data0,maxiter,
                 constrains0,weightflag,model_deriv=None,deltachi=0.01,fulloutput=0,
                                     xdata=None,
                                     ydata=None,
-                                    sigmadata=None):
+                                    sigmadata=None,
+                                    model_jacobian=None):
     #get the codes:
     # 0 = Free       1 = Positive     2 = Quoted
     # 3 = Fixed      4 = Factor       5 = Delta
     # 6 = Sum        7 = ignored
-    constrains=[[],[],[]]
-    for i in range(len(parameters0)):
-        constrains[0].append(constrains0[0][i])
-        constrains[1].append(constrains0[1][i])
-        constrains[2].append(constrains0[2][i])
-    for i in range(len(parameters0)):
-        if type(constrains[0][i]) == type('string'):
-            #get the number
-            if   constrains[0][i] == "FREE":
-                 constrains[0][i] = CFREE
-            elif constrains[0][i] == "POSITIVE":
-                 constrains[0][i] = CPOSITIVE
-            elif constrains[0][i] == "QUOTED":
-                 constrains[0][i] = CQUOTED
-            elif constrains[0][i] == "FIXED":
-                 constrains[0][i] = CFIXED
-            elif constrains[0][i] == "FACTOR":
-                 constrains[0][i] = CFACTOR
-                 constrains[1][i] = int(constrains[1][i])
-            elif constrains[0][i] == "DELTA":
-                 constrains[0][i] = CDELTA
-                 constrains[1][i] = int(constrains[1][i])
-            elif constrains[0][i] == "SUM":
-                 constrains[0][i] = CSUM
-                 constrains[1][i] = int(constrains[1][i])
-            elif constrains[0][i] == "IGNORED":
-                 constrains[0][i] = CIGNORED
-            elif constrains[0][i] == "IGNORE":
-                 constrains[0][i] = CIGNORED
-            else:
-               #I should raise an exception
-                #constrains[0][i] = 0
-                raise ValueError("Unknown constraint %s" % constrains[0][i])
+    constrains = getconstrains(constrains0, len(parameters0))
     # make a local copy of the function for an easy speed up ...
     model = model0
     parameters = numpy.array(parameters0, dtype=numpy.float, copy=False)
@@ -387,7 +364,8 @@ def RestreinedLeastSquaresFit(model0,parameters0,data0,maxiter,
         chisq0, alpha0, beta,\
         n_free, free_index, noigno, fitparam, derivfactor  =ChisqAlphaBeta(
                                                  model,fittedpar,
-                                                 x,y,weight,constrains,model_deriv=model_deriv)
+                                                 x,y,weight,constrains,model_deriv=model_deriv,
+                                                 model_jacobian=model_jacobian)
         nr, nc = alpha0.shape
         flag = 0
         lastdeltachi = chisq0
@@ -463,7 +441,271 @@ def RestreinedLeastSquaresFit(model0,parameters0,data0,maxiter,
     else:
         return fittedpar.tolist(), chisq/(len(yfit)-len(sigma0)), sigmapar.tolist(),niter,lastdeltachi
 
-def ChisqAlphaBeta(model0, parameters, x,y,weight, constrains,model_deriv=None,linear=None):
+def MultipleLeastSquaresFit(model, parameters0, xdata, ydata, sigmadata=None,
+                            constrains=None, weightflag=0, model_jacobian=None,
+                            maxiter=100, deltachi=None):
+    """
+    Levenberg-Marquardt fit of several spectra at once. It follows the same
+    steps as RestreinedLeastSquaresFit for each spectrum but the model and
+    its derivatives are evaluated for all the spectra in a single call.
+
+    Every spectrum has its own damping factor and the spectra that have
+    converged (or reached maxiter) are not evaluated anymore.
+
+        model - it has the form model(parameters, x) where parameters is an
+                array of shape (nspectra, nparameters). It has to return an
+                array of shape (nspectra, len(x)).
+
+        parameters0 - array of shape (nspectra, nparameters) with the
+                initial values
+
+        xdata - 1D array with the points shared by all the spectra
+
+        ydata - array of shape (nspectra, len(xdata))
+
+        sigmadata - uncertainties of ydata (default is sqrt(y))
+
+        constrains - shared by all the spectra (see LeastSquaresFit). The
+                quoted parameters are free if their limits are different.
+
+        model_jacobian - it is called as model_jacobian(parameters, indices, x)
+                and it has to return an array of shape
+                (nspectra, len(indices), len(x))
+
+    Output:
+
+        fitted_parameters, reduced_chi_square, uncertainties, niter,
+        lastdeltachi (one row or one value per spectrum)
+    """
+    if deltachi is None:
+        deltachi = 0.01
+    parameters = numpy.array(parameters0, dtype=numpy.float)
+    if parameters.ndim == 1:
+        parameters = parameters.reshape(1, -1)
+    nspectra, n_param = parameters.shape
+    x = numpy.array(xdata, dtype=numpy.float, copy=False).ravel()
+    y = numpy.array(ydata, dtype=numpy.float, copy=False)
+    y = y.reshape(nspectra, x.size)
+    if constrains is None or len(constrains) == 0:
+        constrains = [[CFREE] * n_param, [0] * n_param, [0] * n_param]
+    constrains = getconstrains(constrains, n_param)
+    if weightflag == 1:
+        if sigmadata is None:
+            dummy = abs(y)
+        else:
+            dummy = abs(numpy.array(sigmadata, dtype=numpy.float,
+                                    copy=False).reshape(y.shape))
+            dummy = dummy * dummy
+        weight = 1.0 / (dummy + numpy.equal(dummy, 0))
+    else:
+        weight = numpy.ones(y.shape, numpy.float)
+
+    # the free parameters and the factors of the quoted ones
+    free_index = []
+    quoted = []
+    for i in range(n_param):
+        if constrains[0][i] in [CFREE, CPOSITIVE]:
+            free_index.append(i)
+        elif constrains[0][i] == CQUOTED:
+            pmax = max(constrains[1][i], constrains[2][i])
+            pmin = min(constrains[1][i], constrains[2][i])
+            if (pmax - pmin) > 0:
+                parameters[:, i] = numpy.clip(parameters[:, i], pmin, pmax)
+                quoted.append(len(free_index))
+                free_index.append(i)
+    n_free = len(free_index)
+    if n_free == 0:
+        raise ValueError("No free parameters to fit")
+    free_index = numpy.array(free_index, dtype=numpy.int64)
+    quoted = numpy.array(quoted, dtype=numpy.int64)
+    pmin = numpy.array([min(constrains[1][free_index[i]],
+                            constrains[2][free_index[i]]) for i in quoted])
+    pmax = numpy.array([max(constrains[1][free_index[i]],
+                            constrains[2][free_index[i]]) for i in quoted])
+    A = 0.5 * (pmax + pmin)
+    B = 0.5 * (pmax - pmin)
+    positive = numpy.array([constrains[0][i] == CPOSITIVE
+                            for i in free_index], dtype=numpy.bool_)
+
+    fittedpar = parameters
+    fittedpar[:, free_index[positive]] = abs(fittedpar[:, free_index[positive]])
+    flambda = numpy.ones((nspectra,), numpy.float) * 0.001
+    iiter = numpy.ones((nspectra,), numpy.int64) * maxiter
+    niter = numpy.zeros((nspectra,), numpy.int64)
+    lastdeltachi = numpy.zeros((nspectra,), numpy.float)
+    alpha0 = numpy.zeros((nspectra, n_free, n_free), numpy.float)
+    identity = numpy.identity(n_free)
+    index = numpy.arange(0, x.size, 2)
+    while numpy.any(iiter > 0):
+        active = numpy.nonzero(iiter > 0)[0]
+        niter[active] += 1
+        if (niter[active[0]] < 2) and (n_param*3 < x.size):
+            xw = x[index]
+            yw = y[active][:, index]
+            weightw = weight[active][:, index]
+        else:
+            xw = x
+            yw = y[active]
+            weightw = weight[active]
+        fitparam = fittedpar[active]
+        derivfactor = numpy.ones((active.size, n_free), numpy.float)
+        derivfactor[:, quoted] = B * numpy.cos(numpy.arcsin(numpy.clip(
+                            (fitparam[:, free_index[quoted]] - A) / B, -1, 1)))
+        newpar = getparametersMultiple(fitparam, constrains)
+        deltay = yw - model(newpar, xw)
+        help0 = weightw * deltay
+        chisq0 = (help0 * deltay).sum(axis=1)
+        deriv = model_jacobian(newpar, free_index, xw)
+        deriv *= derivfactor[:, :, numpy.newaxis]
+        beta = numpy.matmul(deriv, help0[:, :, numpy.newaxis])[:, :, 0]
+        alpha = numpy.matmul(deriv * weightw[:, numpy.newaxis, :],
+                             numpy.transpose(deriv, (0, 2, 1)))
+        alpha0[active] = alpha
+        # spectra looking for a damping factor decreasing the chi-square
+        trial = numpy.arange(active.size)
+        while trial.size:
+            spectra = active[trial]
+            damping = 1.0 + flambda[spectra][:, numpy.newaxis, numpy.newaxis] * identity
+            deltapar = _solveMultiple(alpha[trial] * damping, beta[trial])
+            pwork = fitparam[trial].copy()
+            pwork[:, free_index] += deltapar
+            if quoted.size:
+                pwork[:, free_index[quoted]] = A + B * numpy.sin(
+                        numpy.arcsin(numpy.clip(
+                        (fitparam[trial][:, free_index[quoted]] - A) / B, -1, 1)) + \
+                        deltapar[:, quoted])
+            newpar = getparametersMultiple(pwork, constrains)
+            deltay = yw[trial] - model(newpar, xw)
+            chisq = (weightw[trial] * deltay * deltay).sum(axis=1)
+            better = chisq <= chisq0[trial]
+            iiter[spectra] -= 1
+            # accepted steps
+            accepted = spectra[better]
+            fittedpar[accepted] = newpar[better]
+            lastdeltachi[accepted] = (chisq0[trial][better] - chisq[better]) / \
+                                     (chisq0[trial][better] + \
+                                      (chisq0[trial][better] == 0))
+            iiter[accepted[lastdeltachi[accepted] < deltachi]] = 0
+            flambda[accepted] = flambda[accepted] / 10.0
+            # rejected steps
+            rejected = spectra[~better]
+            flambda[rejected] = flambda[rejected] * 10.0
+            stop = flambda[rejected] > 1000
+            iiter[rejected[stop]] = 0
+            trial = trial[~better][~stop]
+    sigma0 = numpy.sqrt(abs(numpy.diagonal(_invMultiple(alpha0),
+                                           axis1=1, axis2=2)))
+    sigmapar = getsigmaparametersMultiple(fittedpar, sigma0, constrains,
+                                          free_index)
+    deltay = y - model(getparametersMultiple(fittedpar, constrains), x)
+    chisq = (weight * deltay * deltay).sum(axis=1)
+    return fittedpar, chisq / (x.size - n_free), sigmapar, niter, lastdeltachi
+
+def _solveMultiple(alpha, beta):
+    """
+    Solve the systems of equations alpha[i] * x[i] = beta[i]
+    """
+    try:
+        return numpy.linalg.solve(alpha, beta[:, :, numpy.newaxis])[:, :, 0]
+    except numpy.linalg.LinAlgError:
+        # at least one of them is singular
+        return numpy.matmul(numpy.linalg.pinv(alpha),
+                            beta[:, :, numpy.newaxis])[:, :, 0]
+
+def _invMultiple(alpha):
+    try:
+        return inv(alpha)
+    except numpy.linalg.LinAlgError:
+        return numpy.linalg.pinv(alpha)
+
+def getparametersMultiple(parameters, constrains):
+    """
+    getparameters for an array of shape (nspectra, nparameters)
+    """
+    newparam = numpy.array(parameters, dtype=numpy.float)
+    for i in range(len(constrains[0])):
+        if constrains[0][i] == CPOSITIVE:
+            newparam[:, i] = abs(newparam[:, i])
+    for i in range(len(constrains[0])):
+        if constrains[0][i] == CFACTOR:
+            newparam[:, i] = constrains[2][i] * newparam[:, int(constrains[1][i])]
+        elif constrains[0][i] == CDELTA:
+            newparam[:, i] = constrains[2][i] + newparam[:, int(constrains[1][i])]
+        elif constrains[0][i] == CIGNORED:
+            newparam[:, i] = 0
+        elif constrains[0][i] == CSUM:
+            newparam[:, i] = constrains[2][i] - newparam[:, int(constrains[1][i])]
+    return newparam
+
+def getsigmaparametersMultiple(parameters, sigma0, constrains, free_index):
+    """
+    getsigmaparameters for an array of shape (nspectra, nparameters) given
+    the uncertainties of the free parameters in free_index
+    """
+    sigma_par = numpy.zeros(parameters.shape, numpy.float)
+    for i in range(len(constrains[0])):
+        if abs(constrains[0][i]) == CFIXED:
+            sigma_par[:, i] = parameters[:, i]
+        elif constrains[0][i] == CQUOTED:
+            sigma_par[:, i] = parameters[:, i]
+    for n, i in enumerate(free_index):
+        if constrains[0][i] == CQUOTED:
+            pmax = max(constrains[1][i], constrains[2][i])
+            pmin = min(constrains[1][i], constrains[2][i])
+            A = 0.5 * (pmax + pmin)
+            B = 0.5 * (pmax - pmin)
+            sigma_par[:, i] = abs(B * numpy.cos(numpy.arcsin(
+                numpy.clip((parameters[:, i] - A) / B, -1, 1))) * sigma0[:, n])
+        else:
+            sigma_par[:, i] = sigma0[:, n]
+    for i in range(len(constrains[0])):
+        if constrains[0][i] == CFACTOR:
+            sigma_par[:, i] = constrains[2][i] * sigma_par[:, int(constrains[1][i])]
+        elif constrains[0][i] in [CDELTA, CSUM]:
+            sigma_par[:, i] = sigma_par[:, int(constrains[1][i])]
+    return sigma_par
+
+def getconstrains(constrains0, nparameters):
+    """
+    Copy of the constraints with the string codes converted to numbers
+    """
+    constrains=[[],[],[]]
+    for i in range(nparameters):
+        constrains[0].append(constrains0[0][i])
+        constrains[1].append(constrains0[1][i])
+        constrains[2].append(constrains0[2][i])
+    for i in range(nparameters):
+        if type(constrains[0][i]) == type('string'):
+            #get the number
+            if   constrains[0][i] == "FREE":
+                 constrains[0][i] = CFREE
+            elif constrains[0][i] == "POSITIVE":
+                 constrains[0][i] = CPOSITIVE
+            elif constrains[0][i] == "QUOTED":
+                 constrains[0][i] = CQUOTED
+            elif constrains[0][i] == "FIXED":
+                 constrains[0][i] = CFIXED
+            elif constrains[0][i] == "FACTOR":
+                 constrains[0][i] = CFACTOR
+                 constrains[1][i] = int(constrains[1][i])
+            elif constrains[0][i] == "DELTA":
+                 constrains[0][i] = CDELTA
+                 constrains[1][i] = int(constrains[1][i])
+            elif constrains[0][i] == "SUM":
+                 constrains[0][i] = CSUM
+                 constrains[1][i] = int(constrains[1][i])
+            elif constrains[0][i] == "IGNORED":
+                 constrains[0][i] = CIGNORED
+            elif constrains[0][i] == "IGNORE":
+                 constrains[0][i] = CIGNORED
+            else:
+               #I should raise an exception
+                #constrains[0][i] = 0
+                raise ValueError("Unknown constraint %s" % constrains[0][i])
+    return constrains
+
+def ChisqAlphaBeta(model0, parameters, x,y,weight, constrains,model_deriv=None,linear=None,
+                   model_jacobian=None):
     if linear is None:linear=0
     model = model0
     #nr0, nc = data.shape
@@ -525,32 +767,31 @@ def ChisqAlphaBeta(model0, parameters, x,y,weight, constrains,model_deriv=None,l
     newpar = numpy.take(newpar,noigno)
     if n_free == 0:
         raise ValueError("No free parameters to fit")
-    for i in range(n_free):
-        if model_deriv is None:
-            #pwork = parameters.__copy__()
-            pwork [free_index[i]] = fitparam [i] + delta [i]
-            newpar = getparameters(pwork.tolist(),constrains)
-            newpar=numpy.take(newpar,noigno)
-            f1 = model(newpar, x)
-            pwork [free_index[i]] = fitparam [i] - delta [i]
-            newpar = getparameters(pwork.tolist(),constrains)
-            newpar=numpy.take(newpar,noigno)
-            f2 = model(newpar, x)
-            help0 = (f1-f2) / (2.0 * delta [i])
-            help0 = help0 * derivfactor[i]
-            pwork [free_index[i]] = fitparam [i]
-            #removed I resize outside the loop:
-            #help0 = numpy.resize(help0,(1,nr))
-        else:
-            help0=model_deriv(pwork,free_index[i],x)
-            help0 = help0 * derivfactor[i]
-
-        if i == 0 :
-            deriv = help0
-        else:
-            deriv = numpy.concatenate((deriv,help0), 0)
-    #line added to resize outside the loop
-    deriv=numpy.resize(deriv,(n_free,nr))
+    deriv = numpy.zeros((n_free, nr), numpy.float)
+    if (model_jacobian is not None) and (not linear):
+        # all the derivatives in a single call
+        deriv[:, :] = model_jacobian(pwork, free_index, x)
+        deriv *= numpy.array(derivfactor, numpy.float)[:, numpy.newaxis]
+    else:
+        for i in range(n_free):
+            if model_deriv is None:
+                #pwork = parameters.__copy__()
+                pwork [free_index[i]] = fitparam [i] + delta [i]
+                newpar = getparameters(pwork.tolist(),constrains)
+                newpar=numpy.take(newpar,noigno)
+                f1 = model(newpar, x)
+                pwork [free_index[i]] = fitparam [i] - delta [i]
+                newpar = getparameters(pwork.tolist(),constrains)
+                newpar=numpy.take(newpar,noigno)
+                f2 = model(newpar, x)
+                help0 = (f1-f2) / (2.0 * delta [i])
+                help0 = help0 * derivfactor[i]
+                pwork [free_index[i]] = fitparam [i]
+            else:
+                help0=model_deriv(pwork,free_index[i],x)
+                help0 = help0 * derivfactor[i]
+            # filled in place, a concatenation per parameter is quadratic
+            deriv[i, :] = numpy.ravel(help0)
     if linear:
         pseudobetahelp = weight * y
     else:
@@ -559,24 +800,11 @@ def ChisqAlphaBeta(model0, parameters, x,y,weight, constrains,model_deriv=None,l
         yfit = model(newpar, x)
         deltay = y - yfit
         help0 = weight * deltay
-    for i in range(n_free):
-        derivi = numpy.resize(deriv [i,:], (1,nr))
-        if linear:
-            if i==0:
-                beta = numpy.resize(numpy.sum((pseudobetahelp * derivi),1),(1,1))
-            else:
-                beta = numpy.concatenate((beta, numpy.resize(numpy.sum((pseudobetahelp * derivi),1),(1,1))), 1)
-        else:
-            help1 = numpy.resize(numpy.sum((help0 * derivi),1),(1,1))
-            if i == 0:
-                beta = help1
-            else:
-                beta = numpy.concatenate((beta, help1), 1)
-        help1 = numpy.inner(deriv,weight*derivi)
-        if i == 0:
-            alpha = help1
-        else:
-            alpha = numpy.concatenate((alpha, help1),1)
+    if linear:
+        beta = numpy.dot(deriv, pseudobetahelp).reshape(1, n_free)
+    else:
+        beta = numpy.dot(deriv, help0).reshape(1, n_free)
+    alpha = numpy.inner(deriv, weight * deriv)
     if linear:
         #not used
         chisq = 0.0
@@ -0,0 +1,506 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2004-2019 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V.A. Sole - ESRF Data Analysis"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+"""
+Partial derivatives of the area normalized peak functions of SpecfitFuns
+respect to the columns of their peak tables.
+
+All the peaks are evaluated at once and the derivatives are returned as an
+array of shape (number of columns, number of peaks, number of points):
+
+    - row 0: derivative respect to the area (i.e. the peak of unit area)
+    - row 1: derivative respect to the position
+    - row 2: derivative respect to the FWHM
+    - rows 3 to 7: derivatives respect to the remaining columns
+
+The sum over the peaks of the derivative rows weighted by the derivatives
+of the table columns respect to the parameters of a model gives the
+jacobian of the model. This is what ahypermetJacobian and apvoigtJacobian
+calculate.
+"""
+import numpy
+from PyMca5.PyMcaMath.fitting import SpecfitFuns
+
+_LOG2 = 0.69314718055994529
+_SQRT2 = numpy.sqrt(2.0)
+_SQRT2PI = numpy.sqrt(2.0 * numpy.pi)
+_TWOSQRTPI = 2.0 / numpy.sqrt(numpy.pi)
+_TOSIGMA = 1.0 / (2.0 * numpy.sqrt(2.0 * _LOG2))
+# half width, in units of sigma, of the region around a peak where its
+# gaussian is above the double precision and erfc differs from 2 below it
+_NEAR = 8.6
+# maximum number of elements of the arrays of derivatives
+_BLOCKSIZE = 2**20
+_TAILS = [(2, 3, 4), (4, 5, 6)]
+
+
+def ahypermetDerivatives(peaks, x, tails=15):
+    """
+    Derivatives of SpecfitFuns.ahypermet
+
+    :param peaks: table of shape (npeaks, 8) with the columns area,
+                  position, fwhm, st_area_r, st_slope_r, lt_area_r,
+                  lt_slope_r and step_height_r
+    :param x: 1D array of points or 2D array with the points of each peak
+    :param int tails: the same flags as SpecfitFuns.ahypermet (1 gaussian,
+                      2 short tail, 4 long tail, 8 step)
+    :returns: array of shape (8, npeaks, npoints)
+    """
+    peaks = numpy.array(peaks, dtype=numpy.float64, copy=False)
+    peaks = peaks.reshape(-1, 8)
+    x = numpy.array(x, dtype=numpy.float64, copy=False)
+    npoints = x.shape[-1] if x.ndim else 1
+    result = numpy.zeros((8, peaks.shape[0], npoints), numpy.float64)
+    if tails <= 0 or not peaks.shape[0]:
+        return result
+    area = peaks[:, 0:1]
+    sigma = peaks[:, 2:3] * _TOSIGMA
+    if x.ndim == 2:
+        z0 = x - peaks[:, 1:2]
+    else:
+        z0 = x.reshape(1, -1) - peaks[:, 1:2]
+    z1 = sigma * _SQRT2
+    z2 = (0.5 * z0 * z0) / (sigma * sigma)
+    gauss = numpy.where(z2 < 612, numpy.exp(-numpy.minimum(z2, 612.)), 0.0)
+    norm = 1.0 / (sigma * _SQRT2PI)
+    if tails & 1:
+        g = gauss * norm
+        result[0] += g
+        result[1] += area * g * z0 / (sigma * sigma)
+        result[2] += area * _TOSIGMA * g * \
+                     (z0 * z0 / (sigma * sigma) - 1.0) / sigma
+    for flag, iarea, islope in _TAILS:
+        if not (tails & flag):
+            continue
+        ratio = peaks[:, iarea:iarea + 1]
+        slope = peaks[:, islope:islope + 1]
+        valid = (slope != 0).ravel()
+        if not numpy.any(valid):
+            continue
+        slope = numpy.where(slope != 0, slope, 1.0)
+        u = z0 / z1 + 0.5 * z1 / slope
+        v = 0.5 * (sigma / slope) * (sigma / slope) + z0 / slope
+        mask = (u < 10) & (numpy.abs(z0 / slope) <= 612) & valid[:, None]
+        # erfc(u) * exp(v), exp(v - u * u) is the gaussian term
+        ev = numpy.where(mask, SpecfitFuns.erfc(numpy.where(mask, u, 0.0)) *
+                               numpy.exp(numpy.where(mask, v, 0.0)), 0.0)
+        gv = numpy.where(mask, gauss, 0.0)
+        unit = ev / (2.0 * slope)
+        tail = ratio * unit
+        result[0] += tail
+        result[iarea] += area * unit
+        dz = ratio / (2.0 * slope) * (ev / slope - \
+                                      _TWOSQRTPI * gv / z1)
+        result[1] -= area * dz
+        result[2] += area * _TOSIGMA * ratio / (2.0 * slope) * \
+                     (ev * sigma / (slope * slope) - \
+                      _TWOSQRTPI * gv * (1.0 / (_SQRT2 * slope) -
+                                         z0 / (z1 * sigma)))
+        result[islope] += area * (-tail / slope + ratio / (2.0 * slope) * \
+                     (-ev * (sigma * sigma / slope + z0) / (slope * slope) + \
+                      _TWOSQRTPI * gv * sigma / (_SQRT2 * slope * slope)))
+    if tails & 8:
+        ratio = peaks[:, 7:8]
+        unit = norm * 0.5 * SpecfitFuns.erfc(z0 / z1)
+        step = ratio * unit
+        result[0] += step
+        result[7] += area * unit
+        g = gauss / (2.0 * numpy.pi * sigma * sigma)
+        result[1] += area * ratio * g
+        result[2] += area * _TOSIGMA * (-step / sigma + ratio * g * z0 / sigma)
+    return result
+
+
+def apvoigtDerivatives(peaks, x):
+    """
+    Derivatives of SpecfitFuns.apvoigt
+
+    :param peaks: table of shape (npeaks, 4) with the columns area,
+                  position, fwhm and eta
+    :param x: 1D array of points or 2D array with the points of each peak
+    :returns: array of shape (4, npeaks, npoints)
+    """
+    peaks = numpy.array(peaks, dtype=numpy.float64, copy=False)
+    peaks = peaks.reshape(-1, 4)
+    x = numpy.array(x, dtype=numpy.float64, copy=False)
+    npoints = x.shape[-1] if x.ndim else 1
+    result = numpy.zeros((4, peaks.shape[0], npoints), numpy.float64)
+    if not peaks.shape[0]:
+        return result
+    area = peaks[:, 0:1]
+    fwhm = peaks[:, 2:3]
+    eta = peaks[:, 3:4]
+    if x.ndim == 2:
+        z0 = x - peaks[:, 1:2]
+    else:
+        z0 = x.reshape(1, -1) - peaks[:, 1:2]
+    # lorentzian
+    q = z0 / (0.5 * fwhm)
+    q2 = 1.0 + q * q
+    lorentz = 1.0 / (0.5 * numpy.pi * fwhm * q2)
+    # gaussian
+    sigma = fwhm * _TOSIGMA
+    dhelp = z0 / sigma
+    gauss = numpy.where(dhelp <= 35,
+                        numpy.exp(-0.5 * numpy.minimum(dhelp * dhelp, 1400.)),
+                        0.0) / (sigma * _SQRT2PI)
+    result[0] = eta * lorentz + (1.0 - eta) * gauss
+    result[1] = area * (eta * lorentz * (2.0 * q / q2) / (0.5 * fwhm) + \
+                        (1.0 - eta) * gauss * z0 / (sigma * sigma))
+    result[2] = area * (eta * lorentz * (2.0 * q * q / q2 - 1.0) / fwhm + \
+                        (1.0 - eta) * gauss * _TOSIGMA * \
+                        (dhelp * dhelp - 1.0) / sigma)
+    result[3] = area * (lorentz - gauss)
+    return result
+
+
+def ahypermetJacobian(peaks, x, coefficients, tails=15, spectrum=None):
+    """
+    Linear combinations of the derivatives of SpecfitFuns.ahypermet
+
+    Each peak is only evaluated where its gaussian matters and around the
+    edges of its tails and step. Below that region the tails are exponentials
+    and the step is constant, and they are accumulated for all the peaks at
+    once.
+
+    Several spectra, each one with its own points and peaks, can be
+    evaluated at once giving x as a 2D array and the spectrum of each peak.
+
+    :param peaks: table of shape (npeaks, 8) (see ahypermetDerivatives)
+    :param x: 1D array of points or 2D array with the points of each
+              spectrum
+    :param coefficients: array of shape (nrows, 8, npeaks) or its non-zero
+                         elements as a tuple (nrows, row, column, peak, value)
+    :param int tails: the same flags as SpecfitFuns.ahypermet
+    :param spectrum: index of the spectrum (row of x) of each peak
+    :returns: array of shape (nrows, npoints) or (nrows, nspectra, npoints),
+              the sums over the columns and the peaks of the coefficients
+              times the derivatives
+    """
+    peaks = numpy.array(peaks, dtype=numpy.float64, copy=False)
+    peaks = peaks.reshape(-1, 8)
+    x, spectrum, shape = _parsePoints(x, spectrum, peaks.shape[0])
+    nrows, row, column, peak, values = _parseCoefficients(coefficients)
+    nspectra, npoints = x.shape
+    npeaks = peaks.shape[0]
+    result = numpy.zeros((nrows, nspectra * npoints), numpy.float64)
+    if tails <= 0 or not npeaks or not npoints or not row.size:
+        return result.reshape((nrows,) + shape)
+    sigma = peaks[:, 2] * _TOSIGMA
+    position = peaks[:, 1]
+    low = _NEAR * sigma
+    for flag, iarea, islope in _TAILS:
+        if tails & flag:
+            slope = peaks[:, islope]
+            if numpy.any(slope < 0):
+                low = None
+                break
+            low = low + numpy.where(slope > 0, sigma * sigma /
+                                    numpy.where(slope > 0, slope, 1.0), 0.0)
+    if (low is None) or (npoints < 2) or numpy.any(numpy.diff(x, axis=1) <= 0):
+        # evaluate all the peaks everywhere
+        step = max(_BLOCKSIZE // (8 * npoints), 1)
+        for i0 in range(0, npeaks, step):
+            i1 = min(i0 + step, npeaks)
+            deriv = ahypermetDerivatives(peaks[i0:i1], x[spectrum[i0:i1]],
+                                         tails)
+            result += _denseJacobian(deriv, spectrum, i0, i1,
+                                     row, column, peak, values, nrows,
+                                     nspectra)
+        return result.reshape((nrows,) + shape)
+
+    # the points around each peak
+    xflat = x.ravel()
+    offsets, xsorted = _sortedPoints(x)
+    start = spectrum * npoints
+    first = numpy.searchsorted(xsorted, position - low + offsets[spectrum],
+                               side="left")
+    last = numpy.searchsorted(xsorted,
+                              position + _NEAR * sigma + offsets[spectrum],
+                              side="right")
+    first = numpy.clip(first, start, start + npoints)
+    last = numpy.clip(last, start, start + npoints)
+    sizes = numpy.maximum(last - first, 0)
+    # blocks of peaks limiting the number of evaluated points
+    cumulated = numpy.cumsum(sizes)
+    i0 = 0
+    while i0 < npeaks:
+        i1 = int(numpy.searchsorted(cumulated,
+                                    cumulated[i0] - sizes[i0] + \
+                                    _BLOCKSIZE // 8, side="right"))
+        i1 = min(max(i1, i0 + 1), npeaks)
+        result += _windowJacobian(peaks, xflat, tails, first, sizes, i0, i1,
+                                  row, column, peak, values, nrows)
+        i0 = i1
+
+    # below the region of each peak erfc is 2
+    area = peaks[:, 0]
+    if tails & 8:
+        ratio = peaks[:, 7]
+        norm = 1.0 / (sigma * _SQRT2PI)
+        far = numpy.zeros((8, npeaks), numpy.float64)
+        far[0] = ratio * norm
+        far[2] = -_TOSIGMA * area * ratio * norm / sigma
+        far[7] = area * norm
+        weights = _combine(far, row, column, peak, values, nrows)
+        result += _sumBelow(first - start, weights, npoints,
+                            spectrum=spectrum, nspectra=nspectra)
+    for flag, iarea, islope in _TAILS:
+        if not (tails & flag):
+            continue
+        ratio = peaks[:, iarea]
+        slopes = peaks[:, islope]
+        for slope in numpy.unique(slopes[slopes > 0]):
+            # exp(a + b) with a depending on the peak and b on the point
+            selection = numpy.nonzero(slopes == slope)[0]
+            s = sigma[selection]
+            r = ratio[selection]
+            A = area[selection]
+            p = position[selection]
+            far = numpy.zeros((8, npeaks), numpy.float64)
+            farx = numpy.zeros((8, npeaks), numpy.float64)
+            far[0, selection] = r / slope
+            far[1, selection] = -A * r / (slope * slope)
+            far[2, selection] = _TOSIGMA * A * r * s / (slope * slope * slope)
+            far[iarea, selection] = A / slope
+            far[islope, selection] = (A * r / slope) * (-1.0 / slope - \
+                          s * s / (slope * slope * slope) + \
+                          p / (slope * slope))
+            farx[islope, selection] = -A * r / (slope * slope * slope)
+            weights = _combine(far, row, column, peak, values,
+                               nrows)[:, selection]
+            weightsx = _combine(farx, row, column, peak, values,
+                                nrows)[:, selection]
+            a = 0.5 * (s / slope) * (s / slope) - p / slope
+            _farTails(result, xflat, xsorted / slope, slope, a,
+                      first[selection], spectrum[selection], npoints,
+                      weights, weightsx)
+    return result.reshape((nrows,) + shape)
+
+
+def _parsePoints(x, spectrum, npeaks):
+    """
+    :returns: x as a 2D array, the spectrum of each peak and the shape of
+              the points in the result
+    """
+    x = numpy.array(x, dtype=numpy.float64, copy=False)
+    if x.ndim == 2:
+        if spectrum is None:
+            raise ValueError("The spectrum of each peak is needed")
+        spectrum = numpy.array(spectrum, dtype=numpy.int64, copy=False)
+        spectrum = spectrum.ravel()
+        if spectrum.size != npeaks:
+            raise ValueError("One spectrum index per peak is needed")
+        return x, spectrum, x.shape
+    x = x.reshape(1, -1)
+    return x, numpy.zeros((npeaks,), dtype=numpy.int64), (x.shape[1],)
+
+
+def _parseCoefficients(coefficients):
+    """
+    :returns: nrows and the row, column, peak and value of the non-zero
+              coefficients
+    """
+    if isinstance(coefficients, tuple):
+        nrows, row, column, peak, values = coefficients
+        return int(nrows), numpy.asarray(row, dtype=numpy.int64), \
+               numpy.asarray(column, dtype=numpy.int64), \
+               numpy.asarray(peak, dtype=numpy.int64), \
+               numpy.asarray(values, dtype=numpy.float64)
+    coefficients = numpy.array(coefficients, dtype=numpy.float64, copy=False)
+    # most of the coefficients are zero
+    row, column, peak = numpy.nonzero(coefficients)
+    return coefficients.shape[0], row, column, peak, \
+           coefficients[row, column, peak]
+
+
+def _sortedPoints(x):
+    """
+    Points of all the spectra shifted to be increasing as a whole, to look
+    for the points around the peaks of all the spectra at once.
+
+    :returns: shift of each spectrum and the flattened shifted points
+    """
+    nspectra = x.shape[0]
+    if nspectra == 1:
+        offsets = numpy.zeros((1,), numpy.float64)
+    else:
+        offsets = numpy.arange(nspectra) * (x.max() - x.min() + 1.0)
+    return offsets, (x + offsets[:, numpy.newaxis]).ravel()
+
+
+def _combine(far, row, column, peak, values, nrows):
+    """
+    :param far: array of shape (ncolumns, npeaks)
+    :returns: array of shape (nrows, npeaks) with the sums over the columns
+              of the coefficients times far
+    """
+    npeaks = far.shape[1]
+    return numpy.bincount(row * npeaks + peak,
+                          weights=values * far[column, peak],
+                          minlength=nrows * npeaks).reshape(nrows, npeaks)
+
+
+def _denseJacobian(deriv, spectrum, i0, i1, row, column, peak, values,
+                   nrows, nspectra):
+    """
+    Contribution of the peaks i0 to i1 evaluated on all the points of their
+    spectra.
+    """
+    ncolumns, n, npoints = deriv.shape
+    selection = (peak >= i0) & (peak < i1)
+    matrix = numpy.zeros((nrows * nspectra, ncolumns * n), numpy.float64)
+    numpy.add.at(matrix, (row[selection] * nspectra +
+                          spectrum[peak[selection]],
+                          column[selection] * n + peak[selection] - i0),
+                 values[selection])
+    return numpy.dot(matrix, deriv.reshape(ncolumns * n, npoints))\
+                .reshape(nrows, nspectra * npoints)
+
+
+def _windowJacobian(peaks, x, tails, first, sizes, i0, i1,
+                    row, column, peak, values, nrows):
+    """
+    Contribution of the peaks i0 to i1 to ahypermetJacobian on the points
+    around them, that are evaluated one peak after the other.
+    """
+    npoints = x.size
+    sizes = sizes[i0:i1]
+    starts = numpy.cumsum(sizes) - sizes
+    owner = numpy.repeat(numpy.arange(i1 - i0), sizes)
+    index = numpy.arange(owner.size) - starts[owner] + first[i0:i1][owner]
+    deriv = ahypermetDerivatives(peaks[i0:i1][owner],
+                                 x[index].reshape(-1, 1), tails)[:, :, 0]
+    selection = (peak >= i0) & (peak < i1)
+    row = row[selection]
+    column = column[selection]
+    peak = peak[selection] - i0
+    n = sizes[peak]
+    item = numpy.repeat(numpy.arange(row.size), n)
+    element = numpy.arange(item.size) - (numpy.cumsum(n) - n)[item] + \
+              starts[peak][item]
+    weights = values[selection][item] * deriv[column[item], element]
+    return numpy.bincount(row[item] * npoints + index[element],
+                          weights=weights,
+                          minlength=nrows * npoints).reshape(nrows, npoints)
+
+
+def _farTails(result, x, b, slope, a, first, spectrum, npoints,
+              weights, weightsx):
+    """
+    Add to result the exponential tails below the region of the peaks, the
+    sums over the peaks of (weights + x * weightsx) * exp(a + x / slope).
+
+    :param b: the points divided by the slope, increasing as a whole
+    """
+    # the peaks of each spectrum
+    order = numpy.argsort(spectrum, kind="mergesort")
+    spectrum = spectrum[order]
+    first = first[order]
+    a = a[order]
+    weights = weights[:, order]
+    weightsx = weightsx[:, order]
+    total = result.shape[1]
+    j0 = 0
+    while j0 < total:
+        k = j0 // npoints
+        end = (k + 1) * npoints
+        p0 = int(numpy.searchsorted(spectrum, k, side="left"))
+        p1 = int(numpy.searchsorted(spectrum, k, side="right"))
+        active = p0 + numpy.nonzero(first[p0:p1] > j0)[0]
+        if not active.size:
+            # nothing below any peak of this spectrum anymore
+            j0 = end
+            continue
+        # split the points to keep the exponentials finite
+        j1 = int(numpy.searchsorted(b, b[j0] + 500., side="right"))
+        j1 = min(max(j1, j0 + 1), end)
+        ref = x[j1 - 1] / slope
+        factor = numpy.exp(a[active] + ref)
+        n = numpy.minimum(first[active], j1) - j0
+        scale = numpy.exp(x[j0:j1] / slope - ref)
+        result[:, j0:j1] += scale * \
+            (_sumBelow(n, weights[:, active] * factor, j1 - j0) +
+             x[j0:j1] * _sumBelow(n, weightsx[:, active] * factor, j1 - j0))
+        j0 = j1
+
+
+def _sumBelow(first, weights, npoints, spectrum=None, nspectra=1):
+    """
+    :param first: index of the first point not receiving each weight
+    :param weights: array of shape (nrows, nweights)
+    :param spectrum: index of the spectrum receiving each weight
+    :returns: array of shape (nrows, nspectra * npoints), the sum of the
+              weights with first greater than the point index
+    """
+    nrows = weights.shape[0]
+    first = numpy.minimum(first, npoints)
+    if spectrum is not None:
+        first = first + spectrum * (npoints + 1)
+    size = nspectra * (npoints + 1)
+    offsets = numpy.arange(nrows).reshape(-1, 1) * size
+    bucket = numpy.bincount((first + offsets).ravel(), weights=weights.ravel(),
+                            minlength=nrows * size)
+    bucket = bucket.reshape(nrows, nspectra, npoints + 1)
+    bucket = numpy.cumsum(bucket[:, :, ::-1], axis=2)[:, :, ::-1][:, :, 1:]
+    return bucket.reshape(nrows, nspectra * npoints)
+
+
+def apvoigtJacobian(peaks, x, coefficients, spectrum=None):
+    """
+    Linear combinations of the derivatives of SpecfitFuns.apvoigt
+
+    :param peaks: table of shape (npeaks, 4) (see apvoigtDerivatives)
+    :param x: 1D array of points or 2D array with the points of each
+              spectrum
+    :param coefficients: array of shape (nrows, 4, npeaks) or its non-zero
+                         elements as a tuple (nrows, row, column, peak, value)
+    :param spectrum: index of the spectrum (row of x) of each peak
+    :returns: array of shape (nrows, npoints) or (nrows, nspectra, npoints),
+              the sums over the columns and the peaks of the coefficients
+              times the derivatives
+    """
+    peaks = numpy.array(peaks, dtype=numpy.float64, copy=False)
+    peaks = peaks.reshape(-1, 4)
+    x, spectrum, shape = _parsePoints(x, spectrum, peaks.shape[0])
+    nrows, row, column, peak, values = _parseCoefficients(coefficients)
+    nspectra, npoints = x.shape
+    npeaks = peaks.shape[0]
+    result = numpy.zeros((nrows, nspectra * npoints), numpy.float64)
+    # the lorentzian has no finite support
+    step = max(_BLOCKSIZE // (4 * max(npoints, 1)), 1)
+    for i0 in range(0, npeaks, step):
+        i1 = min(i0 + step, npeaks)
+        deriv = apvoigtDerivatives(peaks[i0:i1], x[spectrum[i0:i1]])
+        result += _denseJacobian(deriv, spectrum, i0, i1,
+                                 row, column, peak, values, nrows, nspectra)
+    return result.reshape((nrows,) + shape)
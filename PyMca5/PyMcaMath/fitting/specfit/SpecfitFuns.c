@@ -128,7 +128,10 @@ SpecfitFuns_snip1d(PyObject *self, PyObject *args)
     }
 
 
+    /* the array is owned by this function: other threads can run */
+    Py_BEGIN_ALLOW_THREADS
     snip1d_multiple((double *) PyArray_DATA(ret), n_channels, width, n_spectra);
+    Py_END_ALLOW_THREADS
 
     for (n = 0; n < n_spectra; n++)
     {
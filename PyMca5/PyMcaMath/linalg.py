@@ -39,6 +39,11 @@
 treatement besides other optimizations in view of simultaneously solving several
 equations of the form `a x = b`.
 
+nnls
+
+Non-negative least-squares solution of several equations of the form `a x = b`
+at once (same arguments as lstsq).
+
 linregress
 
 Similar function to the scipy.stats linregress function handling uncertainties on
@@ -143,7 +148,7 @@ def linregress(x, y, sigmay=None, full_output=False):
 
 def lstsq(a, b, rcond=None, sigma_b=None, weight=False,
           uncertainties=True, covariances=False, digested_output=False, svd=True,
-          last_svd=None):
+          last_svd=None, dtype=None):
     """
     Return the least-squares solution to a linear matrix equation.
 
@@ -172,8 +177,10 @@ def lstsq(a, b, rcond=None, sigma_b=None, weight=False,
                 Weighted fit using the supplied experimental uncertainties or the
                 square root of the b values.
 
-    svd: If not true, a simple matrix inversion will be used in case of weighting with unequal
-         data weights. Ignored in any other cases.
+    svd: In case of weighting with unequal data weights, the normal equations of all the
+         columns are solved at once with an eigenvalue decomposition (equivalent to the SVD
+         of the weighted model matrix) or, if not true, with a simple matrix inversion.
+         Ignored in any other cases.
 
     last_svd: Tuple containing U, s, V of the weighted model matrix or None. This is to
                     prevent recalculation on repeated fits.
@@ -185,6 +192,11 @@ def lstsq(a, b, rcond=None, sigma_b=None, weight=False,
 
     digested_output: If True, returns a dictionnary with explicit keys
 
+    dtype: Precision of the products involving the b values (numpy.float32 or
+           numpy.float64, the default). The decomposition of the model matrix,
+           the normal equations, the parameters and their uncertainties are
+           always calculated in double precision.
+
     Returns
     -------
     x : ndarray, shape (N,) or (N, K)
@@ -228,8 +240,10 @@ def lstsq(a, b, rcond=None, sigma_b=None, weight=False,
     >>> plt.show()
 
     """
+    if dtype is None:
+        dtype = numpy.float64
     a = numpy.array(a, dtype=numpy.float, copy=False)
-    b = numpy.array(b, dtype=numpy.float, copy=False)
+    b = numpy.array(b, dtype=dtype, copy=False)
     a_shape = a.shape
     b_shape = b.shape
     original = b_shape
@@ -291,7 +305,7 @@ def lstsq(a, b, rcond=None, sigma_b=None, weight=False,
         # and get the parameters
         s.shape = -1
         dummy = numpy.dot(V.T, numpy.eye(n)*(1./s))
-        parameters = numpy.dot(dummy, numpy.dot(U.T, b))
+        parameters = numpy.dot(dummy, numpy.dot(U.T.astype(dtype), b))
         parameters.shape = n, b.shape[1]
         if uncertainties or covariances:
             # get the uncertainties
@@ -333,7 +347,7 @@ def lstsq(a, b, rcond=None, sigma_b=None, weight=False,
         # different model and different independent values ...
         # That way one could avoid calculating U, s, V each time
         A = a / w
-        b = b / w
+        b = b / w.astype(dtype)
         # get the SVD decomposition of the A matrix
         if last_svd is not None:
             U, s, V = last_svd
@@ -349,7 +363,7 @@ def lstsq(a, b, rcond=None, sigma_b=None, weight=False,
         # and get the parameters
         s.shape = -1
         dummy = numpy.dot(V.T, numpy.eye(n)*(1./s))
-        parameters = numpy.dot(dummy, numpy.dot(U.T, b))
+        parameters = numpy.dot(dummy, numpy.dot(U.T.astype(dtype), b))
         parameters.shape = n, b.shape[1]
         if uncertainties or covariances:
             _covariance = numpy.dot(dummy, dummy.T)
@@ -359,78 +373,14 @@ def lstsq(a, b, rcond=None, sigma_b=None, weight=False,
             if covariances:
                 covarianceMatrix[:] = _covariance
     else:
-        parameters = numpy.zeros((n, b_shape[1]), numpy.float)
-        sigmapar = numpy.zeros((n, b_shape[1]), numpy.float)
-        if svd:
-            # SVD - slower by a factor 2
-            for i in range(b_shape[1]):
-                tmpWeight = w[:, i:i+1]
-                tmpData = b[:, i:i+1] / tmpWeight
-                A = a / tmpWeight
-                U, s, V = numpy.linalg.svd(A, full_matrices=False)
-                if rcond is None:
-                    s_cutoff = n * numpy.finfo(numpy.float).eps
-                else:
-                    s_cutoff = rcond * s[0]
-                s[s < s_cutoff] = numpy.inf
-                s.shape = -1
-                dummy = numpy.dot(V.T, numpy.eye(n)*(1./s))
-                parameters[:, i:i+1] = numpy.dot(dummy, numpy.dot(U.T, tmpData))
-                if uncertainties or covariances:
-                    # get the uncertainties
-                    _covariance = numpy.dot(dummy, dummy.T)
-                    sigmapar[:, i] = numpy.sqrt(numpy.diag(_covariance))
-                    if covariances:
-                        covarianceMatrix[i] = _covariance
-        elif 1:
-            # Pure matrix inversion (faster than SVD)
-            # I do not seem to gain anything by re-using the storage
-            #alpha = numpy.empty((n, n), numpy.float)
-            #beta = numpy.empty((n, 1), numpy.float)
-            for i in range(b_shape[1]):
-                tmpWeight = w[:, i:i+1]
-                A = a / tmpWeight
-                tmpData =  b[:, i:i+1] / tmpWeight
-                #numpy.dot(A.T, A, alpha)
-                #numpy.dot(A.T, tmpData, beta)
-                alpha = numpy.dot(A.T, A)
-                beta = numpy.dot(A.T, tmpData)
-                try:
-                    _covariance = numpy.linalg.inv(alpha)
-                except:
-                    print("Exception")
-                    print("Exception", sys.exc_info()[1])
-                    continue
-                parameters[:, i:i+1] = numpy.dot(_covariance, beta)
-                if uncertainties:
-                    sigmapar[:, i] = numpy.sqrt(numpy.diag(_covariance))
-                if covariances:
-                    covarianceMatrix[i] = covariance
-        else:
-            # Matrix inversion with buffers does not improve
-            bufferProduct = numpy.empty((n, n + 1), numpy.float)
-            bufferAB = numpy.empty((b_shape[0], n+1), numpy.float)
-            alpha = numpy.empty((n, n), numpy.float)
-            for i in range(b_shape[1]):
-                tmpWeight = w[:, i:i+1]
-                A = a / tmpWeight
-                tmpData =  b[:, i:i+1] / tmpWeight
-                bufferAB [:, :n] = A
-                bufferAB [:, n:n+1] = tmpData
-                numpy.dot(A.T, bufferAB, bufferProduct)
-                alpha[:, :]  = bufferProduct[:n, :n]
-                beta = bufferProduct[:,n]
-                try:
-                    _covariance = numpy.linalg.inv(alpha)
-                except:
-                    print("Exception")
-                    print("Exception", sys.exc_inf())
-                    continue
-                parameters[:, i] = numpy.dot(_covariance, beta)
-                if uncertainties:
-                    sigmapar[:, i] = numpy.sqrt(numpy.diag(_covariance))
-                if covariances:
-                    covarianceMatrix[i] = covariance
+        # individual weights: the normal equations of all the columns
+        # are built and solved at once
+        parameters, sigmapar, _covariance = _lstsqIndividualWeights(
+                    a, b, w, rcond=rcond, svd=svd,
+                    uncertainties=uncertainties or covariances,
+                    covariances=covariances)
+        if covariances:
+            covarianceMatrix[:] = _covariance
     if len(original) == 1:
         parameters.shape = -1
     if covariances:
@@ -451,13 +401,380 @@ def lstsq(a, b, rcond=None, sigma_b=None, weight=False,
             ddict['uncertainties'] = result[1]
         elif covariances:
             ddict['covariances'] = result[2]
-        if svd or fastest:
+        if fastest:
             ddict['svd'] = (U, s, V)
         return ddict
     else:
         return result
 
 
+def _lstsqIndividualWeights(a, b, w, rcond=None, svd=True,
+                            uncertainties=True, covariances=False):
+    """
+    Weighted least-squares solution for each column of b with its own
+    weights. The normal equations of all the columns are calculated with
+    matrix products (alpha = A^T W A with W = 1/w^2) and the stacked
+    systems are solved with a single LAPACK call per block of columns.
+    The systems are scaled to unit diagonal to limit round-off errors.
+
+    :param a: (M, N) model matrix
+    :param b: (M, K) data
+    :param w: (M, K) uncertainties
+    :param svd: use an eigenvalue decomposition of the normal equations
+                (equivalent to the SVD of the weighted model matrix) instead
+                of a matrix inversion. Singular values below the cutoff
+                defined by rcond are ignored.
+    :returns: parameters (N, K), uncertainties (N, K) or None,
+              covariance matrices (K, N, N) or None
+    """
+    m, n = a.shape
+    K = b.shape[1]
+    parameters = numpy.zeros((n, K), numpy.float)
+    sigmapar = None
+    covarianceMatrix = None
+    if uncertainties:
+        sigmapar = numpy.zeros((n, K), numpy.float)
+    if covariances:
+        covarianceMatrix = numpy.zeros((K, n, n), numpy.float)
+    if not K:
+        return parameters, sigmapar, covarianceMatrix
+
+    # Products of all pairs of columns of the model matrix (upper triangle)
+    # so that alpha of all columns is a single matrix product
+    iu, ju = numpy.triu_indices(n)
+    products = a[:, iu] * a[:, ju]
+    symmetric = numpy.empty((n, n), dtype=numpy.intp)
+    symmetric[iu, ju] = numpy.arange(iu.size)
+    symmetric[ju, iu] = symmetric[iu, ju]
+    symmetric = symmetric.ravel()
+    diag = numpy.arange(n)
+    if rcond is None:
+        rcond = n * numpy.finfo(numpy.float).eps
+    nBlock = max(1, 2**22 // (n * n + m))
+    for i in range(0, K, nBlock):
+        w2 = 1. / numpy.square(w[:, i:i+nBlock], dtype=numpy.float64)
+        k = w2.shape[1]
+        alpha = numpy.take(numpy.dot(w2.T, products), symmetric, axis=1)
+        alpha.shape = k, n, n
+        beta = numpy.dot((b[:, i:i+nBlock] * w2).T, a)
+
+        # scale to unit diagonal
+        scale = numpy.sqrt(alpha[:, diag, diag])
+        scale[scale == 0] = 1
+        scale = 1. / scale
+        alpha *= scale[:, :, numpy.newaxis]
+        alpha *= scale[:, numpy.newaxis, :]
+        beta *= scale
+
+        covariance = None
+        if not svd:
+            try:
+                covariance = numpy.linalg.inv(alpha)
+            except numpy.linalg.LinAlgError:
+                # singular systems: use the eigenvalue decomposition
+                pass
+        if covariance is None:
+            e, Q = numpy.linalg.eigh(alpha)
+            cutoff = max(rcond * rcond, n * numpy.finfo(numpy.float).eps) * \
+                     e[:, -1:]
+            e = numpy.where(e > cutoff, 1. / numpy.where(e > cutoff, e, 1), 0)
+            covariance = numpy.matmul(Q * e[:, numpy.newaxis, :],
+                                      Q.transpose(0, 2, 1))
+        x = numpy.matmul(covariance, beta[:, :, numpy.newaxis])[:, :, 0]
+        parameters[:, i:i+nBlock] = (x * scale).T
+        if uncertainties:
+            sigma = numpy.sqrt(numpy.abs(covariance[:, diag, diag])) * scale
+            sigmapar[:, i:i+nBlock] = sigma.T
+        if covariances:
+            covarianceMatrix[i:i+nBlock] = covariance * \
+                    scale[:, :, numpy.newaxis] * scale[:, numpy.newaxis, :]
+    return parameters, sigmapar, covarianceMatrix
+
+
+# Non-negative Linear Least Squares
+
+def nnls(a, b, rcond=None, sigma_b=None, weight=False, uncertainties=True,
+         digested_output=False, svd=True, last_svd=None, free=None,
+         maxiter=None, dtype=None):
+    """
+    Return the non-negative least-squares solution to a linear matrix equation.
+
+    Solves the equation `a x = b` by computing a vector `x >= 0` that
+    minimizes the Euclidean 2-norm `|| b - a x ||^2` for each column of `b`.
+
+    All columns are solved at once with the fast combinatorial active set
+    algorithm (M.H. Van Benthem and M.R. Keenan, J. Chemometrics 2004, 18,
+    441-450): the normal equations are shared by all columns and the columns
+    with the same set of non-zero parameters are solved together.
+
+    Parameters
+    ----------
+    a, b, rcond, sigma_b, weight, uncertainties, digested_output : see lstsq
+
+    svd, dtype: ignored (for compatibility with lstsq), the active set
+                iterations are done in double precision
+
+    last_svd: Tuple containing U, s, V of the weighted model matrix or None. This is to
+              prevent recalculation on repeated fits. Ignored when each column of `b`
+              has its own weights.
+
+    free: indices of the parameters which are not constrained to be non-negative
+
+    maxiter: maximal number of iterations (3 times the number of parameters by default)
+
+    Returns
+    -------
+    x : ndarray, shape (N,) or (N, K)
+        Non-negative least-squares solution.
+
+    uncertainties: ndarray, shape (N,) or (N, K)
+        Zero for the parameters at the constraint.
+
+    With digested_output, the dictionary also contains the number of
+    non-zero parameters of each solution (key 'nfree').
+    """
+    a = numpy.array(a, dtype=numpy.float, copy=False)
+    b = numpy.array(b, dtype=numpy.float, copy=False)
+    original = b.shape
+    if len(a.shape) != 2:
+        raise ValueError("Model matrix must be two dimensional")
+    if len(original) == 1:
+        b = b.reshape(-1, 1)
+    m, n = a.shape
+    if m != b.shape[0]:
+        raise ValueError('Incompatible dimensions between A and b matrices')
+    if maxiter is None:
+        maxiter = 3 * n
+
+    # Weights
+    if weight:
+        if sigma_b is not None:
+            w = numpy.abs(numpy.array(sigma_b, dtype=numpy.float, copy=False))
+            w = w + numpy.equal(w, 0)
+            if w.size == m:
+                w = w.reshape(m, 1)
+            else:
+                w = w.reshape(b.shape)
+        else:
+            w = numpy.sqrt(numpy.abs(b))
+            w = w + numpy.equal(w, 0)
+    else:
+        w = None
+
+    # Normal equations: alpha x = beta
+    U = None
+    if w is None or w.shape[1] == 1:
+        # same weights for all columns: one alpha matrix
+        if w is None:
+            A = a
+            bw = b
+        else:
+            A = a / w
+            bw = b / w
+        if last_svd is not None:
+            U, s, V = last_svd
+        else:
+            U, s, V = numpy.linalg.svd(A, full_matrices=False)
+        alpha = numpy.dot(V.T * (s * s), V)
+        beta = numpy.dot(A.T, bw)
+    else:
+        # individual weights: one alpha matrix per column
+        w2 = 1. / (w * w)
+        beta = numpy.dot(a.T, b * w2)
+        alpha = numpy.empty((b.shape[1], n, n), numpy.float)
+        nBlock = max(1, 2**20 // (m * n))
+        for i in range(0, b.shape[1], nBlock):
+            A = a[numpy.newaxis, :, :] * numpy.sqrt(w2[:, i:i+nBlock].T)[:, :, numpy.newaxis]
+            numpy.matmul(A.transpose(0, 2, 1), A, out=alpha[i:i+nBlock])
+
+    constrained = numpy.ones((n, 1), dtype=bool)
+    if free is not None:
+        constrained[list(free)] = False
+    tol = 10 * numpy.finfo(numpy.float).eps * \
+          numpy.abs(alpha).sum(axis=-2).max() * max(m, n)
+
+    def alphaColumns(cols):
+        if alpha.ndim == 2:
+            return alpha
+        else:
+            return alpha[cols]
+
+    # Unconstrained solution
+    passive = numpy.ones(beta.shape, dtype=bool)
+    x = _nnlsPassiveSolve(alpha, beta, passive, rcond=rcond)
+    passive = (x > 0) | ~constrained
+    x[~passive] = 0
+    d = x.copy()
+    fset = numpy.nonzero((~passive).any(axis=0))[0]
+    niter = 0
+    while fset.size:
+        # Solve for the passive parameters
+        x[:, fset] = _nnlsPassiveSolve(alphaColumns(fset), beta[:, fset],
+                                       passive[:, fset], rcond=rcond)
+        hset = fset[((x[:, fset] < 0) & constrained).any(axis=0)]
+        # Make infeasible solutions feasible
+        while hset.size and niter < maxiter:
+            niter += 1
+            xh = x[:, hset]
+            dh = d[:, hset]
+            ph = passive[:, hset]
+            negative = ph & (xh < 0) & constrained
+            ratio = numpy.full(xh.shape, numpy.inf)
+            ratio[negative] = dh[negative] / (dh[negative] - xh[negative])
+            imin = numpy.argmin(ratio, axis=0)
+            icol = numpy.arange(hset.size)
+            dh += ratio[imin, icol] * (xh - dh)
+            ph[imin, icol] = False
+            d[:, hset] = dh
+            passive[:, hset] = ph
+            x[:, hset] = _nnlsPassiveSolve(alphaColumns(hset), beta[:, hset],
+                                           ph, rcond=rcond)
+            hset = hset[((x[:, hset] < 0) & constrained).any(axis=0)]
+        if hset.size:
+            # Maximal number of iterations reached
+            x[:, hset] = d[:, hset]
+            break
+        # Optimality: gradient of the active parameters
+        if alpha.ndim == 2:
+            gradient = beta[:, fset] - numpy.dot(alpha, x[:, fset])
+        else:
+            gradient = beta[:, fset] - numpy.einsum('kij,jk->ik', alpha[fset],
+                                                    x[:, fset])
+        gradient[passive[:, fset] | ~constrained] = -numpy.inf
+        notOptimal = (gradient > tol).any(axis=0)
+        fset = fset[notOptimal]
+        if not fset.size:
+            break
+        niter += 1
+        if niter >= maxiter:
+            break
+        imax = numpy.argmax(gradient[:, notOptimal], axis=0)
+        passive[imax, fset] = True
+        d[:, fset] = x[:, fset]
+
+    if uncertainties:
+        sigmapar = _nnlsPassiveSolve(alpha, None, passive, rcond=rcond)
+    if len(original) == 1:
+        x.shape = -1
+        if uncertainties:
+            sigmapar.shape = -1
+    if uncertainties:
+        result = [x, sigmapar]
+    else:
+        result = [x]
+
+    if digested_output:
+        ddict = {}
+        ddict['parameters'] = result[0]
+        if uncertainties:
+            ddict['uncertainties'] = result[1]
+        ddict['nfree'] = passive.sum(axis=0)
+        if U is not None:
+            ddict['svd'] = (U, s, V)
+        return ddict
+    else:
+        return result
+
+
+def _nnlsPassiveSolve(alpha, beta, passive, rcond=None):
+    """
+    Solve alpha[P, P] x[P] = beta[P] for each column with P the passive
+    parameters of that column (x is zero for the other parameters).
+    Columns with the same passive parameters are solved together.
+
+    :param alpha: (N, N) or (K, N, N)
+    :param beta: (N, K) or None to get the uncertainties sqrt(diag(inv(alpha[P, P])))
+    :param passive: (N, K) bool
+    :returns: (N, K)
+    """
+    x = numpy.zeros(passive.shape, numpy.float)
+    if not passive.shape[1]:
+        return x
+    keys = numpy.packbits(passive, axis=0).T
+    _, groups = numpy.unique(keys, axis=0, return_inverse=True)
+    groups = groups.flatten()
+    nGroups = groups.max() + 1
+    if nGroups > 16 and nGroups * 4 > passive.shape[1]:
+        # Too many different passive sets: solve each column
+        # with a stacked solver
+        _nnlsStackedSolve(alpha, beta, passive, x, rcond=rcond)
+        return x
+    for group in range(nGroups):
+        cols = numpy.nonzero(groups == group)[0]
+        idx = numpy.nonzero(passive[:, cols[0]])[0]
+        if not idx.size:
+            continue
+        if alpha.ndim == 2:
+            alphaPP = alpha[numpy.ix_(idx, idx)]
+        else:
+            alphaPP = alpha[numpy.ix_(cols, idx, idx)]
+        if beta is None:
+            try:
+                covariance = numpy.linalg.inv(alphaPP)
+            except numpy.linalg.LinAlgError:
+                covariance = _nnlsPinv(alphaPP, rcond)
+            sigma = numpy.sqrt(numpy.abs(numpy.diagonal(covariance,
+                                                        axis1=-2, axis2=-1)))
+            if alpha.ndim == 2:
+                x[numpy.ix_(idx, cols)] = sigma[:, numpy.newaxis]
+            else:
+                x[numpy.ix_(idx, cols)] = sigma.T
+        elif alpha.ndim == 2:
+            betaP = beta[numpy.ix_(idx, cols)]
+            try:
+                x[numpy.ix_(idx, cols)] = numpy.linalg.solve(alphaPP, betaP)
+            except numpy.linalg.LinAlgError:
+                x[numpy.ix_(idx, cols)] = numpy.dot(_nnlsPinv(alphaPP, rcond), betaP)
+        else:
+            betaP = beta[numpy.ix_(idx, cols)].T[:, :, numpy.newaxis]
+            try:
+                xP = numpy.linalg.solve(alphaPP, betaP)
+            except numpy.linalg.LinAlgError:
+                xP = numpy.matmul(_nnlsPinv(alphaPP, rcond), betaP)
+            x[numpy.ix_(idx, cols)] = xP[:, :, 0].T
+    return x
+
+
+def _nnlsStackedSolve(alpha, beta, passive, x, rcond=None):
+    """
+    Same as _nnlsPassiveSolve but each column has its own system: the
+    rows and columns of alpha that correspond to non-passive parameters
+    are replaced by those of the identity matrix.
+    """
+    n, K = passive.shape
+    nBlock = max(1, 2**21 // (n * n))
+    diag = numpy.arange(n)
+    for i in range(0, K, nBlock):
+        p = passive[:, i:i+nBlock].T
+        k = p.shape[0]
+        mask = p[:, :, numpy.newaxis] & p[:, numpy.newaxis, :]
+        if alpha.ndim == 2:
+            alphaP = numpy.where(mask, alpha, 0.)
+        else:
+            alphaP = numpy.where(mask, alpha[i:i+nBlock], 0.)
+        alphaP[:, diag, diag] += ~p
+        if beta is None:
+            try:
+                covariance = numpy.linalg.inv(alphaP)
+            except numpy.linalg.LinAlgError:
+                covariance = _nnlsPinv(alphaP, rcond)
+            sigma = numpy.sqrt(numpy.abs(covariance[:, diag, diag]))
+            x[:, i:i+nBlock] = (sigma * p).T
+        else:
+            betaP = (beta[:, i:i+nBlock].T * p)[:, :, numpy.newaxis]
+            try:
+                xP = numpy.linalg.solve(alphaP, betaP)
+            except numpy.linalg.LinAlgError:
+                xP = numpy.matmul(_nnlsPinv(alphaP, rcond), betaP)
+            x[:, i:i+nBlock] = (xP[:, :, 0] * p).T
+
+
+def _nnlsPinv(alpha, rcond=None):
+    if rcond is None:
+        rcond = alpha.shape[-1] * numpy.finfo(numpy.float).eps
+    return numpy.linalg.pinv(alpha, rcond=rcond)
+
+
 def getModelMatrixFromFunction(model_function, dummy_parameters, xdata, derivative=None):
     nPoints = xdata.size
     nParameters = len(dummy_parameters)
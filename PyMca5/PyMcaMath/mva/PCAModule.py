@@ -483,6 +483,25 @@ def numpyPCA(stack, ncomponents=10, binning=None, legacy=True, **kw):
                              legacy=legacy,
                              **kw)
 
+def randomizedPCA(stack, ncomponents=10, binning=None, legacy=True, **kw):
+    """
+    This is a randomized SVD method reading the data in a few passes
+    """
+    _logger.debug("PCAModule.randomizedPCA called")
+    if hasattr(stack, "info"):
+        index = stack.info.get('McaIndex', -1)
+    elif "index" in kw:
+        index = kw["index"]
+    else:
+        print("WARNING: Assuming index is -1 in randomizedPCA")
+        index = -1
+    return PCATools.randomizedPCA(stack,
+                                  index=index,
+                                  ncomponents=ncomponents,
+                                  binning=binning,
+                                  legacy=legacy,
+                                  **kw)
+
 def mdpPCASVDFloat32(stack, ncomponents=10, binning=None,
                      mask=None, spectral_mask=None, legacy=True, **kw):
     return mdpPCA(stack, ncomponents, binning=binning, dtype='float32',
@@ -719,6 +719,203 @@ def numpyPCA(stack, index=-1, ncomponents=10, binning=None,
                 "variance": calculatedTotalVariance}
 
 
+def _spectraChunks(data, actualIndex, binning=1, chunksize=None):
+    """
+    Iterate over the spectra of a stack by chunks of pixels.
+
+    :param data: 2D or 3D array or HDF5 dataset
+    :param actualIndex: 0 or last dimension, the one of the channels
+    :param binning: spectral sampling
+    :param chunksize: maximum number of spectra per chunk
+    :returns generator: (first pixel, chunk) with chunk as a float64
+                        (nPixels, nChannels) array.
+    """
+    shape = data.shape
+    nChannels = shape[actualIndex]
+    if chunksize is None:
+        # about 64 MBytes per chunk
+        chunksize = (64 * 1024 * 1024) // (8 * nChannels)
+    chunksize = max(int(chunksize), 1)
+    if actualIndex == 0:
+        spatialShape = shape[1:]
+    else:
+        spatialShape = shape[:-1]
+    if len(spatialShape) == 1:
+        rowSize = 1
+    else:
+        rowSize = spatialShape[1]
+    # whole rows (lines of the map) are read at once
+    nRows = max(chunksize // rowSize, 1)
+    pixel = 0
+    for i in range(0, spatialShape[0], nRows):
+        if actualIndex == 0:
+            chunk = data[::binning, i:i + nRows]
+            chunk = chunk.reshape(chunk.shape[0], -1).T
+        else:
+            chunk = data[i:i + nRows, ..., ::binning]
+            chunk = chunk.reshape(-1, chunk.shape[-1])
+        chunk = numpy.array(chunk, dtype=numpy.float64, copy=False)
+        yield pixel, chunk
+        pixel += chunk.shape[0]
+
+
+def randomizedPCA(stack, index=-1, ncomponents=10, binning=None,
+                  center=True, scale=True, mask=None, spectral_mask=None,
+                  legacy=True, oversampling=10, iterations=2,
+                  chunksize=None, seed=None, **kw):
+    """
+    Principal components of a stack by randomized SVD.
+
+    The covariance matrix is never built. The data are read by chunks of
+    pixels, iterations + 2 times: iterations + 1 passes to find a basis
+    of the dominant subspace of the covariance matrix by subspace
+    iteration from a random start, and a last pass to calculate the
+    scores. This keeps the memory needs bounded and the number of reads
+    small for dynamically loaded (HDF5) data.
+
+    :param stack: Array of data or PyMca data object
+    :param index: Dimension of the channels (0 or -1)
+    :param ncomponents: Number of principal components
+    :param binning: Spectral sampling
+    :param center: Subtract the average spectrum
+    :param mask: Spatial mask, only the pixels different from zero are used
+    :param spectral_mask: Weight of each channel
+    :param oversampling: Number of additional vectors of the random subspace
+    :param iterations: Number of subspace iterations
+    :param chunksize: Maximum number of spectra read at once
+    :param seed: Seed of the random start
+    :returns: As numpyPCA. The scores of the masked pixels are set to zero.
+    """
+    _logger.debug("PCATools.randomizedPCA")
+    if hasattr(stack, "info") and hasattr(stack, "data"):
+        data = stack.data
+    else:
+        data = stack
+
+    oldShape = data.shape
+    if index not in [0, -1, len(oldShape) - 1]:
+        data = None
+        raise IndexError("1D index must be one of 0, -1 or %d, got %d" %\
+                             (len(oldShape) - 1, index))
+    if index < 0:
+        actualIndex = len(oldShape) + index
+    else:
+        actualIndex = index
+
+    nPixels = 1
+    for i in range(len(oldShape)):
+        if i != actualIndex:
+            nPixels *= oldShape[i]
+    if binning is None:
+        binning = 1
+    N = len(range(0, oldShape[actualIndex], binning))
+    if ncomponents > N:
+        msg = "Requested %d components for a maximum of %d" % (ncomponents, N)
+        raise ValueError(msg)
+
+    if mask is not None:
+        badMask = numpy.array(mask, copy=False).reshape(-1) < 1
+        usedPixels = nPixels - badMask.sum()
+    else:
+        badMask = None
+        usedPixels = nPixels
+    if spectral_mask is None:
+        weights = numpy.ones((N,), numpy.float64)
+    else:
+        weights = numpy.array(spectral_mask, dtype=numpy.float64, copy=False)
+        if weights.size != N:
+            # binning was not taken into account
+            weights = weights[::binning]
+
+    def chunks():
+        for pixel, chunk in _spectraChunks(data, actualIndex,
+                                           binning=binning,
+                                           chunksize=chunksize):
+            if badMask is not None:
+                chunk[badMask[pixel:pixel + chunk.shape[0]]] = 0
+            yield pixel, chunk
+
+    # product of the covariance matrix by a set of vectors in one pass
+    sumSpectrum = numpy.zeros((N,), numpy.float64)
+    sumSquares = numpy.zeros((N,), numpy.float64)
+    def covarianceProduct(vectors, first=False):
+        product = numpy.zeros(vectors.shape, numpy.float64)
+        weightedVectors = vectors * weights[:, None]
+        for pixel, chunk in chunks():
+            product += dotblas.dot(chunk.T, dotblas.dot(chunk,
+                                                        weightedVectors))
+            if first:
+                sumSpectrum[:] += chunk.sum(axis=0)
+                sumSquares[:] += (chunk * chunk).sum(axis=0)
+        product *= weights[:, None]
+        if center:
+            # (X - 1 avg) .T (X - 1 avg) = X.T X - n avg avg.T
+            weightedSum = sumSpectrum * weights
+            product -= numpy.outer(weightedSum,
+                        dotblas.dot(weightedSum, vectors)) / usedPixels
+        return product / (usedPixels - 1)
+
+    t0 = time.time()
+    nVectors = min(N, ncomponents + oversampling)
+    randomState = numpy.random.RandomState(seed)
+    Q = randomState.standard_normal((N, nVectors))
+    Q, r = numpy.linalg.qr(Q)
+    for i in range(iterations + 1):
+        # the sums are accumulated during the first pass
+        Z = covarianceProduct(Q, first=(i == 0))
+        if i < iterations:
+            Q, r = numpy.linalg.qr(Z)
+    # Rayleigh-Ritz: eigenvalues of the covariance matrix in the subspace
+    B = dotblas.dot(Q.T, Z)
+    B = 0.5 * (B + B.T)
+    evalues, evectors = numpy.linalg.eigh(B)
+    idx = numpy.argsort(evalues)[::-1][:ncomponents]
+    evalues = evalues[idx]
+    evectors = dotblas.dot(Q, evectors[:, idx])
+    _logger.debug("Randomized SVD elapsed = %s", time.time() - t0)
+
+    # the total variance is the trace of the covariance matrix
+    weightedSum = sumSpectrum * weights
+    variance = sumSquares * weights * weights
+    if center:
+        variance -= weightedSum * weightedSum / usedPixels
+    calculatedTotalVariance = variance.sum() / (usedPixels - 1)
+    _logger.info("Total Variance = %s", calculatedTotalVariance)
+    totalExplainedVariance = 0.0
+    for i in range(ncomponents):
+        partialExplainedVariance = 100. * evalues[i] / calculatedTotalVariance
+        _logger.info("PC%02d  Explained variance %.5f %% ",
+                     i + 1, partialExplainedVariance)
+        totalExplainedVariance += partialExplainedVariance
+    _logger.info("Total explained variance = %.2f %% ",
+                 totalExplainedVariance)
+
+    dtype = numpy.float32
+    eigenvalues = evalues.astype(dtype)
+    eigenvectors = evectors.T.astype(dtype)
+
+    # calculate the projections (without subtracting the average as
+    # numpyPCA does)
+    images = numpy.zeros((ncomponents, nPixels), dtype)
+    for pixel, chunk in chunks():
+        images[:, pixel:pixel + chunk.shape[0]] = \
+                                    dotblas.dot(evectors.T, chunk.T)
+    if len(oldShape) == 3:
+        if actualIndex == 0:
+            images.shape = ncomponents, oldShape[1], oldShape[2]
+        else:
+            images.shape = ncomponents, oldShape[0], oldShape[1]
+    if legacy:
+        return images, eigenvalues, eigenvectors
+    else:
+        return {"scores": images,
+                "eigenvalues": eigenvalues,
+                "eigenvectors": eigenvectors,
+                "average": sumSpectrum / usedPixels,
+                "pixels": usedPixels,
+                "variance": calculatedTotalVariance}
+
+
 def test():
     x = numpy.array([[0.0,  2.0,  3.0],
                      [3.0,  0.0, -1.0],
@@ -39,6 +39,7 @@
 import numpy
 import time
 from PyMca5.PyMca import XASNormalization
+from PyMca5.PyMcaMath import SGModule
 from PyMca5.PyMca import linalg
 try:
     from PyMca5.PyMca import _xas
@@ -395,53 +396,22 @@ def polspl_test():
     return
 
 
-def postEdge(set2,kmin=None,kmax=None,polDegree=[3,3,3],knots=None, full=False):
-    r"""
-        postEdge(set2,kmin=None,kmax=None,polDegree=[3,3,3],knots=None)
-
-     PURPOSE:
-    	This procedure calculates the post edge fit of a xafs spectrum
-
-     INPUTS:
-    	set2: input set of data
-
-     KEYWORD PARAMETERS:
-        kmin the bottom limit for the fit (defaults kmin=0)
-        kmax the upper limit for the fit (defaults max)
-
-     OUTPUTS:
-    	a set with the fit
-
-     MODIFICATION HISTORY:
-     	Written by:	Manuel Sanchez del Rio. ESRF
-    	February, 1993
-        1996-08-13 MSR (srio@esrf.fr) changes wmenu->wmenu2 and
-                   xtext->widget_message
-    	1998-10-01 srio@esrf.fr adapts for delia.
-    	2000-02-12 MSR (srio@esrf.fr) adds Dialog_Parent keyword
-    	2014-12-04 srio@esrf.eu Translated to python
-
+def _getPostEdgeRanges(kmin, kmax, polDegree, knots=None):
     """
-    #Note that in/out arrays are numpy way: numpy.array((npoints,2))
+    Ranges of the polynomials of the post-edge spline between kmin and kmax.
 
+    Returns the xl, xh and nc arrays and the number of ranges nr expected
+    by polspl and the limits of the fitted region.
+    """
     xl = numpy.zeros(10)
     xh = numpy.zeros(10)
-    c = numpy.zeros(36)
     nc = numpy.zeros(10, numpy.int32)
     if len(polDegree) > 10:
         _logger.warning("Error: Maximum number of intervals is 10")
         _logger.warning("       Number of intervals forced to 10")
         polDegree = polDegree[0:9]
 
-    x1 = 0.0 # set2[:,0].min()
-    x2 = set2[:,0].max()
-
-    if kmin != None:
-        x1 = kmin
-    if kmax != None:
-        x2 = kmax
-
-    xrange1 = [x1,x2]
+    xrange1 = [kmin, kmax]
     _logger.debug("++++++++++++++++++%s", xrange1)
     if knots not in [None, []]:
         if len(knots) == len(polDegree):
@@ -480,6 +450,48 @@ def postEdge(set2,kmin=None,kmax=None,polDegree=[3,3,3],knots=None, full=False):
             xl[i+1] = knots[i]
             xh[i]   = xl[i+1]
 
+    return xl, xh, nc, nr, xrange1
+
+
+def postEdge(set2,kmin=None,kmax=None,polDegree=[3,3,3],knots=None, full=False):
+    r"""
+        postEdge(set2,kmin=None,kmax=None,polDegree=[3,3,3],knots=None)
+
+     PURPOSE:
+    	This procedure calculates the post edge fit of a xafs spectrum
+
+     INPUTS:
+    	set2: input set of data
+
+     KEYWORD PARAMETERS:
+        kmin the bottom limit for the fit (defaults kmin=0)
+        kmax the upper limit for the fit (defaults max)
+
+     OUTPUTS:
+    	a set with the fit
+
+     MODIFICATION HISTORY:
+     	Written by:	Manuel Sanchez del Rio. ESRF
+    	February, 1993
+        1996-08-13 MSR (srio@esrf.fr) changes wmenu->wmenu2 and
+                   xtext->widget_message
+    	1998-10-01 srio@esrf.fr adapts for delia.
+    	2000-02-12 MSR (srio@esrf.fr) adds Dialog_Parent keyword
+    	2014-12-04 srio@esrf.eu Translated to python
+
+    """
+    #Note that in/out arrays are numpy way: numpy.array((npoints,2))
+
+    x1 = 0.0 # set2[:,0].min()
+    x2 = set2[:,0].max()
+
+    if kmin != None:
+        x1 = kmin
+    if kmax != None:
+        x2 = kmax
+
+    xl, xh, nc, nr, xrange1 = _getPostEdgeRanges(x1, x2, polDegree, knots)
+
     #
     # select only points in selected interval
     #
@@ -540,6 +552,123 @@ def postEdge0(k, mu, kmin=None, kmax=None, degrees=(3, 3, 3), knots=None, full=F
     set0[:, 1] = mu
     return postEdge(set0, kmin, kmax, degrees, knots=knots, full=full)
 
+def polsplMultiple(x, y, w, npts, xl, xh, nr, nc):
+    r"""
+        polsplMultiple(x,y,w,npts,xl,xh,nr,nc): polspl of several spectra
+
+     x, y and w are 2D arrays with one spectrum per row (the first column
+     is not used as in polspl), npts gives the number of points of each
+     spectrum, xl and xh the ranges shared by all the spectra (1D) or
+     those of each spectrum (2D). nr and nc are the same for all spectra.
+
+     The compiled version is used when available.
+
+     OUTPUTS:
+        2D array with the coefficients of each spectrum in a row.
+    """
+    if _XAS:
+        return _xas.polsplMultiple(x, y, w, npts, xl, xh, nr, nc)
+    x = numpy.array(x, dtype=numpy.float64, copy=False, ndmin=2)
+    y = numpy.array(y, dtype=numpy.float64, copy=False, ndmin=2)
+    nSpectra = x.shape[0]
+    w = numpy.broadcast_to(numpy.asarray(w, dtype=numpy.float64), x.shape)
+    npts = numpy.broadcast_to(numpy.asarray(npts, dtype=numpy.int32),
+                              (nSpectra,))
+    xl = numpy.array(xl, dtype=numpy.float64, copy=False, ndmin=2)
+    xh = numpy.array(xh, dtype=numpy.float64, copy=False, ndmin=2)
+    xl = numpy.broadcast_to(xl, (nSpectra, xl.shape[1]))
+    xh = numpy.broadcast_to(xh, (nSpectra, xh.shape[1]))
+    c = numpy.zeros((nSpectra, 36), dtype=numpy.float64)
+    for i in range(nSpectra):
+        # polspl modifies the ranges
+        c[i] = polspl(x[i], y[i], w[i], int(npts[i]),
+                      xl[i].copy(), xh[i].copy(), nr, nc)
+    return c
+
+def postEdgeMultiple(k, mu, kmin=None, kmax=None, polDegree=(3, 3, 3),
+                     knots=None, full=False):
+    r"""
+        postEdgeMultiple(k,mu,kmin=None,kmax=None,polDegree=(3,3,3),knots=None)
+
+     PURPOSE:
+        Post edge fit of several xafs spectra, one per row of k and mu.
+        It gives the same result as postEdge applied to each spectrum.
+
+     KEYWORD PARAMETERS:
+        kmin the bottom limit for the fit (defaults kmin=0)
+        kmax the upper limit for the fit (defaults max). It can be an
+             array with the limit of each spectrum.
+
+     OUTPUTS:
+        2D array with the fit of each spectrum. If full is set, the
+        positions and values of the knots of each spectrum are also returned.
+    """
+    k = numpy.array(k, dtype=numpy.float64, copy=False, ndmin=2)
+    mu = numpy.array(mu, dtype=numpy.float64, copy=False, ndmin=2)
+    nSpectra = k.shape[0]
+    if kmin is None:
+        kmin = 0.0
+    if kmax is None:
+        kmax = k.max(axis=1)
+    kmin = numpy.broadcast_to(kmin, (nSpectra,))
+    kmax = numpy.broadcast_to(kmax, (nSpectra,))
+
+    # the ranges only depend on the limits of each spectrum
+    xl = numpy.zeros((nSpectra, 10))
+    xh = numpy.zeros((nSpectra, 10))
+    lower = numpy.zeros((nSpectra,))
+    upper = numpy.zeros((nSpectra,))
+    ranges = {}
+    for i in range(nSpectra):
+        key = (kmin[i], kmax[i])
+        if key not in ranges:
+            ranges[key] = _getPostEdgeRanges(kmin[i], kmax[i],
+                                             list(polDegree), knots)
+        xl[i], xh[i], nc, nr, (lower[i], upper[i]) = ranges[key]
+
+    #
+    # pack the points of the selected interval of every spectrum
+    #
+    goodi = (k >= lower[:, None]) & (k <= upper[:, None])
+    npts = goodi.sum(axis=1)
+    rows = numpy.nonzero(goodi)[0]
+    columns = numpy.cumsum(goodi, axis=1)[goodi]
+    xx = numpy.zeros((nSpectra, npts.max() + 1))
+    yy = numpy.zeros((nSpectra, npts.max() + 1))
+    xx[rows, columns] = k[goodi]
+    yy[rows, columns] = mu[goodi]
+    w = numpy.ones(xx.shape)
+
+    c = polsplMultiple(xx, yy, w, npts, xl, xh, nr, nc)
+
+    # evaluate the fit, the first and last ranges are extrapolated
+    xl[:, 1] = k.min(axis=1)
+    xh[:, nr] = k.max(axis=1)
+    def evaluate(j, x):
+        cstart = numpy.sum(nc[0:j])
+        yval = 0.0 * x
+        xpower = numpy.ones(x.shape, dtype=numpy.float64)
+        for p in range(1, int(nc[j] + 1)):
+            yval += c[:, cstart + p][:, None] * xpower
+            xpower *= x
+        return yval
+
+    fit = numpy.zeros(k.shape, dtype=numpy.float64)
+    fit[:, 0] = evaluate(1, k[:, :1])[:, 0]
+    for j in range(1, int(nr + 1)):
+        idx = (k > xl[:, j:j+1]) & (k <= xh[:, j:j+1])
+        fit = numpy.where(idx, evaluate(j, k), fit)
+
+    if full:
+        xNodes = numpy.zeros((nSpectra, nr-1), dtype=numpy.float32)
+        yNodes = numpy.zeros((nSpectra, nr-1), dtype=numpy.float32)
+        for j in range(1, int(nr)):
+            xNodes[:, j-1] = xh[:, j]
+            yNodes[:, j-1] = evaluate(j, xh[:, j:j+1])[:, 0]
+        return fit, xNodes, yNodes
+    else:
+        return fit
+
 def getFTWindowWeights(tk, window="Gaussian", windpar=0.2, wrange=None):
 
     r"""
@@ -591,10 +720,13 @@ def getFTWindowWeights(tk, window="Gaussian", windpar=0.2, wrange=None):
         window = names[window]
     _logger.debug("Using window %s", window)
 
-    if wrange == None:
+    tk = numpy.asarray(tk)
+    if wrange is None:
         xmax = tk.max()
         xmin = tk.min()
     else:
+        # the limits can also be arrays broadcastable against tk
+        # (one window per spectrum)
         xmin = wrange[0]
         xmax = wrange[1]
 
@@ -603,61 +735,48 @@ def getFTWindowWeights(tk, window="Gaussian", windpar=0.2, wrange=None):
     apo1 = xmin + windpar
     apo2 = xmax - windpar
 
-    npoint = len(tk)
-    wind = numpy.ones(npoint, dtype=numpy.float)
+    wind = numpy.ones(tk.shape, dtype=numpy.float64)
+    if window not in ["Gaussian", "Gauss", "Kaiser", "Kasel"]:
+        low = tk <= apo1
+        high = tk >= apo2
+        # the points of both apodization regions take the high value
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            lowArg = (tk - xmin) / windpar
+            highArg = (tk - apo2) / windpar
 
     if window in ["Gaussian", "Gauss"]:
         wind = numpy.power((tk - xp)/xm, 2)
         wind = numpy.exp(-wind * 9.2)
 
     elif window == "Hanning":
-        for i in range(npoint):
-            if tk[i] <= apo1:
-                wind[i] = 0.5*(1.0-numpy.cos(numpy.pi*(tk[i]-xmin)/windpar))
-            if tk[i] >= apo2:
-                wind[i] = 0.5*(1.0+numpy.cos(numpy.pi*(tk[i]-apo2)/windpar))
+        wind = numpy.where(low, 0.5*(1.0-numpy.cos(numpy.pi*lowArg)), wind)
+        wind = numpy.where(high, 0.5*(1.0+numpy.cos(numpy.pi*highArg)), wind)
     elif window == "Box":
-        for i in range(npoint):
-            if tk[i] <= apo1:
-                wind[i] = 0.0
-            if tk[i] >= apo2:
-                wind[i] = 0.0
+        wind = numpy.where(low | high, 0.0, wind)
     elif window in ["Parzen", "Triangle", "Triangular"]:
-        for i in range(npoint):
-            if tk[i] <= apo1:
-                wind[i] = (tk[i]-xmin)/windpar
-            if tk[i] >= apo2:
-                wind[i] = 1 - (tk[i]-apo2)/windpar
+        wind = numpy.where(low, lowArg, wind)
+        wind = numpy.where(high, 1 - highArg, wind)
     elif window == "Welch":
-        for i in range(npoint):
-            if tk[i] <= apo1:
-                wind[i] = 1.0 - numpy.power( ( (tk[i]-apo1) / windpar), 2)
-            if tk[i] >= apo2:
-                wind[i] =  1.0 - numpy.power( (tk[i]-apo2) / windpar, 2 )
+        wind = numpy.where(low, 1.0 - numpy.power((tk-apo1) / windpar, 2), wind)
+        wind = numpy.where(high, 1.0 - numpy.power(highArg, 2), wind)
     elif window == "Hamming":
-        for i in range(npoint):
-            if tk[i] <= apo1:
-                wind[i] = 1.08 - (.54+0.46*numpy.cos(numpy.pi*(tk[i]-xmin)/windpar))
-            if tk[i] >= apo2:
-                wind[i] =   1.08 - (.54-0.46*numpy.cos(numpy.pi*(tk[i]-apo2)/windpar))
+        wind = numpy.where(low, 1.08 - (.54+0.46*numpy.cos(numpy.pi*lowArg)), wind)
+        wind = numpy.where(high, 1.08 - (.54-0.46*numpy.cos(numpy.pi*highArg)), wind)
     elif window == "Tukey":
-        for i in range(npoint):
-            if tk[i] <= apo1:
-                wind[i] = 1.0 - numpy.power(numpy.cos(0.5*numpy.pi*(tk[i]-xmin)/windpar),2)
-            if tk[i] >= apo2:
-                wind[i] = numpy.power(numpy.cos(-0.5*numpy.pi*(tk[i]-apo2)/windpar),2)
+        wind = numpy.where(low, 1.0 - numpy.power(numpy.cos(0.5*numpy.pi*lowArg),2), wind)
+        wind = numpy.where(high, numpy.power(numpy.cos(-0.5*numpy.pi*highArg),2), wind)
     elif window == "Papul":
-        for i in range(npoint):
-            if tk[i] <= apo1:
-                a=(1./numpy.pi)*numpy.sin(numpy.pi*(tk[i]-xmin)/windpar) + \
-                  (1.-(tk[i]-xmin)/windpar)*numpy.cos(numpy.pi*(tk[i]-xmin)/windpar)
-                wind[i] = 1.0 - a
-            if tk[i] >= apo2:
-                a=(1./numpy.pi)*numpy.sin(numpy.pi*(tk[i]-apo2)/windpar) + \
-                  (1.-(tk[i]-apo2)/windpar)*numpy.cos(numpy.pi*(tk[i]-apo2)/windpar)
-                wind[i] = a
+        a = (1./numpy.pi)*numpy.sin(numpy.pi*lowArg) + \
+            (1.-lowArg)*numpy.cos(numpy.pi*lowArg)
+        wind = numpy.where(low, 1.0 - a, wind)
+        a = (1./numpy.pi)*numpy.sin(numpy.pi*highArg) + \
+            (1.-highArg)*numpy.cos(numpy.pi*highArg)
+        wind = numpy.where(high, a, wind)
     elif _XAS and window in ["Kaiser", "Kasel"]:
-        wind= (_xas.j0(windpar * numpy.sqrt(1. - 4.0 * pow((tk-xp)/xm, 2))) - 1.0)/ (_xas.j0(windpar) - 1.0)
+        with numpy.errstate(invalid="ignore"):
+            arg = windpar * numpy.sqrt(1. - 4.0 * pow((tk-xp)/xm, 2))
+        wind = _xas.j0(numpy.ravel(arg)).reshape(arg.shape)
+        wind = (wind - 1.0) / (_xas.j0(windpar) - 1.0)
     else:
         raise ValueError("Window <%s> not implemented" % window)
     return wind
@@ -738,6 +857,142 @@ def getFT(k, exafs, npoints=2048, rrange=(0.0, 7.0),
     ddict["FTImaginary"] = f13
     return ddict
 
+def getFTKernel(npoints=2048, rrange=(0.0, 7.0), kstep=0.02):
+    r"""
+    Discrete Fourier transform restricted to the radii inside rrange.
+
+    :return: A dictionary with the interpolation grid (InterpolatedK), the
+             radii (FTRadius) and the (npoints, nRadii) matrices giving the
+             real (FTReal) and imaginary (FTImaginary) parts of the
+             transform as calculated by getFT.
+    """
+    interpolatedDataX = numpy.linspace(0.0, npoints-1, npoints) * kstep
+    rstep = numpy.pi / npoints / kstep
+    rr = numpy.linspace(0.0, npoints-1, npoints) * rstep
+    goodi = numpy.nonzero((rr  >= rrange[0]) & (rr  <= rrange[1]))[0]
+    coef = npoints * kstep / numpy.sqrt(numpy.pi) * numpy.sqrt(2.)
+    # same phase as numpy.fft.ifft
+    phase = (numpy.arange(npoints)[:, None] * goodi[None, :]) % npoints
+    phase = (2 * numpy.pi / npoints) * phase
+    ddict = {}
+    ddict["InterpolatedK"] = interpolatedDataX
+    ddict["FTRadius"] = rr[goodi]
+    ddict["FTReal"] = (coef / npoints) * numpy.cos(phase)
+    ddict["FTImaginary"] = (-coef / npoints) * numpy.sin(phase)
+    return ddict
+
+def getFTMultiple(k, exafs, krange, npoints=2048, rrange=(0.0, 7.0),
+                  kstep=0.02, kweight=0, window="gaussian", apodization=0.2,
+                  kernel=None):
+    r"""
+    Equivalent of getFT for several spectra at once.
+
+    :param k: 2D array (nSpectra, nPoints). Every row must be increasing.
+    :param exafs: 2D array (nSpectra, nPoints) with the EXAFS signals.
+    :param krange: (kMin, kMax) pair of scalars or of nSpectra arrays.
+    :param kernel: Output of getFTKernel for the same npoints, rrange and
+                   kstep. If given, the transform is a product with the
+                   kernel restricted to the non-zero part of the signals
+                   instead of a full FFT.
+    :return: A dictionary with the same keys as getFT, except "Set" and "K".
+             The radius and interpolated k grids are shared, the window
+             weights are zero outside krange.
+    """
+    k = numpy.atleast_2d(numpy.asarray(k, dtype=numpy.float64))
+    exafs = numpy.atleast_2d(numpy.asarray(exafs, dtype=numpy.float64))
+    nSpectra, nPoints = k.shape
+    kMin = numpy.zeros((nSpectra, 1)) + numpy.reshape(krange[0], (-1, 1))
+    kMax = numpy.zeros((nSpectra, 1)) + numpy.reshape(krange[1], (-1, 1))
+    selection = (k >= kMin) & (k <= kMax)
+    wweights = getFTWindowWeights(k,
+                                  window=window,
+                                  windpar=apodization,
+                                  wrange=(kMin, kMax))
+    wweights = numpy.where(selection, wweights, 0.0)
+    signal = wweights * exafs * pow(k, kweight)
+
+    # ;
+    # ; creates the input interpolated values
+    # ;
+    if kernel is None:
+        interpolatedDataX = numpy.linspace(0.0, npoints-1, npoints) * kstep
+    else:
+        interpolatedDataX = kernel["InterpolatedK"]
+    interpolatedDataY = numpy.zeros((nSpectra, npoints), dtype=numpy.float64)
+    # first and last selected points of each spectrum
+    first = numpy.argmax(selection, axis=1)
+    last = nPoints - 1 - numpy.argmax(selection[:, ::-1], axis=1)
+    valid = selection.any(axis=1) & (last > first)
+    # only the grid points between the selected points can be non-zero
+    m0, m1 = 0, 0
+    if valid.any():
+        rows = numpy.nonzero(valid)[0]
+        k = k[rows]
+        first = first[rows][:, None]
+        last = last[rows][:, None]
+        m0 = numpy.searchsorted(interpolatedDataX,
+                    numpy.take_along_axis(k, first, axis=1).min())
+        m1 = numpy.searchsorted(interpolatedDataX,
+                    numpy.take_along_axis(k, last, axis=1).max(),
+                    side="right")
+    if m1 > m0:
+        gridX = interpolatedDataX[m0:m1]
+        # searchsorted on all the rows at once: every row is shifted
+        # to its own band of a single increasing array
+        lo = min(k.min(), gridX[0])
+        band = max(k.max(), gridX[-1]) - lo + 1.0
+        offsets = band * numpy.arange(rows.size)[:, None]
+        j = numpy.searchsorted(((k - lo) + offsets).ravel(),
+                    ((gridX[None, :] - lo) + offsets).ravel(),
+                    side="right")
+        j = j.reshape(rows.size, gridX.size) - 1 - \
+            nPoints * numpy.arange(rows.size)[:, None]
+        j = numpy.clip(j, first, last - 1)
+        x0 = numpy.take_along_axis(k, j, axis=1)
+        x1 = numpy.take_along_axis(k, j + 1, axis=1)
+        y0 = numpy.take_along_axis(signal[rows], j, axis=1)
+        y1 = numpy.take_along_axis(signal[rows], j + 1, axis=1)
+        values = y0 + (gridX[None, :] - x0) * (y1 - y0) / (x1 - x0)
+        inside = (gridX[None, :] >= \
+                        numpy.take_along_axis(k, first, axis=1)) & \
+                 (gridX[None, :] <= \
+                        numpy.take_along_axis(k, last, axis=1))
+        interpolatedDataY[rows, m0:m1] = numpy.where(inside, values, 0.0)
+
+    if kernel is not None:
+        # ; the transform of the non-zero part of the signals
+        f12 = numpy.dot(interpolatedDataY[:, m0:m1], kernel["FTReal"][m0:m1])
+        f13 = numpy.dot(interpolatedDataY[:, m0:m1],
+                        kernel["FTImaginary"][m0:m1])
+        f10 = kernel["FTRadius"]
+    else:
+        # ; calculates the fft of all the spectra and generates the
+        # ; conjugated variable (rr)
+        ff = numpy.fft.ifft(interpolatedDataY, axis=-1)
+        rstep = numpy.pi / npoints / kstep
+        rr = numpy.linspace(0.0, npoints-1, npoints) * rstep
+
+        # ;
+        # ; prepare the results cut to the selected interval in r (rrange)
+        # ;
+        goodi = (rr  >= rrange[0]) & (rr  <= rrange[1])
+        coef = npoints * kstep / numpy.sqrt(numpy.pi) * numpy.sqrt(2.)
+        f12 = coef*numpy.real(ff[:, goodi])         # real part of fft
+        f13 = coef*numpy.imag(ff[:, goodi])*(-1.)   # imaginary part of fft
+        f10 = rr[goodi]
+    f11 = numpy.sqrt( f12*f12 + f13*f13)
+
+    ddict = {}
+    ddict["InterpolatedK"] = interpolatedDataX
+    ddict["InterpolatedSignal"] = interpolatedDataY
+    ddict["KWeight"] = kweight
+    ddict["WindowWeight"] = wweights
+    ddict["FTRadius"] = f10
+    ddict["FTIntensity"] = f11
+    ddict["FTReal"] = f12
+    ddict["FTImaginary"] = f13
+    return ddict
+
 def getBackFT(fourier,npoint=4096,krange=[2.0,12.0],rstep=None,rmin=None,rmax=None):
     r"""
         fastbftr(fourier,npoint=4096,krange=[2.0,12.0],rstep=None,rmin=None,rmax=None)
@@ -890,6 +1145,9 @@ def __init__(self, backend=None):
         self._processingPending = True
         self._energy = None
         self._mu = None
+        # what only depends on the energy axis and the configuration
+        self._sharedAxis = None
+        self._ftKernel = None
 
     def getDefaultConfiguration(self, backend=None):
         configuration = {}
@@ -998,6 +1256,7 @@ def setConfiguration(self, configuration, backend=None):
                 self.mergeConfigurationDicts(currentConfig, inputConfig)
         self._configuration[backend] = newConfiguration
         self._processingPending = True
+        self._sharedAxis = None
 
     def mergeConfigurationDicts(self, referenceDict,
                                       inputDict):
@@ -1038,31 +1297,83 @@ def setSpectrum(self, energy, mu, units=None, sanitize=True):
         mu0 = numpy.array(mu, dtype=numpy.float64, copy=True)
         energy0.shape = -1
         mu0.shape = -1
-        self._equidistant = False
 
-        # TODO: This should become a function to be called on its own
-        # make sure data are sorted
-        idx = energy.argsort(kind='mergesort')
+        axis = self._getSharedAxis(energy0, units)
+        idx = axis["Indices"]
+        equidistant = axis["Equidistant"]
         energy = numpy.take(energy0, idx)
         mu = numpy.take(mu0, idx)
+        units = axis["Units"]
+        if units.lower() == "kev":
+            energy *= 1000.
+            energy0 *= 1000.
+
+        # everything went well, update internal variables
+        self._energy0 = energy0
+        self._mu0 = mu0
+        self._energy = energy
+        self._mu = mu
+        self._units = units
+        self._equidistant = equidistant
+
+    def _getSharedAxis(self, energy0, units=None):
+        """
+        Sorting permutation, units and processed energy axis of energy0.
+
+        They are only calculated when the axis changes. The returned
+        dictionary is also used to keep everything else only depending on
+        the axis and on the configuration (edge search stencils, polynomial
+        bases, ...) until the axis or the configuration change.
+        """
+        axis = self._sharedAxis
+        if axis is not None:
+            if (axis["UnitsIn"] == units) and \
+               (axis["Energy0"].shape == energy0.shape) and \
+               numpy.array_equal(axis["Energy0"], energy0):
+                return axis
+        idx, equidistant = self._getEnergyIndices(energy0)
+        energy = numpy.take(energy0, idx)
+        unitsOut = self._getEnergyUnits(energy, units)
+        if unitsOut.lower() == "kev":
+            energy *= 1000.
+        # shared by all the results
+        energy.flags.writeable = False
+        axis = {"Energy0": numpy.array(energy0, copy=True),
+                "UnitsIn": units,
+                "Indices": idx,
+                "Sorted": (idx.size == energy0.size) and \
+                          bool(numpy.all(idx[1:] > idx[:-1])),
+                "Equidistant": equidistant,
+                "Energy": energy,
+                "Units": unitsOut}
+        self._sharedAxis = axis
+        return axis
+
+    def _getEnergyIndices(self, energy):
+        """
+        Indices of the points to be used in order to get a strictly
+        increasing energy axis and flag indicating if the axis is equidistant.
+        """
+        # make sure data are sorted
+        idx = energy.argsort(kind='mergesort')
+        sortedEnergy = numpy.take(energy, idx)
 
         # make sure data are strictly increasing
-        delta = energy[1:] - energy[:-1]
+        delta = sortedEnergy[1:] - sortedEnergy[:-1]
         dmin = delta.min()
         dmax = delta.max()
-        if delta.min() <= 1.0e-10:
+        if dmin <= 1.0e-10:
             # force data to be strictly increasing
             # although we do not consider last point
-            idx = numpy.nonzero(delta>0)[0]
-            energy = numpy.take(energy, idx)
-            mu = numpy.take(mu, idx)
-            delta = None
+            idx = numpy.take(idx, numpy.nonzero(delta>0)[0])
 
         if dmin == dmax:
             equidistant = True
         else:
             equidistant = False
+        return idx, equidistant
 
+    def _getEnergyUnits(self, energy, units=None):
         if units is None:
             if (energy[-1] - energy[0]) < 10:
                 units = "keV"
@@ -1070,17 +1381,7 @@ def setSpectrum(self, energy, mu, units=None, sanitize=True):
                 units = "eV"
         if units.lower() not in ["kev", "ev"]:
             raise ValueError("Unhandled units %s" % units)
-        elif units.lower() == "kev":
-            energy *= 1000.
-            energy0 *= 1000.
-
-        # everything went well, update internal variables
-        self._energy0 = energy0
-        self._mu0 = mu0
-        self._energy = energy
-        self._mu = mu
-        self._units = units
-        self._equidistant = equidistant
+        return units
 
     def processSpectrum(self):
         e0 = self.calculateE0()
@@ -1163,6 +1464,32 @@ def fourierTransform(self, k, mu, kMin=None, kMax=None, backend=None):
                      kstep=config["KStep"])
 
     def postEdge(self, k, mu, backend=None):
+        if backend not in [None, "Default", "DefaultBackend"]:
+            raise ValueError("Only default backend implemented")
+        else:
+            backend = "DefaultBackend"
+        kMin, kMax, kWeight, orders, knots = \
+                    self._getPostEdgeParameters(k.max(), backend=backend)
+        fit0, xNodes, yNodes = postEdge0(k, mu, kMin, kMax,
+                         orders,
+                         knots=knots, full=True)
+        ddict = {}
+        ddict["PostEdgeK"] = fit0[:, 0]
+        ddict["PostEdgeB"] = fit0[:, 1]
+        ddict["KnotsX"] = xNodes
+        ddict["KnotsY"] = yNodes
+        ddict["KMin"] = kMin
+        ddict["KMax"] = kMax
+        ddict["KWeight"] = kWeight
+        # TODO: add polynomials?
+        return ddict
+
+    def _getPostEdgeParameters(self, kLast, backend=None):
+        """
+        Return kMin, kMax, kWeight, polynomial orders and knots of the EXAFS
+        extraction of a spectrum whose last point is kLast.
+        kLast can be an array with the values of several spectra.
+        """
         if backend not in [None, "Default", "DefaultBackend"]:
             raise ValueError("Only default backend implemented")
         else:
@@ -1176,9 +1503,9 @@ def postEdge(self, k, mu, backend=None):
         if kMin is None:
             kMin = 2
         if kMax is None:
-            kMax = k.max()
+            kMax = kLast
         else:
-            kMax = min(k.max(), kMax)
+            kMax = numpy.minimum(kLast, kMax)
         number = config["Knots"].get("Number", 0)
         if number == 0:
             knots = None
@@ -1186,21 +1513,12 @@ def postEdge(self, k, mu, backend=None):
                 config["Knots"]["Orders"] = [config["Knots"]["Orders"]]
         else:
             knots = config["Knots"]["Values"]
-            if not hasattr(knots, "__len__"):
+            if knots is None:
+                # automatic (equidistant) knots
+                pass
+            elif not hasattr(knots, "__len__"):
                 knots = [knots]
-        fit0, xNodes, yNodes = postEdge0(k, mu, kMin, kMax,
-                         config["Knots"]["Orders"],
-                         knots=knots, full=True)
-        ddict = {}
-        ddict["PostEdgeK"] = fit0[:, 0]
-        ddict["PostEdgeB"] = fit0[:, 1]
-        ddict["KnotsX"] = xNodes
-        ddict["KnotsY"] = yNodes
-        ddict["KMin"] = kMin
-        ddict["KMax"] = kMax
-        ddict["KWeight"] = kWeight
-        # TODO: add polynomials?
-        return ddict
+        return kMin, kMax, kWeight, config["Knots"]["Orders"], knots
 
     def calculateE0(self, energy=None, mu=None, backend=None):
         self._lastE0CalculationDict = None
@@ -1255,7 +1573,7 @@ def _calculateE0(self, energy, mu, config):
             return {"edge":e0}
         elif methodLower.endswith("no smooth"):
             idx = numpy.gradient(muWork).argmax()
-            return eWork[idx]
+            return {"edge":eWork[idx]}
         elif methodLower.endswith("3pt sg"):
             npoints = 3
         elif methodLower.endswith("5pt sg"):
@@ -1424,6 +1742,319 @@ def normalize(self, energy=None, mu=None, backend=None):
                 "NormalizedPlotMin": plotMin,
                 "NormalizedPlotMax":plotMax}
 
+    def processMultipleSpectra(self, energy, mu, units=None):
+        """
+        Process several spectra sharing the same energy axis.
+
+        The result is the one of calling setSpectrum and processSpectrum
+        for every spectrum, but the edge, the pre- and post-edge polynomials,
+        the post-edge splines, the interpolation in k and the Fourier
+        transforms are calculated for all the spectra at once.
+
+        :param energy: 1D array with the energy axis of the spectra
+        :param mu: 2D array with the spectra as [nSpectra, nEnergies]
+        :param units: "eV" or "keV". Guessed from the energy axis if not given.
+        :return: A dictionary with the keys of processSpectrum. The values
+                 depending on the spectrum have the spectrum index as first
+                 dimension.
+        """
+        energy0 = numpy.asarray(energy, dtype=numpy.float64).reshape(-1)
+        mu0 = numpy.asarray(mu, dtype=numpy.float64)
+        mu0 = mu0.reshape(-1, energy0.size)
+
+        # the work only depending on the energy axis is done once
+        axis = self._getSharedAxis(energy0, units)
+        energy = axis["Energy"]
+        if axis["Sorted"]:
+            mu = mu0
+        else:
+            mu = numpy.take(mu0, axis["Indices"], axis=1)
+
+        config = self._configuration["DefaultBackend"]["Normalization"]
+        e0 = self._calculateE0Multiple(energy, mu, config,
+                                       equidistant=axis["Equidistant"],
+                                       cache=axis)
+        ddict = self._normalizeMultiple(energy, mu, e0, config, cache=axis)
+        ddict["Energy"] = energy.copy()
+        ddict["NormalizedEnergy"] = ddict["Energy"]
+        ddict["Mu"] = mu
+        cleanMu = mu - ddict["NormalizedBackground"]
+        kValues = e2k(energy[None, :] - e0[:, None])
+        ddict.update(self._postEdgeMultiple(kValues, cleanMu))
+
+        # normalization
+        exafs = (cleanMu - ddict["PostEdgeB"]) / ddict["PostEdgeB"]
+        ddict["EXAFSEnergy"] = k2e(kValues)
+        ddict["EXAFSKValues"] = kValues
+        ddict["EXAFSSignal"] = cleanMu
+        if ddict["KWeight"]:
+            exafs *= pow(kValues, ddict["KWeight"])
+        ddict["EXAFSNormalized"] = exafs
+
+        # FT of the points with KMin <= k <= KMax
+        ddict["FT"] = self.fourierTransformMultiple(kValues, exafs,
+                                                    kMin=ddict["KMin"],
+                                                    kMax=ddict["KMax"])
+        return ddict
+
+    def fourierTransformMultiple(self, k, mu, kMin=None, kMax=None,
+                                 backend=None):
+        """
+        Fourier transform of several spectra (one per row of k and mu).
+        kMin and kMax can be scalars or have one value per spectrum.
+        """
+        if backend not in [None, "Default", "DefaultBackend"]:
+            raise ValueError("Only default backend implemented")
+        else:
+            backend = "DefaultBackend"
+        config = self._configuration[backend]["FT"]
+        if kMin is None:
+            kMin = k.min(axis=-1)
+        if kMax is None:
+            kMax = k.max(axis=-1)
+        kRange = config["WindowRange"]
+        if config["WindowRange"] in [None, "None"]:
+            kRange = [kMin, kMax]
+        else:
+            kRange = [numpy.maximum(kRange[0], kMin),
+                      numpy.minimum(kRange[1], kMax)]
+        # the transform itself is the same for all the calls
+        key = (config["Points"], tuple(config["Range"]), config["KStep"])
+        if (self._ftKernel is None) or (self._ftKernel[0] != key):
+            self._ftKernel = key, getFTKernel(npoints=config["Points"],
+                                              rrange=config["Range"],
+                                              kstep=config["KStep"])
+        return getFTMultiple(k, mu, kRange, npoints=config["Points"],
+                             window=config.get("Window", "Gaussian"),
+                             apodization=config.get("WindowApodization", 0.02),
+                             rrange=config["Range"],
+                             kstep=config["KStep"],
+                             kernel=self._ftKernel[1])
+
+    def _postEdgeMultiple(self, k, mu):
+        kMin, kMax, kWeight, orders, knots = \
+                    self._getPostEdgeParameters(k.max(axis=1))
+        kMax = kMax * numpy.ones((k.shape[0],), dtype=numpy.float64)
+        background, xNodes, yNodes = postEdgeMultiple(k, mu, kMin, kMax,
+                                                      orders,
+                                                      knots=knots, full=True)
+        ddict = {}
+        ddict["PostEdgeK"] = k
+        ddict["PostEdgeB"] = background
+        ddict["KnotsX"] = xNodes
+        ddict["KnotsY"] = yNodes
+        ddict["KMin"] = kMin
+        ddict["KMax"] = kMax
+        ddict["KWeight"] = kWeight
+        return ddict
+
+    def _calculateE0Multiple(self, energy, mu, config, equidistant=False,
+                             cache=None):
+        method = config["E0Method"]
+        methodLower = method.lower()
+        if methodLower.endswith("manual"):
+            e0 = config["E0Value"]
+            if e0 is None:
+                raise ValueError("Edge energy not set")
+            return e0 * numpy.ones((mu.shape[0],), dtype=numpy.float64)
+        if methodLower.endswith("no smooth"):
+            npoints = 0
+        elif methodLower.endswith("3pt sg"):
+            npoints = 3
+        elif methodLower.endswith("5pt sg"):
+            npoints = 5
+        elif methodLower.endswith("7pt sg"):
+            npoints = 7
+        elif methodLower.endswith("9pt sg"):
+            npoints = 9
+        else:
+            raise ValueError("Method <%s> not implemented" % method)
+        if cache is None:
+            cache = {}
+        key = "E0Operator", npoints
+        if key not in cache:
+            cache[key] = self._getE0Operator(energy, npoints,
+                                             equidistant=equidistant)
+        eWork, blocks = cache[key]
+        # the interpolated spectra, or their derivative, are a linear
+        # combination of a few consecutive points of the spectra
+        muWork = numpy.zeros((mu.shape[0], eWork.size), dtype=numpy.float64)
+        for r0, r1, c0, c1, block in blocks:
+            muWork[:, r0:r1] = numpy.dot(mu[:, c0:c1], block)
+        if npoints == 0:
+            idx = numpy.gradient(muWork, axis=1).argmax(axis=1)
+            return eWork[idx]
+        return XASNormalization.getE0SavitzkyGolayMultiple(eWork, None,
+                                                           points=npoints,
+                                                           derivative=muWork)
+
+    def _getE0Operator(self, energy, npoints, equidistant=False, blockSize=256):
+        """
+        Working energy grid of the edge search and the operator giving the
+        linearly interpolated spectra (npoints = 0) or their Savitzky-Golay
+        derivative (npoints > 0) on that grid.
+
+        :return: working grid and list of (r0, r1, c0, c1, block) such that
+                 the values of the grid points [r0:r1] are the product of the
+                 points [c0:c1] of a spectrum by block.
+        """
+        if equidistant:
+            # data do not need to be interpolated
+            eWork = energy
+        else:
+            nWorkingPoints = 10 * energy.size
+            eWork = numpy.linspace(energy[1], energy[-2], nWorkingPoints)
+        j = numpy.searchsorted(energy, eWork, side="right") - 1
+        j = numpy.clip(j, 0, energy.size - 2)
+        t = (eWork - energy[j]) / (energy[j + 1] - energy[j])
+        if npoints:
+            # the first and last N points of the derivative are zero
+            coeff = SGModule.calc_coeff(npoints, 2, 1)[::-1]
+        else:
+            coeff = numpy.ones((1,), dtype=numpy.float64)
+        N = coeff.size // 2
+        blocks = []
+        for r0 in range(N, eWork.size - N, blockSize):
+            r1 = min(r0 + blockSize, eWork.size - N)
+            c0 = j[r0 - N]
+            c1 = j[r1 - 1 + N] + 2
+            block = numpy.zeros((c1 - c0, r1 - r0), dtype=numpy.float64)
+            rows = numpy.arange(r1 - r0)
+            for i, c in enumerate(coeff):
+                k = slice(r0 - N + i, r1 - N + i)
+                block[j[k] - c0, rows] += c * (1.0 - t[k])
+                block[j[k] + 1 - c0, rows] += c * t[k]
+            blocks.append((r0, r1, c0, c1, block))
+        return eWork, blocks
+
+    def _getNormalizationBasis(self, x, method, eMin, eMax):
+        """
+        Functions of the pre- or post-edge polynomials evaluated at x.
+        The variable is scaled with the limits of the energy axis to keep
+        the normal equations well conditioned.
+        """
+        methodLower = method.lower()
+        x = numpy.asarray(x, dtype=numpy.float64)
+        if methodLower in ["constant", "linear", "parabolic", "cubic"]:
+            degree = ["constant", "linear", "parabolic", "cubic"].index(methodLower)
+            halfWidth = 0.5 * (eMax - eMin)
+            if halfWidth <= 0:
+                halfWidth = 1.0
+            u = (x - 0.5 * (eMax + eMin)) / halfWidth
+            basis = numpy.empty((x.size, degree + 1), numpy.float64)
+            basis[:, 0] = 1.0
+            for i in range(1, degree + 1):
+                basis[:, i] = pow(u, i)
+        elif methodLower in ["victoreen", "modif. victoreen"]:
+            u = x / eMax
+            basis = numpy.empty((x.size, 2), numpy.float64)
+            basis[:, 0] = pow(u, -3)
+            if methodLower == "victoreen":
+                basis[:, 1] = pow(u, -4)
+            else:
+                basis[:, 1] = 1.0
+        else:
+            raise ValueError("Unhandled polynomial <%s> " % method)
+        return basis
+
+    def _normalizeMultiple(self, energy, mu, e0, config, cache=None):
+        nSpectra = mu.shape[0]
+        if cache is None:
+            cache = {}
+        # reference values
+        eMin = energy.min()
+        eMax = energy.max()
+
+        data = {}
+        edgeValues = {}
+        for key in ["PreEdge", "PostEdge"]:
+            # Regions is a single list with 2 * n values delimiting n regions.
+            regions = config [key] ["Regions"]
+            edgeMethod = config[key]["Method"]
+            if edgeMethod.lower() != "polynomial":
+                raise ValueError("Only normalization with polynomials implemented")
+            method = config[key]["Polynomial"]
+            if regions is None:
+                if key == "PreEdge":
+                    regions = [-1000., -40.]
+                else:
+                    regions = [20., 1000.]
+            # the regions depend on the edge of each spectrum, they are
+            # taken into account by the weights of the fit
+            weights = numpy.zeros(mu.shape, dtype=numpy.float64)
+            if key == "PreEdge":
+                plotMin = eMax * numpy.ones((nSpectra,), dtype=numpy.float64)
+                for i in range(0, len(regions), 2):
+                    vMin = e0 + regions[2 * i]
+                    vMax = e0 + regions[2 * i + 1]
+                    vMin = numpy.where(vMin < eMin, eMin, vMin)
+                    vMax = numpy.where(vMax < eMin, 0.5 * (eMin + e0), vMax)
+                    plotMin = numpy.minimum(plotMin, vMin)
+                    weights += (energy[None, :] >= vMin[:, None]) & \
+                               (energy[None, :] <= vMax[:, None])
+            else:
+                plotMax = eMin * numpy.ones((nSpectra,), dtype=numpy.float64)
+                for i in range(0, len(regions), 2):
+                    vMin = e0 + regions[2 * i]
+                    vMax = e0 + regions[2 * i + 1]
+                    vMin = numpy.where(vMin > eMax, 0.5 * (e0 + eMax), vMin)
+                    vMax = numpy.where(vMax < eMin, eMax, vMax)
+                    plotMax = numpy.maximum(plotMax, vMax)
+                    weights += (energy[None, :] >= vMin[:, None]) & \
+                               (energy[None, :] <= vMax[:, None])
+            cacheKey = "NormalizationBasis", method
+            if cacheKey not in cache:
+                try:
+                    basis = self._getNormalizationBasis(energy, method,
+                                                        eMin, eMax)
+                except ValueError:
+                    raise ValueError("Unhandled %s polynomial <%s> " % \
+                                     (key, config[key]["Polynomial"]))
+                products = (basis[:, :, None] * basis[:, None, :]).reshape(
+                                                    energy.size, -1)
+                cache[cacheKey] = basis, products
+            basis, products = cache[cacheKey]
+            # normal equations of all the spectra
+            nParameters = basis.shape[1]
+            alpha = numpy.dot(weights, products)
+            alpha.shape = nSpectra, nParameters, nParameters
+            beta = numpy.dot(weights * mu, basis)
+            try:
+                parameters = numpy.linalg.solve(alpha, beta[:, :, None])[:, :, 0]
+            except numpy.linalg.LinAlgError:
+                parameters = numpy.einsum("ijk,ik->ij",
+                                          numpy.linalg.pinv(alpha), beta)
+            data[key] = numpy.dot(parameters, basis.T)
+            edgeValues[key] = (parameters * \
+                self._getNormalizationBasis(e0, method, eMin, eMax)).sum(axis=1)
+        jump = edgeValues["PostEdge"] - edgeValues["PreEdge"]
+        jumpMethod = config.get("JumpNormalizationMethod", "Flattened")
+        normalizedSpectrum = (mu - data["PreEdge"]) / jump[:, None]
+        if jumpMethod in [0, "Constant", "constant"]:
+            jumpMethod = "Constant"
+        else:
+            if jumpMethod not in [1, "Flattened", "flattened",
+                                  "Flatten", "flatten"]:
+                _logger.warning("WARNING: Undefined jump normalization method. Assume Flattened")
+            jumpMethod = "Flattened"
+            i = numpy.argmin(energy[None, :] < e0[:, None], axis=1)
+            flatten = numpy.arange(energy.size)[None, :] >= i[:, None]
+            with numpy.errstate(divide="ignore", invalid="ignore"):
+                factor = jump[:, None] / (data["PostEdge"] - data["PreEdge"])
+            normalizedSpectrum = numpy.where(flatten,
+                                             normalizedSpectrum * factor,
+                                             normalizedSpectrum)
+
+        return {"Jump": jump,
+                "JumpNormalizationMethod":jumpMethod,
+                "Edge":e0,
+                "NormalizedEnergy": energy,
+                "NormalizedMu":normalizedSpectrum,
+                "NormalizedBackground": data["PreEdge"],
+                "NormalizedSignal":data["PostEdge"],
+                "NormalizedPlotMin": plotMin,
+                "NormalizedPlotMax":plotMax}
+
 if __name__ == "__main__":
     import os
     import sys
@@ -138,6 +138,37 @@ def getE0SavitzkyGolay(energy, mu, points=5, full=False):
         # return the corresponding x value
         return edge
 
+def getE0SavitzkyGolayMultiple(energy, mu, points=5, derivative=None):
+    """
+    Edge energy of several spectra sharing the energy axis. It does not
+    check anything, data have to be prepared as for getE0SavitzkyGolay.
+
+    :param energy: 1D array
+    :param mu: 2D array as [nSpectra, nEnergies]
+    :param derivative: Savitzky-Golay first derivative of mu if already
+                       calculated (mu is not used then)
+    :return: 1D array with the edge of each spectrum
+    """
+    if derivative is None:
+        # take the first derivative of all the spectra
+        yPrime = SGModule.getSavitzkyGolayMultiple(mu, npoints=points,
+                                                   degree=2, order=1)
+    else:
+        yPrime = derivative
+
+    # get the index at maximum value
+    iMax = numpy.argmax(yPrime, axis=1)
+
+    # get the center of mass
+    w = points
+    idx = iMax[:, None] + numpy.arange(-w, w + 1)[None, :]
+    inside = (idx >= 0) & (idx < energy.size)
+    idx = numpy.clip(idx, 0, energy.size - 1)
+    selection = numpy.take_along_axis(yPrime, idx, axis=1) * inside
+    edge = (selection * energy[idx]).sum(axis=1, dtype=numpy.float64)/\
+           selection.sum(axis=1, dtype=numpy.float64)
+    return edge
+
 
 def estimateXANESEdge(spectrum, energy=None, npoints=5, full=False,
                       sanitize=True):
@@ -138,20 +138,26 @@ def correctNormalizedSpectrum(self, energy0, spectrum):
                                             (total - edgeCrossSections)
         # calculate the mass attenuation coefficient of the sample at the fluorescent energy
         # assume we are detecting the main fluorescence line of the element shell
+        # excited at the highest energy of the spectrum
+        excitationEnergy = energy.max()
+        if excitationEnergy < userEdgeEnergy:
+            excitationEnergy = None
+        elementTable = Elements.getElementRateTable(element,
+                                                    energy=excitationEnergy)
         if edge == 'K':
-            rays = Elements.Element[element]["Ka xrays"]
+            rays = elementTable["Ka xrays"]
         elif edge[0] == 'L':
-            rays = Elements.Element[element][edge + " xrays"]
+            rays = elementTable[edge + " xrays"]
         elif edge[0] == 'M':
             rays = []
-            for transition in Elements.Element[element]['M xrays']:
+            for transition in elementTable['M xrays']:
                 if transition.startswith(edge):
                     rays.append(transition)
 
         lineList = []
         for label in rays:
-            ene  = Elements.Element[element][label]['energy']
-            rate = Elements.Element[element][label]['rate']
+            ene  = elementTable[label]['energy']
+            rate = elementTable[label]['rate']
             lineList.append([ene, rate, label])
 
         # whithin 50 eV lines considered the same
@@ -34,10 +34,14 @@
 Module to process a stack of absorption spectra.
 """
 import os
+import hashlib
 import numpy
 import h5py
 import posixpath
 import logging
+import collections
+import multiprocessing
+from contextlib import contextmanager
 from PyMca5.PyMca import XASClass
 from PyMca5.PyMcaIO import ConfigDict
 import time
@@ -74,13 +78,25 @@ def processMultipleSpectra(self, x, y,
                                mask=None,
                                directory=None,
                                name=None,
-                               entry=None):
+                               entry=None,
+                               nWorkers=None,
+                               rowsPerBlock=None,
+                               resume=False):
         """
         This method performs the actual work.
 
         :param x: 1D array containing the x axis (usually the channels) of the spectra.
         :param y: 3D array containing the spectra as [nrows, ncolumns, nchannels]
         :param weight: 0 Means no weight, 1 Use an average weight, 2 Individual weights (slow)
+        :param mask: 2D array, only the pixels different from zero are processed
+        :param nWorkers: number of worker processes (None or 1: no
+                         parallelization, < 1: number of CPU's)
+        :param rowsPerBlock: number of rows processed and written at once
+        :param resume: continue the processing of an existing output file,
+                       skipping the rows flagged as done in its progress
+                       dataset. The previous results are discarded when
+                       the stack shape, the configuration or the output
+                       axes changed.
         :return: A dictionnary with the results as keys.
         """
 
@@ -100,9 +116,8 @@ def processMultipleSpectra(self, x, y,
         weightPolicy = 0 # no weight
         #weightPolicy = 1 # use average weight from the sum spectrum
         #weightPolicy = 2 # individual pixel weights (slow)
-        if hasattr(x, "value"):
-            # hdf5 dataset
-            x = x.value
+        if isinstance(x, h5py.Dataset):
+            x = x[()]
 
         if hasattr(y, "info") and hasattr(y, "data"):
             data = y.data
@@ -178,147 +193,314 @@ def processMultipleSpectra(self, x, y,
             entry = posixpath.join(entry, "xas_analysis")
         if not fname.endswith(".h5"):
             fname = fname + ".h5"
-        out = h5py.File(fname, "w")
-        e0Path = posixpath.join(entry, "edge")
-        jumpPath = posixpath.join(entry, "jump")
-        spectrumXPath = posixpath.join(entry, "spectrum", "energy")
-        spectrumYPath = posixpath.join(entry, "spectrum", "mu")
-        normalizedXPath = posixpath.join(entry, "normalized", "energy")
-        normalizedYPath = posixpath.join(entry, "normalized", "mu")
-        exafsXPath = posixpath.join(entry, "exafs", "k")
-        exafsYPath = posixpath.join(entry, "exafs", "signal")
-        ftXPath = posixpath.join(entry, "FT", "Radius")
-        ftYPath = posixpath.join(entry, "FT", "Intensity")
-        ftImaginaryPath = posixpath.join(entry, "FT", "Imaginary")
 
         iXMin = 0
         iXMax = data.shape[-1] - 1
-        e0 = out.require_dataset(e0Path,
-                                 shape=data.shape[:-1],
-                                 dtype=numpy.float32,
-                                 chunks=None,
-                                 compression=None)
-        jump = out.require_dataset(jumpPath,
-                                   shape=data.shape[:-1],
-                                   dtype=numpy.float32,
-                                   chunks=None,
-                                   compression=None)
-        shape = list(data.shape[:-1]) + [usedEnergy.size]
-        spectrumX = out.require_dataset(spectrumXPath,
-                                   shape=[usedEnergy.size],
-                                   dtype=numpy.float32,
-                                   chunks=None,
-                                   compression=None)
-        spectrumY = out.require_dataset(spectrumYPath,
-                                   shape=shape,
-                                   dtype=numpy.float32,
-                                   chunks=None,
-                                   compression=None)
-        shape = list(data.shape[:-1]) + [normalizedSpectrumX.size]
-        normalizedX = out.require_dataset(normalizedXPath,
-                                   shape=[normalizedSpectrumX.size],
-                                   dtype=numpy.float32,
-                                   chunks=None,
-                                   compression=None)
-        normalizedY = out.require_dataset(normalizedYPath,
-                                   shape=shape,
-                                   dtype=numpy.float32,
-                                   chunks=None,
-                                   compression=None)
-        shape = list(data.shape[:-1]) + [exafsSpectrumX.size]
-        exafsX = out.require_dataset(exafsXPath,
-                                     shape=[exafsSpectrumX.size],
-                                     dtype=numpy.float32,
-                                     chunks=None,
-                                     compression=None)
-        exafsY = out.require_dataset(exafsYPath,
-                                     shape=shape,
-                                     dtype=numpy.float32,
-                                     chunks=None,
-                                     compression=None)
-        shape = list(data.shape[:-1]) + [xFT.size]
-        ftX = out.require_dataset(ftXPath,
-                                     shape=[xFT.size],
-                                     dtype=numpy.float32,
-                                     chunks=None,
-                                     compression=None)
-        ftY = out.require_dataset(ftYPath,
-                                     shape=shape,
-                                     dtype=numpy.float32,
-                                     chunks=None,
-                                     compression=None)
-        ftImaginary = out.require_dataset(ftImaginaryPath,
-                                     shape=shape,
-                                     dtype=numpy.float32,
-                                     chunks=None,
-                                     compression=None)
-        spectrumX[:] = ddict["Energy"]
-        normalizedX[:] = ddict["NormalizedEnergy"][normalizedIdx]
-        exafsX[:] = ddict["EXAFSKValues"][exafsIdx]
-        ftX[:] = ddict["FT"]["FTRadius"]
+        nRows, nColumns = data.shape[:2]
+        if rowsPerBlock is None:
+            rowsPerBlock = max(1, 1000 // nColumns)
+        rowsPerBlock = max(1, min(int(rowsPerBlock), nRows))
+        nWorkers = numberOfWorkers(nWorkers)
 
-        t0 = time.time()
-        totalSpectra = data.shape[0] * data.shape[1]
-        jStep = min(100, data.shape[1])
-        if weightPolicy == 2:
-            SVD = False
-            sigma_b = None
-        elif weightPolicy == 1:
-            # the +1 is to prevent misbehavior due to weights less than 1.0
-            sigma_b = 1 + numpy.sqrt(dummySpectrum)/nPixels
-            SVD = True
+        if resume:
+            # keep the rows already processed by a previous run
+            out = h5py.File(fname, "a")
         else:
-            SVD = True
-            sigma_b = None
-        last_svd = None
-        #for i in range(10):
-        for i in range(0, data.shape[0]):
-            #print(i)
-            #chunks of nColumns spectra
-            if i == 0:
-                chunk = numpy.zeros((jStep,
-                                     iXMax-iXMin+1),
-                                     numpy.float)
-            jStart = 0
-            j = 0
-            while jStart < data.shape[1]:
-                jEnd = min(jStart + jStep, data.shape[1])
-                #chunk[:,:(jEnd - jStart)] = data[i, jStart:jEnd, iXMin:iXMax+1].T
-                spectra  = data[i, jStart:jEnd, iXMin:iXMax+1]
-                nSpectra = spectra.shape[0]
-                for spectrumNumber in range(nSpectra):
-                    if mask is not None:
-                        if mask[i, j] == 0:
-                            continue
-                    self._analyzer.setSpectrum(x, spectra[spectrumNumber])
-                    ddict = self._analyzer.processSpectrum()
-                    spectrumY[i, j] = ddict["Mu"]
-                    e0[i, j] = ddict["Edge"]
-                    jump[i, j] = ddict["Jump"]
-                    #normalizedX[i, j] = ddict["NormalizedEnergy"][normalizedIdx]
-                    normalizedY[i, j] = ddict["NormalizedMu"][normalizedIdx]
-                    #exafsX[i, j] = ddict["EXAFSKValues"][exafsIdx]
-                    exafsY[i, j] = ddict["EXAFSNormalized"][exafsIdx]
-                    #ftX[i, j] = ddict["FT"]["FTRadius"]
-                    ftY[i, j] = ddict["FT"]["FTIntensity"]
-                    ftImaginary[i, j] = ddict["FT"]["FTImaginary"]
-                    j +=1
-                jStart = jEnd
-        outputDict = {}
-        outputDict["names"] = ["Jump", "Edge"]
-        output = numpy.zeros((2, e0.shape[0], e0.shape[1]), dtype = e0.dtype)
-        output[0, :] = jump.value
-        output[1, :] = e0.value
-        outputDict["images"] = output
-        out.flush()
-        out.close()
+            out = h5py.File(fname, "w")
+        try:
+            imageShape = data.shape[:-1]
+            stackShape = numpy.array(data.shape, dtype=numpy.int64)
+            xasConfig = ConfigDict.ConfigDict()
+            xasConfig["XASParameters"] = config
+            xasConfig = xasConfig.tostring()
+            maskHash = self._maskHash(mask, imageShape)
+            if resume and (entry in out):
+                outputAxes = {("spectrum", "energy"): usedEnergy,
+                              ("normalized", "energy"): normalizedSpectrumX,
+                              ("exafs", "k"): exafsSpectrumX,
+                              ("FT", "Radius"): xFT}
+                if not self._isSameProcessing(out[entry], xasConfig,
+                                              stackShape, maskHash,
+                                              outputAxes):
+                    _logger.warning("Stack, mask or configuration changed: "
+                                    "discarding the results of %s",
+                                    out[entry].name)
+                    del out[entry]
+            for path, value in [("configuration", xasConfig),
+                                ("stack_shape", stackShape),
+                                ("mask_hash", maskHash)]:
+                path = posixpath.join(entry, path)
+                if path not in out:
+                    out[path] = value
+            datasets = {}
+            for key, path in [("Edge", "edge"),
+                              ("Jump", "jump")]:
+                datasets[key] = out.require_dataset( \
+                                    posixpath.join(entry, path),
+                                    shape=imageShape,
+                                    dtype=numpy.float32,
+                                    chunks=(rowsPerBlock, nColumns),
+                                    compression="gzip")
+            axes = [("Mu", usedEnergy,
+                     ("spectrum", "energy"), ("spectrum", "mu")),
+                    ("NormalizedMu", normalizedSpectrumX,
+                     ("normalized", "energy"), ("normalized", "mu")),
+                    ("EXAFSNormalized", exafsSpectrumX,
+                     ("exafs", "k"), ("exafs", "signal")),
+                    ("FTIntensity", xFT,
+                     ("FT", "Radius"), ("FT", "Intensity")),
+                    ("FTImaginary", xFT,
+                     None, ("FT", "Imaginary"))]
+            for key, axis, xPath, yPath in axes:
+                if xPath is not None:
+                    ds = out.require_dataset(posixpath.join(entry, *xPath),
+                                             shape=(axis.size,),
+                                             dtype=numpy.float32,
+                                             chunks=None,
+                                             compression=None)
+                    ds[:] = axis
+                # a chunk holds complete spectra of a single row
+                shape = imageShape + (axis.size,)
+                nChunkColumns = max(1, min(nColumns,
+                                           (1 << 18) // (4 * axis.size)))
+                datasets[key] = out.require_dataset( \
+                                    posixpath.join(entry, *yPath),
+                                    shape=shape,
+                                    dtype=numpy.float32,
+                                    chunks=(1, nChunkColumns, axis.size),
+                                    compression="gzip")
+            # rows already written to the output file
+            progress = out.require_dataset(posixpath.join(entry, "progress"),
+                                           shape=(nRows,),
+                                           dtype=numpy.uint8,
+                                           chunks=None,
+                                           compression=None)
+            done = progress[()].astype(bool)
+            if done.any():
+                _logger.info("Resuming %s: %d of %d rows already processed",
+                             fname, done.sum(), nRows)
+
+            blocks = []
+            for i0 in range(0, nRows, rowsPerBlock):
+                i1 = min(i0 + rowsPerBlock, nRows)
+                if not done[i0:i1].all():
+                    blocks.append((i0, i1))
+
+            def blockItems():
+                for i0, i1 in blocks:
+                    spectra = numpy.asarray(data[i0:i1, :, iXMin:iXMax+1])
+                    if mask is None:
+                        maskBlock = None
+                    else:
+                        maskBlock = numpy.asarray(mask[i0:i1])
+                    yield (i0, i1), spectra, maskBlock
+
+            workerKwargs = {"configuration": config,
+                            "x": x,
+                            "normalizedIdx": normalizedIdx,
+                            "exafsIdx": exafsIdx}
+            t0 = time.time()
+            if nWorkers == 1:
+                for (i0, i1), spectra, maskBlock in blockItems():
+                    result = _processBlock(self._analyzer, spectra, maskBlock,
+                                           x=x, normalizedIdx=normalizedIdx,
+                                           exafsIdx=exafsIdx)
+                    self._writeBlock(out, datasets, progress, i0, i1, result)
+            else:
+                # reading and writing is done in order by this process
+                pending = collections.deque()
+                with workerPool(nWorkers, workerKwargs) as apply_async:
+                    for (i0, i1), spectra, maskBlock in blockItems():
+                        pending.append(((i0, i1),
+                                        apply_async(spectra, maskBlock)))
+                        if len(pending) >= 2 * nWorkers:
+                            (i0, i1), result = pending.popleft()
+                            self._writeBlock(out, datasets, progress,
+                                             i0, i1, result.get())
+                    while pending:
+                        (i0, i1), result = pending.popleft()
+                        self._writeBlock(out, datasets, progress,
+                                         i0, i1, result.get())
+
+            outputDict = {}
+            outputDict["names"] = ["Jump", "Edge"]
+            output = numpy.zeros((2,) + imageShape, dtype=numpy.float32)
+            output[0, :] = datasets["Jump"][()]
+            output[1, :] = datasets["Edge"][()]
+            outputDict["images"] = output
+        finally:
+            out.flush()
+            out.close()
 
         t = time.time() - t0
-        _logger.debug("First fit elapsed = %f", t)
-        _logger.debug("Spectra per second = %f", data.shape[0]*data.shape[1]/float(t))
-        t0 = time.time()
+        _logger.debug("Processing elapsed = %f", t)
+        if t > 0:
+            _logger.debug("Spectra per second = %f",
+                          sum(i1 - i0 for i0, i1 in blocks) * nColumns / t)
         return outputDict
 
+    @staticmethod
+    def _maskHash(mask, imageShape):
+        """
+        Hash of the processed pixels (all of them when mask is None).
+        """
+        if mask is None:
+            selected = numpy.ones(imageShape, dtype=numpy.uint8)
+        else:
+            selected = (numpy.asarray(mask) != 0).astype(numpy.uint8)
+            selected = selected.reshape(imageShape)
+        return hashlib.sha1(selected.tobytes()).hexdigest()
+
+    @staticmethod
+    def _isSameProcessing(group, configuration, shape, maskHash, axes):
+        """
+        Check the output group of a previous run was obtained from a stack
+        of the same shape, with the same mask, configuration and output axes.
+        """
+        for path in ["configuration", "stack_shape", "mask_hash"]:
+            if path not in group:
+                return False
+        stored = group["configuration"][()]
+        if hasattr(stored, "decode"):
+            stored = stored.decode("utf-8")
+        if stored != configuration:
+            return False
+        if not numpy.array_equal(group["stack_shape"][()], shape):
+            return False
+        stored = group["mask_hash"][()]
+        if hasattr(stored, "decode"):
+            stored = stored.decode("utf-8")
+        if stored != maskHash:
+            return False
+        for path, axis in axes.items():
+            path = posixpath.join(*path)
+            if path not in group:
+                return False
+            # the axes are stored in single precision
+            if not numpy.array_equal(group[path][()],
+                                     numpy.asarray(axis, numpy.float32)):
+                return False
+        return True
+
+    @staticmethod
+    def _writeBlock(out, datasets, progress, i0, i1, result):
+        """
+        Write the results of the rows [i0, i1) and flag them as processed.
+        """
+        for key, dataset in datasets.items():
+            if key in result:
+                dataset[i0:i1] = result[key]
+            else:
+                # all the pixels of the block are masked
+                dataset[i0:i1] = 0
+        progress[i0:i1] = 1
+        out.flush()
+
+
+def _processBlock(analyzer, spectra, mask, x=None, normalizedIdx=None,
+                  exafsIdx=None):
+    """
+    Process a block of rows of the stack.
+
+    :param analyzer: configured XASClass instance
+    :param array spectra: nRows x nColumns x nChannels
+    :param array mask: nRows x nColumns or None (all pixels processed)
+    :returns dict: the images and spectra of the block, zero where masked
+    """
+    nRows, nColumns = spectra.shape[:2]
+    result = {}
+    for key in ["Edge", "Jump"]:
+        result[key] = numpy.zeros((nRows, nColumns), dtype=numpy.float32)
+    # all the spectra of a chunk are processed at once
+    jStep = min(200, nColumns)
+    for i in range(nRows):
+        jStart = 0
+        while jStart < nColumns:
+            jEnd = min(jStart + jStep, nColumns)
+            chunk = spectra[i, jStart:jEnd]
+            if mask is None:
+                columns = slice(jStart, jEnd)
+            else:
+                selected = numpy.nonzero(mask[i, jStart:jEnd])[0]
+                if selected.size == (jEnd - jStart):
+                    columns = slice(jStart, jEnd)
+                elif selected.size:
+                    chunk = chunk[selected]
+                    columns = jStart + selected
+                else:
+                    jStart = jEnd
+                    continue
+            ddict = analyzer.processMultipleSpectra(x, chunk)
+            images = {"Mu": ddict["Mu"],
+                      "NormalizedMu": ddict["NormalizedMu"][:, normalizedIdx],
+                      "EXAFSNormalized": ddict["EXAFSNormalized"][:, exafsIdx],
+                      "FTIntensity": ddict["FT"]["FTIntensity"],
+                      "FTImaginary": ddict["FT"]["FTImaginary"]}
+            for key, value in images.items():
+                if key not in result:
+                    result[key] = numpy.zeros((nRows, nColumns,
+                                               value.shape[-1]),
+                                              dtype=numpy.float32)
+                result[key][i, columns] = value
+            result["Edge"][i, columns] = ddict["Edge"]
+            result["Jump"][i, columns] = ddict["Jump"]
+            jStart = jEnd
+    return result
+
+
+def numberOfWorkers(nWorkers):
+    """
+    :param int nWorkers: None or 1 (no parallelization), < 1 (number of CPU's)
+    :returns int:
+    """
+    if nWorkers is None:
+        return 1
+    nWorkers = int(nWorkers)
+    if nWorkers < 1:
+        nWorkers = multiprocessing.cpu_count()
+    return nWorkers
+
+
+# Analyzer and keyword arguments of _processBlock in the worker processes
+_WORKER_KWARGS = {}
+
+
+def _workerInit(kwargs):
+    kwargs = dict(kwargs)
+    analyzer = XASClass.XASClass()
+    analyzer.setConfiguration(kwargs.pop("configuration"))
+    _WORKER_KWARGS.clear()
+    _WORKER_KWARGS.update(kwargs)
+    _WORKER_KWARGS["analyzer"] = analyzer
+
+
+def _workerProcessBlock(spectra, mask):
+    kwargs = dict(_WORKER_KWARGS)
+    analyzer = kwargs.pop("analyzer")
+    return _processBlock(analyzer, spectra, mask, **kwargs)
+
+
+@contextmanager
+def workerPool(nWorkers, workerKwargs):
+    """
+    Pool of worker processes for processing blocks of rows
+
+    :param int nWorkers:
+    :param dict workerKwargs: configuration, x, normalizedIdx and exafsIdx
+    :yields callable: spectra(nRows x nColumns x nChannels), mask
+                      -> AsyncResult
+    """
+    pool = multiprocessing.Pool(nWorkers, initializer=_workerInit,
+                                initargs=(workerKwargs,))
+    def apply_async(spectra, mask):
+        return pool.apply_async(_workerProcessBlock, (spectra, mask))
+    try:
+        yield apply_async
+    finally:
+        pool.terminate()
+        pool.join()
+
+
 if __name__ == "__main__":
     _logger.setLevel(logging.DEBUG)
     analyzer = XASClass.XASClass()
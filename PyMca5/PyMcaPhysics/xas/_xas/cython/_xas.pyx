@@ -70,6 +70,57 @@ def polspl(x, y, w, npts, xl, xh, nr, nc):
             &c_xl[0], &c_xh[0], &c_nc[0], c_nr, &c_c[0], c_sizeC)
     return c
 
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def polsplMultiple(x, y, w, npts, xl, xh, nr, nc):
+    """
+    polspl of several spectra in one call.
+
+    x, y and w are 2D arrays with one spectrum per row (first column unused
+    as in polspl), npts is the number of points of each spectrum, xl and xh
+    contain the ranges shared by all the spectra (1D) or the ranges of
+    each spectrum (2D). nr and nc are common to all the spectra.
+    Returns an array with the coefficients of each spectrum in a row.
+    """
+    x = numpy.require(numpy.array(x, dtype=numpy.float64, copy=False, ndmin=2),
+                      requirements=["C", "W"])
+    nSpectra = x.shape[0]
+    c = numpy.zeros((nSpectra, 36), dtype=numpy.float64)
+    cdef double[:, ::1] c_c = c
+    cdef double[:, ::1] c_x = x
+    cdef double[:, ::1] c_y = numpy.require( \
+            numpy.array(y, dtype=numpy.float64, copy=False, ndmin=2),
+            requirements=["C", "W"])
+    cdef double[:, ::1] c_w = numpy.array( \
+            numpy.broadcast_to(numpy.array(w, dtype=numpy.float64,
+                                           copy=False), x.shape),
+            copy=True, order="C")
+    cdef int[::1] c_npts = numpy.array( \
+            numpy.broadcast_to(numpy.array(npts, dtype=numpy.int32),
+                               (nSpectra,)), copy=True, order="C")
+    # polspl modifies the ranges, every spectrum gets its own copy
+    xl = numpy.array(xl, dtype=numpy.float64, copy=False, ndmin=2)
+    xh = numpy.array(xh, dtype=numpy.float64, copy=False, ndmin=2)
+    cdef double[:, ::1] c_xl = numpy.array( \
+            numpy.broadcast_to(xl, (nSpectra, xl.shape[1])),
+            copy=True, order="C")
+    cdef double[:, ::1] c_xh = numpy.array( \
+            numpy.broadcast_to(xh, (nSpectra, xh.shape[1])),
+            copy=True, order="C")
+    cdef int c_nr = nr
+    cdef int[::1] c_nc = numpy.array(nc, dtype=numpy.int32, copy=True)
+    cdef int c_sizeC = c_c.shape[1]
+    cdef int i
+    cdef int c_nSpectra = nSpectra
+    if (c_y.shape[0] != c_nSpectra) or (c_y.shape[1] != c_x.shape[1]):
+        raise ValueError("x and y must have the same shape")
+    with nogil:
+        for i in range(c_nSpectra):
+            _polspl(&c_x[i, 0], &c_y[i, 0], &c_w[i, 0], c_npts[i], \
+                    &c_xl[i, 0], &c_xh[i, 0], &c_nc[0], c_nr, \
+                    &c_c[i, 0], c_sizeC)
+    return c
+
 def polspl2(x,y,w,npts,xl0,xh0,nr,nc):
 
     # ;
@@ -29,4 +29,4 @@
 cimport cython
 
 cdef extern from "polspl.h":
-    void polspl(double *, double *, double *, int, double *, double *, int *, int, double *, int)
+    void polspl(double *, double *, double *, int, double *, double *, int *, int, double *, int) nogil
@@ -25,7 +25,7 @@
 #include <stdio.h>
 #include <math.h>
 #include "polspl.h"
-#define POLABS(x) (x>0) ? x : -x
+#define POLABS(x) (((x) > 0) ? (x) : -(x))
 
 void polspl(double *xx, double *yy, double *w, int npts, \
             double *xl, double *xh, int *nc, int nr, \
@@ -185,7 +185,7 @@ void polspl(double *xx, double *yy, double *w, int npts, \
                 a[m][j] = t;
             }
         }
-        for(j=i1; j<n1+1 ;j++)
+        for(j=i1; j<n+1 ;j++)
         {
             t = a[j][i] / a[i][i];
             for(k=i1; k<n1+1 ;k++)
@@ -33,13 +33,13 @@
 import os
 import numpy
 from PyMca5 import getDataFile
-from PyMca5.PyMcaIO import specfile
+from . import PhysicsDatabase
 
 filename = getDataFile("BindingEnergies.dat")
-sf = specfile.Specfile(filename)
-ElementShells = sf[0].alllabels()
-ElementBinding = numpy.transpose(sf[0].data()).tolist()
-sf = None
+scans = [PhysicsDatabase.getSpecScan(filename, 0)]
+ElementShells = scans[0][0]
+ElementBinding = numpy.transpose(scans[0][1]).tolist()
+scans = None
 
 Elements = ['H', 'He',
             'Li', 'Be', 'B', 'C', 'N', 'O', 'F', 'Ne',
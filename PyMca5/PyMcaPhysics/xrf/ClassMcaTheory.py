@@ -44,12 +44,166 @@
 from PyMca5.PyMcaMath.fitting import SpecfitFuns
 from PyMca5.PyMcaIO import ConfigDict
 from PyMca5.PyMcaMath.fitting import Gefit
+from PyMca5.PyMcaMath.fitting import PeakDerivatives
 from PyMca5 import PyMcaDataDir
 _logger = logging.getLogger(__name__)
 #"python ClassMcaTheory.py -s1.1 --file=03novs060sum.mca --pkm=McaTheory.dat --continuum=0 --strip=1 --sumflag=1 --maxiter=4"
 CONTINUUM_LIST = [None,'Constant','Linear','Parabolic','Linear Polynomial','Exp. Polynomial']
 OLDESCAPE = 0
 MAX_ATTENUATION = 1.0E-300
+
+# escape peaks by detector (material, composition, thresholds, fisx)
+# and by peak energy, shared by all the McaTheory instances
+_ESCAPE_CACHE = {}
+
+
+def clearEscapeCache():
+    """
+    Forget the escape peaks calculated so far.
+    """
+    _ESCAPE_CACHE.clear()
+
+
+def _escapeCacheKey(detele, composition, ethreshold, ithreshold,
+                    nthreshold, fisx):
+    composition = tuple(sorted((str(ele), float(fraction))
+                               for ele, fraction in composition))
+    return (str(detele), composition, float(ethreshold),
+            float(ithreshold), int(nthreshold), int(bool(fisx)))
+
+
+def _asList(value):
+    # ConfigDict reads back a list with a single item as that item
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return [value]
+
+
+def _escapeTableToConfig(key, table):
+    """
+    Escape table as the 'escapes' section of a fit configuration.
+    """
+    detele, composition, ethreshold, ithreshold, nthreshold, fisx = key
+    ddict = {}
+    ddict['detele'] = detele
+    ddict['elements'] = [x[0] for x in composition]
+    ddict['massfractions'] = [x[1] for x in composition]
+    ddict['ethreshold'] = ethreshold
+    ddict['ithreshold'] = ithreshold
+    ddict['nthreshold'] = nthreshold
+    ddict['fisx'] = fisx
+    energies = sorted(table.keys())
+    ddict['energy'] = energies
+    ddict['nescapes'] = [len(table[energy]) for energy in energies]
+    ddict['escape_energy'] = []
+    ddict['escape_rate'] = []
+    ddict['escape_label'] = []
+    for energy in energies:
+        for escape in table[energy]:
+            ddict['escape_energy'].append(float(escape[0]))
+            ddict['escape_rate'].append(float(escape[1]))
+            ddict['escape_label'].append(str(escape[2]))
+    return ddict
+
+
+def _escapeTableFromConfig(ddict):
+    """
+    Inverse of _escapeTableToConfig. It returns (key, table) or
+    (None, {}) when the section cannot be interpreted.
+    """
+    try:
+        composition = zip(_asList(ddict['elements']),
+                          _asList(ddict['massfractions']))
+        key = _escapeCacheKey(ddict['detele'], composition,
+                              ddict['ethreshold'], ddict['ithreshold'],
+                              ddict['nthreshold'], ddict['fisx'])
+        energies = _asList(ddict['energy'])
+        nescapes = _asList(ddict['nescapes'])
+        escapeEnergies = _asList(ddict['escape_energy'])
+        escapeRates = _asList(ddict['escape_rate'])
+        escapeLabels = _asList(ddict['escape_label'])
+        if len(energies) != len(nescapes) or \
+           sum(nescapes) != len(escapeEnergies) or \
+           len(escapeEnergies) != len(escapeRates) or \
+           len(escapeEnergies) != len(escapeLabels):
+            raise ValueError("Inconsistent escape table")
+    except (KeyError, TypeError, ValueError):
+        _logger.warning("Ignoring invalid escapes section of the configuration")
+        return None, {}
+    table = {}
+    i = 0
+    for energy, n in zip(energies, nescapes):
+        table[float(energy)] = [[escapeEnergies[j], escapeRates[j],
+                                 str(escapeLabels[j])]
+                                for j in range(i, i + n)]
+        i += n
+    return key, table
+
+
+class PileupModel(object):
+    """
+    Pile-up (sum) peaks of a spectrum, the same as SpecfitFuns.pileup
+    but the self-convolution of the spectrum is done by FFT, which scales
+    as N log N instead of N**2 with the number of channels.
+
+    Several spectra (the last axis being the channels) can be given at
+    once, with their own zero and gain. The last result is kept and it is
+    given back when the input did not change.
+    """
+    def __init__(self):
+        self._lastInput = None
+        self._lastOutput = None
+
+    def __call__(self, y, xmin=0, zero=0.0, gain=1.0):
+        """
+        :param y: spectrum or spectra (channels on the last axis)
+        :param int xmin: channel of the first point of the spectra
+        :param zero: energy calibration offset (one per spectrum or scalar)
+        :param gain: energy calibration gain (one per spectrum or scalar)
+        :returns: array with the shape of y
+        """
+        y = numpy.array(y, dtype=numpy.float64, copy=False)
+        spectra = y.reshape(-1, y.shape[-1]) if y.ndim else y.reshape(1, 1)
+        # same channel offset as the C code: int(zero/gain)
+        offset = numpy.zeros(spectra.shape[0], dtype=numpy.int64)
+        offset += (numpy.asarray(zero, dtype=numpy.float64) /
+                   numpy.asarray(gain, dtype=numpy.float64)).astype(numpy.int64)
+        xmin = int(xmin)
+        if self._lastInput is not None:
+            lastY, lastXMin, lastOffset = self._lastInput
+            if lastXMin == xmin and \
+               numpy.array_equal(lastOffset, offset) and \
+               numpy.array_equal(lastY, spectra):
+                return self._lastOutput.reshape(y.shape).copy()
+        result = numpy.zeros(spectra.shape, dtype=numpy.float64)
+        for k in numpy.unique(offset):
+            selection = offset == k
+            result[selection] = self._pileup(spectra[selection], xmin, int(k))
+        self._lastInput = spectra.copy(), xmin, offset
+        self._lastOutput = result
+        return result.reshape(y.shape).copy()
+
+    @staticmethod
+    def _pileup(spectra, xmin, k):
+        # ret[i + k + j] += y[i - xmin] * y[j] for i in [xmin, n), i + k >= 0
+        n = spectra.shape[-1]
+        result = numpy.zeros(spectra.shape, dtype=numpy.float64)
+        mlo = max(0, -k - xmin)
+        mhi = n - xmin
+        shift = xmin + k + mlo
+        length = n - shift
+        if (mhi <= mlo) or (length <= 0):
+            return result
+        first = spectra[:, mlo:min(mhi, mlo + length)]
+        second = spectra[:, :min(n, length)]
+        nfft = 1 << int(2 * length - 2).bit_length()
+        conv = numpy.fft.irfft(numpy.fft.rfft(first, nfft) *
+                               numpy.fft.rfft(second, nfft), nfft)
+        start = max(0, shift)
+        result[:, start:] = conv[:, start - shift:n - shift]
+        return result
+
+
 class McaTheory(object):
     def __init__(self, initdict=None, filelist=None, **kw):
         self.ydata0  = None
@@ -105,6 +259,7 @@ def __init__(self, initdict=None, filelist=None, **kw):
         self.laststripanchorsflag = None
         self.laststripanchorslist = None
         self.disableOptimizedLinearFit()
+        self._pileup = PileupModel()
         self.__configure()
         self.startFit = self.startfit
         #incompatible with multiple energies
@@ -123,6 +278,80 @@ def useFisxEscape(self, flag=None):
         else:
             self.__USE_FISX_ESCAPE = False
 
+    def _getEscapeTable(self):
+        """
+        Escape peaks calculated so far for the current detector, by peak
+        energy. The table is shared by all the instances and it is
+        completed with the 'escapes' section of the configuration when
+        that section was calculated for the same detector and thresholds.
+        """
+        detector = self.config['detector']
+        detele = detector['detele']
+        composition = Elements.getMaterialMassFractions([detele], [1.0])
+        key = _escapeCacheKey(detele, composition.items(),
+                              detector['ethreshold'],
+                              detector['ithreshold'],
+                              detector['nthreshold'],
+                              self.__USE_FISX_ESCAPE)
+        table = _ESCAPE_CACHE.setdefault(key, {})
+        if self.config.get('escapes', {}):
+            savedKey, savedTable = _escapeTableFromConfig(self.config['escapes'])
+            if savedKey == key:
+                for energy in savedTable:
+                    if energy not in table:
+                        table[energy] = savedTable[energy]
+        return key, table
+
+    def __getEscapes(self, table, energies, used=None):
+        """
+        Escape peaks of the given peak energies, only the ones missing
+        in the table are calculated.
+        """
+        detector = self.config['detector']
+        detele = detector['detele']
+        ethreshold = detector['ethreshold']
+        ithreshold = detector['ithreshold']
+        nthreshold = detector['nthreshold']
+        energies = [float(energy) for energy in energies]
+        missing = [energy for energy in energies if energy not in table]
+        missing = sorted(set(missing))
+        if missing and self.__USE_FISX_ESCAPE:
+            _logger.debug("Using fisx escape")
+            xcom = FisxHelper.xcom
+            detector_composition = Elements.getMaterialMassFractions([detele],
+                                                                     [1.0])
+            xcom.updateEscapeCache(detector_composition,
+                                   missing,
+                                   energyThreshold=ethreshold,
+                                   intensityThreshold=ithreshold,
+                                   nThreshold=nthreshold)
+            for energy in missing:
+                _esc_ = xcom.getEscape(detector_composition,
+                                       energy,
+                                       energyThreshold=ethreshold,
+                                       intensityThreshold=ithreshold,
+                                       nThreshold=nthreshold)
+                _esc_ = [[_esc_[x]["energy"],
+                          _esc_[x]["rate"],
+                          x[:-3].replace("_"," ")] for x in _esc_]
+                table[energy] = Elements._filterPeaks(_esc_,
+                                                      ethreshold=ethreshold,
+                                                      ithreshold=ithreshold,
+                                                      nthreshold=nthreshold,
+                                                      absoluteithreshold=True,
+                                                      keeptotalrate=False)
+        else:
+            for energy in missing:
+                table[energy] = Elements.getEscape([detele, 1.0, 1.0], energy,
+                                                   ethreshold=ethreshold,
+                                                   ithreshold=ithreshold,
+                                                   nthreshold=nthreshold)
+        if used is not None:
+            for energy in energies:
+                used[energy] = table[energy]
+        return [[list(escape) for escape in table[energy]]
+                for energy in energies]
+
     def enableOptimizedLinearFit(self):
         self._batchFlag = True
 
@@ -163,6 +392,13 @@ def configure(self, newdict=None):
         self.__configure()
         return copy.deepcopy(self.config)
 
+    def getExcitationEnergy(self):
+        """
+        Highest excitation energy of the current configuration (None if
+        not defined). The emission lines are selected at this energy.
+        """
+        return self.__maxEnergy
+
     def _updateCallback(self):
         print("no update callback")
         #self.config['fit']['energy'] = Elements.Element['Fe']['buildparameters']['energy']
@@ -239,6 +475,7 @@ def __configure(self):
                         if maxenergy is None:maxenergy=self.config['fit']['energy'][i]
                         if maxenergy < self.config['fit']['energy'][i]:
                             maxenergy = self.config['fit']['energy'][i]
+        self.__maxEnergy = maxenergy
         self.config['fit']['scatterflag']  = self.config['fit'].get('scatterflag',0)
         self.config['fit']['deltaonepeak'] = self.config['fit'].get('deltaonepeak',0.010)
         self.config['fit']['linpolorder']  = self.config['fit'].get('linpolorder',6)
@@ -259,6 +496,9 @@ def __configure(self):
         self.config['detector']['ethreshold'] = ethreshold
         self.config['detector']['ithreshold'] = ithreshold
         self.config['detector']['nthreshold'] = nthreshold
+        if self.config['fit']['escapeflag']:
+            escapeKey, escapeTable = self._getEscapeTable()
+            usedEscapes = {}
         usematrix = 0
         attenuatorlist =[]
         filterlist = []
@@ -315,8 +555,6 @@ def __configure(self):
                   ele = element[0:1].upper()+element[1:2].lower()
               else:
                   ele = element.upper()
-              if maxenergy != Elements.Element[ele]['buildparameters']['energy']:
-                  Elements.updateDict (energy= maxenergy)
               if type(self.config['peaks'][element]) == type([]):
                   for peak in self.config['peaks'][element]:
                       data.append([Elements.getz(ele),ele,peak])
@@ -449,39 +687,11 @@ def __configure(self):
             PEAKS0ESCAPE.append([])
             _nescape_ = 0
             if self.config['fit']['escapeflag']:
-                if self.__USE_FISX_ESCAPE:
-                    _logger.debug("Using fisx escape")
-                    xcom = FisxHelper.xcom
-                    detector_composition = Elements.getMaterialMassFractions([detele],
-                                                                             [1.0])
-                    xcom.updateEscapeCache(detector_composition,
-                                           [newpeaks[i][1] for i in range(len(newpeaks))],
-                                           energyThreshold=ethreshold,
-                                           intensityThreshold=ithreshold,
-                                           nThreshold=nthreshold)
-                    for i in range(len(newpeaks)):
-                        _esc_ = xcom.getEscape(detector_composition,
-                                       newpeaks[i][1],
-                                       energyThreshold=ethreshold,
-                                       intensityThreshold=ithreshold,
-                                       nThreshold=nthreshold)
-                        _esc_ = [[_esc_[x]["energy"],
-                                  _esc_[x]["rate"],
-                                   x[:-3].replace("_"," ")] for x in _esc_]
-                        _esc_ = Elements._filterPeaks(_esc_, ethreshold=ethreshold,
-                                          ithreshold=ithreshold,
-                                          nthreshold=nthreshold,
-                                           absoluteithreshold=True,
-                                           keeptotalrate=False)
-                        PEAKS0ESCAPE[-1].append(_esc_)
-                        _nescape_ += len(_esc_)
-                else:
-                    for i in range(len(newpeaks)):
-                        _esc_ = Elements.getEscape([detele,1.0,1.0], newpeaks[i][1],
-                                            ethreshold=ethreshold, ithreshold=ithreshold,
-                                            nthreshold=nthreshold)
-                        PEAKS0ESCAPE[-1].append(_esc_)
-                        _nescape_ += len(_esc_)
+                for _esc_ in self.__getEscapes(escapeTable,
+                                               [peak[1] for peak in newpeaks],
+                                               usedEscapes):
+                    PEAKS0ESCAPE[-1].append(_esc_)
+                    _nescape_ += len(_esc_)
             PEAKS0.append(numpy.array(newpeaks))
             PEAKS0NAMES.append(newpeaksnames)
             #print ele,"PEAKS0ESCAPE[-1] = ",PEAKS0ESCAPE[-1]
@@ -523,8 +733,6 @@ def __configure(self):
                         ele = element[0:1].upper()+element[1:2].lower()
                     else:
                         ele = element.upper()
-                    if maxenergy != Elements.Element[ele]['buildparameters']['energy']:
-                        Elements.updateDict (energy= maxenergy)
                     if type(self.config['peaks'][element]) == type([]):
                         for peak in self.config['peaks'][element]:
                             data.append([Elements.getz(ele),ele,peak])
@@ -553,14 +761,16 @@ def __configure(self):
                     else:
                         ele = element.upper()
                     rays= item[2] +' xrays'
-                    if not rays in Elements.Element[ele]['rays']:continue
+                    elementTable = Elements.getElementRateTable(ele,
+                                                        energy=maxenergy)
+                    if not rays in elementTable['rays']:continue
                     eta = 0.0
-                    for transition in Elements.Element[ele][rays]:
+                    for transition in elementTable[rays]:
                         eta = 0.0
                         fwhm = numpy.sqrt(noise*noise + \
-                                0.00385 *Elements.Element[ele][transition]['energy']* fano*2.3548*2.3548)
-                        newpeaks.append([Elements.Element[ele][transition]['rate'],
-                                      Elements.Element[ele][transition]['energy'],
+                                0.00385 *elementTable[transition]['energy']* fano*2.3548*2.3548)
+                        newpeaks.append([elementTable[transition]['rate'],
+                                      elementTable[transition]['energy'],
                                        fwhm,eta])
                        #               1.00,eta])
                         newpeaksnames.append(transition)
@@ -629,7 +839,7 @@ def __configure(self):
                                     except:
                                         print("warning, alphaOut set to 45 degrees")
                                         alphaOut  = 45.0
-                                    matrixExcitationEnergy = Elements.Element[ele]['buildparameters']['energy']
+                                    matrixExcitationEnergy = elementTable['buildparameters']['energy']
                                     #matrixExcitationEnergy = self.config['fit']['energy']
                                     if matrixExcitationEnergy is not None:
                                         transmissionenergies.append(matrixExcitationEnergy)
@@ -761,39 +971,11 @@ def __configure(self):
                     PEAKS0ESCAPE.append([])
                     _nescape_ = 0
                     if self.config['fit']['escapeflag']:
-                        if self.__USE_FISX_ESCAPE:
-                            _logger.debug("Using fisx escape")
-                            xcom = FisxHelper.xcom
-                            detector_composition = Elements.getMaterialMassFractions([detele],
-                                                                             [1.0])
-                            xcom.updateEscapeCache(detector_composition,
-                                                   [newpeaks[i][1] for i in range(len(newpeaks))],
-                                                   energyThreshold=ethreshold,
-                                                   intensityThreshold=ithreshold,
-                                                   nThreshold=nthreshold)
-                            for i in range(len(newpeaks)):
-                                _esc_ = xcom.getEscape(detector_composition,
-                                               newpeaks[i][1],
-                                               energyThreshold=ethreshold,
-                                               intensityThreshold=ithreshold,
-                                               nThreshold=nthreshold)
-                                _esc_ = [[_esc_[x]["energy"],
-                                          _esc_[x]["rate"],
-                                           x[:-3].replace("_"," ")] for x in _esc_]
-                                _esc_ = Elements._filterPeaks(_esc_, ethreshold=ethreshold,
-                                                  ithreshold=ithreshold,
-                                                  nthreshold=nthreshold,
-                                                   absoluteithreshold=True,
-                                                   keeptotalrate=False)
-                                PEAKS0ESCAPE[-1].append(_esc_)
-                                _nescape_ += len(_esc_)
-                        else:
-                            for i in range(len(newpeaks)):
-                                _esc_ = Elements.getEscape([detele,1.0,1.0], newpeaks[i][1],
-                                                    ethreshold=ethreshold, ithreshold=ithreshold,
-                                                    nthreshold=nthreshold)
-                                PEAKS0ESCAPE[-1].append(_esc_)
-                                _nescape_ += len(_esc_)
+                        for _esc_ in self.__getEscapes(escapeTable,
+                                            [peak[1] for peak in newpeaks],
+                                            usedEscapes):
+                            PEAKS0ESCAPE[-1].append(_esc_)
+                            _nescape_ += len(_esc_)
                     PEAKS0.append(numpy.array(newpeaks))
                     PEAKS0NAMES.append(newpeaksnames)
                     #print ele,"PEAKS0ESCAPE[-1] = ",PEAKS0ESCAPE[-1]
@@ -861,34 +1043,9 @@ def __configure(self):
                                 PEAKS0ESCAPE.append([])
                                 _nescape_ = 0
                                 if self.config['fit']['escapeflag']:
-                                    if self.__USE_FISX_ESCAPE:
-                                        _logger.debug("Using fisx escape")
-                                        xcom = FisxHelper.xcom
-                                        detector_composition = Elements.getMaterialMassFractions([detele],
-                                                                                                 [1.0])
-                                        xcom.updateEscapeCache(detector_composition,
-                                                               [ene],
-                                                               energyThreshold=ethreshold,
-                                                               intensityThreshold=ithreshold,
-                                                               nThreshold=nthreshold)
-                                        _esc_ = xcom.getEscape(detector_composition,
-                                                       ene,
-                                                       energyThreshold=ethreshold,
-                                                       intensityThreshold=ithreshold,
-                                                       nThreshold=nthreshold)
-                                        _esc_ = [[_esc_[x]["energy"],
-                                                  _esc_[x]["rate"],
-                                                  x[:-3].replace("_"," ")] for x in _esc_]
-                                        _esc_ = Elements._filterPeaks(_esc_, ethreshold=ethreshold,
-                                                              ithreshold=ithreshold,
-                                                              nthreshold=nthreshold,
-                                                              absoluteithreshold=True,
-                                                              keeptotalrate=False)
-                                    else:
-                                        _esc_ = Elements.getEscape([detele,1.0,1.0],
-                                                            ene,
-                                                            ethreshold=ethreshold, ithreshold=ithreshold,
-                                                            nthreshold=nthreshold)
+                                    _esc_ = self.__getEscapes(escapeTable,
+                                                              [ene],
+                                                              usedEscapes)[0]
                                     PEAKS0ESCAPE[-1].append(_esc_)
                                     _nescape_ += len(_esc_)
                                 r = 1
@@ -964,6 +1121,11 @@ def __configure(self):
         self.NGLOBAL    = NGLOBAL
         self.PARAMETERS = PARAMETERS
         self.ESCAPE     = self.config['fit']['escapeflag']
+        if self.ESCAPE:
+            # keep the escape peaks with the configuration for next time
+            self.config['escapes'] = _escapeTableToConfig(escapeKey,
+                                                          usedEscapes)
+        self.__buildPeakTables()
         self.__SUM        = self.config['fit']['sumflag']
         self.__CONTINUUM     = CONTINUUM
         self.MAXITER    = self.config['fit']['maxiter']
@@ -1278,124 +1440,132 @@ def __getselfzz(self):
     def getPeakMatrixContribution(self,param0,t0=None,hypermet=None,
                                   continuum=None,summing=None):
         """
-        For the time being a huge copy paste from mcatheory
+        Contribution of each peak group for a unit area (one column per
+        group) evaluated at the array of points t0.
         """
-        if continuum is None:
-            continuum = self.__CONTINUUM
         if hypermet is None:
             hypermet = self.__HYPERMET
-        if summing is None:
-            summing  = self.__SUM
         param= numpy.array(param0)
-        #param= numpy.ones(param.shape, numpy.float)
         if t0 is None:t0 = self.xdata
         x    = numpy.array(t0)
-        matrix = numpy.zeros((len(x),len(param)-self.NGLOBAL)).astype(numpy.float)
-
-
+        ngroups = len(param) - self.NGLOBAL
+        matrix = numpy.zeros((len(x), ngroups)).astype(numpy.float)
         zero = param[0]
         gain = param[1]
         energy=zero + gain * x
-        #print energy
-        noise= param[2] * param[2]
-        fano = param[3] * 2.3548*2.3548*0.00385
-        #t=time.time()
+        PEAKSW = self.PEAKSW
+        self.__fillPeakTables(param, hypermet,
+                              areas=numpy.ones((ngroups,), numpy.float))
+        for i in range(ngroups):
+            if hypermet:
+                result = SpecfitFuns.ahypermet(PEAKSW[i],energy,hypermet)
+            else:
+                result = SpecfitFuns.apvoigt(PEAKSW[i],energy)
+            matrix[:,i] = result[:,0]
+        return matrix
+
+    def __buildPeakTables(self):
+        """
+        Flatten the peak tables of all the peak groups.
+
+        PEAKS0 and PEAKSW become views of two arrays with the lines of all
+        the groups. For each row of the PEAKSW tables, the line it derives
+        from, its group, its escape rate and its energies are kept in flat
+        arrays so that __fillPeakTables does not need to loop over groups
+        and escape lines.
+        """
         PEAKS0 = self.PEAKS0
-        PEAKS0ESCAPE = self.PEAKS0ESCAPE
         PEAKSW = self.PEAKSW
-        PARAMETERS = self.PARAMETERS
-        FASTER = 0
-        for i in range(len(param[self.NGLOBAL:])):
-            result = 0 * energy
+        if self.__HYPERMET:
+            ncolumns = 3 + 5
+        else:
+            ncolumns = 3 + 1
+        if len(PEAKS0):
+            self.__peaks0 = numpy.concatenate(PEAKS0).astype(numpy.float)
+            self.__peaksw = numpy.concatenate(PEAKSW).astype(numpy.float)
+        else:
+            self.__peaks0 = numpy.zeros((0, 4), numpy.float)
+            self.__peaksw = numpy.zeros((0, ncolumns), numpy.float)
+        lines = []
+        groups = []
+        rates = []
+        energies = []
+        main = []
+        n0 = 0
+        nw = 0
+        for i in range(len(PEAKS0)):
+            (r, c) = (PEAKS0[i]).shape
+            rw = PEAKSW[i].shape[0]
+            lines.extend(range(n0, n0 + r))
+            rates.extend([1.0] * r)
+            energies.extend(PEAKS0[i][:,1] * 1.0)
+            main.extend([True] * r)
             if self.ESCAPE:
-                #area = param[NGLOBAL+i]
-                (r,c) = (PEAKS0[i]).shape
-                PEAKSW[i][0:r,0] = PEAKS0[i][:,0] * 1 * gain
-                PEAKSW[i][0:r,1] = PEAKS0[i][:,1] * 1.0
-                PEAKSW[i][0:r,2] = numpy.sqrt(noise + PEAKS0[i][:,1] * fano)
-                #escape
                 if OLDESCAPE:
-                    PEAKSW[i][r:,0] = PEAKSW[i][0:r,0] * PEAKS0[i][:,3]
-                    PEAKSW[i][r:,1] = PEAKS0[i][:,1] - self.config['detector']['detene']
-                    PEAKSW[i][r:,2] = numpy.sqrt(noise + \
-                                        (PEAKSW[i][r:,1]>0) * PEAKSW[i][r:,1] * fano)
+                    lines.extend(range(n0, n0 + r))
+                    rates.extend(PEAKS0[i][:,3])
+                    energies.extend(PEAKS0[i][:,1] - \
+                                    self.config['detector']['detene'])
                 else:
-                    ii=0
-                    j=0
-                    for esc_group in PEAKS0ESCAPE[i]:
+                    ii = n0
+                    for esc_group in self.PEAKS0ESCAPE[i]:
                         for esc_line in esc_group:
-                            esc_ene  = esc_line[0] * 1.0
-                            esc_rate = esc_line[1]
-                            PEAKSW[i][j+r,0] =  PEAKSW[i][ii,0] * esc_rate
-                            PEAKSW[i][j+r,1] =  esc_ene
-                            j = j + 1
+                            lines.append(ii)
+                            rates.append(esc_line[1])
+                            energies.append(esc_line[0] * 1.0)
                         ii = ii + 1
-                    PEAKSW[i][r:, 2] = numpy.sqrt(noise + \
-                                    (PEAKSW[i][r:,1]>0) * PEAKSW[i][r:,1] * fano)
-                (rw,cw) = (PEAKSW[i]).shape
-                if 0 and self.PARAMETERS[self.NGLOBAL+i] =='Fe K':
-                  for ii in range(rw):
-                    if ii < r:
-                        print(self.PARAMETERS[self.NGLOBAL+i],"PEAK ",ii,PEAKSW[i][ii])
-                    else:
-                        print(self.PARAMETERS[self.NGLOBAL+i],"PEAKesc ",ii,PEAKSW[i][ii])
-                #print PARAMETERS[self.NGLOBAL+i]
-                #print PEAKSW[i][:,1]
-                #print PEAKS0ESCAPE[i]
-                #for j in range(PEAKSW[i].shape[0]):
-                #    print "H = ", PEAKSW[i][j*r,0],"E = ",PEAKSW[i][j*r,1]
+                main.extend([False] * (rw - r))
+            groups.extend([i] * rw)
+            PEAKS0[i] = self.__peaks0[n0:(n0 + r)]
+            PEAKSW[i] = self.__peaksw[nw:(nw + rw)]
+            n0 += r
+            nw += rw
+        self.__peakLine = numpy.array(lines, dtype=numpy.int64)
+        self.__peakGroup = numpy.array(groups, dtype=numpy.int64)
+        self.__peakEscapeRate = numpy.array(rates, dtype=numpy.float)
+        self.__peakEnergy = numpy.array(energies, dtype=numpy.float)
+        self.__peakMain = numpy.array(main, dtype=numpy.bool_)
+        # escape peaks below zero energy get the width at zero energy
+        self.__peakWidthEnergy = numpy.where(self.__peakMain,
+                        self.__peakEnergy,
+                        (self.__peakEnergy > 0) * self.__peakEnergy)
+
+    def __fillPeakTables(self, param, hypermet, areas=None):
+        """
+        Fill the PEAKSW tables of all the peak groups at once.
 
-                #if HYPERMET:
-                if hypermet:
-                    PEAKSW[i] [0:r,3] = param[PARAMETERS.index('ST AreaR')]
-                    PEAKSW[i] [:,4] = param[PARAMETERS.index('ST SlopeR')]
-                    PEAKSW[i] [0:r,5] = param[PARAMETERS.index('LT AreaR')]
-                    PEAKSW[i] [:,6] = param[PARAMETERS.index('LT SlopeR')]
-                    PEAKSW[i] [0:r,7] = param[PARAMETERS.index('STEP HeightR')]
-                    #neglect tails in escape peaks
-                    PEAKSW[i] [r:,3] = 0.0
-                    PEAKSW[i] [r:,5] = 0.0
-                    PEAKSW[i] [r:,7] = 0.0
-                if not FASTER:
-                    #if HYPERMET:
-                    if hypermet:
-                        if i == 0:
-                            result = SpecfitFuns.ahypermet(PEAKSW[i],energy,hypermet)
-                        else:
-                            result += SpecfitFuns.ahypermet(PEAKSW[i],energy,hypermet)
-                    else:
-                        if i == 0:
-                            result = SpecfitFuns.apvoigt(PEAKSW[i],energy)
-                        else:
-                            result += SpecfitFuns.apvoigt(PEAKSW[i],energy)
-            else:
-                PEAKSW[i][:,0] = PEAKS0[i][:,0] * param[self.NGLOBAL+i] * gain
-                PEAKSW[i][:,1] = PEAKS0[i][:,1] * 1.0
-                PEAKSW[i][:,2] = numpy.sqrt(noise + PEAKS0[i][:,1] * fano)
-                if hypermet:
-                    PEAKSW[i] [:,3] = param[PARAMETERS.index('ST AreaR')]
-                    PEAKSW[i] [:,4] = param[PARAMETERS.index('ST SlopeR')]
-                    PEAKSW[i] [:,5] = param[PARAMETERS.index('LT AreaR')]
-                    PEAKSW[i] [:,6] = param[PARAMETERS.index('LT SlopeR')]
-                    PEAKSW[i] [:,7] = param[PARAMETERS.index('STEP HeightR')]
-                else:
-                    #pseudo voigt
-                    PEAKSW[i] [:,3] = param[PARAMETERS.index('Eta Factor')]
-                if not FASTER:
-                    if hypermet:
-                        if i == 0:
-                            result = SpecfitFuns.ahypermet(PEAKSW[i],energy,hypermet)
-                        else:
-                            result += SpecfitFuns.ahypermet(PEAKSW[i],energy,hypermet)
-                    else:
-                        if i == 0:
-                            result = SpecfitFuns.apvoigt(PEAKSW[i],energy)
-                        else:
-                            result += SpecfitFuns.apvoigt(PEAKSW[i],energy)
-            #print "shape = ",result.shape
-            #print "matrix = ",matrix.shape
-            matrix[:,i] = result[:,0]
-        return matrix
+        :param param: fit parameters
+        :param hypermet: hypermet flag, zero for pseudo-Voigt peaks
+        :param areas: group areas to use instead of the ones in param
+        :returns: the concatenation of the PEAKSW tables (they are views)
+        """
+        PARAMETERS = self.PARAMETERS
+        gain = param[1]
+        noise= param[2] * param[2]
+        fano = param[3] * 2.3548*2.3548*0.00385
+        if areas is None:
+            areas = param[self.NGLOBAL:]
+        peaksw = self.__peaksw
+        peaksw[:,0] = self.__peaks0[self.__peakLine, 0] * \
+                      areas[self.__peakGroup] * gain
+        if self.ESCAPE:
+            peaksw[:,0] *= self.__peakEscapeRate
+        peaksw[:,1] = self.__peakEnergy
+        peaksw[:,2] = numpy.sqrt(noise + self.__peakWidthEnergy * fano)
+        if hypermet:
+            # neglect tails in escape peaks
+            main = self.__peakMain
+            peaksw[:,3] = numpy.where(main,
+                                param[PARAMETERS.index('ST AreaR')], 0.0)
+            peaksw[:,4] = param[PARAMETERS.index('ST SlopeR')]
+            peaksw[:,5] = numpy.where(main,
+                                param[PARAMETERS.index('LT AreaR')], 0.0)
+            peaksw[:,6] = param[PARAMETERS.index('LT SlopeR')]
+            peaksw[:,7] = numpy.where(main,
+                                param[PARAMETERS.index('STEP HeightR')], 0.0)
+        else:
+            peaksw[:,3] = param[PARAMETERS.index('Eta Factor')]
+        return peaksw
 
     def linearMcaTheory(self, param0, t0, hypermet=None, continuum=None, summing=None):
         if continuum is None:
@@ -1417,7 +1587,7 @@ def linearMcaTheory(self, param0, t0, hypermet=None, continuum=None, summing=Non
             result += self.continuum(param,x)
         if summing:
             xmin=int(x[0])
-            return result+param[4]*SpecfitFuns.pileup(result, xmin, zero, gain)
+            return result+param[4]*self._pileup(result, xmin, zero, gain)
         else:
             return result
 
@@ -1433,122 +1603,32 @@ def mcatheory(self,param0,t0,hypermet=None,continuum=None,summing=None):
         zero = param[0]
         gain = param[1]
         energy=zero + gain * x
-        #print energy
-        noise= param[2] * param[2]
-        fano = param[3] * 2.3548*2.3548*0.00385
-        #t=time.time()
-        PEAKS0 = self.PEAKS0
-        PEAKS0ESCAPE = self.PEAKS0ESCAPE
         PEAKSW = self.PEAKSW
-        PARAMETERS = self.PARAMETERS
-        FASTER = self.FASTER
-        for i in range(len(param[self.NGLOBAL:])):
-            if self.ESCAPE:
-                #area = param[NGLOBAL+i]
-                (r,c) = (PEAKS0[i]).shape
-                PEAKSW[i][0:r,0] = PEAKS0[i][:,0] * param[self.NGLOBAL+i] * gain
-                PEAKSW[i][0:r,1] = PEAKS0[i][:,1] * 1.0
-                PEAKSW[i][0:r,2] = numpy.sqrt(noise + PEAKS0[i][:,1] * fano)
-                #escape
-                if OLDESCAPE:
-                    PEAKSW[i][r:,0] = PEAKSW[i][0:r,0] * PEAKS0[i][:,3]
-                    PEAKSW[i][r:,1] = PEAKS0[i][:,1] - self.config['detector']['detene']
-                    PEAKSW[i][r:,2] = numpy.sqrt(noise + \
-                                        (PEAKSW[i][r:,1]>0) * PEAKSW[i][r:,1] * fano)
-                else:
-                    ii=0
-                    j=0
-                    for esc_group in PEAKS0ESCAPE[i]:
-                        for esc_line in esc_group:
-                            esc_ene  = esc_line[0] * 1.0
-                            esc_rate = esc_line[1]
-                            PEAKSW[i][j+r,0] =  PEAKSW[i][ii,0] * esc_rate
-                            PEAKSW[i][j+r,1] =  esc_ene
-                            j = j + 1
-                        ii = ii + 1
-                    PEAKSW[i][r:, 2] = numpy.sqrt(noise + \
-                                    (PEAKSW[i][r:,1]>0) * PEAKSW[i][r:,1] * fano)
-                (rw,cw) = (PEAKSW[i]).shape
-                if 0 and self.PARAMETERS[self.NGLOBAL+i] =='Fe K':
-                  for ii in range(rw):
-                    if ii < r:
-                        print(self.PARAMETERS[self.NGLOBAL+i],"PEAK ",ii,PEAKSW[i][ii])
-                    else:
-                        print(self.PARAMETERS[self.NGLOBAL+i],"PEAKesc ",ii,PEAKSW[i][ii])
-                #print PARAMETERS[self.NGLOBAL+i]
-                #print PEAKSW[i][:,1]
-                #print PEAKS0ESCAPE[i]
-                #for j in range(PEAKSW[i].shape[0]):
-                #    print "H = ", PEAKSW[i][j*r,0],"E = ",PEAKSW[i][j*r,1]
-
+        # the PEAKSW tables are views of the filled table
+        peaksw = self.__fillPeakTables(param, hypermet)
+        if self.FASTER:
+            if len(PEAKSW[:]):
                 #if HYPERMET:
                 if hypermet:
-                    PEAKSW[i] [0:r,3] = param[PARAMETERS.index('ST AreaR')]
-                    PEAKSW[i] [:,4] = param[PARAMETERS.index('ST SlopeR')]
-                    PEAKSW[i] [0:r,5] = param[PARAMETERS.index('LT AreaR')]
-                    PEAKSW[i] [:,6] = param[PARAMETERS.index('LT SlopeR')]
-                    PEAKSW[i] [0:r,7] = param[PARAMETERS.index('STEP HeightR')]
-                    #neglect tails in escape peaks
-                    PEAKSW[i] [r:,3] = 0.0
-                    PEAKSW[i] [r:,5] = 0.0
-                    PEAKSW[i] [r:,7] = 0.0
+                    result = SpecfitFuns.fastahypermet(peaksw,energy,hypermet)
                 else:
-                    PEAKSW[i] [:,3] = param[PARAMETERS.index('Eta Factor')]
-                if not FASTER:
-                    print("not FASTER")
-                    #if HYPERMET:
-                    if hypermet:
-                        if i == 0:
-                            result = SpecfitFuns.ahypermet(PEAKSW[i],energy,hypermet)
-                        else:
-                            result += SpecfitFuns.ahypermet(PEAKSW[i],energy,hypermet)
-                    else:
-                        if i == 0:
-                            result = SpecfitFuns.apvoigt(PEAKSW[i],energy)
-                        else:
-                            result += SpecfitFuns.apvoigt(PEAKSW[i],energy)
+                    result = SpecfitFuns.apvoigt(peaksw,energy)
             else:
-                PEAKSW[i][:,0] = PEAKS0[i][:,0] * param[self.NGLOBAL+i] * gain
-                PEAKSW[i][:,1] = PEAKS0[i][:,1] * 1.0
-                PEAKSW[i][:,2] = numpy.sqrt(noise + PEAKS0[i][:,1] * fano)
+                result = 0.0 * x
+        else:
+            result = 0.0 * x
+            for i in range(len(PEAKSW)):
                 if hypermet:
-                    PEAKSW[i] [:,3] = param[PARAMETERS.index('ST AreaR')]
-                    PEAKSW[i] [:,4] = param[PARAMETERS.index('ST SlopeR')]
-                    PEAKSW[i] [:,5] = param[PARAMETERS.index('LT AreaR')]
-                    PEAKSW[i] [:,6] = param[PARAMETERS.index('LT SlopeR')]
-                    PEAKSW[i] [:,7] = param[PARAMETERS.index('STEP HeightR')]
-                else:
-                    PEAKSW[i] [:,3] = param[PARAMETERS.index('Eta Factor')]
-                if not FASTER:
-                    if hypermet:
-                        if i == 0:
-                            result = SpecfitFuns.ahypermet(PEAKSW[i],energy,hypermet)
-                        else:
-                            result += SpecfitFuns.ahypermet(PEAKSW[i],energy,hypermet)
+                    if i == 0:
+                        result = SpecfitFuns.ahypermet(PEAKSW[i],energy,hypermet)
                     else:
-                        if i == 0:
-                            result = SpecfitFuns.apvoigt(PEAKSW[i],energy)
-                        else:
-                            result += SpecfitFuns.apvoigt(PEAKSW[i],energy)
-        #print PARAMETERS[self.NGLOBAL+4]
-        #print self.PEAKS0NAMES[4]
-        #print PEAKSW[4]
-        #print "loop takes ",time.time()-t
-        #loop takes 0.006 seconds
-        #t=time.time()
-        if FASTER:
-            if len(PEAKSW[:]):
-                a=numpy.concatenate(PEAKSW[:])
-                #t=time.time()
-                #result = SpecfitFuns.agauss(a,energy)
-                #if HYPERMET:
-                if hypermet:
-                    result = SpecfitFuns.fastahypermet(a,energy,hypermet)
+                        result += SpecfitFuns.ahypermet(PEAKSW[i],energy,hypermet)
                 else:
-                    result = SpecfitFuns.apvoigt(a,energy)
-            else:
-                result = 0.0 * x
-            #print "eval = ",time.time()-t
+                    if i == 0:
+                        result = SpecfitFuns.apvoigt(PEAKSW[i],energy)
+                    else:
+                        result += SpecfitFuns.apvoigt(PEAKSW[i],energy)
+
         #evaluation takes 0.058 seconds
         #with less peaks 0.036
         #with tabulated function 0.018
@@ -1566,7 +1646,7 @@ def mcatheory(self,param0,t0,hypermet=None,continuum=None,summing=None):
           else:
             #summing takes 0.0047 seconds
             xmin=int(x[0])
-            return result+param[4]*SpecfitFuns.pileup(result, xmin, zero, gain)
+            return result+param[4]*self._pileup(result, xmin, zero, gain)
         else:
             return result
 
@@ -1792,6 +1872,281 @@ def analyticalDerivative(self, param0, index, t0):
             #print "f1,f2,delta = ",f1,f2,delta
             return (f1-f2) / (2.0 * delta)
 
+    def _getPeakTable(self, param, hypermet):
+        """
+        Peak table of all the peaks of all the peak groups as evaluated by
+        mcatheory (the concatenation of the PEAKSW tables) and, for each
+        peak, its area per unit of group area, its group index, the energy
+        used to calculate its width and a flag telling if it is not an escape
+        peak.
+        """
+        table = self.__fillPeakTables(param, hypermet).copy()
+        units = self.__peaks0[self.__peakLine, 0] * param[1]
+        if self.ESCAPE:
+            units *= self.__peakEscapeRate
+        return table, units, self.__peakGroup, self.__peakWidthEnergy, \
+               self.__peakMain
+
+    def analyticalJacobian(self, param0, indices, t0):
+        """
+        analyticalJacobian(self, parameters, indices, x)
+        Internal function to calculate at once the derivatives of the
+        fitting function f(parameters, x) respect to the parameters given by
+        the indices at the array of points x.
+
+        All the peaks are evaluated in a single pass instead of once (or
+        twice for the numerical derivatives) per parameter. As in
+        analyticalDerivative, the pile-up only contributes to the derivative
+        respect to the Sum parameter.
+
+        :returns: array of shape (len(indices), len(x))
+        """
+        NGLOBAL = self.NGLOBAL
+        HYPERMET = self.__HYPERMET
+        PARAMETERS = self.PARAMETERS
+        param = numpy.array(param0, dtype=numpy.float)
+        x = numpy.array(t0, dtype=numpy.float)
+        zero = param[0]
+        gain = param[1] * 1.0
+        energy = zero + gain * x
+        table, units, groups, widthEnergies, main = \
+                                    self._getPeakTable(param, HYPERMET)
+        npeaks, ncolumns = table.shape
+        # the derivatives respect to the parameters are linear combinations
+        # of the derivatives respect to the columns of the peak table
+        # rows 0 and 1 are the peaks and their derivative respect to energy
+        coefficients = numpy.zeros((len(indices) + 2, ncolumns, npeaks),
+                                   dtype=numpy.float)
+        coefficients[0, 0] = table[:, 0]
+        coefficients[1, 1] = -1.0
+        columns = {'ST AreaR': 3, 'ST SlopeR': 4, 'LT AreaR': 5,
+                   'LT SlopeR': 6, 'STEP HeightR': 7}
+        peakIndices = []
+        for k, index in enumerate(indices):
+            name = PARAMETERS[index]
+            if index > NGLOBAL - 1:
+                selection = groups == (index - NGLOBAL)
+                coefficients[k + 2, 0, selection] = units[selection]
+            elif name == 'Noise':
+                coefficients[k + 2, 2] = param[2] / table[:, 2]
+            elif name == 'Fano':
+                coefficients[k + 2, 2] = widthEnergies * \
+                            (2.3548*2.3548*0.00385) / (2.0 * table[:, 2])
+            elif HYPERMET and (name in columns):
+                if name in ['ST SlopeR', 'LT SlopeR']:
+                    # escape peaks have no tails
+                    coefficients[k + 2, columns[name]] = 1.0
+                else:
+                    coefficients[k + 2, columns[name], main] = 1.0
+            elif (not HYPERMET) and (name == 'Eta Factor'):
+                coefficients[k + 2, 3] = 1.0
+            else:
+                continue
+            peakIndices.append(k)
+        if HYPERMET:
+            result = PeakDerivatives.ahypermetJacobian(table, energy,
+                                                      coefficients, HYPERMET)
+        else:
+            result = PeakDerivatives.apvoigtJacobian(table, energy,
+                                                     coefficients)
+        jacobian = numpy.zeros((len(indices), len(x)), dtype=numpy.float)
+        jacobian[peakIndices] = result[2:][peakIndices]
+        for k, index in enumerate(indices):
+            if k in peakIndices:
+                continue
+            name = PARAMETERS[index]
+            if name == 'Zero':
+                jacobian[k] = result[1]
+            elif name == 'Gain':
+                jacobian[k] = result[1] * x + result[0] / gain
+            elif name == 'Sum':
+                if self.__SUM:
+                    yfit = result[0]
+                    if self.__CONTINUUM:
+                        yfit = yfit + self.continuum(param, x)
+                    jacobian[k] = self._pileup(yfit, int(x[0]),
+                                                     zero, gain)
+            else:
+                jacobian[k] = self.analyticalDerivative(param, index, x)
+        return jacobian
+
+    def _getPeakTables(self, parameters, hypermet):
+        """
+        Peak tables of several sets of fit parameters sharing the same peak
+        groups, as given by _getPeakTable for a single set.
+
+        :param parameters: array of shape (nspectra, nparameters)
+        :returns: the tables, of shape (nspectra, npeaks, ncolumns), the
+                  areas of the peaks per unit of group area, of shape
+                  (nspectra, npeaks), and the group index, the energy used
+                  to calculate the width and the non-escape flag of each
+                  peak
+        """
+        PARAMETERS = self.PARAMETERS
+        param = numpy.array(parameters, dtype=numpy.float, copy=False)
+        param = param.reshape(-1, len(PARAMETERS))
+        nspectra = param.shape[0]
+        npeaks, ncolumns = self.__peaksw.shape
+        gain = param[:, 1:2]
+        noise = param[:, 2:3] * param[:, 2:3]
+        fano = param[:, 3:4] * 2.3548*2.3548*0.00385
+        units = self.__peaks0[self.__peakLine, 0] * gain
+        if self.ESCAPE:
+            units = units * self.__peakEscapeRate
+        areas = param[:, self.NGLOBAL:]
+        tables = numpy.zeros((nspectra, npeaks, ncolumns), numpy.float)
+        tables[:, :, 0] = units * areas[:, self.__peakGroup]
+        tables[:, :, 1] = self.__peakEnergy
+        tables[:, :, 2] = numpy.sqrt(noise + self.__peakWidthEnergy * fano)
+        if hypermet:
+            # neglect tails in escape peaks
+            main = self.__peakMain
+            for column, name in [(3, 'ST AreaR'), (5, 'LT AreaR'),
+                                 (7, 'STEP HeightR')]:
+                tables[:, :, column] = numpy.where(main,
+                            param[:, PARAMETERS.index(name)][:, None], 0.0)
+            tables[:, :, 4] = param[:, PARAMETERS.index('ST SlopeR')][:, None]
+            tables[:, :, 6] = param[:, PARAMETERS.index('LT SlopeR')][:, None]
+        else:
+            tables[:, :, 3] = param[:, PARAMETERS.index('Eta Factor')][:, None]
+        return tables, units, self.__peakGroup, self.__peakWidthEnergy, \
+               self.__peakMain
+
+    def mcatheoryMultiple(self, parameters, t0):
+        """
+        mcatheoryMultiple(self, parameters, x)
+        Evaluate mcatheory for several sets of fit parameters (one per
+        spectrum) at the same array of points x.
+
+        :param parameters: array of shape (nspectra, nparameters)
+        :returns: array of shape (nspectra, len(x))
+        """
+        HYPERMET = self.__HYPERMET
+        param = numpy.array(parameters, dtype=numpy.float, copy=False)
+        param = param.reshape(-1, len(self.PARAMETERS))
+        x = numpy.array(t0, dtype=numpy.float).ravel()
+        tables = self._getPeakTables(param, HYPERMET)[0]
+        result = numpy.zeros((param.shape[0], x.size), dtype=numpy.float)
+        for k in range(param.shape[0]):
+            zero = param[k, 0]
+            gain = param[k, 1]
+            energy = zero + gain * x
+            if tables.shape[1]:
+                if not HYPERMET:
+                    result[k] = SpecfitFuns.apvoigt(tables[k], energy)
+                elif self.FASTER:
+                    result[k] = SpecfitFuns.fastahypermet(tables[k], energy,
+                                                          HYPERMET)
+                else:
+                    result[k] = SpecfitFuns.ahypermet(tables[k], energy,
+                                                      HYPERMET)
+            if self.__CONTINUUM:
+                result[k] += self.continuum(param[k], x)
+        if self.__SUM:
+            # the pile-up of all the spectra at once
+            result += param[:, 4:5] * self._pileup(result, int(x[0]),
+                                                   param[:, 0], param[:, 1])
+        return result
+
+    def analyticalJacobianMultiple(self, parameters, indices, t0):
+        """
+        analyticalJacobianMultiple(self, parameters, indices, x)
+        Evaluate analyticalJacobian for several sets of fit parameters (one
+        per spectrum) at the same array of points x.
+
+        The peaks of all the spectra are evaluated in a single pass.
+
+        :param parameters: array of shape (nspectra, nparameters)
+        :returns: array of shape (nspectra, len(indices), len(x))
+        """
+        NGLOBAL = self.NGLOBAL
+        HYPERMET = self.__HYPERMET
+        PARAMETERS = self.PARAMETERS
+        param = numpy.array(parameters, dtype=numpy.float, copy=False)
+        param = param.reshape(-1, len(PARAMETERS))
+        x = numpy.array(t0, dtype=numpy.float).ravel()
+        tables, units, groups, widthEnergies, main = \
+                                    self._getPeakTables(param, HYPERMET)
+        nspectra, npeaks, ncolumns = tables.shape
+        energy = param[:, 0:1] + param[:, 1:2] * x
+        # non-zero coefficients of the linear combinations of the derivatives
+        # respect to the columns of the peak tables of all the spectra
+        # rows 0 and 1 are the peaks and their derivative respect to energy
+        coefficients = [[], [], [], []]
+        def addCoefficients(row, column, selection, values):
+            peaks = numpy.nonzero(selection)[0]
+            peaks = numpy.arange(nspectra)[:, None] * npeaks + peaks
+            values = numpy.broadcast_to(values, peaks.shape)
+            coefficients[0].append(numpy.full(peaks.size, row))
+            coefficients[1].append(numpy.full(peaks.size, column))
+            coefficients[2].append(peaks.ravel())
+            coefficients[3].append(values.ravel())
+        allPeaks = numpy.ones((npeaks,), dtype=numpy.bool_)
+        addCoefficients(0, 0, allPeaks, tables[:, :, 0])
+        addCoefficients(1, 1, allPeaks, -1.0)
+        columns = {'ST AreaR': 3, 'ST SlopeR': 4, 'LT AreaR': 5,
+                   'LT SlopeR': 6, 'STEP HeightR': 7}
+        peakIndices = []
+        for k, index in enumerate(indices):
+            name = PARAMETERS[index]
+            if index > NGLOBAL - 1:
+                selection = groups == (index - NGLOBAL)
+                addCoefficients(k + 2, 0, selection, units[:, selection])
+            elif name == 'Noise':
+                addCoefficients(k + 2, 2, allPeaks,
+                                param[:, 2:3] / tables[:, :, 2])
+            elif name == 'Fano':
+                addCoefficients(k + 2, 2, allPeaks, widthEnergies * \
+                        (2.3548*2.3548*0.00385) / (2.0 * tables[:, :, 2]))
+            elif HYPERMET and (name in columns):
+                if name in ['ST SlopeR', 'LT SlopeR']:
+                    # escape peaks have no tails
+                    addCoefficients(k + 2, columns[name], allPeaks, 1.0)
+                else:
+                    addCoefficients(k + 2, columns[name], main, 1.0)
+            elif (not HYPERMET) and (name == 'Eta Factor'):
+                addCoefficients(k + 2, 3, allPeaks, 1.0)
+            else:
+                continue
+            peakIndices.append(k)
+        coefficients = (len(indices) + 2,) + \
+                       tuple(numpy.concatenate(c) for c in coefficients)
+        spectrum = numpy.repeat(numpy.arange(nspectra), npeaks)
+        peaks = tables.reshape(-1, ncolumns)
+        if HYPERMET:
+            result = PeakDerivatives.ahypermetJacobian(peaks, energy,
+                                                      coefficients, HYPERMET,
+                                                      spectrum=spectrum)
+        else:
+            result = PeakDerivatives.apvoigtJacobian(peaks, energy,
+                                                     coefficients,
+                                                     spectrum=spectrum)
+        jacobian = numpy.zeros((nspectra, len(indices), x.size),
+                               dtype=numpy.float)
+        jacobian[:, peakIndices] = \
+                        numpy.transpose(result[2:][peakIndices], (1, 0, 2))
+        for k, index in enumerate(indices):
+            if k in peakIndices:
+                continue
+            name = PARAMETERS[index]
+            if name == 'Zero':
+                jacobian[:, k] = result[1]
+            elif name == 'Gain':
+                jacobian[:, k] = result[1] * x + result[0] / param[:, 1:2]
+            elif name == 'Sum':
+                if self.__SUM:
+                    yfit = result[0].copy()
+                    if self.__CONTINUUM:
+                        for i in range(nspectra):
+                            yfit[i] += self.continuum(param[i], x)
+                    jacobian[:, k] = self._pileup(yfit, int(x[0]),
+                                                  param[:, 0], param[:, 1])
+            else:
+                for i in range(nspectra):
+                    jacobian[i, k] = self.analyticalDerivative(param[i],
+                                                               index, x)
+        return jacobian
+
     def estimate(self):
         if self.__toBeConfigured:
             _logger.debug("CONFIGURING FROM ESTIMATION")
@@ -2147,7 +2502,7 @@ def startfit(self,digest=0, linear=None, currentIteration=None):
                 gain = self.parameters[1]
                 xw = self.datatofit[:,0]
                 yfitw = self.mcatheory(fitresult[0], xw,summing=0)
-                pileup= self.parameters[4]*SpecfitFuns.pileup(yfitw,int(xw[0]), zero, gain)
+                pileup= self.parameters[4]*self._pileup(yfitw,int(xw[0]), zero, gain)
                 self.datatofit[:,1] -= pileup
                 fitresult =  Gefit.LeastSquaresFit(self.linearMcaTheory,
                                            self.parameters,
@@ -2167,6 +2522,7 @@ def startfit(self,digest=0, linear=None, currentIteration=None):
                                            weightflag=self.config['fit']['fitweight'],
                                            maxiter=self.MAXITER,
                                            model_deriv=self.analyticalDerivative,
+                                           model_jacobian=self.analyticalJacobian,
                                            deltachi=self.config['fit']['deltachi'],
                                            fulloutput=1, linear=linear)
             if self.__SUM and linear:
@@ -2177,7 +2533,7 @@ def startfit(self,digest=0, linear=None, currentIteration=None):
                 gain = self.parameters[1]
                 xw = self.datatofit[:,0]
                 yfitw = self.mcatheory(fitresult[0], xw,summing=0)
-                pileup= self.parameters[4]*SpecfitFuns.pileup(yfitw,int(xw[0]), zero, gain)
+                pileup= self.parameters[4]*self._pileup(yfitw,int(xw[0]), zero, gain)
                 self.datatofit[:,1] -= pileup
                 fitresult =  Gefit.LeastSquaresFit(self.mcatheory,
                                            self.parameters,
@@ -2186,6 +2542,7 @@ def startfit(self,digest=0, linear=None, currentIteration=None):
                                            weightflag=self.config['fit']['fitweight'],
                                            maxiter=self.MAXITER,
                                            model_deriv=self.analyticalDerivative,
+                                           model_jacobian=self.analyticalJacobian,
                                            deltachi=self.config['fit']['deltachi'],
                                            fulloutput=1, linear=linear)
         self.fittedpar=fitresult[0]
@@ -2297,7 +2654,7 @@ def digestresult(self,outfile=None, info=None):
         energyw=zero + gain * xw
         #print energy
         yfitw = self.mcatheory(param,xw,summing=0)
-        pileup= param[4]*SpecfitFuns.pileup(yfitw,int(xw[0]), zero, gain)
+        pileup= param[4]*self._pileup(yfitw,int(xw[0]), zero, gain)
         yfitw += pileup
         # + numpy.ravel(self.zz)
         #reduced chi square
@@ -2553,69 +2910,10 @@ def digestresult(self,outfile=None, info=None):
         return result
 
     def getpeaksw(self,param,hypermet=None,continuum=None):
-        if continuum is None:
-            continuum = self.__CONTINUUM
         if hypermet is None:
             hypermet = self.__HYPERMET
-        # zero = param[0]
-        gain = param[1]
-        #energy=zero + gain * x
-        #print energy
-        noise= param[2] * param[2]
-        fano = param[3] * 2.3548*2.3548*0.00385
-        #t=time.time()
-        PEAKS0 = self.PEAKS0
-        PEAKS0ESCAPE = self.PEAKS0ESCAPE
-        PEAKSW = self.PEAKSW
-        PARAMETERS = self.PARAMETERS
-        for i in range(len(param[self.NGLOBAL:])):
-            if self.ESCAPE:
-                #area = param[NGLOBAL+i]
-                (r,c) = (PEAKS0[i]).shape
-                PEAKSW[i][0:r,0] = PEAKS0[i][:,0] * param[self.NGLOBAL+i] * gain
-                PEAKSW[i][0:r,1] = PEAKS0[i][:,1] * 1.0
-                PEAKSW[i][0:r,2] = numpy.sqrt(noise + PEAKS0[i][:,1] * fano)
-                #escape
-                if OLDESCAPE:
-                    PEAKSW[i][r:,0] = PEAKSW[i][0:r,0] * PEAKS0[i][:,3]
-                    PEAKSW[i][r:,1] = PEAKS0[i][:,1] - self.config['detector']['detene']
-                    PEAKSW[i][r:,2] = numpy.sqrt(noise + (PEAKSW[i][r:,1]>0) * PEAKSW[i][r:,1] * fano)
-                else:
-                    ii=0
-                    j=0
-                    for esc_group in PEAKS0ESCAPE[i]:
-                        for esc_line in esc_group:
-                            esc_ene  = esc_line[0] * 1.0
-                            esc_rate = esc_line[1]
-                            PEAKSW[i][j+r,0] =  PEAKSW[i][ii,0] * esc_rate
-                            PEAKSW[i][j+r,1] =  esc_ene
-                            j = j + 1
-                        ii = ii + 1
-                    PEAKSW[i][r:, 2] = numpy.sqrt(noise + \
-                                    (PEAKSW[i][r:,1]>0) * PEAKSW[i][r:,1] * fano)
-                #if HYPERMET:
-                if hypermet:
-                    PEAKSW[i] [0:r,3] = param[PARAMETERS.index('ST AreaR')]
-                    PEAKSW[i] [:,4] = param[PARAMETERS.index('ST SlopeR')]
-                    PEAKSW[i] [0:r,5] = param[PARAMETERS.index('LT AreaR')]
-                    PEAKSW[i] [:,6] = param[PARAMETERS.index('LT SlopeR')]
-                    PEAKSW[i] [0:r,7] = param[PARAMETERS.index('STEP HeightR')]
-                    #neglect tails in escape peaks
-                    PEAKSW[i] [r:,3] = 0.0
-                    PEAKSW[i] [r:,5] = 0.0
-                    PEAKSW[i] [r:,7] = 0.0
-            else:
-                # area = param[self.NGLOBAL + i]
-                PEAKSW[i][:,0] = PEAKS0[i][:,0] * param[self.NGLOBAL+i] * gain
-                PEAKSW[i][:,1] = PEAKS0[i][:,1] * 1.0
-                PEAKSW[i][:,2] = numpy.sqrt(noise + PEAKS0[i][:,1] * fano)
-                if hypermet:
-                    PEAKSW[i] [:,3] = param[PARAMETERS.index('ST AreaR')]
-                    PEAKSW[i] [:,4] = param[PARAMETERS.index('ST SlopeR')]
-                    PEAKSW[i] [:,5] = param[PARAMETERS.index('LT AreaR')]
-                    PEAKSW[i] [:,6] = param[PARAMETERS.index('LT SlopeR')]
-                    PEAKSW[i] [:,7] = param[PARAMETERS.index('STEP HeightR')]
-        return PEAKSW
+        self.__fillPeakTables(numpy.array(param, dtype=numpy.float), hypermet)
+        return self.PEAKSW
 
     # UTILITIES #
     def roifit(self,x, y, background = None, width=None):
@@ -2633,24 +2931,26 @@ def roifit(self,x, y, background = None, width=None):
         for group in self.PARAMETERS[self.NGLOBAL:]:
             ele,shell = group.split()
             if ele not in Elements.Element.keys(): continue
-            lines = self.__getlines(ele,shell,width)
+            elementTable = Elements.getElementRateTable(ele,
+                                                energy=self.__maxEnergy)
+            lines = self.__getlines(elementTable,shell,width)
             ddict[group] = {}
             for line in lines:
-                emin = Elements.Element[ele][line]['energy'] - 0.5 * width
-                emax = Elements.Element[ele][line]['energy'] + 0.5 * width
+                emin = elementTable[line]['energy'] - 0.5 * width
+                emax = elementTable[line]['energy'] + 0.5 * width
                 i1 = numpy.nonzero((energy >= emin) & (energy <= emax))[0]
                 ddict[group][line + " ROI"] = numpy.sum(numpy.take(yw,i1))
         return ddict
 
 
-    def __getlines(self, ele, shell, width, threshold = 0.010):
+    def __getlines(self, elementTable, shell, width, threshold = 0.010):
         rays = shell + " xrays"
         ratelines    = []
         linestotreat = []
-        if rays not in Elements.Element[ele]['rays']:return {}
-        for transition in Elements.Element[ele][rays]:
-            if Elements.Element[ele][transition]['rate'] > threshold:
-                ratelines.append  ([Elements.Element[ele][transition]['rate'],
+        if rays not in elementTable['rays']:return {}
+        for transition in elementTable[rays]:
+            if elementTable[transition]['rate'] > threshold:
+                ratelines.append  ([elementTable[transition]['rate'],
                           transition])
                 linestotreat.append(transition)
         #sort according rate
@@ -2658,13 +2958,13 @@ def __getlines(self, ele, shell, width, threshold = 0.010):
         ratelines.reverse()
         lines = []
         for rate,transition in ratelines:
-            #print " rate, transition, energy = ",rate, transition, Elements.Element[ele][transition]['energy']
+            #print " rate, transition, energy = ",rate, transition, elementTable[transition]['energy']
             if not len(linestotreat):break
             if transition in linestotreat:
                 linestotreatcopy = linestotreat * 1
                 for line in linestotreatcopy:
-                    if abs(Elements.Element[ele][line]['energy'] - \
-                           Elements.Element[ele][transition]['energy']) < width:
+                    if abs(elementTable[line]['energy'] - \
+                           elementTable[transition]['energy']) < width:
                            del linestotreat[linestotreat.index(line)]
                 lines.append(transition)
         return lines
@@ -2854,6 +3154,44 @@ def myexp2(x):
 """
 
 
+def benchmarkPeakTables(mcaFit=None, param=None, repeat=100):
+    """
+    Time needed to fill the PEAKSW tables of a configured fit, by default
+    the stainless steel example of the PyMca data directory.
+    Run it with "python ClassMcaTheory.py --benchmark".
+
+    :returns float: best time in seconds
+    """
+    import time
+    if mcaFit is None:
+        from PyMca5.PyMcaIO import specfilewrapper as specfile
+        dataDir = PyMcaDataDir.PYMCA_DATA_DIR
+        sf = specfile.Specfile(os.path.join(dataDir, "Steel.spe"))
+        y = sf[0].mca(1)
+        x = numpy.arange(y.size).astype(numpy.float64)
+        sf = None
+        configuration = ConfigDict.ConfigDict()
+        configuration.read(os.path.join(dataDir, "Steel.cfg"))
+        configuration["concentrations"]["usemultilayersecondary"] = 0
+        mcaFit = McaTheory()
+        configuration = mcaFit.configure(configuration)
+        mcaFit.setData(x, y,
+                       xmin=configuration["fit"]["xmin"],
+                       xmax=configuration["fit"]["xmax"])
+        mcaFit.estimate()
+    if param is None:
+        param = numpy.array(mcaFit.parameters, dtype=numpy.float64)
+    best = None
+    for k in range(3):
+        t0 = time.time()
+        for i in range(repeat):
+            mcaFit.getpeaksw(param)
+        elapsed = (time.time() - t0) / repeat
+        if (best is None) or (elapsed < best):
+            best = elapsed
+    return best
+
+
 def test(inputfile=None,scankey=None,pkm=None,
                 continuum=0,stripflag=1,maxiter=10,sumflag=1,
                 hypermetflag=1,plotflag=0,escapeflag=1,attenuatorsflag=1,outfile=None):
@@ -2950,7 +3288,7 @@ def test(inputfile=None,scankey=None,pkm=None,
             longoptions = ['file=','scan=','pkm=','cfg=',
                             'output=','continuum=','stripflag=',
                             'maxiter=','sumflag=','escapeflag=','hypermetflag=','plotflag=',
-                            'attenuatorsflag=','outfile=']
+                            'attenuatorsflag=','outfile=','benchmark']
             opts, args = getopt.getopt(
                 sys.argv[1:],
                 options,
@@ -2994,6 +3332,10 @@ def test(inputfile=None,scankey=None,pkm=None,
                     attenuatorsflag = int(float(arg))
                 if opt in ('--outfile'):
                     outfile = arg
+                if opt == '--benchmark':
+                    print("Peak tables: %.3f ms" % \
+                          (1000. * benchmarkPeakTables()))
+                    sys.exit(0)
             test(inputfile=inputfile,scankey=scan,pkm=pkm,
                 maxiter=maxiter,continuum=continuum,stripflag=stripflag,sumflag=sumflag,
                 hypermetflag=hypermetflag,escapeflag=escapeflag,plotflag=plotflag,
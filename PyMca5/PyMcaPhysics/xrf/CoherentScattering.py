@@ -32,27 +32,10 @@
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
 import os
 import numpy
-from PyMca5.PyMcaIO import ConfigDict
-from PyMca5 import PyMcaDataDir
+from . import PhysicsDatabase
 
-dirmod = PyMcaDataDir.PYMCA_DATA_DIR
-ffile = os.path.join(dirmod, "attdata")
-ffile = os.path.join(ffile, "atomsf.dict")
-if not os.path.exists(ffile):
-    #freeze does bad things with the path ...
-    dirmod = os.path.dirname(dirmod)
-    ffile = os.path.join(dirmod, "attdata")
-    ffile = os.path.join(ffile, "atomsf.dict")
-    if not os.path.exists(ffile):
-        if dirmod.lower().endswith(".zip"):
-            dirmod = os.path.dirname(dirmod)
-            ffile = os.path.join(dirmod, "attdata")
-            ffile = os.path.join(ffile, "atomsf.dict")
-    if not os.path.exists(ffile):
-        print("Cannot find file ", ffile)
-        raise IOError("Cannot find file %s" % ffile)
-COEFFICIENTS = ConfigDict.ConfigDict()
-COEFFICIENTS.read(ffile)
+ffile = PhysicsDatabase.getAttDataFile("atomsf.dict")
+COEFFICIENTS = PhysicsDatabase.getConfigDict(ffile)
 KEVTOANG = 12.39852000
 R0 = 2.82E-13 #electron radius in cm
 
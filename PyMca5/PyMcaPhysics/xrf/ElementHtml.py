@@ -36,7 +36,12 @@ class ElementHtml(object):
     def __init__(self,element=None):
         self.element = None
 
-    def gethtml(self,element=None):
+    def gethtml(self,element=None,energy=None):
+        """
+        :param str element: element symbol
+        :param float energy: excitation energy in keV for the emission
+                             lines (None for all shells)
+        """
         if element is None:element = self.element
         if element is None:return ""
         ele = element
@@ -226,16 +231,17 @@ def gethtml(self,element=None):
 
         hcolor = 'white'
         finalcolor = 'white'
-        for rays in Elements.Element[ele]['rays']:
+        rateTable = Elements.getElementRateTable(ele, energy=energy)
+        for rays in rateTable['rays']:
             if rays == "Ka xrays":continue
             if rays == "Kb xrays":continue
             #text+="<center>"
             text+="<br><b><font color=blue size=4>%s Emission Energies</font></b>" % rays[0:-1]
             #text+="</center>"
             if 0:
-                for transition in Elements.Element[ele][rays]:
-                    text+="<br><b><font size=3>%s energy = %.5f  rate = %.5f</font></b>"  % (transition,Elements.Element[ele][transition]['energy'],
-                                                                            Elements.Element[ele][transition]['rate'])
+                for transition in rateTable[rays]:
+                    text+="<br><b><font size=3>%s energy = %.5f  rate = %.5f</font></b>"  % (transition,rateTable[transition]['energy'],
+                                                                            rateTable[transition]['rate'])
 
             else:
                 text+="<nobr><table><tr>"
@@ -249,17 +255,17 @@ def gethtml(self,element=None):
                 text+='Rate'
                 text+="</b></td>"
                 text+="</tr>"
-                for transition in Elements.Element[ele][rays]:
+                for transition in rateTable[rays]:
                     transitiontext = transition.replace('*','')
                     text+="<tr>"
                     text+='<td align="left" bgcolor="%s">' % finalcolor
                     text+="<b><font size=3>%s </font></b>"  % transitiontext
                     text+="</td>"
                     text+='<td align="right" bgcolor="%s">' % finalcolor
-                    text+="<b><font size=3>%.5f</font></b>"  % Elements.Element[ele][transition]['energy']
+                    text+="<b><font size=3>%.5f</font></b>"  % rateTable[transition]['energy']
                     text+="</td>"
                     text+='<td align="right" bgcolor="%s">' % finalcolor
-                    text+="<b><font size=3>%.5f </font></b>"  % Elements.Element[ele][transition]['rate']
+                    text+="<b><font size=3>%.5f </font></b>"  % rateTable[transition]['rate']
                     text+="</td>"
                 text+="</tr>"
                 text+="</table>"
@@ -37,10 +37,13 @@
 import re
 import weakref
 import types
+import threading
+import collections
 from PyMca5.PyMcaIO import ConfigDict
 from . import CoherentScattering
 from . import IncoherentScattering
 from . import PyMcaEPDL97
+from . import PhysicsDatabase
 from PyMca5 import PyMcaDataDir
 
 """
@@ -171,10 +174,15 @@
    ["Mt",  109,   9,7,  "meitnerium", 268,         0         ],
 ]
 ElementList= [ elt[0] for elt in ElementsInfo ]
+_ElementZ = dict((ele, i + 1) for i, ele in enumerate(ElementList))
 
 from . import BindingEnergies
 ElementShells = BindingEnergies.ElementShells[1:]
 ElementBinding = BindingEnergies.ElementBinding
+# column of each shell in ElementBinding (first occurrence)
+_ShellColumn = {}
+for i, shell in enumerate(ElementShells):
+    _ShellColumn.setdefault(shell, i + 1)
 
 from . import KShell
 from . import LShell
@@ -213,10 +221,7 @@ def getname(z):
         return None
 
 def getz(ele):
-    if ele in ElementList:
-        return ElementList.index(ele)+1
-    else:
-        return None
+    return _ElementZ.get(ele, None)
 
 #fluorescence yields
 def getomegak(ele):
@@ -2097,17 +2102,17 @@ def getxrayenergy(symbol,transition):
         trans=trans[0:2]+'2'
     if trans[0:1] == 'K':
         i=1
-        emax = energies[ElementShells.index('K')+1]
-    elif trans[0:2] in ElementShells:
+        emax = energies[_ShellColumn['K']]
+    elif trans[0:2] in _ShellColumn:
         i=2
-        emax = energies[ElementShells.index(trans[0:2])+1]
+        emax = energies[_ShellColumn[trans[0:2]]]
     else:
         #print transition
         #print "Shell %s not in Element %s Shells" % (trans[0:2], ele)
         return -1
 
-    if trans[i:i+2] in ElementShells:
-        emin = energies[ElementShells.index(trans[i:i+2])+1]
+    if trans[i:i+2] in _ShellColumn:
+        emin = energies[_ShellColumn[trans[i:i+2]]]
     else:
         if (z > 80) and (trans[i:i+2] == "Q1"):
             emin = 0.003
@@ -2208,90 +2213,162 @@ def getmassattcoef(compound, energy=None):
     div      = sum(fraction)
     fraction = [x/div for x in fraction]
     #print "fraction = ",fraction
-    ddict={}
-    ddict['energy']   = []
-    ddict['coherent'] = []
-    ddict['compton']  = []
-    ddict['photo']    = []
-    ddict['pair']     = []
-    ddict['total']    = []
-    eltindex = 0
     if energy is None:
-        energy=[]
-        for ele in elts:
-            xcom_data = getelementmassattcoef(ele,None)['energy']
-            for ene in xcom_data:
-                if ene not in energy:
-                    energy.append(ene)
-        energy.sort()
-
-    for ele in elts:
-        xcom_data = getelementmassattcoef(ele,None)
-        #now I have to interpolate at the different energies
-        if not hasattr(energy, "__len__"):
-            energy =[energy]
-        eneindex = 0
-        for ene in energy:
-            if ene < 1.0:
-                if PyMcaEPDL97.EPDL97_DICT[ele]['original']:
-                    #make sure the binding energies are those used by this module and not EADL ones
-                    PyMcaEPDL97.setElementBindingEnergies(ele,
-                                                          Element[ele]['binding'])
-                tmpDict = PyMcaEPDL97.getElementCrossSections(ele, ene)
-                cohe  = tmpDict['coherent'][0]
-                comp  = tmpDict['compton'][0]
-                photo = tmpDict['photo'][0]
-                pair  = 0.0
-            else:
-                i0=max(numpy.nonzero(xcom_data['energy'] <= ene)[0])
-                i1=min(numpy.nonzero(xcom_data['energy'] >= ene)[0])
-                if (i1 == i0) or (i0>i1):
-                    cohe=xcom_data['coherent'][i1]
-                    comp=xcom_data['compton'][i1]
-                    photo=xcom_data['photo'][i1]
-                    pair=xcom_data['pair'][i1]
-                else:
-                    if LOGLOG:
-                        A=xcom_data['energylog10'][i0]
-                        B=xcom_data['energylog10'][i1]
-                        logene = numpy.log10(ene)
-                        c2=(logene-A)/(B-A)
-                        c1=(B-logene)/(B-A)
-                    else:
-                        A=xcom_data['energy'][i0]
-                        B=xcom_data['energy'][i1]
-                        c2=(ene-A)/(B-A)
-                        c1=(B-ene)/(B-A)
-                    cohe= pow(10.0,c2*xcom_data['coherentlog10'][i1]+\
-                                   c1*xcom_data['coherentlog10'][i0])
-                    comp= pow(10.0,c2*xcom_data['comptonlog10'][i1]+\
-                                   c1*xcom_data['comptonlog10'][i0])
-                    photo=pow(10.0,c2*xcom_data['photolog10'][i1]+\
-                                   c1*xcom_data['photolog10'][i0])
-                    if xcom_data['pair'][i1] > 0.0:
-                        c2 = c2*numpy.log10(xcom_data['pair'][i1])
-                        if xcom_data['pair'][i0] > 0.0:
-                            c1 = c1*numpy.log10(xcom_data['pair'][i0])
-                            pair = pow(10.0,c1+c2)
-                        else:
-                            pair =0.0
-                    else:
-                        pair =0.0
-            if eltindex == 0:
-                ddict['energy'].append(ene)
-                ddict['coherent'].append(cohe *fraction[eltindex])
-                ddict['compton'].append(comp *fraction[eltindex])
-                ddict['photo'].append(photo *fraction[eltindex])
-                ddict['pair'].append(pair*fraction[eltindex])
-                ddict['total'].append((cohe+comp+photo+pair)*fraction[eltindex])
-            else:
-                ddict['coherent'][eneindex] += cohe  *fraction[eltindex]
-                ddict['compton'] [eneindex] += comp  *fraction[eltindex]
-                ddict['photo']   [eneindex] += photo *fraction[eltindex]
-                ddict['pair']    [eneindex] += pair  *fraction[eltindex]
-                ddict['total']   [eneindex] += (cohe+comp+photo+pair) * fraction[eltindex]
-            eneindex += 1
-        eltindex += 1
+        energy = _getEnergyGrid(elts)
+    if not hasattr(energy, "__len__"):
+        energy =[energy]
+    return _getMassAttenuationCoefficients(list(zip(elts, fraction)), energy)
+
+def _getEnergyGrid(elementList):
+    """
+    Sorted union of the XCOM energies of the elements
+    """
+    grids = [getelementmassattcoef(ele,None)['energy'] for ele in elementList]
+    if not grids:
+        return []
+    return list(numpy.unique(numpy.concatenate(grids)))
+
+_xcomTables = {}
+
+def _getXCOMTable(ele):
+    """
+    XCOM data of an element with the logarithm of the pair production
+    cross section, calculated once.
+    """
+    if 'xcom' in Element[ele]:
+        xcom = Element[ele]['xcom']
+    else:
+        xcom = getelementmassattcoef(ele,None)
+    table = _xcomTables.get(ele, None)
+    if (table is None) or (table[0] is not xcom):
+        pair = xcom['pair']
+        positive = pair > 0.0
+        pairlog10 = numpy.zeros(pair.shape, numpy.float64)
+        pairlog10[positive] = numpy.log10(pair[positive])
+        table = (xcom, positive, pairlog10)
+        _xcomTables[ele] = table
+    return table
+
+def _getElementCrossSections(ele, energy):
+    """
+    Vectorized cross sections of an element. Same interpolation as done
+    energy by energy in getelementmassattcoef.
+
+    :param str ele: element symbol
+    :param energy: list of energies in keV
+    :returns list: coherent, compton, photo and pair cross sections (arrays)
+    """
+    xcom, positive, pairlog10 = _getXCOMTable(ele)
+    energies = numpy.array(energy, dtype=numpy.float64, ndmin=1)
+    n = energies.size
+    cohe = numpy.zeros(n, numpy.float64)
+    comp = numpy.zeros(n, numpy.float64)
+    photo = numpy.zeros(n, numpy.float64)
+    pair = numpy.zeros(n, numpy.float64)
+
+    # below 1 keV: EPDL97
+    low = energies < 1.0
+    for i in numpy.nonzero(low)[0]:
+        if PyMcaEPDL97.EPDL97_DICT[ele]['original']:
+            #make sure the binding energies are those used by this module and not EADL ones
+            PyMcaEPDL97.setElementBindingEnergies(ele,
+                                                  Element[ele]['binding'])
+        tmpDict = PyMcaEPDL97.getElementCrossSections(ele, energy[i])
+        cohe[i]  = tmpDict['coherent'][0]
+        comp[i]  = tmpDict['compton'][0]
+        photo[i] = tmpDict['photo'][0]
+
+    # XCOM
+    high = numpy.nonzero(~low)[0]
+    if not len(high):
+        return [cohe, comp, photo, pair]
+    ene = energies[high]
+    grid = xcom['energy']
+    # last grid point <= ene and first grid point >= ene
+    i0 = numpy.searchsorted(grid, ene, side='right') - 1
+    i1 = numpy.searchsorted(grid, ene, side='left')
+    if (i0.min() < 0) or (i1.max() >= len(grid)):
+        raise ValueError("Energy outside the tabulated range of %s" % ele)
+    onGrid = i1 <= i0
+    idx = high[onGrid]
+    j = i1[onGrid]
+    cohe[idx] = xcom['coherent'][j]
+    comp[idx] = xcom['compton'][j]
+    photo[idx] = xcom['photo'][j]
+    pair[idx] = xcom['pair'][j]
+
+    between = ~onGrid
+    idx = high[between]
+    i0 = i0[between]
+    i1 = i1[between]
+    if LOGLOG:
+        A = xcom['energylog10'][i0]
+        B = xcom['energylog10'][i1]
+        x = numpy.log10(ene[between])
+    else:
+        A = grid[i0]
+        B = grid[i1]
+        x = ene[between]
+    c2 = (x - A) / (B - A)
+    c1 = (B - x) / (B - A)
+    cohe[idx] = numpy.power(10.0, c2 * xcom['coherentlog10'][i1] + \
+                                  c1 * xcom['coherentlog10'][i0])
+    comp[idx] = numpy.power(10.0, c2 * xcom['comptonlog10'][i1] + \
+                                  c1 * xcom['comptonlog10'][i0])
+    photo[idx] = numpy.power(10.0, c2 * xcom['photolog10'][i1] + \
+                                   c1 * xcom['photolog10'][i0])
+    withPair = positive[i1] & positive[i0]
+    pair[idx[withPair]] = numpy.power(10.0,
+                            c1[withPair] * pairlog10[i0[withPair]] + \
+                            c2[withPair] * pairlog10[i1[withPair]])
+    return [cohe, comp, photo, pair]
+
+def _getMassAttenuationCoefficients(weightList, energy, cache=None,
+                                    listoutput=True):
+    """
+    Mass attenuation coefficients of a mixture of elements
+
+    :param list weightList: (element, mass fraction) pairs
+    :param list energy: energies in keV
+    :param dict cache: element cross sections already calculated at
+                       these energies
+    :param bool listoutput: lists (default) or arrays
+    :returns dict: see getmassattcoef
+    """
+    output = {}
+    for key in ['coherent', 'compton', 'photo', 'pair', 'total']:
+        output[key] = None
+    for ele, w in weightList:
+        if cache is None:
+            sections = _getElementCrossSections(ele, energy)
+        else:
+            sections = cache.get(ele, None)
+            if sections is None:
+                sections = _getElementCrossSections(ele, energy)
+                cache[ele] = sections
+        cohe, comp, photo, pair = sections
+        total = (cohe+comp+photo+pair) * w
+        if output['total'] is None:
+            output['coherent'] = cohe * w
+            output['compton'] = comp * w
+            output['photo'] = photo * w
+            output['pair'] = pair * w
+            output['total'] = total
+        else:
+            output['coherent'] += cohe * w
+            output['compton'] += comp * w
+            output['photo'] += photo * w
+            output['pair'] += pair * w
+            output['total'] += total
+    ddict = {}
+    ddict['energy'] = list(energy)
+    for key in ['coherent', 'compton', 'photo', 'pair', 'total']:
+        if output[key] is None:
+            ddict[key] = []
+        elif listoutput:
+            ddict[key] = list(output[key])
+        else:
+            ddict[key] = output[key]
     return ddict
 
 def __materialInCompoundList(lst):
@@ -2355,10 +2432,75 @@ def getMaterialMassAttenuationCoefficients(compoundList0, fractionList0, energy0
     energy       - Energy at which the values are desired
     massfractions- Flag to supply mass fractions on output
     """
+    materialElements, gridElements = _getMaterialElements(compoundList0,
+                                                          fractionList0)
+    if massfractions == True:
+        return materialElements
+    energy = _getEnergyList(energy0)
+    if energy is None:
+        energy = _getEnergyGrid(gridElements)
+    return _getMassAttenuationCoefficients(list(materialElements.items()),
+                                           energy)
+
+_compoundCache = {}
+
+def _parseCompound(compound):
+    """
+    Elements and number of atoms of a compound formula
+
+    :returns tuple: list, list
+    """
+    result = _compoundCache.get(compound, None)
+    if result is not None:
+        return result
+    if compound in Element.keys():
+        elts=[compound]
+        nbs =[1]
+    else:
+        elts= [ w for w in re.split('[0-9]', compound) if w != '' ]
+        try:
+            nbs= [ int(w) for w in re.split('[a-zA-Z]', compound) if w != '' ]
+        except:
+            raise ValueError("Compound '%s' not understood" % compound)
+        if len(elts)==1 and len(nbs)==0:
+            elts=[compound]
+            nbs =[1]
+    if (len(elts)==0 and len(nbs)==0) or (len(elts) != len(nbs)):
+        print("compound %s not understood" % compound)
+        raise ValueError("compound %s not understood" % compound)
+    if len(_compoundCache) > 1024:
+        _compoundCache.clear()
+    _compoundCache[compound] = (elts, nbs)
+    return elts, nbs
+
+def _getEnergyList(energy0):
+    """
+    Energies as a list (None if not given)
+    """
+    energy = energy0
+    if energy0 is not None:
+        if type(energy0) == type(2.):
+            energy = [energy0]
+        elif type(energy0) == type(1):
+            energy = [1.0 * energy0]
+        elif type(energy0) == numpy.ndarray:
+            energy = energy0.tolist()
+        if (type(energy) != type([])):
+            energy =[energy]
+    return energy
+
+def _getMaterialElements(compoundList0, fractionList0):
+    """
+    Mass fractions of the elements of a material
+
+    :returns tuple: dictionary of mass fractions, elements of the first
+                    compound (they give the default energy grid)
+    """
     if type(compoundList0) != type([]):
         compoundList = [compoundList0]
     else:
-        compoundList = compoundList0
+        # the materials are replaced by their compounds in this list
+        compoundList = list(compoundList0)
     if type(fractionList0) == numpy.ndarray:
         fractionList = fractionList0.tolist()
     elif type(fractionList0) != type([]):
@@ -2401,136 +2543,92 @@ def getMaterialMassAttenuationCoefficients(compoundList0, fractionList0, energy0
     total=sum(fractionList)
     compoundFractionList = [float(x)/total for x in fractionList]
     materialElements = {}
-    energy = energy0
-    if energy0 is not None:
-        if type(energy0) == type(2.):
-            energy = [energy0]
-        elif type(energy0) == type(1):
-            energy = [1.0 * energy0]
-        elif type(energy0) == numpy.ndarray:
-            energy = energy0.tolist()
-
+    gridElements = None
     for compound, compoundFraction in zip(compoundList, compoundFractionList):
-        elts=[]
-        #get energy list
-        if compound in Element.keys():
-            elts=[compound]
-            nbs =[1]
-        else:
-            elts= [ w for w in re.split('[0-9]', compound) if w != '' ]
-            try:
-                nbs= [ int(w) for w in re.split('[a-zA-Z]', compound) if w != '' ]
-            except:
-                raise ValueError("Compound '%s' not understood" % compound)
-            if len(elts)==1 and len(nbs)==0:
-                elts=[compound]
-                nbs =[1]
-        if (len(elts)==0 and len(nbs)==0) or (len(elts) != len(nbs)):
-            print("compound %s not understood" % compound)
-            raise ValueError("compound %s not understood" % compound)
-
+        elts, nbs = _parseCompound(compound)
         #the proportion of the element in that compound times the compound fraction
         fraction = [Element[elt]['mass'] *nb for (elt, nb) in zip(elts, nbs) ]
         div      = compoundFraction/sum(fraction)
         fraction = [x * div for x in fraction]
-        if energy is None:
-            #get energy list
-            energy = []
-            for ele in elts:
-                xcom_data = getelementmassattcoef(ele,None)['energy']
-                for ene in xcom_data:
-                    if ene not in energy:
-                        energy.append(ene)
+        if gridElements is None:
+            gridElements = elts
         for ele in elts:
             if ele not in materialElements.keys():
                 materialElements[ele]  = fraction[elts.index(ele)]
             else:
                 materialElements[ele] += fraction[elts.index(ele)]
-    if massfractions == True:
-        return materialElements
-    if energy0 is None:
-        energy.sort()
-
-    #I have the energy grid, the elements and their fractions
-    dict={}
-    dict['energy']   = []
-    dict['coherent'] = []
-    dict['compton']  = []
-    dict['photo']    = []
-    dict['pair']     = []
-    dict['total']    = []
-    eltindex = 0
-    for ele in materialElements.keys():
-        if 'xcom' in Element[ele]:
-            xcom_data = Element[ele]['xcom']
-        else:
-            xcom_data = getelementmassattcoef(ele,None)
-        #now I have to interpolate at the different energies
-        if (type(energy) != type([])):
-            energy =[energy]
-        eneindex = 0
-        for ene in energy:
-            if ene < 1.0:
-                if PyMcaEPDL97.EPDL97_DICT[ele]['original']:
-                    #make sure the binding energies are those used by this module and not EADL ones
-                    PyMcaEPDL97.setElementBindingEnergies(ele,
-                                                          Element[ele]['binding'])
-                tmpDict = PyMcaEPDL97.getElementCrossSections(ele, ene)
-                cohe  = tmpDict['coherent'][0]
-                comp  = tmpDict['compton'][0]
-                photo = tmpDict['photo'][0]
-                pair  = 0.0
-            else:
-                i0=max(numpy.nonzero(xcom_data['energy'] <= ene)[0])
-                i1=min(numpy.nonzero(xcom_data['energy'] >= ene)[0])
-                if (i1 == i0) or (i0>i1):
-                    cohe=xcom_data['coherent'][i1]
-                    comp=xcom_data['compton'][i1]
-                    photo=xcom_data['photo'][i1]
-                    pair=xcom_data['pair'][i1]
-                else:
-                    if LOGLOG:
-                        A=xcom_data['energylog10'][i0]
-                        B=xcom_data['energylog10'][i1]
-                        logene = numpy.log10(ene)
-                        c2=(logene-A)/(B-A)
-                        c1=(B-logene)/(B-A)
-                    else:
-                        A=xcom_data['energy'][i0]
-                        B=xcom_data['energy'][i1]
-                        c2=(ene-A)/(B-A)
-                        c1=(B-ene)/(B-A)
-                    cohe= pow(10.0,c2*xcom_data['coherentlog10'][i1]+\
-                                   c1*xcom_data['coherentlog10'][i0])
-                    comp= pow(10.0,c2*xcom_data['comptonlog10'][i1]+\
-                                   c1*xcom_data['comptonlog10'][i0])
-                    photo=pow(10.0,c2*xcom_data['photolog10'][i1]+\
-                                   c1*xcom_data['photolog10'][i0])
-                    if xcom_data['pair'][i1] > 0.0:
-                        c2 = c2*numpy.log10(xcom_data['pair'][i1])
-                        if xcom_data['pair'][i0] > 0.0:
-                            c1 = c1*numpy.log10(xcom_data['pair'][i0])
-                            pair = pow(10.0,c1+c2)
-                        else:
-                            pair =0.0
-                    else:
-                        pair =0.0
-            if eltindex == 0:
-                dict['energy'].append(ene)
-                dict['coherent'].append(cohe * materialElements[ele])
-                dict['compton'].append(comp * materialElements[ele])
-                dict['photo'].append(photo * materialElements[ele])
-                dict['pair'].append(pair* materialElements[ele])
-                dict['total'].append((cohe+comp+photo+pair)* materialElements[ele])
-            else:
-                dict['coherent'][eneindex] += cohe  * materialElements[ele]
-                dict['compton'] [eneindex] += comp  * materialElements[ele]
-                dict['photo']   [eneindex] += photo * materialElements[ele]
-                dict['pair']    [eneindex] += pair  * materialElements[ele]
-                dict['total']   [eneindex] += (cohe+comp+photo+pair) *  materialElements[ele]
-            eneindex += 1
-        eltindex += 1
-    return dict
+    if gridElements is None:
+        gridElements = []
+    return materialElements, gridElements
+
+class CompiledMaterial(object):
+    """
+    Material with its composition resolved once, to evaluate its mass
+    attenuation coefficients many times or at many energies without the
+    overhead of getMaterialMassAttenuationCoefficients.
+
+    Usage:
+        material = CompiledMaterial(["Fe2O3", "SiO2"], [0.3, 0.7])
+        mu = material.getMassAttenuationCoefficients(energies)['total']
+    """
+    def __init__(self, compoundList, fractionList=1.0):
+        """
+        :param compoundList: compound, material or list of them
+        :param fractionList: mass of each compound
+        """
+        self.massFractions, self._gridElements = \
+                    _getMaterialElements(compoundList, fractionList)
+        self._weights = list(self.massFractions.items())
+
+    def getEnergyGrid(self):
+        """
+        :returns list: energies used when none are given
+        """
+        return _getEnergyGrid(self._gridElements)
+
+    def getMassAttenuationCoefficients(self, energy=None, listoutput=True,
+                                       cache=None):
+        """
+        Same output as getMaterialMassAttenuationCoefficients
+
+        :param energy: energy or energies in keV
+        :param bool listoutput: lists (default) or arrays
+        :param dict cache: element cross sections at these energies shared
+                           with other materials
+        :returns dict:
+        """
+        energy = _getEnergyList(energy)
+        if energy is None:
+            energy = self.getEnergyGrid()
+        return _getMassAttenuationCoefficients(self._weights, energy,
+                                               cache=cache,
+                                               listoutput=listoutput)
+
+def getMaterialsMassAttenuationCoefficients(materialList, energy,
+                                            key='total'):
+    """
+    Mass attenuation coefficients of several materials at the same energies.
+    The cross sections of the elements present in several materials are
+    only calculated once.
+
+    :param list materialList: CompiledMaterial instances, compounds or
+                              material names
+    :param energy: energies in keV
+    :param str key: 'total', 'photo', 'coherent', 'compton' or 'pair'
+    :returns numpy.ndarray: 2D array (material, energy) in cm2/g
+    """
+    energy = _getEnergyList(energy)
+    cache = {}
+    output = numpy.zeros((len(materialList), len(energy)), numpy.float64)
+    for i, material in enumerate(materialList):
+        if not isinstance(material, CompiledMaterial):
+            material = CompiledMaterial(material)
+        result = material.getMassAttenuationCoefficients(energy,
+                                                         listoutput=False,
+                                                         cache=cache)
+        if len(result[key]):
+            output[i] = result[key]
+    return output
 
 
 def getcandidates(energy,threshold=None,targetrays=None):
@@ -2634,172 +2732,29 @@ def getelementmassattcoef(ele,energy=None):
             dict['total']      = [total cross section]
     """
     if 'xcom' not in Element[ele].keys():
-        dirmod = PyMcaDataDir.PYMCA_DATA_DIR
         #read xcom file
-        #print dirmod+"/"+ele+".mat"
-        xcomfile = os.path.join(dirmod, "attdata")
-        xcomfile = os.path.join(xcomfile, ele+".mat")
-        if not os.path.exists(xcomfile):
-            #freeze does bad things with the path ...
-            dirmod = os.path.dirname(dirmod)
-            xcomfile = os.path.join(dirmod, "attdata")
-            xcomfile = os.path.join(xcomfile, ele+".mat")
-            if dirmod.lower().endswith(".zip"):
-                dirmod = os.path.dirname(dirmod)
-                xcomfile = os.path.join(dirmod, "attdata")
-                xcomfile = os.path.join(xcomfile, ele+".mat")
-            if not os.path.exists(xcomfile):
-                print("Cannot find file ",xcomfile)
-                raise IOError("Cannot find %s" % xcomfile)
-        f = open(xcomfile, 'r')
-        line=f.readline()
-        while (line.split('ENERGY')[0] == line):
-            line = f.readline()
-        Element[ele]['xcom'] = {}
-        Element[ele]['xcom']['energy']   =[]
-        Element[ele]['xcom']['coherent'] =[]
-        Element[ele]['xcom']['compton']  =[]
-        Element[ele]['xcom']['photo']  =[]
-        Element[ele]['xcom']['pair']     =[]
-        Element[ele]['xcom']['total']    =[]
-        line = f.readline()
-        while (line.split('COHERENT')[0] == line):
-            line = line.split()
-            for value in line:
-                Element[ele]['xcom']['energy'].append(float(value)*1000.)
-            line = f.readline()
-        Element[ele]['xcom']['energy']=numpy.array(Element[ele]['xcom']['energy'])
-        line = f.readline()
-        while (line.split('INCOHERENT')[0] == line):
-            line = line.split()
-            for value in line:
-                Element[ele]['xcom']['coherent'].append(float(value))
-            line = f.readline()
-        Element[ele]['xcom']['coherent']=numpy.array(Element[ele]['xcom']['coherent'])
-        line = f.readline()
-        while (line.split('PHOTO')[0] == line):
-            line = line.split()
-            for value in line:
-                Element[ele]['xcom']['compton'].append(float(value))
-            line = f.readline()
-        Element[ele]['xcom']['compton']=numpy.array(Element[ele]['xcom']['compton'])
-        line = f.readline()
-        while (line.split('PAIR')[0] == line):
-            line = line.split()
-            for value in line:
-                Element[ele]['xcom']['photo'].append(float(value))
-            line = f.readline()
-        line = f.readline()
-        while (line.split('PAIR')[0] == line):
-            line = line.split()
-            for value in line:
-                Element[ele]['xcom']['pair'].append(float(value))
-            line = f.readline()
-        i = 0
-        line = f.readline()
-        while (len(line)):
-            line = line.split()
-            for value in line:
-                Element[ele]['xcom']['pair'][i] += float(value)
-                i += 1
-            line = f.readline()
-        f.close()
-        if sys.version >= '3.0':
-            # next line gave problems under under windows
-            # just try numpy.argsort([1,1,1,1,1]) under linux and windows to see
-            # what I mean
-            # i1=numpy.argsort(Element[ele]['xcom']['energy']) did not work
-            # (uses quicksort and gives problems with Pb not passing tests)
-            i1=numpy.argsort(Element[ele]['xcom']['energy'], kind='mergesort')
-        else:
-            sset = map(None,Element[ele]['xcom']['energy'],range(len(Element[ele]['xcom']['energy'])))
-            sset.sort()
-            i1=numpy.array([x[1] for x in sset])
-        Element[ele]['xcom']['energy']=numpy.take(Element[ele]['xcom']['energy'],i1)
-        Element[ele]['xcom']['coherent']=numpy.take(Element[ele]['xcom']['coherent'],i1)
-        Element[ele]['xcom']['compton']=numpy.take(Element[ele]['xcom']['compton'],i1)
-        Element[ele]['xcom']['photo']=numpy.take(Element[ele]['xcom']['photo'],i1)
-        Element[ele]['xcom']['pair']=numpy.take(Element[ele]['xcom']['pair'],i1)
-        if Element[ele]['xcom']['coherent'][0] <= 0:
-           Element[ele]['xcom']['coherent'][0] = Element[ele]['xcom']['coherent'][1] * 1.0
+        xcomfile = PhysicsDatabase.getAttDataFile(ele+".mat")
+        xcom = PhysicsDatabase.getXCOM(xcomfile)
+        xcom['total'] = []
         try:
-            Element[ele]['xcom']['energylog10']=numpy.log10(Element[ele]['xcom']['energy'])
-            Element[ele]['xcom']['coherentlog10']=numpy.log10(Element[ele]['xcom']['coherent'])
-            Element[ele]['xcom']['comptonlog10']=numpy.log10(Element[ele]['xcom']['compton'])
-            Element[ele]['xcom']['photolog10']=numpy.log10(Element[ele]['xcom']['photo'])
+            xcom['energylog10']=numpy.log10(xcom['energy'])
+            xcom['coherentlog10']=numpy.log10(xcom['coherent'])
+            xcom['comptonlog10']=numpy.log10(xcom['compton'])
+            xcom['photolog10']=numpy.log10(xcom['photo'])
         except:
             raise ValueError("Problem calculating logaritm of %s.mat file data" % ele)
-        for i in range(0,len(Element[ele]['xcom']['energy'])):
-            Element[ele]['xcom']['total'].append(Element[ele]['xcom']['coherent'][i]+\
-                                                 Element[ele]['xcom']['compton'] [i]+\
-                                                 Element[ele]['xcom']['photo'] [i]+\
-                                                 Element[ele]['xcom']['pair'] [i])
+        for i in range(0,len(xcom['energy'])):
+            xcom['total'].append(xcom['coherent'][i]+\
+                                 xcom['compton'] [i]+\
+                                 xcom['photo'] [i]+\
+                                 xcom['pair'] [i])
+        Element[ele]['xcom'] = xcom
 
     if energy is None:
         return  Element[ele]['xcom']
-    ddict={}
-    ddict['energy']   = []
-    ddict['coherent'] = []
-    ddict['compton']  = []
-    ddict['photo']    = []
-    ddict['pair']     = []
-    ddict['total']    = []
     if not hasattr(energy, "__len__"):
         energy =[energy]
-    for ene in energy:
-        if ene < 1.0:
-            if PyMcaEPDL97.EPDL97_DICT[ele]['original']:
-                #make sure the binding energies are those used by this module and not EADL ones
-                PyMcaEPDL97.setElementBindingEnergies(ele,
-                                                      Element[ele]['binding'])
-            tmpDict = PyMcaEPDL97.getElementCrossSections(ele, ene)
-            cohe  = tmpDict['coherent'][0]
-            comp  = tmpDict['compton'][0]
-            photo = tmpDict['photo'][0]
-            pair  = 0.0
-        else:
-            i0=max(numpy.nonzero(Element[ele]['xcom']['energy'] <= ene)[0])
-            i1=min(numpy.nonzero(Element[ele]['xcom']['energy'] >= ene)[0])
-            if i1 <= i0:
-                cohe=Element[ele]['xcom']['coherent'][i1]
-                comp=Element[ele]['xcom']['compton'][i1]
-                photo=Element[ele]['xcom']['photo'][i1]
-                pair=Element[ele]['xcom']['pair'][i1]
-            else:
-                if LOGLOG:
-                    A=Element[ele]['xcom']['energylog10'][i0]
-                    B=Element[ele]['xcom']['energylog10'][i1]
-                    logene = numpy.log10(ene)
-                    c2=(logene-A)/(B-A)
-                    c1=(B-logene)/(B-A)
-                else:
-                    A=Element[ele]['xcom']['energy'][i0]
-                    B=Element[ele]['xcom']['energy'][i1]
-                    c2=(ene-A)/(B-A)
-                    c1=(B-ene)/(B-A)
-
-                cohe= pow(10.0,c2*Element[ele]['xcom']['coherentlog10'][i1]+\
-                               c1*Element[ele]['xcom']['coherentlog10'][i0])
-                comp= pow(10.0,c2*Element[ele]['xcom']['comptonlog10'][i1]+\
-                               c1*Element[ele]['xcom']['comptonlog10'][i0])
-                photo=pow(10.0,c2*Element[ele]['xcom']['photolog10'][i1]+\
-                               c1*Element[ele]['xcom']['photolog10'][i0])
-                if Element[ele]['xcom']['pair'][i1] > 0.0:
-                    c2 = c2*numpy.log10(Element[ele]['xcom']['pair'][i1])
-                    if Element[ele]['xcom']['pair'][i0] > 0.0:
-                        c1 = c1*numpy.log10(Element[ele]['xcom']['pair'][i0])
-                        pair = pow(10.0,c1+c2)
-                    else:
-                        pair =0.0
-                else:
-                    pair =0.0
-        ddict['energy'].append(ene)
-        ddict['coherent'].append(cohe)
-        ddict['compton'].append(comp)
-        ddict['photo'].append(photo)
-        ddict['pair'].append(pair)
-        ddict['total'].append(cohe+comp+photo+pair)
-    return ddict
+    return _getMassAttenuationCoefficients([(ele, 1.0)], energy)
 
 def getElementLShellRates(symbol,energy=None,photoweights = None):
     """
@@ -2873,7 +2828,140 @@ def getElementMShellRates(symbol,energy=None, photoweights = None):
     return shellrates
 
 
+# Least recently used cache of the read-only emission rate tables
+RATE_TABLE_CACHE_SIZE = 2048
+_rateTableCache = collections.OrderedDict()
+_rateTableLock = threading.Lock()
+
+
+class _ReadOnlyDict(dict):
+    """
+    Dictionary that cannot be modified. Copies are normal dictionaries.
+    """
+    def _readOnly(self, *args, **kwargs):
+        raise TypeError("Rate tables are read-only, use a copy")
+
+    __setitem__ = __delitem__ = _readOnly
+    clear = pop = popitem = setdefault = update = _readOnly
+
+    def copy(self):
+        return dict(self)
+
+    def __copy__(self):
+        return dict(self)
+
+    def __reduce__(self):
+        return (dict, (dict(self),))
+
+
+class _ReadOnlyList(list):
+    """
+    List that cannot be modified. Copies are normal lists.
+    """
+    def _readOnly(self, *args, **kwargs):
+        raise TypeError("Rate tables are read-only, use a copy")
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _readOnly
+    append = extend = insert = pop = remove = reverse = sort = _readOnly
+    if sys.version_info < (3,):
+        __setslice__ = __delslice__ = _readOnly
+
+    def __copy__(self):
+        return list(self)
+
+    def __reduce__(self):
+        return (list, (list(self),))
+
+
+def _readOnly(obj):
+    if isinstance(obj, dict):
+        return _ReadOnlyDict((key, _readOnly(value))
+                             for key, value in obj.items())
+    elif isinstance(obj, list):
+        return _ReadOnlyList(_readOnly(value) for value in obj)
+    return obj
+
+
+def _getCachedRateTable(key, function, *args, **kwargs):
+    """
+    Return the read-only version of function(*args, **kwargs) from the cache
+    or calculate it. It can be called from several threads.
+    """
+    with _rateTableLock:
+        table = _rateTableCache.get(key, None)
+        if table is not None:
+            # most recently used
+            del _rateTableCache[key]
+            _rateTableCache[key] = table
+            return table
+    # calculated outside the lock (at worst it is done twice)
+    table = _readOnly(function(*args, **kwargs))
+    with _rateTableLock:
+        _rateTableCache[key] = table
+        while len(_rateTableCache) > RATE_TABLE_CACHE_SIZE:
+            _rateTableCache.popitem(last=False)
+    return table
+
+
+def clearRateTableCache():
+    with _rateTableLock:
+        _rateTableCache.clear()
+
+
+def _elementSymbol(symbol):
+    if len(symbol) > 1:
+        return symbol[0].upper() + symbol[1].lower()
+    else:
+        return symbol.upper()
+
+
+def getElementRateTable(symbol, energy=None, minenergy=MINENERGY,
+                        minrate=0.0010, normalize=None, photoweights=None):
+    """
+    Emission lines of an element excited at the given energy, with the same
+    content as Element[symbol] after calling updateDict with the same
+    arguments, but without modifying the global Element dictionary.
+
+    The tables are cached and read-only (use a copy to modify them) so
+    they can be shared between threads.
+
+    :param str symbol: element
+    :param float energy: excitation energy in keV (None for all shells)
+    :param float minenergy: minimum energy of the lines
+    :param float minrate: minimum rate of the lines relative to the
+                          strongest line of their group
+    :returns dict: 'rays', list of transitions per rays, energy and rate
+                   per transition and 'buildparameters'
+    """
+    if normalize is None:
+        normalize = True
+    if photoweights is None:
+        photoweights = True
+    ele = _elementSymbol(symbol)
+    if energy is not None:
+        energy = float(energy)
+    key = ("filtered", ele, energy, minenergy, minrate,
+           bool(normalize), bool(photoweights))
+
+    def build():
+        ddict = {}
+        _updateElementDict(ele, ddict, energy=energy, minenergy=minenergy,
+                           minrate=minrate, normalize=normalize,
+                           photoweights=photoweights)
+        return ddict
+    return _getCachedRateTable(key, build)
+
+
 def _getUnfilteredElementDict(symbol, energy, photoweights=None):
+    if photoweights == None:photoweights = False
+    if energy is not None:
+        energy = float(energy)
+    key = ("unfiltered", _elementSymbol(symbol), energy, bool(photoweights))
+    return _getCachedRateTable(key, _buildUnfilteredElementDict,
+                               symbol, energy, photoweights=photoweights)
+
+
+def _buildUnfilteredElementDict(symbol, energy, photoweights=None):
     if photoweights == None:photoweights = False
     ddict = {}
     if len(symbol) > 1:
@@ -39,13 +39,21 @@
 import time
 import h5py
 import collections
+import tempfile
+import hashlib
+import zipfile
+from io import StringIO
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from contextlib import contextmanager
 from . import ClassMcaTheory
 from . import ConcentrationsTool
-from PyMca5.PyMcaMath.linalg import lstsq
+from PyMca5.PyMcaMath.linalg import lstsq, nnls
 from PyMca5.PyMcaMath.fitting import Gefit
-from PyMca5.PyMcaMath.fitting import SpecfitFuns
+from PyMca5.PyMcaMath import SNIPModule
 from PyMca5.PyMcaIO import ConfigDict
 from PyMca5.PyMcaMisc import PhysicalMemory
+from PyMca5 import version as pymcaVersion
 from .FastXRFLinearFitOutput import OutputBuffer
 from . import McaStackView
 
@@ -55,6 +63,15 @@
 class FastXRFLinearFit(object):
     def __init__(self, mcafit=None):
         self._config = None
+        # Memory budget (bytes) for one chunk of spectra
+        # (None: derived from the physical memory)
+        self.chunkMemory = None
+        # On-disk cache of the linear models (None: no cache)
+        self.modelCache = None
+        # Single precision for the least-squares solution, the background
+        # and the fit model (uncertainties and normal equations are always
+        # calculated in double precision)
+        self.singlePrecision = False
         if mcafit is None:
             self._mcaTheory = ClassMcaTheory.McaTheory()
         else:
@@ -74,7 +91,8 @@ def setFitConfigurationFile(self, ffile):
     def fitMultipleSpectra(self, x=None, y=None, xmin=None, xmax=None,
                            configuration=None, concentrations=False,
                            ysum=None, weight=None, refit=True, livetime=None,
-                           outbuffer=None):
+                           outbuffer=None, nWorkers=None, useProcesses=False,
+                           refitCache=True, nonNegative=False):
         """
         This method performs the actual fit. The y keyword is the only mandatory input argument.
 
@@ -83,13 +101,29 @@ def fitMultipleSpectra(self, x=None, y=None, xmin=None, xmax=None,
         :param xmin: lower limit of the fitting region
         :param xmax: upper limit of the fitting region
         :param ysum: sum spectrum
-        :param weight: 0 Means no weight, 1 Use an average weight, 2 Individual weights (slow)
+        :param weight: 0 Means no weight, 1 Use an average weight, 2 Individual weights
         :param concentrations: 0 Means no calculation, 1 Calculate elemental concentrations
         :param refit: if False, no check for negative results. Default is True.
         :livetime: It will be used if not different from None and concentrations
                    are to be calculated by using fundamental parameters with
                    automatic time. The default is None.
         :outbuffer dict: 
+        :param nWorkers: number of parallel workers fitting chunks of spectra.
+                         None or 1 means no parallelization, a value smaller
+                         than 1 means the number of CPU's. The default is None.
+        :param useProcesses: use a process pool instead of a thread pool
+                             when parallelizing. The default is False.
+        :param refitCache: keep the background subtracted spectra of the
+                           pixels to be refitted in memory ('memory'), in a
+                           temporary memory-mapped file ('file') or in either
+                           of them depending on the available memory (True).
+                           When False, the spectra are read and the background
+                           is subtracted in each refit iteration.
+                           The default is True.
+        :param nonNegative: constrain the peak areas to be non-negative by
+                            solving a non-negative least-squares problem for
+                            each spectrum. No refit is needed in that case.
+                            The default is False.
         :return dict: outbuffer
         """
         # Parse data
@@ -102,19 +136,50 @@ def fitMultipleSpectra(self, x=None, y=None, xmin=None, xmax=None,
         with outbuffer._bufferContext(update=False):
             t0 = time.time()
 
-            # Configure fit
+            # Linear model from a previous fit with the same
+            # configuration and MCA axis (if any)
             nSpectra = data.size // data.shape[mcaIndex]
-            configorg, config, weight, weightPolicy, \
-            autotime, liveTimeFactor = self._fitConfigure(
+            dtypeCalculcation = self._fitDtypeCalculation(data)
+            model = None
+            if self.modelCache is not None:
+                if configuration is None:
+                    if self._config is None:
+                        raise ValueError("Fit configuration missing")
+                    cacheConfiguration = self._config
+                else:
+                    cacheConfiguration = configuration
+                cacheKey = self.modelCache.key(
+                                configuration=cacheConfiguration,
+                                x=x, nChannels=data.shape[mcaIndex],
+                                xmin=xmin, xmax=xmax, weight=weight,
+                                concentrations=bool(concentrations),
+                                dtype=numpy.dtype(dtypeCalculcation).name)
+                model = self.modelCache.load(cacheKey)
+
+            # Configure fit
+            if model is None or concentrations:
+                configorg, config, weight, weightPolicy, \
+                autotime, liveTimeFactor = self._fitConfigure(
                                                 configuration=configuration,
                                                 concentrations=concentrations,
                                                 livetime=livetime,
                                                 weight=weight,
                                                 nSpectra=nSpectra)
+            else:
+                # No need to configure the fit theory
+                configorg = model['configorg']
+                config = model['config']
+                weight = int(model['weight'])
+                weightPolicy = int(model['weightPolicy'])
+                autotime = 0
+                liveTimeFactor = 1.0
             outbuffer['configuration'] = configorg
 
             # Sum spectrum
-            if ysum is None:
+            if model is not None and not concentrations and weightPolicy != 1:
+                # not needed
+                yref = None
+            elif ysum is None:
                 if weightPolicy == 1:
                     # we need to calculate the sum spectrum
                     # to derive the uncertainties
@@ -134,16 +199,54 @@ def fitMultipleSpectra(self, x=None, y=None, xmin=None, xmax=None,
                 xmin = config['fit']['xmin']
             if xmax is None:
                 xmax = config['fit']['xmax']
-            dtypeCalculcation = self._fitDtypeCalculation(data)
-            self._mcaTheory.setData(x=x, y=yref, xmin=xmin, xmax=xmax)
-            derivatives, freeNames, nFree, nFreeBkg = self._fitCreateModel(dtype=dtypeCalculcation)
-            outbuffer['parameter_names'] = freeNames
+            if model is None:
+                self._mcaTheory.setData(x=x, y=yref, xmin=xmin, xmax=xmax)
+                derivatives, freeNames, nFree, nFreeBkg = self._fitCreateModel(dtype=dtypeCalculcation)
+
+                # Background anchor points (if any)
+                anchorslist = self._fitBkgAnchorList(config=config)
+
+                # MCA trimming: [iXMin:iXMax]
+                iXMin, iXMax = self._fitMcaTrimInfo(x=x)
 
-            # Background anchor points (if any)
-            anchorslist = self._fitBkgAnchorList(config=config)
+                # Energy calibration
+                zero, gain = self._mcaTheory.parameters[:2]
 
-            # MCA trimming: [iXMin:iXMax]
-            iXMin, iXMax = self._fitMcaTrimInfo(x=x)
+                if self.modelCache is not None:
+                    if weightPolicy == 0:
+                        # Same SVD for all spectra
+                        svd = numpy.linalg.svd(derivatives.astype(numpy.float64),
+                                               full_matrices=False)
+                    else:
+                        svd = None
+                    self.modelCache.save(cacheKey,
+                                         configorg=configorg,
+                                         config=config,
+                                         weight=weight,
+                                         weightPolicy=weightPolicy,
+                                         derivatives=derivatives,
+                                         freeNames=freeNames,
+                                         nFreeBkg=nFreeBkg,
+                                         anchorslist=anchorslist,
+                                         trim=(iXMin, iXMax),
+                                         calibration=(zero, gain),
+                                         svd=svd)
+            else:
+                if concentrations:
+                    # The fit theory is needed for the concentrations
+                    self._mcaTheory.setData(x=x, y=yref, xmin=xmin, xmax=xmax)
+                    self._mcaTheory.estimate()
+                derivatives = model['derivatives']
+                freeNames = [str(name) for name in model['freeNames']]
+                nFree = len(freeNames)
+                nFreeBkg = int(model['nFreeBkg'])
+                anchorslist = model['anchorslist']
+                if anchorslist is not None:
+                    anchorslist = [int(i) for i in anchorslist]
+                iXMin, iXMax = [int(i) for i in model['trim']]
+                zero, gain = model['calibration']
+                svd = model['svd']
+            outbuffer['parameter_names'] = freeNames
             sliceChan = slice(iXMin, iXMax)
             nObs = iXMax-iXMin
 
@@ -162,7 +265,13 @@ def fitMultipleSpectra(self, x=None, y=None, xmin=None, xmax=None,
                 # No weights
                 SVD = True
                 sigma_b = None
-            lstsq_kwargs = {'svd': SVD, 'sigma_b': sigma_b, 'weight': weight}
+            lstsq_kwargs = {'svd': SVD, 'sigma_b': sigma_b, 'weight': weight,
+                            'dtype': dtypeCalculcation}
+            if self.modelCache is not None and weightPolicy == 0:
+                lstsq_kwargs['last_svd'] = svd
+            if nonNegative:
+                # The background parameters can be negative
+                lstsq_kwargs['free'] = list(range(nFreeBkg))
 
             # Allocate output buffers
             stackShape = data.shape
@@ -186,11 +295,13 @@ def fitMultipleSpectra(self, x=None, y=None, xmin=None, xmax=None,
                                                 shape=imageShape,
                                                 fill_value=nObs,
                                                 dtype=numpy.int32)
+                # Same storage chunks as the data so that
+                # both are iterated over in the same chunks
                 fitmodel = outbuffer.allocateH5('model',
                                                 nxdata='fit',
                                                 shape=stackShape,
                                                 dtype=dtypeResult,
-                                                chunks=True,
+                                                chunks=self._storageChunks(data) or True,
                                                 fill_value=0)
                 idx = [slice(None)]*fitmodel.ndim
                 idx[mcaIndex] = slice(0, iXMin)
@@ -209,7 +320,9 @@ def fitMultipleSpectra(self, x=None, y=None, xmin=None, xmax=None,
                             derivatives=derivatives, fitmodel=fitmodel,
                             results=results, uncertainties=uncertainties,
                             config=config, anchorslist=anchorslist,
-                            lstsq_kwargs=lstsq_kwargs)
+                            lstsq_kwargs=lstsq_kwargs, nWorkers=nWorkers,
+                            useProcesses=useProcesses,
+                            nFreeParameters=nFreeParameters)
 
             t = time.time() - t0
             _logger.debug("First fit elapsed = %f", t)
@@ -219,13 +332,15 @@ def fitMultipleSpectra(self, x=None, y=None, xmin=None, xmax=None,
             t0 = time.time()
 
             # Refit spectra with negative peak areas
-            if refit:
+            if refit and not nonNegative:
                 self._fitLstSqNegative(data=data, sliceChan=sliceChan, mcaIndex=mcaIndex,
                             derivatives=derivatives, fitmodel=fitmodel,
                             results=results, uncertainties=uncertainties,
                             config=config, anchorslist=anchorslist,
                             lstsq_kwargs=lstsq_kwargs, freeNames=freeNames,
-                            nFreeBkg=nFreeBkg, nFreeParameters=nFreeParameters)
+                            nFreeBkg=nFreeBkg, nFreeParameters=nFreeParameters,
+                            nWorkers=nWorkers, useProcesses=useProcesses,
+                            refitCache=refitCache)
                 t = time.time() - t0
                 _logger.debug("Fit of negative peaks elapsed = %f", t)
                 t0 = time.time()
@@ -253,8 +368,10 @@ def fitMultipleSpectra(self, x=None, y=None, xmin=None, xmax=None,
                 dataAxes = [(name, numpy.arange(n, dtype=dtypeResult), {})
                             for name, n in zip(stackAxesNames, stackShape)]
                 # MCA axis: use energy and add channels as extra (unused) axis
-                xdata = self._mcaTheory.xdata0.flatten()
-                zero, gain = self._mcaTheory.parameters[:2]
+                if x is None:
+                    xdata = numpy.arange(data.shape[mcaIndex])
+                else:
+                    xdata = numpy.array(x).flatten()
                 xenergy = zero + gain*xdata
                 stackAxesNames[mcaIndex] = 'energy'
                 dataAxes[mcaIndex] = 'energy', xenergy.astype(dtypeResult), {'units': 'keV'}
@@ -379,7 +496,7 @@ def _fitConfigure(self, configuration=None, concentrations=False,
             # dictated by the file
             weight = config['fit']['fitweight']
             if weight:
-                # individual pixel weights (slow)
+                # individual pixel weights
                 weightPolicy = 2
             else:
                 # No weight
@@ -391,7 +508,7 @@ def _fitConfigure(self, configuration=None, concentrations=False,
                 config['fit']['fitweight'] = 1
                 toReconfigure = True
         elif weight == 2:
-            # individual pixel weights (slow)
+            # individual pixel weights
             weightPolicy = 2
             if not config['fit']['fitweight']:
                 config['fit']['fitweight'] = 1
@@ -423,13 +540,15 @@ def _fitConfigure(self, configuration=None, concentrations=False,
     def _fitReferenceSpectrum(self, data=None, mcaIndex=None, sumover='all'):
         """Get sum spectrum
         """
-        dtype = self._fitDtypeCalculation(data)
+        # the sum needs double precision
+        dtype = numpy.float64
         if sumover == 'all':
-            nMca = self._numberOfSpectra(20, 'MiB', data=data, mcaIndex=mcaIndex)
+            nMca = self._numberOfSpectra(data=data, mcaIndex=mcaIndex)
             _logger.debug('Add spectra in chunks of {}'.format(nMca))
             datastack = McaStackView.FullView(data, mcaAxis=mcaIndex, nMca=nMca)
             yref = numpy.zeros((data.shape[mcaIndex],), dtype)
-            for key, chunk in datastack.items():
+            nPrefetch = self._numberOfPrefetchChunks(data)
+            for key, chunk in datastack.items(nPrefetch=nPrefetch):
                 yref += chunk.sum(axis=0, dtype=dtype)
         elif sumover == 'first vector':
             # Sum spectrum of the first row
@@ -448,7 +567,7 @@ def _fitReferenceSpectrum(self, data=None, mcaIndex=None, sumover='all'):
             # First spectrum
             idx = [0]*data.ndim
             idx[mcaIndex] = slice(None)
-            yref = data[idx].astype(dtype)
+            yref = data[tuple(idx)].astype(dtype)
         return yref
 
     def _fitCreateModel(self, dtype=None):
@@ -547,76 +666,172 @@ def _dataChunkIter(self, slicecls, data=None, fitmodel=None, **kwargs):
         dtype = self._fitDtypeResult(data)
         datastack = slicecls(data, dtype=dtype,
                              readonly=True, **kwargs)
-        chunkItems = datastack.items(keyType='select')
+        chunkItems = datastack.items(keyType='select',
+                                     nPrefetch=self._numberOfPrefetchChunks(data))
         if fitmodel is not None:
             modelstack = slicecls(fitmodel, dtype=dtype,
                                   readonly=False, **kwargs)
-            modeliter = modelstack.items()
+            modeliter = modelstack.items(nPrefetch=self._numberOfPrefetchChunks(fitmodel))
             chunkItems = McaStackView.izipChunkItems(chunkItems, modeliter)
         return chunkItems
 
-    def _fitLstSqAll(self, data=None, sliceChan=None, mcaIndex=None,
-                     derivatives=None, results=None, uncertainties=None,
-                     fitmodel=None, config=None, anchorslist=None,
-                     lstsq_kwargs=None):
+    @staticmethod
+    def _numberOfPrefetchChunks(data):
+        """Chunks of datasets are read ahead (and written back) in the
+        background so that I/O overlaps with the fit
         """
-        Fit all spectra
+        if isinstance(data, numpy.ndarray):
+            return 0
+        else:
+            return 2
+
+    def _fitLstSqChunks(self, slicecls, data=None, fitmodel=None,
+                        derivatives=None, config=None, anchorslist=None,
+                        lstsq_kwargs=None, nWorkers=None, useProcesses=False,
+                        **kwargs):
         """
-        nChan, nFree = derivatives.shape
-        bkgsub = bool(config['fit']['stripflag'])
+        Fit all spectra of a stack view chunk by chunk. The fit model
+        (if any) is saved.
+
+        :param slicecls: McaStackView class
+        :param derivatives: nChan x nFree
+        :param int nWorkers: number of parallel workers
+                             (None or 1: no parallelization,
+                             < 1: number of CPU's)
+        :param bool useProcesses: process pool instead of thread pool
+        :param \**kwargs: see slicecls
+        :returns generator: (index(tuple), shape(tuple)), ddict(dict)
+        """
+        nWorkers = numberOfWorkers(nWorkers)
+        if nWorkers == 1:
+            chunkItems = self._dataChunkIter(slicecls, data=data,
+                                             fitmodel=fitmodel, **kwargs)
+            for chunk in chunkItems:
+                if fitmodel is None:
+                    key, chunk = chunk
+                    chunkModel = None
+                else:
+                    (key, chunk), (_, chunkModel) = chunk
+                    chunkModel = chunkModel.T
+                ddict = fitLstSqChunk(chunk.T, derivatives,
+                                      fitmodel=chunkModel, config=config,
+                                      anchorslist=anchorslist,
+                                      lstsq_kwargs=lstsq_kwargs)
+                lstsq_kwargs['last_svd'] = ddict.get('svd', None)
+                yield key, ddict
+            return
 
-        nMca = self._numberOfSpectra(1, 'MiB', data=data, mcaIndex=mcaIndex,
-                                     sliceChan=sliceChan)
-        _logger.debug('Fit spectra in chunks of {}'.format(nMca))
-        chunkItems = self._dataChunkIter(McaStackView.FullView,
-                                         data=data,
-                                         fitmodel=fitmodel,
-                                         mcaSlice=sliceChan,
-                                         mcaAxis=mcaIndex,
-                                         nMca=nMca)
-        for chunk in chunkItems:
-            if fitmodel is None:
-                (idx, idxShape), chunk = chunk
+        # Reading and saving is done in order by this thread
+        dtype = self._fitDtypeResult(data)
+        chunkItems = slicecls(data, dtype=dtype, readonly=True, **kwargs)\
+                        .items(keyType='select',
+                               nPrefetch=self._numberOfPrefetchChunks(data))
+        if fitmodel is None:
+            modelItems = None
+        else:
+            modelItems = slicecls(fitmodel, dtype=dtype, readonly=False,
+                                  **kwargs)\
+                        .items(nPrefetch=self._numberOfPrefetchChunks(fitmodel))
+
+        # The first chunk provides the SVD for all other chunks
+        for key, chunk in chunkItems:
+            if modelItems is None:
                 chunkModel = None
             else:
-                ((idx, idxShape), chunk), (_, chunkModel) = chunk
+                _, chunkModel = next(modelItems)
                 chunkModel = chunkModel.T
-            chunk = chunk.T
+            ddict = fitLstSqChunk(chunk.T, derivatives,
+                                  fitmodel=chunkModel, config=config,
+                                  anchorslist=anchorslist,
+                                  lstsq_kwargs=lstsq_kwargs)
+            lstsq_kwargs['last_svd'] = ddict.get('svd', None)
+            yield key, ddict
+            break
+        else:
+            return
+
+        # The other chunks are fitted by a pool of workers
+        workerKwargs = {'derivatives': derivatives,
+                        'config': config,
+                        'anchorslist': anchorslist,
+                        'lstsq_kwargs': lstsq_kwargs,
+                        'model': fitmodel is not None}
+        pending = collections.deque()
+        with workerPool(nWorkers, useProcesses, workerKwargs) as apply_async:
+            for key, chunk in chunkItems:
+                # The view buffer is reused for the next chunk
+                pending.append((key, apply_async(chunk.copy())))
+                if len(pending) >= 2*nWorkers:
+                    yield self._fitLstSqSaveModel(pending, modelItems)
+            while pending:
+                yield self._fitLstSqSaveModel(pending, modelItems)
+        if modelItems is not None:
+            # Write the last model chunk
+            next(modelItems, None)
 
-            # Subtract background
-            if bkgsub:
-                self._fitBkgSubtract(chunk, config=config,
-                                     anchorslist=anchorslist,
-                                     fitmodel=chunkModel)
+    @staticmethod
+    def _fitLstSqSaveModel(pending, modelItems):
+        """Wait for the oldest chunk to be fitted
+        """
+        key, result = pending.popleft()
+        ddict, chunkModel = result.get()
+        if modelItems is not None:
+            _, modelBuffer = next(modelItems)
+            modelBuffer[()] = chunkModel
+        return key, ddict
 
-            # Solve linear system of equations
-            ddict = lstsq(derivatives, chunk, digested_output=True,
-                          **lstsq_kwargs)
-            lstsq_kwargs['last_svd'] = ddict.get('svd', None)
+    def _fitLstSqAll(self, data=None, sliceChan=None, mcaIndex=None,
+                     derivatives=None, results=None, uncertainties=None,
+                     fitmodel=None, config=None, anchorslist=None,
+                     lstsq_kwargs=None, nWorkers=None, useProcesses=False,
+                     nFreeParameters=None):
+        """
+        Fit all spectra
+        """
+        nChan, nFree = derivatives.shape
 
+        nMca = self._numberOfSpectra(data=data, mcaIndex=mcaIndex,
+                                     sliceChan=sliceChan, nWorkers=nWorkers)
+        _logger.debug('Fit spectra in chunks of {}'.format(nMca))
+        chunkResults = self._fitLstSqChunks(McaStackView.FullView,
+                                            data=data,
+                                            fitmodel=fitmodel,
+                                            derivatives=derivatives,
+                                            config=config,
+                                            anchorslist=anchorslist,
+                                            lstsq_kwargs=lstsq_kwargs,
+                                            nWorkers=nWorkers,
+                                            useProcesses=useProcesses,
+                                            mcaSlice=sliceChan,
+                                            mcaAxis=mcaIndex,
+                                            nMca=nMca,
+                                            chunkAlign=self._storageChunks(data))
+        for (idx, idxShape), ddict in chunkResults:
             # Save results
             idx = (slice(None),) + idx
             idxShape = (nFree,) + idxShape
             results[idx] = ddict['parameters'].reshape(idxShape)
             uncertainties[idx] = ddict['uncertainties'].reshape(idxShape)
-            if chunkModel is not None:
-                if bkgsub:
-                    chunkModel += numpy.dot(derivatives, ddict['parameters'])
-                else:
-                    chunkModel[()] = numpy.dot(derivatives, ddict['parameters'])
+            if nFreeParameters is not None and 'nfree' in ddict:
+                # Non-negative least-squares
+                nFreeParameters[idx[1:]] = ddict['nfree'].reshape(idxShape[1:])
 
     def _fitLstSqReduced(self, data=None, sliceChan=None, mcaIndex=None,
                          derivatives=None, results=None, uncertainties=None,
                          fitmodel=None, config=None, anchorslist=None,
                          lstsq_kwargs=None, mask=None,
                          skipNames=None, skipParams=None,
-                         nFreeParameters=None, nmin=None):
+                         nFreeParameters=None, nmin=None,
+                         nWorkers=None, useProcesses=False, cache=None):
         """
         Fit reduced number of spectra (mask) with a reduced model (skipped parameters will be set to zero)
+
+        :param SpectrumCache cache: background subtracted spectra of
+                                    the masked pixels (optional)
         """
         npixels = int(mask.sum())
-        nMca = self._numberOfSpectra(1, 'MiB', data=data, mcaIndex=mcaIndex,
-                                     sliceChan=sliceChan)
+        nMca = self._numberOfSpectra(data=data, mcaIndex=mcaIndex,
+                                     sliceChan=sliceChan, nWorkers=nWorkers)
         if npixels < nmin:
             _logger.debug("Not worth refitting #%d pixels", npixels)
             for iFree, name in zip(skipParams, skipNames):
@@ -635,34 +850,30 @@ def _fitLstSqReduced(self, data=None, sliceChan=None, mcaIndex=None,
             lstsq_kwargs['last_svd'] = None
 
             # Fit all selected spectra in one chunk
-            bkgsub = bool(config['fit']['stripflag'])
-            chunkItems = self._dataChunkIter(McaStackView.MaskedView,
-                                             data=data,
-                                             fitmodel=fitmodel,
-                                             mask=mask,
-                                             mcaSlice=sliceChan,
-                                             mcaAxis=mcaIndex,
-                                             nMca=nMca)
-            for chunk in chunkItems:
-                if fitmodel is None:
-                    (idx, idxShape), chunk = chunk
-                    chunkModel = None
-                else:
-                    ((idx, idxShape), chunk), (_, chunkModel) = chunk
-                    chunkModel = chunkModel.T
-                chunk = chunk.T
-
-                # Subtract background
-                if bkgsub:
-                    self._fitBkgSubtract(chunk, config=config,
-                                         anchorslist=anchorslist,
-                                         fitmodel=chunkModel)
-
-                # Solve linear system of equations
-                ddict = lstsq(A, chunk, digested_output=True,
-                              **lstsq_kwargs)
-                lstsq_kwargs['last_svd'] = ddict.get('svd', None)
-
+            if cache is None:
+                chunkResults = self._fitLstSqChunks(McaStackView.MaskedView,
+                                                    data=data,
+                                                    fitmodel=fitmodel,
+                                                    derivatives=A,
+                                                    config=config,
+                                                    anchorslist=anchorslist,
+                                                    lstsq_kwargs=lstsq_kwargs,
+                                                    nWorkers=nWorkers,
+                                                    useProcesses=useProcesses,
+                                                    mask=mask,
+                                                    mcaSlice=sliceChan,
+                                                    mcaAxis=mcaIndex,
+                                                    nMca=nMca)
+            else:
+                chunkResults = self._fitLstSqCachedChunks(cache,
+                                                    fitmodel=fitmodel,
+                                                    derivatives=A,
+                                                    lstsq_kwargs=lstsq_kwargs,
+                                                    mask=mask,
+                                                    mcaSlice=sliceChan,
+                                                    mcaAxis=mcaIndex,
+                                                    nMca=nMca)
+            for (idx, idxShape), ddict in chunkResults:
                 # Save results
                 iParam = 0
                 for iFree in range(nFreeOrg):
@@ -675,14 +886,90 @@ def _fitLstSqReduced(self, data=None, sliceChan=None, mcaIndex=None,
                         uncertainties[iFree][idx] = ddict['uncertainties'][iParam]\
                                                 .reshape(idxShape)
                         iParam += 1
-                if chunkModel is not None:
-                    if bkgsub:
-                        chunkModel += numpy.dot(A, ddict['parameters'])
-                    else:
-                        chunkModel[()] = numpy.dot(A, ddict['parameters'])
                 if nFreeParameters is not None:
                     nFreeParameters[idx] = nFree
 
+    def _fitLstSqCachedChunks(self, cache, fitmodel=None, derivatives=None,
+                              lstsq_kwargs=None, mask=None, nMca=None,
+                              **kwargs):
+        """
+        Fit the cached spectra of the masked pixels chunk by chunk.
+        The fit model (if any) is saved.
+
+        :param SpectrumCache cache:
+        :param derivatives: nChan x nFree
+        :param \**kwargs: see McaStackView.MaskedView
+        :returns generator: (index(tuple), shape(tuple)), ddict(dict)
+        """
+        rows = cache.index[mask]
+        maskIndex = mask.nonzero()
+        if fitmodel is None:
+            modelItems = None
+        else:
+            modelItems = McaStackView.MaskedView(fitmodel, mask=mask,
+                                                 nMca=nMca, readonly=False,
+                                                 dtype=cache.dtype,
+                                                 **kwargs).items()
+        for idx, n in McaStackView.chunkIndexGen(0, rows.size, nMca):
+            chunkRows = rows[idx]
+            ddict = lstsq(derivatives, cache.spectra[chunkRows].T,
+                          digested_output=True, **lstsq_kwargs)
+            lstsq_kwargs['last_svd'] = ddict.get('svd', None)
+            if modelItems is not None:
+                _, chunkModel = next(modelItems)
+                if cache.background is None:
+                    chunkModel[()] = 0
+                else:
+                    chunkModel[()] = cache.background[chunkRows]
+                parameters = ddict['parameters'].astype(derivatives.dtype,
+                                                        copy=False)
+                chunkModel += numpy.dot(derivatives, parameters).T
+            yield (tuple(ind[idx] for ind in maskIndex), (n,)), ddict
+        if modelItems is not None:
+            # Write the last model chunk
+            next(modelItems, None)
+
+    def _fitCreateCache(self, data=None, mask=None, mode=True,
+                        sliceChan=None, mcaIndex=None, fitmodel=None,
+                        config=None, anchorslist=None, nWorkers=None,
+                        **kwargs):
+        """
+        Read the spectra of the masked pixels and keep them in a
+        cache after background subtraction
+
+        :returns SpectrumCache:
+        """
+        dtype = self._fitDtypeResult(data)
+        nChan = McaStackView.sliceLen(sliceChan, data.shape[mcaIndex])
+        bkgsub = bool(config['fit']['stripflag'])
+        saveBackground = bkgsub and fitmodel is not None
+        cache = SpectrumCache(mask, nChan, dtype,
+                              background=saveBackground, mode=mode)
+        _logger.debug("Cache #{} spectra to be refitted ({})"
+                      .format(cache.nSpectra, cache.mode))
+        nMca = self._numberOfSpectra(data=data, mcaIndex=mcaIndex,
+                                     sliceChan=sliceChan, nWorkers=nWorkers)
+        chunkItems = self._dataChunkIter(McaStackView.MaskedView,
+                                         data=data, mask=mask,
+                                         mcaSlice=sliceChan,
+                                         mcaAxis=mcaIndex,
+                                         nMca=nMca)
+        i = 0
+        for key, chunk in chunkItems:
+            n = chunk.shape[0]
+            if bkgsub:
+                if saveBackground:
+                    background = cache.background[i:i+n].T
+                else:
+                    background = None
+                self._fitBkgSubtract(chunk.T, config=config,
+                                     anchorslist=anchorslist,
+                                     fitmodel=background,
+                                     dtype=self._fitDtypeCalculation(data))
+            cache.spectra[i:i+n] = chunk
+            i += n
+        return cache
+
     @staticmethod
     def _fitDtypeResult(data):
         if data.dtype not in [numpy.float32, numpy.float64]:
@@ -693,53 +980,66 @@ def _fitDtypeResult(data):
         else:
             return data.dtype
 
-    @staticmethod
-    def _fitDtypeCalculation(data):
-        # TODO: always 64bit?
-        return numpy.float
+    def _fitDtypeCalculation(self, data):
+        if self.singlePrecision:
+            return numpy.float32
+        else:
+            return numpy.float64
 
-    def _numberOfSpectra(self, n, unit, data=None, mcaIndex=None, sliceChan=None):
-        p = ['b', 'kib', 'mib', 'gib'].index(unit.lower())
+    def _numberOfSpectra(self, data=None, mcaIndex=None, sliceChan=None,
+                         nWorkers=None):
+        """Number of spectra in one chunk, given the memory budget
+        (shared by the parallel workers)
+        """
+        nbytes = self.chunkMemory
+        if not nbytes:
+            nbytes = McaStackView.chunkMemoryBudget()
+        nbytes //= numberOfWorkers(nWorkers)
         dtype = self._fitDtypeCalculation(data)
         nChan = data.shape[mcaIndex]
         if sliceChan is not None:
             nChan = McaStackView.sliceLen(sliceChan, nChan)
         nByteMca = numpy.array([0], dtype).itemsize*nChan
-        return max((n*1024**p)//nByteMca, 1)
+        return max(nbytes//nByteMca, 1)
 
     @staticmethod
-    def _fitBkgSubtract(spectra, config=None, anchorslist=None, fitmodel=None):
+    def _storageChunks(data):
+        """Chunks are aligned with the HDF5 storage chunks (if any)
+        to avoid reading and decompressing the same storage chunk
+        more than once
+        """
+        chunks, compression = McaStackView.storageChunkInfo(data)
+        if chunks:
+            _logger.debug('Data storage chunks: {} (compression: {})'
+                          .format(chunks, compression))
+        return chunks
+
+    @staticmethod
+    def _fitBkgSubtract(spectra, config=None, anchorslist=None, fitmodel=None,
+                        dtype=None):
         """Subtract brackground from data and add it to fit model
         """
-        for k in range(spectra.shape[1]):
-            # obtain the smoothed spectrum
-            background = SpecfitFuns.SavitskyGolay(spectra[:, k],
-                                    config['fit']['stripfilterwidth'])
-            lastAnchor = 0
-            for anchor in anchorslist:
-                if (anchor > lastAnchor) and (anchor < background.size):
-                    background[lastAnchor:anchor] =\
-                            SpecfitFuns.snip1d(background[lastAnchor:anchor],
-                                               config['fit']['snipwidth'],
-                                               0)
-                    lastAnchor = anchor
-            if lastAnchor < background.size:
-                background[lastAnchor:] =\
-                        SpecfitFuns.snip1d(background[lastAnchor:],
-                                           config['fit']['snipwidth'],
-                                           0)
-            spectra[:, k] -= background
-            if fitmodel is not None:
-                fitmodel[:, k] = background
+        # All spectra of the chunk are stripped at once
+        background = SNIPModule.getStripBackgroundMultiple(spectra.T,
+                                    config['fit']['snipwidth'],
+                                    smoothing_width=config['fit']['stripfilterwidth'],
+                                    anchorslist=anchorslist,
+                                    dtype=dtype)
+        spectra -= background.T
+        if fitmodel is not None:
+            fitmodel[()] = background.T
 
     def _fitLstSqNegative(self, data=None, freeNames=None, nFreeBkg=None,
-                          results=None, **kwargs):
+                          results=None, refitCache=False, **kwargs):
         """Refit pixels with negative peak areas (remove the parameters from the model)
+
+        :param refitCache: see fitMultipleSpectra
         """
         nFree = len(freeNames)
         iIter = 1
         nIter = 2 * (nFree - nFreeBkg) + iIter
         negativePresent = True
+        cache = None
         while negativePresent:
             # Pixels with negative peak areas
             negList = []
@@ -787,12 +1087,22 @@ def _fitLstSqNegative(self, data=None, freeNames=None, nFreeBkg=None,
             nmin = 0.0025 * badMask.size
             _logger.debug("Refit iteration #{}. Fixed to zero: {}"
                           .format(iIter, badNames))
+            if refitCache and cache is None and badMask.sum() >= nmin:
+                # Only pixels with negative peak areas at the
+                # first refit can be refitted afterwards
+                candidates = negList[0][2].copy()
+                for nNeg, iFree, negMask in negList[1:]:
+                    candidates |= negMask
+                cache = self._fitCreateCache(data=data, mask=candidates,
+                                             mode=refitCache, **kwargs)
             self._fitLstSqReduced(data=data, mask=badMask,
                                   skipParams=badParameters,
                                   skipNames=badNames,
                                   results=results,
-                                  nmin=nmin, **kwargs)
+                                  nmin=nmin, cache=cache, **kwargs)
             iIter += 1
+        if cache is not None:
+            cache.close()
 
     def _fitDeriveMassFractions(self, config=None, outputDict=None, results=None,
                            nFreeBkg=None, autotime=None, liveTimeFactor=None):
@@ -930,6 +1240,359 @@ def _fitDeriveMassFractions(self, config=None, outputDict=None, results=None,
         outputDict['massfractions'] = massFractions
 
 
+def fitLstSqChunk(chunk, derivatives, fitmodel=None, config=None,
+                  anchorslist=None, lstsq_kwargs=None):
+    """
+    Subtract the background (if requested) and solve the linear system
+    for a chunk of spectra
+
+    :param array chunk: nChan x nMca (modified in place)
+    :param array derivatives: nChan x nFree
+    :param array fitmodel: nChan x nMca buffer for the fit model
+    :returns dict: see lstsq
+    """
+    bkgsub = bool(config['fit']['stripflag'])
+    if bkgsub:
+        FastXRFLinearFit._fitBkgSubtract(chunk, config=config,
+                                         anchorslist=anchorslist,
+                                         fitmodel=fitmodel,
+                                         dtype=lstsq_kwargs.get('dtype'))
+    if 'free' in lstsq_kwargs:
+        # Non-negative least-squares
+        ddict = nnls(derivatives, chunk, digested_output=True,
+                     **lstsq_kwargs)
+    else:
+        ddict = lstsq(derivatives, chunk, digested_output=True,
+                      **lstsq_kwargs)
+    if fitmodel is not None:
+        parameters = ddict['parameters'].astype(derivatives.dtype, copy=False)
+        if bkgsub:
+            fitmodel += numpy.dot(derivatives, parameters)
+        else:
+            fitmodel[()] = numpy.dot(derivatives, parameters)
+    return ddict
+
+
+class SpectrumCache(object):
+    """
+    Spectra (and optionally their background) of a selection of pixels,
+    kept in memory or in a temporary memory-mapped file
+    """
+
+    def __init__(self, mask, nChan, dtype, background=False, mode=True):
+        """
+        :param array mask: pixels to be cached
+        :param int nChan: number of channels of each spectrum
+        :param dtype:
+        :param bool background: cache the background of each spectrum
+        :param mode: 'memory', 'file' or True ('memory' when it takes
+                     less than a quarter of the physical memory)
+        """
+        nSpectra = int(mask.sum())
+        self.index = numpy.full(mask.shape, -1, dtype=numpy.intp)
+        self.index[mask] = numpy.arange(nSpectra)
+        self.dtype = dtype
+        shape = 1 + int(bool(background)), nSpectra, nChan
+        if mode is True:
+            nbytes = numpy.prod(shape) * numpy.dtype(dtype).itemsize
+            available = McaStackView.chunkMemoryBudget(fraction=0.25,
+                                                       minimal=0,
+                                                       maximal=None)
+            if nbytes <= available:
+                mode = 'memory'
+            else:
+                mode = 'file'
+        if mode == 'memory':
+            self._file = None
+            self._buffer = numpy.empty(shape, dtype=dtype)
+        elif mode == 'file':
+            self._file = tempfile.TemporaryFile(prefix='pymca_cache_')
+            self._buffer = numpy.memmap(self._file, dtype=dtype,
+                                        mode='w+', shape=shape)
+        else:
+            raise ValueError("Unknown cache mode {}".format(repr(mode)))
+        self.mode = mode
+
+    @property
+    def nSpectra(self):
+        return self._buffer.shape[1]
+
+    @property
+    def spectra(self):
+        """nSpectra x nChan
+        """
+        return self._buffer[0]
+
+    @property
+    def background(self):
+        """nSpectra x nChan or None
+        """
+        if self._buffer.shape[0] > 1:
+            return self._buffer[1]
+        else:
+            return None
+
+    def close(self):
+        self._buffer = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class ModelCache(object):
+    """
+    On-disk cache of the linear models (derivatives, parameter names,
+    SVD factors, ...) of FastXRFLinearFit, so that repeated fits with the
+    same configuration and MCA axis do not need to configure the fit theory.
+
+    Each model is saved in its own npz file. When the total size of the
+    files exceeds the maximal size, the least recently used ones are removed.
+    """
+
+    _PREFIX = 'fastxrflinearfit_'
+    _SUFFIX = '.npz'
+
+    def __init__(self, directory, maxSize=256*1024**2):
+        """
+        :param str directory: created when missing
+        :param int maxSize: maximal size of the cache in bytes
+        """
+        self.directory = directory
+        self.maxSize = maxSize
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # created in the mean time?
+                if not os.path.isdir(directory):
+                    raise
+
+    @staticmethod
+    def key(**kwargs):
+        """
+        Hash of everything the model depends on
+
+        :param \**kwargs: fit configurations (dict), arrays, scalars or None
+        :returns str:
+        """
+        h = hashlib.sha1()
+        h.update(pymcaVersion().encode('utf-8'))
+        for name in sorted(kwargs):
+            value = kwargs[name]
+            h.update(name.encode('utf-8'))
+            if value is None:
+                h.update(b'None')
+            elif hasattr(value, 'keys'):
+                value = ConfigDict.ConfigDict(initdict=_sortedDict(value))
+                h.update(value.tostring().encode('utf-8'))
+            else:
+                value = numpy.ascontiguousarray(value)
+                h.update(str((value.dtype.str, value.shape)).encode('utf-8'))
+                h.update(value.tobytes())
+        return h.hexdigest()
+
+    def _filename(self, key):
+        return os.path.join(self.directory, self._PREFIX + key + self._SUFFIX)
+
+    def _files(self):
+        """
+        :returns list: (time of last use, size, path) most recent first
+        """
+        files = []
+        for name in os.listdir(self.directory):
+            if name.startswith(self._PREFIX) and name.endswith(self._SUFFIX):
+                path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        files.sort(reverse=True)
+        return files
+
+    def load(self, key):
+        """
+        :param str key:
+        :returns dict or None: None when the model is not cached
+        """
+        filename = self._filename(key)
+        try:
+            with numpy.load(filename, allow_pickle=False) as npz:
+                arrays = dict((name, npz[name]) for name in npz.files)
+        except (IOError, OSError, ValueError, KeyError, zipfile.BadZipfile):
+            return None
+        try:
+            # mark as recently used
+            os.utime(filename, None)
+        except OSError:
+            pass
+        configs = arrays.pop('__configs__').tolist()
+        nones = arrays.pop('__none__').tolist()
+        model = {}
+        for name, value in arrays.items():
+            if name in configs:
+                model[name] = ConfigDict.ConfigDict()
+                model[name].readfp(StringIO(value[()]))
+            else:
+                model[name] = value
+        for name in nones:
+            model[name] = None
+        svd = [model.pop(name) for name in ('svdU', 'svdS', 'svdV')]
+        if svd[0] is None:
+            model['svd'] = None
+        else:
+            model['svd'] = tuple(svd)
+        _logger.debug("Linear model loaded from %s", filename)
+        return model
+
+    def save(self, key, svd=None, **kwargs):
+        """
+        :param str key:
+        :param tuple svd: U, s, V
+        :param \**kwargs: fit configurations (dict), arrays, scalars or None
+        """
+        if svd is None:
+            svd = None, None, None
+        kwargs['svdU'], kwargs['svdS'], kwargs['svdV'] = svd
+        arrays = {}
+        configs = []
+        nones = []
+        for name, value in kwargs.items():
+            if value is None:
+                nones.append(name)
+            elif hasattr(value, 'keys'):
+                configs.append(name)
+                value = ConfigDict.ConfigDict(initdict=value)
+                arrays[name] = numpy.array(value.tostring())
+            else:
+                arrays[name] = numpy.asarray(value)
+        arrays['__configs__'] = numpy.array(configs, dtype=numpy.str_)
+        arrays['__none__'] = numpy.array(nones, dtype=numpy.str_)
+        # Write a temporary file first so that other processes never
+        # see an incomplete model
+        filename = self._filename(key)
+        fd, tmpname = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                numpy.savez(f, **arrays)
+            if os.path.exists(filename):
+                os.remove(filename)
+            os.rename(tmpname, filename)
+        except Exception:
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+            raise
+        _logger.debug("Linear model saved in %s", filename)
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used models when the cache is too big
+        """
+        total = 0
+        for i, (_, size, path) in enumerate(self._files()):
+            total += size
+            if i and total > self.maxSize:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def clear(self):
+        for _, _, path in self._files():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def _sortedDict(ddict):
+    """Copy of a nested dictionary with sorted keys
+    """
+    return collections.OrderedDict(
+                (key, _sortedDict(ddict[key]) if hasattr(ddict[key], 'keys')
+                      else ddict[key])
+                for key in sorted(ddict.keys(), key=str))
+
+
+def numberOfWorkers(nWorkers):
+    """
+    :param int nWorkers: None or 1 (no parallelization), < 1 (number of CPU's)
+    :returns int:
+    """
+    if nWorkers is None:
+        return 1
+    nWorkers = int(nWorkers)
+    if nWorkers < 1:
+        nWorkers = multiprocessing.cpu_count()
+    return nWorkers
+
+
+# Keyword arguments of fitLstSqChunk in the worker processes
+_WORKER_KWARGS = {}
+
+
+def _workerInit(kwargs):
+    _WORKER_KWARGS.clear()
+    _WORKER_KWARGS.update(kwargs)
+
+
+def _workerFitLstSqChunk(chunk, derivatives=None, config=None,
+                         anchorslist=None, lstsq_kwargs=None, model=False):
+    """
+    :param array chunk: nMca x nChan
+    :returns tuple: ddict, fitmodel (nMca x nChan or None)
+    """
+    chunk = chunk.T
+    if model:
+        fitmodel = numpy.empty(chunk.shape[::-1], dtype=chunk.dtype).T
+    else:
+        fitmodel = None
+    # Do not modify the SVD shared by all workers
+    lstsq_kwargs = dict(lstsq_kwargs)
+    last_svd = lstsq_kwargs.get('last_svd', None)
+    if last_svd is not None:
+        U, s, V = last_svd
+        lstsq_kwargs['last_svd'] = U, s.copy(), V
+    ddict = fitLstSqChunk(chunk, derivatives, fitmodel=fitmodel,
+                          config=config, anchorslist=anchorslist,
+                          lstsq_kwargs=lstsq_kwargs)
+    ddict.pop('svd', None)
+    if fitmodel is not None:
+        fitmodel = fitmodel.T
+    return ddict, fitmodel
+
+
+def _workerProcessFitLstSqChunk(chunk):
+    return _workerFitLstSqChunk(chunk, **_WORKER_KWARGS)
+
+
+@contextmanager
+def workerPool(nWorkers, useProcesses, workerKwargs):
+    """
+    Pool of workers for fitting chunks of spectra
+
+    :param int nWorkers:
+    :param bool useProcesses: process pool instead of thread pool
+    :param dict workerKwargs: see _workerFitLstSqChunk
+    :yields callable: chunk(nMca x nChan) -> AsyncResult
+    """
+    if useProcesses:
+        pool = multiprocessing.Pool(nWorkers, initializer=_workerInit,
+                                    initargs=(workerKwargs,))
+        def apply_async(chunk):
+            return pool.apply_async(_workerProcessFitLstSqChunk, (chunk,))
+    else:
+        pool = ThreadPool(nWorkers)
+        def apply_async(chunk):
+            return pool.apply_async(_workerFitLstSqChunk, (chunk,),
+                                    workerKwargs)
+    try:
+        yield apply_async
+    finally:
+        pool.terminate()
+        pool.join()
+
+
 def getFileListFromPattern(pattern, begin, end, increment=None):
     if type(begin) == type(1):
         begin = [begin]
@@ -1008,7 +1671,9 @@ def main():
                    'tif=', 'edf=', 'csv=', 'h5=',
                    'filepattern=', 'begin=', 'end=', 'increment=',
                    'outroot=', 'outentry=', 'outprocess=',
-                   'diagnostics=', 'debug=', 'overwrite=']
+                   'diagnostics=', 'debug=', 'overwrite=',
+                   'nworkers=', 'processes=', 'nonnegative=',
+                   'modelcache=', 'singleprecision=']
     try:
         opts, args = getopt.getopt(
                      sys.argv[1:],
@@ -1038,6 +1703,11 @@ def main():
     saveData = 0
     debug = 0
     overwrite = 1
+    nWorkers = None
+    useProcesses = 0
+    nonNegative = 0
+    modelCacheDir = None
+    singlePrecision = 0
     for opt, arg in opts:
         if opt == '--cfg':
             configurationFile = arg
@@ -1089,6 +1759,16 @@ def main():
             debug = int(arg)
         elif opt == '--overwrite':
             overwrite = int(arg)
+        elif opt == '--nworkers':
+            nWorkers = int(arg)
+        elif opt == '--processes':
+            useProcesses = int(arg)
+        elif opt == '--nonnegative':
+            nonNegative = int(arg)
+        elif opt == '--modelcache':
+            modelCacheDir = arg
+        elif opt == '--singleprecision':
+            singlePrecision = int(arg)
 
     logging.basicConfig()
     if debug:
@@ -1116,7 +1796,15 @@ def main():
 
     t0 = time.time()
     fastFit = FastXRFLinearFit()
-    fastFit.setFitConfigurationFile(configurationFile)
+    fastFit.singlePrecision = bool(singlePrecision)
+    if modelCacheDir:
+        # the fit is only configured when the model is not cached
+        fastFit.modelCache = ModelCache(modelCacheDir)
+        configuration = ConfigDict.ConfigDict()
+        configuration.read(configurationFile)
+    else:
+        fastFit.setFitConfigurationFile(configurationFile)
+        configuration = None
     print("Main configuring Elapsed = % s " % (time.time() - t0))
 
     outbuffer = OutputBuffer(outputDir=outputDir,
@@ -1129,10 +1817,14 @@ def main():
     with ProfilingUtils.profile(memory=debug, time=debug):
         with outbuffer.saveContext():
             outbuffer = fastFit.fitMultipleSpectra(y=dataStack,
+                                                configuration=configuration,
                                                 weight=weight,
                                                 refit=refit,
                                                 concentrations=concentrations,
-                                                outbuffer=outbuffer)
+                                                outbuffer=outbuffer,
+                                                nWorkers=nWorkers,
+                                                useProcesses=useProcesses,
+                                                nonNegative=nonNegative)
         # Without saveContext you need to execute: outbuffer.save()
         print("Total Elapsed = % s " % (time.time() - t0))
 
@@ -515,7 +515,8 @@ def _saveH5(self):
         # Save diagnostics
         signals = []
         attrs = {'interpretation':'image'}
-        for name in ['nObservations', 'nFreeParameters']:
+        for name in ['nObservations', 'nFreeParameters',
+                     'chisq', 'nIterations']:
             img = self.get(name, None)
             if img is not None:
                 signals.append((name, img, attrs))
@@ -0,0 +1,293 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2004-2019 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V.A. Sole - ESRF Data Analysis"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+__doc__ = """
+Module to perform a non-linear fit of every spectrum of a stack of
+fluorescence spectra.
+
+The spectra are fitted chunk by chunk (see McaStackView) and all the spectra
+of a chunk are refined at once by Gefit.MultipleLeastSquaresFit. They share
+the peak families of the fit configuration but every spectrum has its own
+parameters, including the energy calibration, the noise and the Fano factor.
+"""
+import numpy
+import logging
+import time
+from . import ClassMcaTheory
+from . import McaStackView
+from .FastXRFLinearFit import FastXRFLinearFit
+from .FastXRFLinearFitOutput import OutputBuffer
+from PyMca5.PyMcaMath.fitting import Gefit
+
+_logger = logging.getLogger(__name__)
+
+
+class FastXRFNonLinearFit(FastXRFLinearFit):
+
+    def fitMultipleSpectra(self, x=None, y=None, xmin=None, xmax=None,
+                           configuration=None, ysum=None, weight=None,
+                           outbuffer=None, maxiter=None):
+        """
+        This method performs the actual fit. The y keyword is the only mandatory input argument.
+
+        :param x: 1D array containing the x axis (usually the channels) of the spectra.
+        :param y: nD array containing the spectra
+        :param xmin: lower limit of the fitting region
+        :param xmax: upper limit of the fitting region
+        :param ysum: sum spectrum, used to estimate the starting parameters
+        :param weight: 0 Means no weight, 1 Individual (Poisson) weights.
+                       The default is given by the fit configuration.
+        :param maxiter: maximum number of iterations. The default is given
+                        by the fit configuration.
+        :outbuffer dict:
+        :return dict: outbuffer with the parameters, uncertainties, reduced
+                      chi-square (chisq) and number of iterations
+                      (nIterations) images
+        """
+        # Parse data
+        x, data, mcaIndex, livetime = self._fitParseData(x=x, y=y)
+
+        if outbuffer is None:
+            outbuffer = OutputBuffer()
+        with outbuffer._bufferContext(update=False):
+            t0 = time.time()
+
+            # Configure fit
+            configorg, config = self._fitConfigureNonLinear(
+                                            configuration=configuration,
+                                            weight=weight)
+            outbuffer['configuration'] = configorg
+
+            # Starting parameters from the sum spectrum
+            if ysum is None:
+                yref = self._fitReferenceSpectrum(data=data, mcaIndex=mcaIndex,
+                                                  sumover='all')
+            else:
+                yref = ysum
+            if xmin is None:
+                xmin = config['fit']['xmin']
+            if xmax is None:
+                xmax = config['fit']['xmax']
+            self._mcaTheory.setData(x=x, y=yref, xmin=xmin, xmax=xmax)
+            self._mcaTheory.estimate()
+            freeIndex = [i for i, code in enumerate(self._mcaTheory.codes[0])
+                         if code != Gefit.CFIXED]
+            if not freeIndex:
+                txt = "No free parameters to be fitted!\n"
+                txt += "No peaks inside fitting region?"
+                raise ValueError(txt)
+            freeNames = [self._mcaTheory.PARAMETERS[i] for i in freeIndex]
+            outbuffer['parameter_names'] = freeNames
+            nFree = len(freeIndex)
+
+            # Background anchor points (if any)
+            anchorslist = self._fitBkgAnchorList(config=config)
+
+            # MCA trimming: [iXMin:iXMax]
+            iXMin, iXMax = self._fitMcaTrimInfo(x=x)
+            sliceChan = slice(iXMin, iXMax)
+
+            # Allocate output buffers
+            imageShape = list(data.shape)
+            imageShape.pop(mcaIndex)
+            imageShape = tuple(imageShape)
+            paramShape = (nFree,) + imageShape
+            dtypeResult = self._fitDtypeResult(data)
+            results = outbuffer.allocateMemory('parameters',
+                                               shape=paramShape,
+                                               dtype=dtypeResult)
+            uncertainties = outbuffer.allocateMemory('uncertainties',
+                                                     shape=paramShape,
+                                                     dtype=dtypeResult)
+            chisq = outbuffer.allocateMemory('chisq',
+                                             shape=imageShape,
+                                             dtype=dtypeResult)
+            nIterations = outbuffer.allocateMemory('nIterations',
+                                                   shape=imageShape,
+                                                   dtype=numpy.int32)
+
+            _logger.debug("Configuration elapsed = %f", time.time() - t0)
+            t0 = time.time()
+
+            # The derivatives of a chunk take nFree times its memory
+            nMca = self._numberOfSpectra(data=data, mcaIndex=mcaIndex,
+                                         sliceChan=sliceChan)
+            nMca = max(nMca // (nFree + 2), 1)
+            _logger.debug('Fit spectra in chunks of {}'.format(nMca))
+            # the non-linear fit is done in double precision
+            datastack = McaStackView.FullView(data,
+                                    dtype=numpy.float64,
+                                    readonly=True, mcaSlice=sliceChan,
+                                    mcaAxis=mcaIndex, nMca=nMca,
+                                    chunkAlign=self._storageChunks(data))
+            chunkItems = datastack.items(keyType='select',
+                            nPrefetch=self._numberOfPrefetchChunks(data))
+            for (idx, idxShape), chunk in chunkItems:
+                ddict = self.fitChunk(chunk, config=config,
+                                      anchorslist=anchorslist,
+                                      maxiter=maxiter)
+                # Save results
+                chisq[idx] = ddict['chisq'].reshape(idxShape)
+                nIterations[idx] = ddict['niter'].reshape(idxShape)
+                idx = (slice(None),) + idx
+                idxShape = (nFree,) + idxShape
+                results[idx] = ddict['parameters'][freeIndex]\
+                                    .reshape(idxShape)
+                uncertainties[idx] = ddict['uncertainties'][freeIndex]\
+                                    .reshape(idxShape)
+
+            t = time.time() - t0
+            _logger.debug("Fit elapsed = %f", t)
+            if t > 0.:
+                _logger.debug("Spectra per second = %f",
+                              numpy.prod(imageShape)/float(t))
+            return outbuffer
+
+    def _fitConfigureNonLinear(self, configuration=None, weight=None):
+        """Prepare configuration for fitting
+        """
+        if configuration is not None:
+            self._mcaTheory.setConfiguration(configuration)
+        elif self._config is None:
+            raise ValueError("Fit configuration missing")
+        else:
+            _logger.debug("Setting default configuration")
+            self._mcaTheory.setConfiguration(self._config)
+        configorg = self._mcaTheory.getConfiguration()
+        config = self._mcaTheory.getConfiguration()
+        toReconfigure = False
+
+        # no time information is needed without concentrations
+        if config['concentrations'].get("useautotime", 0):
+            config['concentrations']["useautotime"] = 0
+            toReconfigure = True
+
+        # use of strategies is not supported for the time being
+        strategy = config['fit'].get('strategyflag', 0)
+        if strategy:
+            raise RuntimeError("Strategies are incompatible with stack fit")
+
+        # background of all the spectra of a chunk at once
+        if config['fit']['stripflag']:
+            if config['fit']['stripalgorithm'] != 1:
+                raise RuntimeError("Please use the faster SNIP background")
+
+        if weight is not None:
+            weight = int(bool(weight))
+            if config['fit']['fitweight'] != weight:
+                config['fit']['fitweight'] = weight
+                toReconfigure = True
+
+        if config['fit']['linearfitflag']:
+            # make sure we perform a non-linear fit
+            config['fit']['linearfitflag'] = 0
+            toReconfigure = True
+
+        if toReconfigure:
+            self._mcaTheory.setConfiguration(config)
+        return configorg, config
+
+    def fitChunk(self, chunk, config=None, anchorslist=None, maxiter=None):
+        """
+        Fit all spectra of a chunk at once. The fit theory must have been
+        given the reference spectrum (setData) and its parameters estimated,
+        they are the starting point of every spectrum once the linear ones
+        are scaled by the counts of the spectrum.
+
+        :param array chunk: nMca x nChan spectra in the fitting region
+                            (modified in place by the background subtraction)
+        :param dict config: fit configuration
+        :param list anchorslist: background anchor points
+        :param int maxiter: maximum number of iterations
+        :returns dict: parameters and uncertainties (nParameters x nMca),
+                       chisq and niter (nMca)
+        """
+        mcaTheory = self._mcaTheory
+        if config is None:
+            config = mcaTheory.getConfiguration()
+        if maxiter is None:
+            maxiter = mcaTheory.MAXITER
+        nMca = chunk.shape[0]
+        xdata = numpy.ravel(mcaTheory.xdata)
+        if config['fit']['fitweight']:
+            # assume Poisson statistics, as setData does
+            sigmay = numpy.sqrt(abs(chunk))
+            sigmay = sigmay + numpy.equal(sigmay, 0)
+        else:
+            sigmay = None
+
+        # starting parameters
+        ratio = chunk.sum(axis=1) / max(numpy.sum(mcaTheory.ydata), 1.)
+        ratio[ratio <= 0] = 1.0 / nMca
+        parameters = numpy.array(mcaTheory.parameters, dtype=numpy.float64)
+        parameters = numpy.repeat(parameters.reshape(1, -1), nMca, axis=0)
+        for i in self._linearParameters(config):
+            parameters[:, i] *= ratio
+        if mcaTheory.PARAMETERS[4] == 'Sum':
+            parameters[:, 4] /= ratio
+
+        if config['fit']['stripflag']:
+            spectra = chunk.T
+            self._fitBkgSubtract(spectra, config=config,
+                                 anchorslist=anchorslist)
+        fitresult = Gefit.MultipleLeastSquaresFit(
+                                    mcaTheory.mcatheoryMultiple,
+                                    parameters, xdata, chunk,
+                                    sigmadata=sigmay,
+                                    constrains=mcaTheory.codes,
+                                    weightflag=config['fit']['fitweight'],
+                                    model_jacobian=mcaTheory.analyticalJacobianMultiple,
+                                    maxiter=maxiter,
+                                    deltachi=config['fit']['deltachi'])
+        fittedpar, chisq, sigmapar, niter, lastdeltachi = fitresult
+        return {'parameters': fittedpar.T,
+                'uncertainties': sigmapar.T,
+                'chisq': chisq,
+                'niter': niter}
+
+    def _linearParameters(self, config):
+        """Indices of the parameters proportional to the counts
+        """
+        PARAMETERS = self._mcaTheory.PARAMETERS
+        NGLOBAL = self._mcaTheory.NGLOBAL
+        continuum = config['fit']['continuum']
+        indices = list(range(NGLOBAL, len(PARAMETERS)))
+        for i, name in enumerate(PARAMETERS[:NGLOBAL]):
+            if name in ['Constant', '1st Order', '2nd Order']:
+                indices.append(i)
+            elif name.startswith('A') and name[1:].isdigit():
+                if continuum == ClassMcaTheory.CONTINUUM_LIST.index('Linear Polynomial'):
+                    indices.append(i)
+                elif name == 'A0':
+                    # exponential polynomial
+                    indices.append(i)
+        return indices
@@ -0,0 +1,421 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2004-2019 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V.A. Sole - ESRF Data Analysis"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+__doc__ = """
+Module to convert the peak area images of a fast fit into mass fraction
+images, with the sample matrix of every pixel refined as done by the
+SingleLayerStrategy for a single spectrum.
+
+For a single layer sample, the theoretical rate of a fluorescence line only
+depends on the matrix through its mass attenuation coefficients at the
+excitation and fluorescence energies. These coefficients are linear in the
+mass fractions of the matrix compounds, hence the rates of all pixels are
+obtained at once from the rates per unit of matrix-dependent term, which are
+calculated only once.
+"""
+import numpy
+import logging
+from . import Elements
+from . import McaStackView
+
+_logger = logging.getLogger(__name__)
+
+
+class FastXRFQuantification(object):
+
+    def __init__(self, configuration=None):
+        """
+        :param dict configuration: fit configuration
+        """
+        self._config = None
+        if configuration is not None:
+            self.setConfiguration(configuration)
+
+    def setConfiguration(self, configuration):
+        self._config = configuration
+        self._rates = None
+
+    def getConfiguration(self):
+        return self._config
+
+    def processFitResult(self, parameters, names, time=None,
+                         strategy=None, tolerance=1.0e-4):
+        """
+        :param array parameters: nParameters x ... peak areas (and other
+                                 parameters, which are ignored)
+        :param list names: parameter names, like the parameter_names of the
+                           FastXRFLinearFit output
+        :param time: acquisition time (scalar or array with the shape of
+                     the images). The time of the configuration by default.
+        :param bool strategy: refine the matrix of each pixel (by default
+                              when the configuration has a SingleLayerStrategy
+                              enabled)
+        :param float tolerance: maximal relative change of the mass fractions
+                                of the strategy peaks to stop iterating
+        :returns dict: massfractions (nGroups x ...), massfraction_names,
+                       nIterations (...), matrix_fractions (nCompounds x ...)
+                       and matrix_names
+        """
+        config = self._config
+        if config is None:
+            raise ValueError("Fit configuration missing")
+        if config['concentrations'].get('usematrix', 0):
+            raise ValueError("Flux and time are needed, " +
+                             "the matrix cannot be used as reference")
+        if config['concentrations'].get('usemultilayersecondary', 0) or \
+           config['concentrations'].get('usexrfmc', 0):
+            raise ValueError("Higher order excitations are not supported")
+        if strategy is None:
+            strategy = config['fit'].get('strategyflag', 0) and \
+                       config['fit'].get('strategy', None) == \
+                            'SingleLayerStrategy'
+        if self._rates is None:
+            self._rates = MatrixFluorescenceRates(config)
+        rates = self._rates
+
+        # peak areas
+        parameters = numpy.asarray(parameters)
+        imageShape = parameters.shape[1:]
+        nPixels = int(numpy.prod(imageShape))
+        groups = rates.groups
+        areas = numpy.zeros((len(groups), nPixels), dtype=numpy.float64)
+        for i, group in enumerate(groups):
+            if group in names:
+                areas[i] = parameters[names.index(group)].ravel()
+
+        # flux, solid angle and time
+        concentrations = config['concentrations']
+        radius2 = concentrations['area'] / numpy.pi
+        distance = concentrations['distance']
+        solidangle = 0.5 * (1.0 - (distance / numpy.sqrt(distance**2 + radius2)))
+        if time is None:
+            time = concentrations['time']
+        time = numpy.asarray(time, dtype=numpy.float64)
+        if time.ndim:
+            time = time.ravel()
+        areas /= concentrations['flux'] * time * solidangle
+
+        if strategy:
+            compounds, peaks = self._strategyCompounds(groups)
+            iterations = config['SingleLayerStrategy']['iterations']
+        else:
+            compounds, peaks = [], []
+            iterations = 0
+        completer = compounds[-1] if len(compounds) > len(peaks) else None
+        _logger.debug("Matrix compounds %s", compounds)
+
+        massFractions = numpy.zeros_like(areas)
+        matrixFractions = numpy.zeros((len(compounds), nPixels),
+                                      dtype=numpy.float64)
+        nIterations = numpy.zeros((nPixels,), dtype=numpy.int32)
+        muCompounds = rates.massAttenuationCoefficients(compounds)
+        nChunk = self._numberOfPixels(rates, len(compounds))
+        for start in range(0, nPixels, nChunk):
+            chunk = slice(start, min(start + nChunk, nPixels))
+            chunkAreas = areas[:, chunk]
+            # start with the configured matrix
+            mu = rates.matrixMassAttenuation[:, numpy.newaxis]
+            active = numpy.ones((chunkAreas.shape[1],), dtype=bool)
+            fractions = numpy.zeros((len(compounds), chunkAreas.shape[1]))
+            result = self._massFractions(chunkAreas, rates.rates(mu))
+            for iteration in range(iterations):
+                if not active.any():
+                    break
+                # the new matrix of the pixels not converged yet
+                newFractions = numpy.zeros((len(compounds), active.sum()))
+                for k, (group, factor) in enumerate(peaks):
+                    newFractions[k] = result[group][active] * factor
+                total = newFractions[:len(peaks)].sum(axis=0)
+                if completer is None:
+                    normalize = numpy.ones(total.shape, dtype=bool)
+                else:
+                    normalize = total >= 1.0
+                    newFractions[-1] = numpy.where(normalize, 0.0, 1.0 - total)
+                with numpy.errstate(divide='ignore', invalid='ignore'):
+                    newFractions[:, normalize] /= total[normalize]
+                # pixels without signal keep their matrix
+                valid = numpy.isfinite(newFractions).all(axis=0) & \
+                        (total > 0)
+                activeIndex = numpy.nonzero(active)[0]
+                active[activeIndex[~valid]] = False
+                activeIndex = activeIndex[valid]
+                fractions[:, activeIndex] = newFractions[:, valid]
+                mu = numpy.dot(muCompounds.T, fractions[:, activeIndex])
+                previous = result[:, activeIndex]
+                current = self._massFractions(chunkAreas[:, activeIndex],
+                                              rates.rates(mu))
+                result[:, activeIndex] = current
+                nIterations[chunk][activeIndex] = iteration + 1
+                # convergence of the mass fractions used by the strategy
+                strategyGroups = [group for group, factor in peaks]
+                delta = numpy.abs(current[strategyGroups] -
+                                  previous[strategyGroups])
+                scale = numpy.abs(current[strategyGroups])
+                converged = (delta <= tolerance * scale).all(axis=0)
+                active[activeIndex[converged]] = False
+            massFractions[:, chunk] = result
+            matrixFractions[:, chunk] = fractions
+
+        ddict = {}
+        ddict['massfraction_names'] = list(groups)
+        ddict['massfractions'] = massFractions.reshape((len(groups),) + imageShape)
+        ddict['nIterations'] = nIterations.reshape(imageShape)
+        ddict['matrix_names'] = list(compounds)
+        ddict['matrix_fractions'] = matrixFractions.reshape(
+                                        (len(compounds),) + imageShape)
+        return ddict
+
+    def _strategyCompounds(self, groups):
+        """
+        :returns tuple: compounds of the matrix (the completer, if any, is
+                        the last one), for each strategy peak its index in
+                        groups and the factor converting its mass fraction
+                        into the mass fraction of the compound
+        """
+        strategyConfiguration = self._config['SingleLayerStrategy']
+        compounds = []
+        peaks = []
+        for i, group in enumerate(strategyConfiguration["peaks"]):
+            if "-" in group:
+                continue
+            if strategyConfiguration["flags"][i] in ["0", 0]:
+                _logger.debug("ignoring %s", group)
+                continue
+            if group not in groups:
+                raise ValueError("Strategy peak %s is not fitted" % group)
+            ele = group.split()[0]
+            material = strategyConfiguration["materials"][i]
+            if material in ["-", ele, ele + "1"]:
+                compounds.append(ele)
+                factor = 1.0
+            else:
+                massFractions = Elements.getMaterialMassFractions([material],
+                                                                  [1.0])
+                compounds.append(material)
+                factor = 1.0 / massFractions[ele]
+            peaks.append((groups.index(group), factor))
+        if not peaks:
+            raise ValueError("No strategy peaks selected")
+        if strategyConfiguration["completer"] not in ["-"]:
+            compounds.append(strategyConfiguration["completer"])
+        return compounds, peaks
+
+    @staticmethod
+    def _massFractions(areas, rates):
+        """Mass fractions are 0 when the group is not excited
+        """
+        result = numpy.zeros(numpy.broadcast(areas, rates).shape)
+        excited = numpy.broadcast_to(rates > 0, result.shape)
+        numpy.divide(areas, rates, out=result, where=excited)
+        return result
+
+    @staticmethod
+    def _numberOfPixels(rates, nCompounds):
+        nbytes = McaStackView.chunkMemoryBudget()
+        nbytes //= 8 * (2 * rates.nTerms + nCompounds + 4 * len(rates.groups))
+        return max(nbytes, 1)
+
+
+class MatrixFluorescenceRates(object):
+    """
+    Theoretical fluorescence rates of the fitted peak families of a single
+    layer sample, as a function of the mass attenuation coefficients of the
+    sample matrix.
+
+    Each line excited by each beam energy contributes to its group with
+
+        K * (1 - exp(-rhoT*(mu(Ebeam)/sinIn + mu(Eline)/sinOut))) /
+            (mu(Ebeam) + mu(Eline) * sinIn/sinOut)
+
+    where K does not depend on the matrix. K is obtained from the rates
+    calculated by Elements.getMultilayerFluorescence for the configured
+    matrix.
+    """
+    def __init__(self, configuration):
+        config = configuration
+        attenuators = []
+        beamfilters = []
+        funnyfilters = []
+        matrix = None
+        detectoratt = None
+        for attenuator in config['attenuators'].keys():
+            values = config['attenuators'][attenuator]
+            if not values[0]:
+                continue
+            if attenuator.upper() == "MATRIX":
+                matrix = values[1:4]
+                alphain = values[4]
+                alphaout = values[5]
+            elif attenuator.upper()[:-1] == "BEAMFILTER":
+                beamfilters.append(values[1:])
+            elif attenuator.upper() == "DETECTOR":
+                detectoratt = values[1:]
+            else:
+                values = list(values)
+                if len(values[1:]) == 4:
+                    values.append(1.0)
+                if abs(values[4] - 1.0) > 1.0e-10:
+                    funnyfilters.append(values[1:])
+                else:
+                    attenuators.append(values[1:])
+        if matrix is None:
+            raise ValueError("Invalid or undefined sample matrix")
+        if matrix[0].upper() == "MULTILAYER":
+            raise ValueError("Only single layer samples are supported")
+        if not Elements.isValidMaterial(matrix[0]):
+            raise ValueError("Material %s is not defined" % matrix[0])
+        if alphain <= 0.0:
+            raise ValueError("Only front excitation is supported")
+        if not config['concentrations'].get('useattenuators', 1):
+            attenuators = []
+            funnyfilters = []
+
+        # beam
+        energyList = config['fit']['energy']
+        if energyList is None:
+            raise ValueError("Invalid energy")
+        if not isinstance(energyList, list):
+            energyList = [energyList]
+            flagList = [1]
+            weightList = [1.0]
+        else:
+            flagList = config['fit']['energyflag']
+            weightList = config['fit']['energyweight']
+        beam = [(energy, weight) for energy, weight, flag in
+                zip(energyList, weightList, flagList) if flag]
+        for energy, weight in beam:
+            if energy is None or energy <= 0.001:
+                raise ValueError("Invalid energy %s" % energy)
+            if weight is None or weight < 0.0:
+                raise ValueError("Invalid weight %s" % weight)
+        totalWeight = sum(weight for energy, weight in beam)
+        if totalWeight == 0.0:
+            raise ValueError("Sum of energy weights is 0.0")
+
+        # fitted groups of actual elements
+        groups = []
+        for element in config['peaks']:
+            families = config['peaks'][element]
+            if not isinstance(families, list):
+                families = [families]
+            for family in families:
+                groups.append(element + " " + family)
+        groups = [group for group in groups if len(group.split()[0]) < 3]
+        elementsList = [[Elements.getz(group.split()[0])] + group.split()
+                        for group in groups]
+        elementsList.sort()
+        self.groups = [ele + " " + family for z, ele, family in elementsList]
+
+        sinIn = numpy.sin(numpy.radians(alphain))
+        sinOut = numpy.sin(numpy.radians(alphaout))
+        self.sinIn = sinIn
+        self.sinRatio = sinIn / sinOut
+        self.rhoT = matrix[1] * matrix[2]
+
+        # rates of every line for every beam energy
+        energies = [energy for energy, weight in beam]
+        terms = []
+        for iBeam, (energy, weight) in enumerate(beam):
+            fluo = Elements.getMultilayerFluorescence([matrix],
+                                    [energy],
+                                    weightList=[1.0],
+                                    flagList=[1],
+                                    fulloutput=0,
+                                    beamfilters=beamfilters * 1,
+                                    attenuators=attenuators * 1,
+                                    elementsList=[x * 1 for x in elementsList],
+                                    alphain=alphain,
+                                    alphaout=alphaout,
+                                    cascade=True,
+                                    detector=detectoratt,
+                                    funnyfilters=funnyfilters * 1,
+                                    forcepresent=1,
+                                    secondary=False)
+            for iGroup, (z, ele, family) in enumerate(elementsList):
+                rays = family + " xrays"
+                if ele not in fluo or rays not in fluo[ele]:
+                    continue
+                for transition in fluo[ele][rays]:
+                    rate = fluo[ele][transition]['rate']
+                    if rate <= 0.0:
+                        continue
+                    lineEnergy = fluo[ele][transition]['energy']
+                    if lineEnergy not in energies:
+                        energies.append(lineEnergy)
+                    terms.append((iGroup, iBeam, energies.index(lineEnergy),
+                                  rate * weight / totalWeight))
+        self.energies = numpy.array(energies, dtype=numpy.float64)
+        self.nTerms = len(terms)
+        terms = numpy.array(terms, dtype=numpy.float64).reshape(-1, 4)
+        self._group = terms[:, 0].astype(numpy.intp)
+        self._beam = terms[:, 1].astype(numpy.intp)
+        self._line = terms[:, 2].astype(numpy.intp)
+        self.matrixMassAttenuation = \
+                self.massAttenuationCoefficients([matrix[0]])[0]
+        # remove the contribution of the configured matrix
+        mu = self.matrixMassAttenuation[:, numpy.newaxis]
+        self._factor = terms[:, 3] / self._matrixTerm(mu)[:, 0]
+
+    def massAttenuationCoefficients(self, compounds):
+        """
+        :param list compounds: elements, formulas or materials
+        :returns array: nCompounds x nEnergies
+        """
+        if not len(compounds):
+            return numpy.zeros((0, len(self.energies)))
+        return Elements.getMaterialsMassAttenuationCoefficients(
+                                        compounds, self.energies.tolist())
+
+    def _matrixTerm(self, mu):
+        """
+        :param array mu: nEnergies x nPixels
+        :returns array: nTerms x nPixels
+        """
+        muBeam = mu[self._beam]
+        muLine = mu[self._line]
+        denominator = muBeam + muLine * self.sinRatio
+        if self.rhoT > 0.0:
+            # (mu(Ebeam)/sinIn + mu(Eline)/sinOut) * rhoT
+            exponent = denominator * (self.rhoT / self.sinIn)
+            return -numpy.expm1(-exponent) / denominator
+        return 1.0 / denominator
+
+    def rates(self, mu):
+        """
+        :param array mu: mass attenuation coefficients of the matrix of each
+                         pixel (nEnergies x nPixels)
+        :returns array: nGroups x nPixels rates per unit mass fraction
+        """
+        terms = self._factor[:, numpy.newaxis] * self._matrixTerm(mu)
+        result = numpy.zeros((len(self.groups), terms.shape[1]))
+        numpy.add.at(result, self._group, terms)
+        return result
@@ -39,6 +39,10 @@
 from fisx import XRF
 import time
 import sys
+import copy
+import hashlib
+import collections
+import multiprocessing
 xcom = None
 
 _logger = logging.getLogger(__name__)
@@ -646,75 +650,228 @@ def _fisxFromFitConfigurationAction(fitConfiguration,
                                     secondaryCalculationLimit=None):
     if action is None:
         raise ValueError("Please specify action")
-    if secondaryCalculationLimit is None:
-        secondaryCalculationLimit = \
-            _getSecondaryCalculationLimitFromFitConfiguration(fitConfiguration)
-    # This is highly inefficient because one has to perform all the parsing
-    # that has been already made when configuring the fit. However, this is
-    # currently the simplest implementation that can work as standalone given
-    # the fit configuration
-
-    # the fisx materials list
-    fisxMaterials = _getFisxMaterials(fitConfiguration)
-
-    # extract beam parameters
-    energyList, weightList, characteristicList = _getBeam(fitConfiguration)
-
-    # extract beamFilters, matrix, geometry, attenuators and detector
-    filterList, multilayerSample, attenuatorList, detector, alphaIn, alphaOut \
-                = _getFiltersMatrixAttenuatorsDetectorGeometry(fitConfiguration)
+    # The parsing of the fit configuration (already made when configuring
+    # the fit) and the calculation itself are only performed the first time
+    # a given configuration is seen.
+    session = getFisxSession(fitConfiguration)
+    return session.calculate(action,
+                             elementsFromMatrix=elementsFromMatrix,
+                             secondaryCalculationLimit=secondaryCalculationLimit)
+
+# The configuration entries the fisx calculations depend on
+_SESSION_KEYS = {"attenuators": None,
+                 "materials": None,
+                 "multilayer": None,
+                 "peaks": None,
+                 "detector": ["detele", "nthreshold"],
+                 "fit": ["energy", "energyflag", "energyweight",
+                         "energyscatter", "escapeflag"],
+                 "concentrations": ["distance", "area",
+                                    "usemultilayersecondary",
+                                    "secondarycalculationlimit"]}
+
+def _hashUpdate(h, value):
+    if hasattr(value, "keys"):
+        h.update(b"{")
+        for key in sorted(value.keys(), key=str):
+            _hashUpdate(h, key)
+            _hashUpdate(h, value[key])
+        h.update(b"}")
+    elif isinstance(value, (list, tuple)) or hasattr(value, "tolist"):
+        if hasattr(value, "tolist"):
+            value = value.tolist()
+        if isinstance(value, (list, tuple)):
+            h.update(b"[")
+            for item in value:
+                _hashUpdate(h, item)
+            h.update(b"]")
+        else:
+            _hashUpdate(h, value)
+    else:
+        if hasattr(value, "decode"):
+            value = value.decode("latin-1")
+        h.update(repr(value).encode("utf-8"))
+        h.update(b",")
 
-    # The elements and families to be considered
-    elementsList = _getPeakList(fitConfiguration)
+def getFisxSessionKey(fitConfiguration):
+    """
+    Hash of the parts of a fit configuration the fisx calculations depend on.
+    """
+    h = hashlib.sha1()
+    for section in sorted(_SESSION_KEYS):
+        _hashUpdate(h, section)
+        ddict = fitConfiguration.get(section, {})
+        keys = _SESSION_KEYS[section]
+        if keys is None:
+            _hashUpdate(h, ddict)
+        else:
+            _hashUpdate(h, [ddict.get(key, None) for key in keys])
+    return h.hexdigest()
 
-    # The detection setup
-    detectorInstance = _getFisxDetector(fitConfiguration, detector)
+class FisxSession(object):
+    """
+    The fisx description of the experiment contained in a fit configuration:
+    materials, beam, filters, sample, attenuators, geometry, detector and
+    peak families. It is parsed once and used with the shared elements
+    instance (see getElementsInstance). The calculated fluorescence and
+    correction factors are kept for subsequent requests.
+    """
+    def __init__(self, fitConfiguration):
+        self.key = getFisxSessionKey(fitConfiguration)
+
+        # the fisx materials list
+        self.materials = _getFisxMaterials(fitConfiguration)
+
+        # extract beam parameters
+        self.energyList, self.weightList, self.characteristicList = \
+                                            _getBeam(fitConfiguration)
+
+        # extract beamFilters, matrix, geometry, attenuators and detector
+        self.filterList, self.multilayerSample, self.attenuatorList, \
+            detector, self.alphaIn, self.alphaOut = \
+                _getFiltersMatrixAttenuatorsDetectorGeometry(fitConfiguration)
+
+        # The elements and families to be considered
+        self.elementsList = _getPeakList(fitConfiguration)
+
+        # The detection setup
+        self.detector = _getFisxDetector(fitConfiguration, detector)
+
+        try:
+            self.secondary = \
+                fitConfiguration["concentrations"]["usemultilayersecondary"]
+        except:
+            _logger.warning("Exception. Forcing tertiary")
+            self.secondary = 2
+        self.secondaryCalculationLimit = \
+            _getSecondaryCalculationLimitFromFitConfiguration(fitConfiguration)
+        self._results = {}
+
+    def calculate(self, action, elementsFromMatrix=False,
+                  secondaryCalculationLimit=None):
+        """
+        :param str action: "fluorescence" or "correction"
+        :returns dict: see getMultilayerFluorescence and
+                       getFisxCorrectionFactors
+        """
+        key = self._resultKey(action, elementsFromMatrix,
+                              secondaryCalculationLimit)
+        if key not in self._results:
+            self._results[key] = self._calculate(action,
+                                    elementsFromMatrix=elementsFromMatrix,
+                                    secondaryCalculationLimit=key[2])
+        else:
+            _logger.debug("Using cached fisx %s", action)
+        # the caller is free to modify the result
+        return copy.deepcopy(self._results[key])
+
+    def _resultKey(self, action, elementsFromMatrix,
+                   secondaryCalculationLimit):
+        if secondaryCalculationLimit is None:
+            secondaryCalculationLimit = self.secondaryCalculationLimit
+        return (action.upper(), bool(elementsFromMatrix),
+                secondaryCalculationLimit)
+
+    def _calculate(self, action, elementsFromMatrix=False,
+                   secondaryCalculationLimit=None):
+        secondary = self.secondary
+        if action.upper() == "FLUORESCENCE":
+            function = getMultilayerFluorescence
+        else:
+            function = getFisxCorrectionFactors
+            if secondary == 0:
+                # otherways it is meaning less to call the function
+                secondary = 2
+        return function(self.multilayerSample,
+                        self.energyList,
+                        weightList = self.weightList,
+                        flagList = self.characteristicList,
+                        fulloutput = None,
+                        beamFilters = self.filterList,
+                        elementsList = self.elementsList,
+                        attenuatorList = self.attenuatorList,
+                        alphaIn = self.alphaIn,
+                        alphaOut = self.alphaOut,
+                        cascade = None,
+                        detector = self.detector,
+                        elementsFromMatrix=elementsFromMatrix,
+                        secondary=secondary,
+                        materials=self.materials,
+                        secondaryCalculationLimit= \
+                                    secondaryCalculationLimit)
+
+# Least recently used sessions come first
+_SESSIONS = collections.OrderedDict()
+MAX_SESSIONS = 32
+
+def getFisxSession(fitConfiguration):
+    """
+    Cached FisxSession of a fit configuration.
+    """
+    key = getFisxSessionKey(fitConfiguration)
+    session = _SESSIONS.pop(key, None)
+    if session is None:
+        session = FisxSession(fitConfiguration)
+        while len(_SESSIONS) >= MAX_SESSIONS:
+            _SESSIONS.popitem(last=False)
+    _SESSIONS[key] = session
+    return session
+
+def clearFisxSessions():
+    _SESSIONS.clear()
+
+def _workerFisxCorrectionFactors(args):
+    fitConfiguration, elementsFromMatrix, secondaryCalculationLimit = args
+    session = getFisxSession(fitConfiguration)
+    return session.calculate("correction",
+                             elementsFromMatrix=elementsFromMatrix,
+                             secondaryCalculationLimit=secondaryCalculationLimit)
+
+def getFisxCorrectionFactorsFromFitConfigurations(fitConfigurations,
+                                                  elementsFromMatrix=False,
+                                                  secondaryCalculationLimit=None,
+                                                  nWorkers=None):
+    """
+    Correction factors for several fit configurations, typically the same
+    experiment with different sample matrices (i.e. the matrix of each
+    cluster of pixels of an heterogeneous sample).
 
-    try:
-        secondary = fitConfiguration["concentrations"]["usemultilayersecondary"]
-    except:
-        _logger.warning("Exception. Forcing tertiary")
-        secondary = 2
-
-    if action.upper() == "FLUORESCENCE":
-        return getMultilayerFluorescence(multilayerSample,
-                                      energyList,
-                                      weightList = weightList,
-                                      flagList = characteristicList,
-                                      fulloutput = None,
-                                      beamFilters = filterList,
-                                      elementsList = elementsList,
-                                      attenuatorList = attenuatorList,
-                                      alphaIn = alphaIn,
-                                      alphaOut = alphaOut,
-                                      cascade = None,
-                                      detector = detectorInstance,
-                                      elementsFromMatrix=elementsFromMatrix,
-                                      secondary=secondary,
-                                      materials=fisxMaterials,
-                                      secondaryCalculationLimit= \
-                                          secondaryCalculationLimit)
-    else:
-        if secondary == 0:
-            # otherways it is meaning less to call the function
-            secondary = 2            
-        return getFisxCorrectionFactors(multilayerSample,
-                                      energyList,
-                                      weightList = weightList,
-                                      flagList = characteristicList,
-                                      fulloutput = None,
-                                      beamFilters = filterList,
-                                      elementsList = elementsList,
-                                      attenuatorList = attenuatorList,
-                                      alphaIn = alphaIn,
-                                      alphaOut = alphaOut,
-                                      cascade = None,
-                                      detector = detectorInstance,
-                                      elementsFromMatrix=elementsFromMatrix,
-                                      secondary=secondary,
-                                      materials=fisxMaterials,
-                                      secondaryCalculationLimit= \
-                                          secondaryCalculationLimit)
+    :param list fitConfigurations:
+    :param int nWorkers: None or 1 (no parallelization), < 1 (number of CPU's)
+    :returns list: see getFisxCorrectionFactors
+    """
+    sessions = [getFisxSession(fitConfiguration)
+                for fitConfiguration in fitConfigurations]
+    if nWorkers is None:
+        nWorkers = 1
+    elif nWorkers < 1:
+        nWorkers = multiprocessing.cpu_count()
+    # the sessions not calculated yet (once per configuration)
+    pending = collections.OrderedDict()
+    for session, fitConfiguration in zip(sessions, fitConfigurations):
+        key = session._resultKey("correction", elementsFromMatrix,
+                                 secondaryCalculationLimit)
+        if key not in session._results:
+            pending.setdefault(session.key, (session, fitConfiguration, key))
+    pending = list(pending.values())
+    nWorkers = min(nWorkers, len(pending))
+    if nWorkers > 1:
+        args = [(fitConfiguration, elementsFromMatrix,
+                 secondaryCalculationLimit)
+                for session, fitConfiguration, key in pending]
+        pool = multiprocessing.Pool(nWorkers)
+        try:
+            results = pool.map(_workerFisxCorrectionFactors, args)
+        finally:
+            pool.terminate()
+            pool.join()
+        for (session, fitConfiguration, key), result in zip(pending, results):
+            session._results[key] = result
+    return [session.calculate("correction",
+                              elementsFromMatrix=elementsFromMatrix,
+                              secondaryCalculationLimit=\
+                                  secondaryCalculationLimit)
+            for session in sessions]
 
 def getFisxCorrectionFactors(*var, **kw):
     expectedFluorescence = getMultilayerFluorescence(*var, **kw)
@@ -32,8 +32,7 @@
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
 import os
 import numpy
-from PyMca5.PyMcaIO import ConfigDict
-from PyMca5 import PyMcaDataDir
+from . import PhysicsDatabase
 
 ElementList= ['H','He','Li','Be','B','C','N','O','F','Ne',
               'Na','Mg','Al','Si','P','S','Cl','Ar','K','Ca','Sc','Ti','V','Cr','Mn','Fe','Co','Ni','Cu','Zn',
@@ -45,25 +44,8 @@
      'Rn','Fr','Ra','Ac','Th','Pa','U','Np','Pu','Am','Cm','Bk','Cf',
      'Es','Fm','Md','No','Lr','Rf','Db','Sg','Bh','Hs','Mt']
 
-dirmod = PyMcaDataDir.PYMCA_DATA_DIR
-ffile   = os.path.join(dirmod,"attdata")
-ffile   = os.path.join(ffile,"incoh.dict")
-if not os.path.exists(ffile):
-    #freeze does bad things with the path ...
-    dirmod = os.path.dirname(dirmod)
-    ffile = os.path.join(dirmod, "attdata")
-    ffile = os.path.join(ffile, "incoh.dict")
-    if not os.path.exists(ffile):
-        if dirmod.lower().endswith(".zip"):
-            dirmod = os.path.dirname(dirmod)
-            ffile = os.path.join(dirmod,"attdata")
-            ffile = os.path.join(ffile, "incoh.dict")
-    if not os.path.exists(ffile):
-        print("Cannot find file ", ffile)
-        raise IOError("Cannot find file %s" % ffile)
-
-COEFFICIENTS = ConfigDict.ConfigDict()
-COEFFICIENTS.read(ffile)
+ffile = PhysicsDatabase.getAttDataFile("incoh.dict")
+COEFFICIENTS = PhysicsDatabase.getConfigDict(ffile)
 xvalues = COEFFICIENTS['ISCADT']['XSVAL']
 svalues = numpy.reshape(COEFFICIENTS['ISCADT']['SCATF'], (100, len(xvalues)))
 #svalues = COEFFICIENTS['ISCADT']['SCATF']
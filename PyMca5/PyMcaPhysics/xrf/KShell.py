@@ -34,11 +34,11 @@
 import os
 import numpy
 from PyMca5 import getDataFile
-from PyMca5.PyMcaIO import specfile
+from . import PhysicsDatabase
 
-sf=specfile.Specfile(getDataFile("KShellRates.dat"))
-ElementKShellTransitions = sf[0].alllabels()
-ElementKShellRates = numpy.transpose(sf[0].data()).tolist()
+ElementKShellTransitions, filedata = PhysicsDatabase.getSpecScan( \
+                                        getDataFile("KShellRates.dat"), 0)
+ElementKShellRates = numpy.transpose(filedata).tolist()
 
 ElementKAlphaTransitions = []
 ElementKBetaTransitions = []
@@ -55,25 +55,20 @@
         #TOTAL column meaningless
         pass
 
-filedata = sf[0].data()
-ndata    = sf[0].lines()
-ElementKAlphaRates = filedata[0] * 1
-ElementKAlphaRates.shape = [ndata, 1]
-ElementKBetaRates = filedata[0] * 1
-ElementKBetaRates.shape  = [ndata, 1]
+# first column the atomic number, then the rates of each transition
+indices = [0]
 for transition in ElementKAlphaTransitions:
     if transition[0] != 'Z':
-        data = filedata[ElementKShellTransitions.index(transition)] * 1
-        data.shape = [ndata, 1]
-        ElementKAlphaRates = numpy.concatenate((ElementKAlphaRates, data),
-                                                 axis = 1)
+        indices.append(ElementKShellTransitions.index(transition))
+ElementKAlphaRates = numpy.transpose(filedata[indices])
 
+indices = [0]
 for transition in ElementKBetaTransitions:
     if transition[0] != 'Z':
-        data = filedata[ElementKShellTransitions.index(transition)] * 1
-        data.shape = [ndata, 1]
-        ElementKBetaRates = numpy.concatenate((ElementKBetaRates, data),
-                                                axis = 1)
+        indices.append(ElementKShellTransitions.index(transition))
+ElementKBetaRates = numpy.transpose(filedata[indices])
+del filedata
+
 for i in range(len(ElementKAlphaTransitions)):
     if ElementKAlphaTransitions[i] != 'Z':
         ElementKAlphaTransitions[i] = ElementKAlphaTransitions[i] + "a"
@@ -85,10 +80,10 @@
 ElementKAlphaRates = ElementKAlphaRates.tolist()
 ElementKBetaRates  = ElementKBetaRates.tolist()
 
-sf=specfile.Specfile(getDataFile("KShellConstants.dat"))
-ElementKShellConstants = sf[0].alllabels()
-ElementKShellValues = numpy.transpose(sf[0].data()).tolist()
-sf=None
+ElementKShellConstants, filedata = PhysicsDatabase.getSpecScan( \
+                                        getDataFile("KShellConstants.dat"), 0)
+ElementKShellValues = numpy.transpose(filedata).tolist()
+del filedata
 
 Elements = ['H', 'He',
             'Li', 'Be', 'B', 'C', 'N', 'O', 'F', 'Ne',
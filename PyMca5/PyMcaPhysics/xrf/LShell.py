@@ -32,36 +32,38 @@
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
 import os
 import numpy
-from PyMca5.PyMcaIO import specfile
 from PyMca5 import getDataFile
+from . import PhysicsDatabase
 
-sf=specfile.Specfile(getDataFile("LShellRates.dat"))
-ElementL1ShellTransitions = sf[0].alllabels()
-ElementL2ShellTransitions = sf[1].alllabels()
-ElementL3ShellTransitions = sf[2].alllabels()
-ElementL1ShellRates = numpy.transpose(sf[0].data()).tolist()
-ElementL2ShellRates = numpy.transpose(sf[1].data()).tolist()
-ElementL3ShellRates = numpy.transpose(sf[2].data()).tolist()
+scans = [PhysicsDatabase.getSpecScan(getDataFile("LShellRates.dat"), i)
+         for i in range(3)]
+ElementL1ShellTransitions = scans[0][0]
+ElementL2ShellTransitions = scans[1][0]
+ElementL3ShellTransitions = scans[2][0]
+ElementL1ShellRates = numpy.transpose(scans[0][1]).tolist()
+ElementL2ShellRates = numpy.transpose(scans[1][1]).tolist()
+ElementL3ShellRates = numpy.transpose(scans[2][1]).tolist()
 
-sf=specfile.Specfile(getDataFile("LShellConstants.dat"))
-ElementL1ShellConstants = sf[0].alllabels()
-ElementL2ShellConstants = sf[1].alllabels()
-ElementL3ShellConstants = sf[2].alllabels()
-ElementL1ShellValues = numpy.transpose(sf[0].data()).tolist()
-ElementL2ShellValues = numpy.transpose(sf[1].data()).tolist()
-ElementL3ShellValues = numpy.transpose(sf[2].data()).tolist()
-sf=None
+scans = [PhysicsDatabase.getSpecScan(getDataFile("LShellConstants.dat"), i)
+         for i in range(3)]
+ElementL1ShellConstants = scans[0][0]
+ElementL2ShellConstants = scans[1][0]
+ElementL3ShellConstants = scans[2][0]
+ElementL1ShellValues = numpy.transpose(scans[0][1]).tolist()
+ElementL2ShellValues = numpy.transpose(scans[1][1]).tolist()
+ElementL3ShellValues = numpy.transpose(scans[2][1]).tolist()
+del scans
 
-fname = getDataFile("EADL97_LShellConstants.dat")
-sf = specfile.Specfile(fname)
-EADL97_ElementL1ShellConstants = sf[0].alllabels()
-EADL97_ElementL2ShellConstants = sf[1].alllabels()
-EADL97_ElementL3ShellConstants = sf[2].alllabels()
-EADL97_ElementL1ShellValues = numpy.transpose(sf[0].data()).tolist()
-EADL97_ElementL2ShellValues = numpy.transpose(sf[1].data()).tolist()
-EADL97_ElementL3ShellValues = numpy.transpose(sf[2].data()).tolist()
+scans = [PhysicsDatabase.getSpecScan(getDataFile("EADL97_LShellConstants.dat"), i)
+         for i in range(3)]
+EADL97_ElementL1ShellConstants = scans[0][0]
+EADL97_ElementL2ShellConstants = scans[1][0]
+EADL97_ElementL3ShellConstants = scans[2][0]
+EADL97_ElementL1ShellValues = numpy.transpose(scans[0][1]).tolist()
+EADL97_ElementL2ShellValues = numpy.transpose(scans[1][1]).tolist()
+EADL97_ElementL3ShellValues = numpy.transpose(scans[2][1]).tolist()
 EADL97 = True
-sf = None
+del scans
 
 Elements = ['H', 'He',
             'Li', 'Be', 'B', 'C', 'N', 'O', 'F', 'Ne',
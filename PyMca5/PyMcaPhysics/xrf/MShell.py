@@ -32,48 +32,50 @@
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
 import os
 import numpy
-from PyMca5.PyMcaIO import specfile
 from PyMca5 import getDataFile
+from . import PhysicsDatabase
 
-sf=specfile.Specfile(getDataFile("MShellRates.dat"))
-ElementM1ShellTransitions = sf[0].alllabels()
-ElementM2ShellTransitions = sf[1].alllabels()
-ElementM3ShellTransitions = sf[2].alllabels()
-ElementM4ShellTransitions = sf[3].alllabels()
-ElementM5ShellTransitions = sf[4].alllabels()
-ElementM1ShellRates = numpy.transpose(sf[0].data()).tolist()
-ElementM2ShellRates = numpy.transpose(sf[1].data()).tolist()
-ElementM3ShellRates = numpy.transpose(sf[2].data()).tolist()
-ElementM4ShellRates = numpy.transpose(sf[3].data()).tolist()
-ElementM5ShellRates = numpy.transpose(sf[4].data()).tolist()
+scans = [PhysicsDatabase.getSpecScan(getDataFile("MShellRates.dat"), i)
+         for i in range(5)]
+ElementM1ShellTransitions = scans[0][0]
+ElementM2ShellTransitions = scans[1][0]
+ElementM3ShellTransitions = scans[2][0]
+ElementM4ShellTransitions = scans[3][0]
+ElementM5ShellTransitions = scans[4][0]
+ElementM1ShellRates = numpy.transpose(scans[0][1]).tolist()
+ElementM2ShellRates = numpy.transpose(scans[1][1]).tolist()
+ElementM3ShellRates = numpy.transpose(scans[2][1]).tolist()
+ElementM4ShellRates = numpy.transpose(scans[3][1]).tolist()
+ElementM5ShellRates = numpy.transpose(scans[4][1]).tolist()
 
-sf=specfile.Specfile(getDataFile("MShellConstants.dat"))
-ElementM1ShellConstants = sf[0].alllabels()
-ElementM2ShellConstants = sf[1].alllabels()
-ElementM3ShellConstants = sf[2].alllabels()
-ElementM4ShellConstants = sf[3].alllabels()
-ElementM5ShellConstants = sf[4].alllabels()
-ElementM1ShellValues = numpy.transpose(sf[0].data()).tolist()
-ElementM2ShellValues = numpy.transpose(sf[1].data()).tolist()
-ElementM3ShellValues = numpy.transpose(sf[2].data()).tolist()
-ElementM4ShellValues = numpy.transpose(sf[3].data()).tolist()
-ElementM5ShellValues = numpy.transpose(sf[4].data()).tolist()
-sf=None
+scans = [PhysicsDatabase.getSpecScan(getDataFile("MShellConstants.dat"), i)
+         for i in range(5)]
+ElementM1ShellConstants = scans[0][0]
+ElementM2ShellConstants = scans[1][0]
+ElementM3ShellConstants = scans[2][0]
+ElementM4ShellConstants = scans[3][0]
+ElementM5ShellConstants = scans[4][0]
+ElementM1ShellValues = numpy.transpose(scans[0][1]).tolist()
+ElementM2ShellValues = numpy.transpose(scans[1][1]).tolist()
+ElementM3ShellValues = numpy.transpose(scans[2][1]).tolist()
+ElementM4ShellValues = numpy.transpose(scans[3][1]).tolist()
+ElementM5ShellValues = numpy.transpose(scans[4][1]).tolist()
+del scans
 
-fname = getDataFile("EADL97_MShellConstants.dat")
-sf = specfile.Specfile(fname)
-EADL97_ElementM1ShellConstants = sf[0].alllabels()
-EADL97_ElementM2ShellConstants = sf[1].alllabels()
-EADL97_ElementM3ShellConstants = sf[2].alllabels()
-EADL97_ElementM4ShellConstants = sf[3].alllabels()
-EADL97_ElementM5ShellConstants = sf[4].alllabels()
-EADL97_ElementM1ShellValues = numpy.transpose(sf[0].data()).tolist()
-EADL97_ElementM2ShellValues = numpy.transpose(sf[1].data()).tolist()
-EADL97_ElementM3ShellValues = numpy.transpose(sf[2].data()).tolist()
-EADL97_ElementM4ShellValues = numpy.transpose(sf[3].data()).tolist()
-EADL97_ElementM5ShellValues = numpy.transpose(sf[4].data()).tolist()
+scans = [PhysicsDatabase.getSpecScan(getDataFile("EADL97_MShellConstants.dat"), i)
+         for i in range(5)]
+EADL97_ElementM1ShellConstants = scans[0][0]
+EADL97_ElementM2ShellConstants = scans[1][0]
+EADL97_ElementM3ShellConstants = scans[2][0]
+EADL97_ElementM4ShellConstants = scans[3][0]
+EADL97_ElementM5ShellConstants = scans[4][0]
+EADL97_ElementM1ShellValues = numpy.transpose(scans[0][1]).tolist()
+EADL97_ElementM2ShellValues = numpy.transpose(scans[1][1]).tolist()
+EADL97_ElementM3ShellValues = numpy.transpose(scans[2][1]).tolist()
+EADL97_ElementM4ShellValues = numpy.transpose(scans[3][1]).tolist()
+EADL97_ElementM5ShellValues = numpy.transpose(scans[4][1]).tolist()
 EADL97 = True
-sf = None
+del scans
 
 
 Elements = ['H', 'He',
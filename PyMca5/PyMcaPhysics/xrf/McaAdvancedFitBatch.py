@@ -32,8 +32,11 @@
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
 import sys
 import os
+import collections
+import multiprocessing
 import numpy
 from . import ClassMcaTheory
+from . import McaFitResultStore
 from PyMca5.PyMcaCore import SpecFileLayer
 from PyMca5.PyMcaCore import EdfFileLayer
 from PyMca5.PyMcaIO import EdfFile
@@ -59,7 +62,8 @@ def __init__(self,initdict,filelist=None,outputdir=None,
                     concentrations=0, fitfiles=1, fitimages=1,
                     filebeginoffset = 0, fileendoffset=0,
                     mcaoffset=0, chunk = None,
-                    selection=None, lock=None, nosave=None, quiet=False):
+                    selection=None, lock=None, nosave=None, quiet=False,
+                    nworkers=None, fitstore=False, fitcurves=False):
         #for the time being the concentrations are bound to the .fit files
         #that is not necessary, but it will be correctly implemented in
         #future releases
@@ -68,6 +72,11 @@ def __init__(self,initdict,filelist=None,outputdir=None,
             self._nosave = True
         else:
             self._nosave = False
+        # a single HDF5 file with all the fit results instead of .fit files
+        self.fitStore = fitstore
+        self.fitCurves = fitcurves
+        if fitstore:
+            fitfiles = 0
         self.fitFiles = fitfiles
         self._concentrations = concentrations
         if type(initdict) == type([]):
@@ -105,6 +114,12 @@ def __init__(self,initdict,filelist=None,outputdir=None,
         self.chunk     = chunk
         self.selection = selection
         self.quiet = quiet
+        # number of worker processes fitting the spectra
+        # (None or 1: no parallelization, < 1: number of CPU's)
+        self.nWorkers = nworkers
+        self.__pool = None
+        self.__lastContext = None
+        self.__store = None
 
 
     def setFileList(self,filelist=None):
@@ -166,6 +181,25 @@ def processList(self):
         self.counter =  0
         self.__row   = self.fileBeginOffset - 1
         self.__stack = None
+        try:
+            self.__openStore()
+            try:
+                self.__processList()
+            finally:
+                self.__stopPool()
+        finally:
+            self.__closeStore()
+
+        if self.counter:
+            if not self.roiFit:
+                if self.fitFiles:
+                    self.listfile.write(']\n')
+                    self.listfile.close()
+            if (self.__ncols is not None) and (not self._nosave):
+                if self.__ncols:self.saveImage()
+        self.onEnd()
+
+    def __processList(self):
         for i in range(0+self.fileBeginOffset,
                        len(self._filelist)-self.fileEndOffset,
                        self.fileStep):
@@ -196,15 +230,6 @@ def processList(self):
             else:
                 self.__processOneFile()
 
-        if self.counter:
-            if not self.roiFit:
-                if self.fitFiles:
-                    self.listfile.write(']\n')
-                    self.listfile.close()
-            if (self.__ncols is not None) and (not self._nosave):
-                if self.__ncols:self.saveImage()
-        self.onEnd()
-
     def getFileHandle(self,inputfile):
         
         try:
@@ -369,7 +394,7 @@ def __processStack(self):
                     infoDict["McaLiveTime"] = \
                             info["McaLiveTime"][i * numberofmca + mca]
                 self.__processOneMca(x, y0, filename, key, info=infoDict)
-                self.onMca(mca, numberofmca, filename=filename,
+                self.__onMcaProcessed(mca, numberofmca, filename=filename,
                                             key=key,
                                             info=infoDict)
 
@@ -407,7 +432,7 @@ def __processOneFile(self):
                         infoDict['Key']        = key
                         infoDict['McaLiveTime'] = info.get('McaLiveTime', None)
                         self.__processOneMca(x,y0,filename,key,info=infoDict)
-                        self.onMca(mca, numberofmca, filename=filename,
+                        self.__onMcaProcessed(mca, numberofmca, filename=filename,
                                                     key=key,
                                                     info=infoDict)
                 else:
@@ -425,6 +450,9 @@ def __processOneFile(self):
                         #slow down everything to deal with not very common
                         #situations
                         #if self.__row == 0:
+                        if self.counter == 0:
+                            # the spectra being fitted may change it
+                            self.__waitForResults()
                         if self.counter == 0:
                             self.__chann0List = numpy.zeros(info['NbMcaDet'])
                             chan0list = scan_obj.header('@CHANN')
@@ -479,11 +507,101 @@ def __processOneFile(self):
                             infoDict['McaLiveTime'] = info.get('McaLiveTime',
                                                                None)
                             self.__processOneMca(x,y0,filename,key,info=infoDict)
-                            self.onMca(i, info['NbMca'],filename=filename,
+                            self.__onMcaProcessed(i, info['NbMca'],filename=filename,
                                                     key=key,
                                                     info=infoDict)
                             #print "remaining = ",(time.time()-e0) * (info['NbMca'] - i)
 
+    def __getPool(self, y):
+        """
+        Pool of worker processes (started with the first spectrum) or None
+        when the spectra are fitted by this process.
+        """
+        if self.__pool is None:
+            nWorkers = self.nWorkers
+            if nWorkers is not None and nWorkers < 1:
+                nWorkers = multiprocessing.cpu_count()
+            if (not nWorkers) or (nWorkers < 2):
+                return None
+            if len(self.__configList) > 1:
+                if not self.quiet:
+                    print("One fit configuration per file: "
+                          "no parallel fitting")
+                self.nWorkers = None
+                return None
+            workerKwargs = {'initdict': self.__configList[self.__currentConfig],
+                            'outputdir': self._outputdir,
+                            'overwrite': not self.useExistingFiles,
+                            'concentrations': self._concentrations,
+                            'fitfiles': self.fitFiles,
+                            'fitstore': self.fitStore,
+                            'fitcurves': self.fitCurves}
+            self.__pool = McaFitPool(nWorkers, len(y), workerKwargs)
+        return self.__pool
+
+    def __storeResult(self, context, output):
+        filename, key, row, col, callbacks = context
+        if output is not None:
+            if self.__storeOneMca(output, filename, key, row, col):
+                self.counter += 1
+        for args, kwargs in callbacks:
+            self.onMca(*args, **kwargs)
+
+    def __onMcaProcessed(self, *args, **kwargs):
+        if self.__lastContext is None:
+            self.onMca(*args, **kwargs)
+        else:
+            # called when the spectrum has been fitted
+            self.__lastContext[-1].append((args, kwargs))
+            self.__lastContext = None
+
+    def __waitForResults(self):
+        if self.__pool is not None:
+            for done in self.__pool.results():
+                self.__storeResult(*done)
+
+    def __stopPool(self):
+        if self.__pool is not None:
+            try:
+                self.__waitForResults()
+            finally:
+                self.__pool.close()
+                self.__pool = None
+
+    def getFitStoreFile(self):
+        """
+        Name of the HDF5 file with the fit results of all the spectra
+        """
+        if self.chunk is not None:
+            name = self._rootname + "_%06d_partial.h5" % self.chunk
+        else:
+            name = self._rootname + ".h5"
+        fitdir = self.os_path_join(self._outputdir, "FIT")
+        return self.os_path_join(fitdir, name)
+
+    def __openStore(self):
+        if (not self.fitStore) or self.roiFit or self._nosave:
+            return
+        config = ConfigDict.ConfigDict(self.mcafit.getConfiguration())
+        self.__store = McaFitResultStore.McaFitResultStore(
+                                    self.getFitStoreFile(),
+                                    configuration=config,
+                                    overwrite=not self.useExistingFiles,
+                                    fitcurves=self.fitCurves)
+
+    def __closeStore(self):
+        if self.__store is not None:
+            try:
+                self.__store.close()
+            finally:
+                self.__store = None
+
+    def __getStoredResult(self, filename, key):
+        if self.__store is None or not self.useExistingFiles:
+            return None
+        return self.__store.get(filename, key,
+                                concentrations=self._concentrations)
+
     def __getFitFile(self, filename, key):
         fitdir = self.os_path_join(self._outputdir,"FIT")
         fitdir = self.os_path_join(fitdir,filename+"_FITDIR")
@@ -512,279 +630,344 @@ def os_path_join(self, a, b):
                                            a.decode('latin-1'))
         return outfile
 
-    def __processOneMca(self,x,y,filename,key,info=None):
-        self._concentrationsAsAscii = ""
-        if not self.roiFit:
-            result = None
-            concentrationsdone = 0
-            concentrations = None
-            outfile=self.os_path_join(self._outputdir, filename)
-            fitfile = self.__getFitFile(filename,key)
-            if self.chunk is not None:
-                con_extension = "_%06d_partial_concentrations.txt" % self.chunk
-            else:
-                con_extension = "_concentrations.txt"
-            self._concentrationsFile = self.os_path_join(self._outputdir,
-                                    self._rootname+ con_extension)
-            #                        self._rootname+"_concentrationsNEW.txt")
-            if self.counter == 0:
-                if os.path.exists(self._concentrationsFile):
+    def _fitOneMca(self, x, y, filename, key, info=None):
+        """
+        Fit one spectrum (or read its existing .fit file) and calculate
+        the concentrations when requested.
+
+        :returns: dictionary with the fit result, the concentrations and
+                  the .fit file or None when the spectrum cannot be fitted
+        """
+        result = None
+        concentrationsdone = 0
+        concentrations = None
+        outfile=self.os_path_join(self._outputdir, filename)
+        fitfile = self.__getFitFile(filename,key)
+        if self.useExistingFiles and (not self.fitStore) and \
+           os.path.exists(fitfile):
+            useExistingResult = 1
+            try:
+                dict = ConfigDict.ConfigDict()
+                dict.read(fitfile)
+                result = dict['result']
+                if 'concentrations' in dict:
+                    concentrationsdone = 1
+            except:
+                print("Error trying to use result file %s" % fitfile)
+                print("Please, consider deleting it.")
+                print(sys.exc_info())
+                return
+        else:
+            useExistingResult = 0
+            try:
+                #I make sure I take the fit limits configuration
+                self.mcafit.config['fit']['use_limit'] = 1
+                self.mcafit.setData(x,y, time=info.get("McaLiveTime", None))
+            except:
+                print("Error entering data of file with output = %s\n%s" %\
+                      (filename, sys.exc_info()[1]))
+                # make sure the configuration is restored
+                if self.mcafit.config['fit'].get("strategyflag", False):
+                    config = self.__configList[self.__currentConfig]
+                    print("Restoring fitconfiguration")
+                    self.mcafit = ClassMcaTheory.McaTheory(config)
+                    self.mcafit.enableOptimizedLinearFit()
+                return
+            try:
+                self.mcafit.estimate()
+                if self.fitFiles or self.fitCurves:
+                    fitresult, result = self.mcafit.startfit(digest=1)
+                elif self._concentrations and (self.mcafit._fluoRates is None):
+                    fitresult, result = self.mcafit.startfit(digest=1)
+                elif self._concentrations:
+                    fitresult = self.mcafit.startfit(digest=0)
                     try:
-                        os.remove(self._concentrationsFile)
-                    except:
-                        print("I could not delete existing concentrations file %s" %\
-                              self._concentrationsFile)
-            #print "self._concentrationsFile", self._concentrationsFile
-            if self.useExistingFiles and os.path.exists(fitfile):
-                useExistingResult = 1
-                try:
-                    dict = ConfigDict.ConfigDict()
-                    dict.read(fitfile)
-                    result = dict['result']
-                    if 'concentrations' in dict:
-                        concentrationsdone = 1
-                except:
-                    print("Error trying to use result file %s" % fitfile)
-                    print("Please, consider deleting it.")
-                    print(sys.exc_info())
-                    return
-            else:
-                useExistingResult = 0
-                try:
-                    #I make sure I take the fit limits configuration
-                    self.mcafit.config['fit']['use_limit'] = 1
-                    self.mcafit.setData(x,y, time=info.get("McaLiveTime", None))
-                except:
-                    print("Error entering data of file with output = %s\n%s" %\
-                          (filename, sys.exc_info()[1]))
-                    # make sure the configuration is restored
-                    if self.mcafit.config['fit'].get("strategyflag", False):
-                        config = self.__configList[self.__currentConfig]
-                        print("Restoring fitconfiguration")
-                        self.mcafit = ClassMcaTheory.McaTheory(config)
-                        self.mcafit.enableOptimizedLinearFit()
-                    return
-                try:
-                    self.mcafit.estimate()
-                    if self.fitFiles:
-                        fitresult, result = self.mcafit.startfit(digest=1)
-                    elif self._concentrations and (self.mcafit._fluoRates is None):
-                        fitresult, result = self.mcafit.startfit(digest=1)
-                    elif self._concentrations:
-                        fitresult = self.mcafit.startfit(digest=0)
-                        try:
-                            fitresult0 = {}
-                            fitresult0['fitresult'] = fitresult
-                            fitresult0['result'] = self.mcafit.imagingDigestResult()
-                            fitresult0['result']['config'] = self.mcafit.config
-                            conf = self.mcafit.configure()
-                            tconf = self._tool.configure()
-                            if 'concentrations' in conf:
-                                tconf.update(conf['concentrations'])
-                            else:
-                                #what to do?
-                                pass
-                            concentrations = self._tool.processFitResult(config=tconf,
-                                            fitresult=fitresult0,
-                                            elementsfrommatrix=False,
-                                            fluorates = self.mcafit._fluoRates)
-                        except:
-                            print("error in concentrations")
-                            print(sys.exc_info()[0:-1])
-                        concentrationsdone = True
-                    else:
-                        #just images
-                        fitresult = self.mcafit.startfit(digest=0)
-                except:
-                    print("Error fitting file with output = %s: %s)" %\
-                          (filename, sys.exc_info()[1]))
-                    if self.mcafit.config['fit'].get("strategyflag", False):
-                        config = self.__configList[self.__currentConfig]
-                        print("Restoring fitconfiguration")
-                        self.mcafit = ClassMcaTheory.McaTheory(config)
-                        self.mcafit.enableOptimizedLinearFit()
-                    return
-            if self._concentrations:
-                if concentrationsdone == 0:
-                    if not ('concentrations' in result):
-                        if useExistingResult:
-                            fitresult0={}
-                            fitresult0['result'] = result
-                            conf = result['config']
-                        else:
-                            fitresult0={}
-                            if result is None:
-                                result = self.mcafit.digestresult()
-                            fitresult0['result']    = result
-                            fitresult0['fitresult'] = fitresult
-                            conf = self.mcafit.configure()
+                        fitresult0 = {}
+                        fitresult0['fitresult'] = fitresult
+                        fitresult0['result'] = self.mcafit.imagingDigestResult()
+                        fitresult0['result']['config'] = self.mcafit.config
+                        conf = self.mcafit.configure()
                         tconf = self._tool.configure()
                         if 'concentrations' in conf:
                             tconf.update(conf['concentrations'])
                         else:
+                            #what to do?
                             pass
-                            #print "Concentrations not calculated"
-                            #print "Is your fit configuration file correct?"
-                            #return
-                        try:
-                            concentrations = self._tool.processFitResult(config=tconf,
-                                            fitresult=fitresult0,
-                                            elementsfrommatrix=False)
-                        except:
-                            print("error in concentrations")
-                            print(sys.exc_info()[0:-1])
-                            #return
-                self._concentrationsAsAscii=self._toolConversion.getConcentrationsAsAscii(concentrations)
-                if len(self._concentrationsAsAscii) > 1:
-                    text  = ""
-                    text += "SOURCE: "+ filename +"\n"
-                    text += "KEY: "+key+"\n"
-                    text += self._concentrationsAsAscii + "\n"
-                    f=open(self._concentrationsFile,"a")
-                    f.write(text)
-                    f.close()
-
-            #output options
-            # .FIT files
-            if self.fitFiles:
-                fitdir = self.os_path_join(self._outputdir,"FIT")
-                if not os.path.exists(fitdir):
+                        concentrations = self._tool.processFitResult(config=tconf,
+                                        fitresult=fitresult0,
+                                        elementsfrommatrix=False,
+                                        fluorates = self.mcafit._fluoRates)
+                    except:
+                        print("error in concentrations")
+                        print(sys.exc_info()[0:-1])
+                    concentrationsdone = True
+                else:
+                    #just images
+                    fitresult = self.mcafit.startfit(digest=0)
+            except:
+                print("Error fitting file with output = %s: %s)" %\
+                      (filename, sys.exc_info()[1]))
+                if self.mcafit.config['fit'].get("strategyflag", False):
+                    config = self.__configList[self.__currentConfig]
+                    print("Restoring fitconfiguration")
+                    self.mcafit = ClassMcaTheory.McaTheory(config)
+                    self.mcafit.enableOptimizedLinearFit()
+                return
+        if self._concentrations:
+            if concentrationsdone == 0:
+                if not ('concentrations' in result):
+                    if useExistingResult:
+                        fitresult0={}
+                        fitresult0['result'] = result
+                        conf = result['config']
+                    else:
+                        fitresult0={}
+                        if result is None:
+                            result = self.mcafit.digestresult()
+                        fitresult0['result']    = result
+                        fitresult0['fitresult'] = fitresult
+                        conf = self.mcafit.configure()
+                    tconf = self._tool.configure()
+                    if 'concentrations' in conf:
+                        tconf.update(conf['concentrations'])
+                    else:
+                        pass
+                        #print "Concentrations not calculated"
+                        #print "Is your fit configuration file correct?"
+                        #return
                     try:
-                        os.mkdir(fitdir)
+                        concentrations = self._tool.processFitResult(config=tconf,
+                                        fitresult=fitresult0,
+                                        elementsfrommatrix=False)
                     except:
+                        print("error in concentrations")
+                        print(sys.exc_info()[0:-1])
+                        #return
+
+        #output options
+        # .FIT files
+        if self.fitFiles:
+            fitdir = self.os_path_join(self._outputdir,"FIT")
+            if not os.path.exists(fitdir):
+                try:
+                    os.mkdir(fitdir)
+                except:
+                    if not os.path.isdir(fitdir):
                         print("I could not create directory %s" % fitdir)
                         return
-                fitdir = self.os_path_join(fitdir,filename+"_FITDIR")
-                if not os.path.exists(fitdir):
-                    try:
-                        os.mkdir(fitdir)
-                    except:
+            fitdir = self.os_path_join(fitdir,filename+"_FITDIR")
+            if not os.path.exists(fitdir):
+                try:
+                    os.mkdir(fitdir)
+                except:
+                    if not os.path.isdir(fitdir):
                         print("I could not create directory %s" % fitdir)
                         return
-                if not os.path.isdir(fitdir):
-                    print("%s does not seem to be a valid directory" % fitdir)
-                else:
-                    outfile = filename +"_"+key+".fit"
-                    outfile = self.os_path_join(fitdir,  outfile)
-                if not useExistingResult:
-                    result = self.mcafit.digestresult(outfile=outfile,
-                                                      info=info)
-                if concentrations is not None:
-                    try:
-                        f=ConfigDict.ConfigDict()
-                        f.read(outfile)
-                        f['concentrations'] = concentrations
-                        try:
-                            os.remove(outfile)
-                        except:
-                            print("error deleting fit file")
-                        f.write(outfile)
-                    except:
-                        print("Error writing concentrations to fit file")
-                        print(sys.exc_info())
-
-                #python like output list
-                if not self.counter:
-                    name = os.path.splitext(self._rootname)[0]+"_fitfilelist.py"
-                    name = self.os_path_join(self._outputdir,name)
+            if not os.path.isdir(fitdir):
+                print("%s does not seem to be a valid directory" % fitdir)
+            else:
+                outfile = filename +"_"+key+".fit"
+                outfile = self.os_path_join(fitdir,  outfile)
+            if not useExistingResult:
+                result = self.mcafit.digestresult(outfile=outfile,
+                                                  info=info)
+            if concentrations is not None:
+                try:
+                    f=ConfigDict.ConfigDict()
+                    f.read(outfile)
+                    f['concentrations'] = concentrations
                     try:
-                        os.remove(name)
+                        os.remove(outfile)
                     except:
-                        pass
-                    self.listfile=open(name,"w+")
-                    self.listfile.write("fitfilelist = [")
-                    self.listfile.write('\n'+outfile)
+                        print("error deleting fit file")
+                    f.write(outfile)
+                except:
+                    print("Error writing concentrations to fit file")
+                    print(sys.exc_info())
+        else:
+            if not useExistingResult:
+                if 0:
+                    #this is very slow and not needed just for imaging
+                    if result is None:
+                        result = self.mcafit.digestresult()
                 else:
-                    self.listfile.write(',\n'+outfile)
+                    if result is None:
+                        result = self.mcafit.imagingDigestResult()
+
+        output = {'result': result,
+                  'concentrations': concentrations,
+                  'outfile': outfile}
+        if self.fitStore and not useExistingResult:
+            output['parameters'] = {'names': list(self.mcafit.PARAMETERS),
+                                    'values': numpy.array(self.mcafit.fittedpar),
+                                    'sigmas': numpy.array(self.mcafit.sigmapar)}
+            if self.fitCurves and ('yfit' in result):
+                output['xdata'] = result['xdata']
+                output['yfit'] = result['yfit']
+        return output
+
+    def __storeOneMca(self, output, filename, key, row, col):
+        """
+        Write the concentrations and the list of .fit files and fill the
+        images with the fit result of one spectrum.
+
+        :param dict output: see _fitOneMca
+        :param int row: image row
+        :param int col: image column
+        :returns bool: False when the result could not be stored
+        """
+        result = output['result']
+        concentrations = output['concentrations']
+        outfile = output['outfile']
+        if self.chunk is not None:
+            con_extension = "_%06d_partial_concentrations.txt" % self.chunk
+        else:
+            con_extension = "_concentrations.txt"
+        self._concentrationsFile = self.os_path_join(self._outputdir,
+                                self._rootname+ con_extension)
+        #                        self._rootname+"_concentrationsNEW.txt")
+        if self.counter == 0:
+            if os.path.exists(self._concentrationsFile):
+                try:
+                    os.remove(self._concentrationsFile)
+                except:
+                    print("I could not delete existing concentrations file %s" %\
+                          self._concentrationsFile)
+        #print "self._concentrationsFile", self._concentrationsFile
+        if self._concentrations:
+            self._concentrationsAsAscii=self._toolConversion.getConcentrationsAsAscii(concentrations)
+            if len(self._concentrationsAsAscii) > 1:
+                text  = ""
+                text += "SOURCE: "+ filename +"\n"
+                text += "KEY: "+key+"\n"
+                text += self._concentrationsAsAscii + "\n"
+                f=open(self._concentrationsFile,"a")
+                f.write(text)
+                f.close()
+
+        #python like output list
+        if self.fitFiles:
+            if not self.counter:
+                name = os.path.splitext(self._rootname)[0]+"_fitfilelist.py"
+                name = self.os_path_join(self._outputdir,name)
+                try:
+                    os.remove(name)
+                except:
+                    pass
+                self.listfile=open(name,"w+")
+                self.listfile.write("fitfilelist = [")
+                self.listfile.write('\n'+outfile)
             else:
-                if not useExistingResult:
-                    if 0:
-                        #this is very slow and not needed just for imaging
-                        if result is None:
-                            result = self.mcafit.digestresult()
-                    else:
-                        if result is None:
-                            result = self.mcafit.imagingDigestResult()
+                self.listfile.write(',\n'+outfile)
 
-            #IMAGES
-            if self.fitImages:
-                #this only works with EDF
-                if self.__ncols is not None:
-                    if not self.counter:
-                        if not self._nosave:
-                            imgdir = self.os_path_join(self._outputdir,"IMAGES")
-                            if not os.path.exists(imgdir):
-                                try:
-                                    os.mkdir(imgdir)
-                                except:
-                                    print("I could not create directory %s" %\
-                                          imgdir)
-                                    return
-                            elif not os.path.isdir(imgdir):
-                                print("%s does not seem to be a valid directory" %\
+        #HDF5 fit result store
+        if self.__store is not None:
+            self.__store.append(filename, key, row, col, output)
+
+        #IMAGES
+        if self.fitImages:
+            #this only works with EDF
+            if self.__ncols is not None:
+                if not self.counter:
+                    if not self._nosave:
+                        imgdir = self.os_path_join(self._outputdir,"IMAGES")
+                        if not os.path.exists(imgdir):
+                            try:
+                                os.mkdir(imgdir)
+                            except:
+                                print("I could not create directory %s" %\
                                       imgdir)
-                            self.imgDir = imgdir
+                                return False
+                        elif not os.path.isdir(imgdir):
+                            print("%s does not seem to be a valid directory" %\
+                                  imgdir)
+                        self.imgDir = imgdir
 
-                        self.__peaks  = []
-                        self.__images = {}
-                        self.__sigmas = {}
-                        if not self.__stack:
-                            self.__nrows   = len(range(0, len(self._filelist), self.fileStep))
-                        for group in result['groups']:
-                            self.__peaks.append(group)
-                            self.__images[group]= numpy.zeros((self.__nrows,
-                                                               self.__ncols),
-                                                               numpy.float)
-                            self.__sigmas[group]= numpy.zeros((self.__nrows,
-                                                               self.__ncols),
-                                                               numpy.float)
-                        self.__images['chisq']  = numpy.zeros((self.__nrows,
-                                                               self.__ncols),
-                                                               numpy.float) - 1.
-                        if self._concentrations:
-                            layerlist = concentrations['layerlist']
-                            if 'mmolar' in concentrations:
-                                self.__conLabel = " mM"
-                                self.__conKey   = "mmolar"
-                            else:
-                                self.__conLabel = " mass fraction"
-                                self.__conKey   = "mass fraction"
-                            for group in concentrations['groups']:
-                                key = group+self.__conLabel
-                                self.__concentrationsKeys.append(key)
-                                self.__images[key] = numpy.zeros((self.__nrows,
-                                                                  self.__ncols),
-                                                                  numpy.float)
-                                if len(layerlist) > 1:
-                                    for layer in layerlist:
-                                        key = group+" "+layer
-                                        self.__concentrationsKeys.append(key)
-                                        self.__images[key] = numpy.zeros((self.__nrows,
-                                                                    self.__ncols),
-                                                                    numpy.float)
-                for peak in self.__peaks:
-                    try:
-                        self.__images[peak][self.__row, self.__col] = result[peak]['fitarea']
-                        self.__sigmas[peak][self.__row, self.__col] = result[peak]['sigmaarea']
-                    except:
-                        pass
-                if self._concentrations:
-                    layerlist = concentrations['layerlist']
-                    for group in concentrations['groups']:
-                        self.__images[group+self.__conLabel][self.__row, self.__col] = \
-                                              concentrations[self.__conKey][group]
-                        if len(layerlist) > 1:
-                            for layer in layerlist:
-                                self.__images[group+" "+layer] [self.__row, self.__col] = \
-                                              concentrations[layer][self.__conKey][group]
+                    self.__peaks  = []
+                    self.__images = {}
+                    self.__sigmas = {}
+                    if not self.__stack:
+                        self.__nrows   = len(range(0, len(self._filelist), self.fileStep))
+                    for group in result['groups']:
+                        self.__peaks.append(group)
+                        self.__images[group]= numpy.zeros((self.__nrows,
+                                                           self.__ncols),
+                                                           numpy.float)
+                        self.__sigmas[group]= numpy.zeros((self.__nrows,
+                                                           self.__ncols),
+                                                           numpy.float)
+                    self.__images['chisq']  = numpy.zeros((self.__nrows,
+                                                           self.__ncols),
+                                                           numpy.float) - 1.
+                    if self._concentrations:
+                        layerlist = concentrations['layerlist']
+                        if 'mmolar' in concentrations:
+                            self.__conLabel = " mM"
+                            self.__conKey   = "mmolar"
+                        else:
+                            self.__conLabel = " mass fraction"
+                            self.__conKey   = "mass fraction"
+                        for group in concentrations['groups']:
+                            key = group+self.__conLabel
+                            self.__concentrationsKeys.append(key)
+                            self.__images[key] = numpy.zeros((self.__nrows,
+                                                              self.__ncols),
+                                                              numpy.float)
+                            if len(layerlist) > 1:
+                                for layer in layerlist:
+                                    key = group+" "+layer
+                                    self.__concentrationsKeys.append(key)
+                                    self.__images[key] = numpy.zeros((self.__nrows,
+                                                                self.__ncols),
+                                                                numpy.float)
+            for peak in self.__peaks:
                 try:
-                    self.__images['chisq'][self.__row, self.__col] = result['chisq']
+                    self.__images[peak][row, col] = result[peak]['fitarea']
+                    self.__sigmas[peak][row, col] = result[peak]['sigmaarea']
                 except:
-                    print("Error on chisq row %d col %d" %\
-                          (self.__row, self.__col))
-                    print("File = %s\n" % filename)
                     pass
+            if self._concentrations:
+                layerlist = concentrations['layerlist']
+                for group in concentrations['groups']:
+                    self.__images[group+self.__conLabel][row, col] = \
+                                          concentrations[self.__conKey][group]
+                    if len(layerlist) > 1:
+                        for layer in layerlist:
+                            self.__images[group+" "+layer] [row, col] = \
+                                          concentrations[layer][self.__conKey][group]
+            try:
+                self.__images['chisq'][row, col] = result['chisq']
+            except:
+                print("Error on chisq row %d col %d" %\
+                      (row, col))
+                print("File = %s\n" % filename)
+                pass
 
+        return True
+
+    def __processOneMca(self,x,y,filename,key,info=None):
+        self._concentrationsAsAscii = ""
+        if not self.roiFit:
+            output = self.__getStoredResult(filename, key)
+            pool = self.__getPool(y)
+            if pool is not None:
+                # fitted by a worker process and stored when done
+                context = (filename, key, self.__row, self.__col, [])
+                if output is None:
+                    done = pool.submit(x, y, filename, key, info, context)
+                else:
+                    done = pool.put(output, context)
+                for item in done:
+                    self.__storeResult(*item)
+                self.__lastContext = context
+                return
+            if output is None:
+                output = self._fitOneMca(x, y, filename, key, info=info)
+            if output is None:
+                return
+            if not self.__storeOneMca(output, filename, key,
+                                      self.__row, self.__col):
+                return
         else:
                 dict=self.mcafit.roifit(x,y,width=self.roiWidth)
                 #this only works with EDF
@@ -949,15 +1132,146 @@ def saveImage(self,ffile=None):
                         i=1
 
 
+class McaFitPool(object):
+    """
+    Pool of worker processes, each one with its own configured fit, fitting
+    the spectra submitted by McaAdvancedFitBatch. The spectra are given to
+    the workers through shared memory and the results are returned in the
+    order the spectra were submitted.
+    """
+    def __init__(self, nworkers, nchannels, batchkwargs):
+        """
+        :param int nworkers: number of processes
+        :param int nchannels: number of channels of the spectra (longer
+                              spectra are sent to the workers by pickling)
+        :param dict batchkwargs: McaAdvancedFitBatch arguments of the workers
+        """
+        self.nSlots = 4 * nworkers
+        self.nChannels = nchannels
+        shape = self.nSlots, 2, nchannels
+        shared = multiprocessing.RawArray('d', int(numpy.prod(shape)))
+        self._buffer = numpy.frombuffer(shared, dtype=numpy.float64)
+        self._buffer.shape = shape
+        self._free = list(range(self.nSlots))
+        self._pending = collections.deque()
+        self._pool = multiprocessing.Pool(nworkers,
+                                          initializer=_workerInit,
+                                          initargs=(batchkwargs, shared, shape))
+
+    def submit(self, x, y, filename, key, info, context):
+        """
+        :param context: returned with the fit result
+        :returns list: (context, output) of the spectra fitted in the mean time
+        """
+        done = []
+        while self._pending and \
+              (len(self._pending) >= self.nSlots or not self._free):
+            done.append(self._next())
+        n = len(y)
+        if n <= self.nChannels:
+            slot = self._free.pop()
+            self._buffer[slot, 0, :n] = x
+            self._buffer[slot, 1, :n] = y
+            task = slot, n, None, None, filename, key, info
+        else:
+            slot = None
+            task = slot, n, x, y, filename, key, info
+        result = self._pool.apply_async(_workerFitOneMca, (task,))
+        self._pending.append((result, slot, context))
+        return done
+
+    def put(self, output, context):
+        """
+        Queue a result that does not need to be fitted (keeping the order)
+
+        :param dict output: fit result
+        :param context: returned with the fit result
+        :returns list: (context, output) of the spectra fitted in the mean time
+        """
+        self._pending.append((output, None, context))
+        done = []
+        while self._pending:
+            result = self._pending[0][0]
+            if isinstance(result, dict) or result.ready():
+                done.append(self._next())
+            else:
+                break
+        return done
+
+    def _next(self):
+        result, slot, context = self._pending.popleft()
+        if isinstance(result, dict):
+            return context, result
+        try:
+            output = result.get()
+        finally:
+            if slot is not None:
+                self._free.append(slot)
+        return context, output
+
+    def results(self):
+        """
+        Wait for all the submitted spectra
+
+        :returns generator: (context, output)
+        """
+        while self._pending:
+            yield self._next()
+
+    def close(self):
+        if self._pending:
+            self._pool.terminate()
+            self._pending.clear()
+        else:
+            self._pool.close()
+        self._pool.join()
+
+
+_WORKER = None
+_WORKER_BUFFER = None
+
+
+def _workerInit(batchkwargs, shared, shape):
+    global _WORKER, _WORKER_BUFFER
+    _WORKER = McaAdvancedFitBatch(quiet=True, nosave=True, **batchkwargs)
+    _WORKER.mcafit.enableOptimizedLinearFit()
+    _WORKER_BUFFER = numpy.frombuffer(shared, dtype=numpy.float64)
+    _WORKER_BUFFER.shape = shape
+
+
+def _workerFitOneMca(task):
+    slot, n, x, y, filename, key, info = task
+    if slot is not None:
+        x = _WORKER_BUFFER[slot, 0, :n].copy()
+        y = _WORKER_BUFFER[slot, 1, :n].copy()
+    output = _WORKER._fitOneMca(x, y, filename, key, info=info)
+    if output is not None:
+        # only what is needed for the images
+        result = output['result']
+        reduced = {'groups': result['groups']}
+        if 'chisq' in result:
+            reduced['chisq'] = result['chisq']
+        for group in result['groups']:
+            if group in result:
+                reduced[group] = {'fitarea': result[group]['fitarea'],
+                                  'sigmaarea': result[group]['sigmaarea']}
+        output['result'] = reduced
+    return output
+
+
 if __name__ == "__main__":
     import getopt
     options     = 'f'
-    longoptions = ['cfg=','pkm=','outdir=','roifit=','roi=','roiwidth=']
+    longoptions = ['cfg=','pkm=','outdir=','roifit=','roi=','roiwidth=',
+                   'nworkers=','fitstore=','fitcurves=']
     filelist = None
     outdir   = None
     cfg      = None
     roifit   = 0
     roiwidth = 250.
+    nworkers = None
+    fitstore = 0
+    fitcurves = 0
     opts, args = getopt.getopt(
                     sys.argv[1:],
                     options,
@@ -971,10 +1285,18 @@ def saveImage(self,ffile=None):
             roifit   = int(arg)
         elif opt in ('--roiwidth'):
             roiwidth = float(arg)
+        elif opt in ('--nworkers'):
+            nworkers = int(arg)
+        elif opt in ('--fitstore'):
+            fitstore = int(arg)
+        elif opt in ('--fitcurves'):
+            fitcurves = int(arg)
     filelist=args
     if len(filelist) == 0:
         print("No input files, run GUI")
         sys.exit(0)
 
-    b = McaAdvancedFitBatch(cfg,filelist,outdir,roifit,roiwidth)
+    b = McaAdvancedFitBatch(cfg,filelist,outdir,roifit,roiwidth,
+                            nworkers=nworkers, fitstore=fitstore,
+                            fitcurves=fitcurves)
     b.processList()
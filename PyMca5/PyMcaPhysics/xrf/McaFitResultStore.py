@@ -0,0 +1,353 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2004-2019 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V.A. Sole - ESRF Data Analysis"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+import os
+import json
+import logging
+import numpy
+from PyMca5.PyMcaIO import NexusUtils
+
+h5py = NexusUtils.h5py
+
+_logger = logging.getLogger(__name__)
+
+
+class McaFitResultStore(object):
+    """
+    Single HDF5 file with the fit results of all the spectra of a batch fit,
+    replacing the individual .fit files. The results are stored as:
+
+        filename::/entry/process/results/
+
+    with one row per spectrum in each of the datasets:
+
+        filename, key, row, column: the spectrum
+        chisq
+        parameters, uncertainties: all the fit parameters
+        fitarea, sigmaarea: the peak group areas
+        concentrations: flattened concentrations dictionary
+        yfit: fitted curves (optional)
+
+    The rows are buffered in memory and written in blocks to chunked
+    datasets. An existing store is reopened to resume a batch fit, unless
+    the fit configuration changed.
+
+    Usage:
+        store = McaFitResultStore(filename, configuration=config)
+        ...
+        output = store.get(filename, key)
+        ...
+        store.append(filename, key, row, col, output)
+        ...
+        store.close()
+    """
+    def __init__(self, filename, entry="mca_fit", process="xrf_fit",
+                 configuration=None, overwrite=False, blocksize=1024,
+                 fitcurves=False):
+        """
+        :param str filename: HDF5 file name
+        :param str entry: NXentry name
+        :param str process: NXprocess name
+        :param ConfigDict configuration: fit configuration
+        :param bool overwrite: discard existing results
+        :param int blocksize: number of buffered spectra
+        :param bool fitcurves: store the fitted curves
+        """
+        self.filename = filename
+        self.blockSize = max(int(blocksize), 1)
+        self.fitCurves = fitcurves
+        self._buffer = []
+        self._index = {}
+        self._nRows = 0
+        self._static = None
+        NexusUtils.mkdir(os.path.dirname(os.path.abspath(filename)))
+        self._h5 = h5py.File(filename, mode="a")
+        try:
+            NexusUtils.nxRootInit(self._h5)
+            nxentry = NexusUtils.nxEntry(self._h5, entry)
+            if configuration is not None:
+                configuration = configuration.tostring()
+            if process in nxentry:
+                if not overwrite:
+                    stored = nxentry[process].get("configuration/data")
+                    if stored is not None:
+                        stored = stored[()]
+                        if hasattr(stored, "decode"):
+                            stored = stored.decode("utf-8")
+                    if stored != configuration:
+                        _logger.warning("Fit configuration changed: "
+                                        "discarding the results of %s",
+                                        nxentry[process].name)
+                        overwrite = True
+                if overwrite:
+                    del nxentry[process]
+            nxprocess = NexusUtils.nxProcess(nxentry, process)
+            if configuration is not None and \
+               "data" not in nxprocess["configuration"]:
+                NexusUtils.nxNoteInit(nxprocess, "configuration",
+                                      data=configuration, type="ini")
+            self._results = nxprocess["results"]
+            self._readIndex()
+        except:
+            self._h5.close()
+            raise
+
+    def _readIndex(self):
+        results = self._results
+        if "filename" not in results:
+            return
+        self._nRows = results["filename"].shape[0]
+        filenames = results["filename"][()]
+        keys = results["key"][()]
+        for i in range(self._nRows):
+            self._index[(_asStr(filenames[i]), _asStr(keys[i]))] = i
+        if "concentrations" in results:
+            self._static = json.loads(_asStr(
+                            results["concentrations"].attrs["static"]))
+
+    def __contains__(self, item):
+        return item in self._index
+
+    def __len__(self):
+        return self._nRows + len(self._buffer)
+
+    def get(self, filename, key, concentrations=False):
+        """
+        Fit result of a spectrum stored by a previous batch fit.
+
+        :param str filename:
+        :param str key:
+        :param bool concentrations: the concentrations are needed
+        :returns dict or None: see McaAdvancedFitBatch._fitOneMca
+        """
+        i = self._index.get((filename, key), None)
+        if i is None:
+            return None
+        results = self._results
+        if concentrations and ("concentrations" not in results):
+            return None
+        result = {'groups': [_asStr(group) for group in
+                             results["fitarea"].attrs["groups"]],
+                  'chisq': results["chisq"][i]}
+        fitarea = results["fitarea"][i]
+        sigmaarea = results["sigmaarea"][i]
+        for j, group in enumerate(result['groups']):
+            result[group] = {'fitarea': fitarea[j],
+                             'sigmaarea': sigmaarea[j]}
+        output = {'result': result,
+                  'concentrations': None,
+                  'outfile': self.filename,
+                  'stored': True}
+        if "concentrations" in results:
+            names = results["concentrations"].attrs["names"]
+            values = results["concentrations"][i]
+            output['concentrations'] = _unflattenDict(
+                            [_asStr(name) for name in names],
+                            values, self._static)
+        return output
+
+    def append(self, filename, key, row, col, output):
+        """
+        Add the fit result of a spectrum.
+
+        :param str filename:
+        :param str key:
+        :param int row: image row
+        :param int col: image column
+        :param dict output: see McaAdvancedFitBatch._fitOneMca
+        """
+        if output.get('stored', False):
+            # it comes from this store
+            return
+        self._buffer.append((filename, key, row, col, output))
+        if len(self._buffer) >= self.blockSize:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the buffered results
+        """
+        if not self._buffer:
+            return
+        if "filename" not in self._results:
+            self._createDatasets(self._buffer[0][-1])
+        n0 = self._nRows
+        n = len(self._buffer)
+        results = self._results
+        groups = [_asStr(group) for group in
+                  results["fitarea"].attrs["groups"]]
+        columns = {}
+        for name in ["filename", "key"]:
+            columns[name] = []
+        for name in ["row", "column", "chisq"]:
+            columns[name] = numpy.zeros((n,), dtype=results[name].dtype)
+        for name in ["parameters", "uncertainties", "fitarea", "sigmaarea",
+                     "concentrations", "yfit"]:
+            if name in results:
+                columns[name] = numpy.full((n,) + results[name].shape[1:],
+                                           numpy.nan, dtype=results[name].dtype)
+        for i, (filename, key, row, col, output) in enumerate(self._buffer):
+            result = output['result']
+            columns["filename"].append(filename)
+            columns["key"].append(key)
+            columns["row"][i] = row
+            columns["column"][i] = col
+            columns["chisq"][i] = result.get('chisq', -1.0)
+            for j, group in enumerate(groups):
+                if group in result:
+                    columns["fitarea"][i, j] = result[group]['fitarea']
+                    columns["sigmaarea"][i, j] = result[group]['sigmaarea']
+            parameters = output.get('parameters', None)
+            if parameters is not None and "parameters" in columns:
+                values = parameters['values']
+                if len(values) == columns["parameters"].shape[1]:
+                    columns["parameters"][i] = values
+                    columns["uncertainties"][i] = parameters['sigmas']
+            concentrations = output.get('concentrations', None)
+            if concentrations is not None and "concentrations" in columns:
+                names = results["concentrations"].attrs["names"]
+                flat = _flattenDict(concentrations)[0]
+                columns["concentrations"][i] = \
+                            [flat.get(_asStr(name), numpy.nan)
+                             for name in names]
+            yfit = output.get('yfit', None)
+            if yfit is not None and "yfit" in columns:
+                m = min(len(yfit), columns["yfit"].shape[1])
+                columns["yfit"][i, :m] = yfit[:m]
+        for name, values in columns.items():
+            dset = results[name]
+            dset.resize(n0 + n, axis=0)
+            if name in ["filename", "key"]:
+                values = NexusUtils.asNxChar(values)
+            dset[n0:n0 + n] = values
+        for i, (filename, key, row, col, output) in enumerate(self._buffer):
+            self._index[(filename, key)] = n0 + i
+        self._nRows += n
+        self._buffer = []
+        NexusUtils.updated(results)
+        self._h5.flush()
+
+    def _createDatasets(self, output):
+        results = self._results
+        result = output['result']
+        groups = list(result['groups'])
+        blockSize = self.blockSize
+
+        def create(name, shape, dtype):
+            # chunks of about 1 MB at most
+            nrows = 2**17 // max(int(numpy.prod(shape)), 1)
+            chunks = (max(min(blockSize, nrows), 1),) + tuple(shape)
+            return results.create_dataset(name, shape=(0,) + tuple(shape),
+                                          maxshape=(None,) + tuple(shape),
+                                          chunks=chunks, dtype=dtype)
+        for name in ["filename", "key"]:
+            create(name, (), NexusUtils.nxcharUnicode)
+        for name in ["row", "column"]:
+            create(name, (), numpy.int32)
+        create("chisq", (), numpy.float64)
+        dset = create("fitarea", (len(groups),), numpy.float64)
+        dset.attrs["groups"] = NexusUtils.asNxChar(groups)
+        dset = create("sigmaarea", (len(groups),), numpy.float64)
+        dset.attrs["groups"] = NexusUtils.asNxChar(groups)
+        parameters = output.get('parameters', None)
+        if parameters is not None:
+            names = list(parameters['names'])
+            for name in ["parameters", "uncertainties"]:
+                dset = create(name, (len(names),), numpy.float64)
+                dset.attrs["names"] = NexusUtils.asNxChar(names)
+        concentrations = output.get('concentrations', None)
+        if concentrations is not None:
+            flat, static = _flattenDict(concentrations)
+            names = sorted(flat.keys())
+            dset = create("concentrations", (len(names),), numpy.float64)
+            dset.attrs["names"] = NexusUtils.asNxChar(names)
+            dset.attrs["static"] = json.dumps(static)
+            self._static = static
+        yfit = output.get('yfit', None)
+        if self.fitCurves and yfit is not None:
+            dset = create("yfit", (len(yfit),), numpy.float64)
+            xdata = output.get('xdata', None)
+            if xdata is not None:
+                results["channels"] = numpy.asarray(xdata)
+
+    def close(self):
+        if self._h5 is not None:
+            try:
+                self.flush()
+            finally:
+                self._h5.close()
+                self._h5 = None
+
+
+def _asStr(s):
+    if hasattr(s, "decode"):
+        return s.decode("utf-8")
+    return s
+
+
+def _flattenDict(ddict, prefix=""):
+    """
+    Split a nested dictionary into its numeric scalars (flattened, the keys
+    are joined with "/") and the rest (nested dictionary).
+
+    :returns tuple: dict, dict
+    """
+    flat = {}
+    static = {}
+    for key, value in ddict.items():
+        if isinstance(value, dict):
+            subflat, substatic = _flattenDict(value, prefix + key + "/")
+            flat.update(subflat)
+            if substatic:
+                static[key] = substatic
+        elif isinstance(value, (int, float, numpy.number)) and \
+             not isinstance(value, bool):
+            flat[prefix + key] = value
+        else:
+            if isinstance(value, numpy.ndarray):
+                value = value.tolist()
+            static[key] = value
+    return flat, static
+
+
+def _unflattenDict(names, values, static=None):
+    """
+    Inverse of _flattenDict
+    """
+    ddict = json.loads(json.dumps(static)) if static else {}
+    for name, value in zip(names, values):
+        keys = name.split("/")
+        target = ddict
+        for key in keys[:-1]:
+            target = target.setdefault(key, {})
+        target[keys[-1]] = float(value)
+    return ddict
@@ -34,9 +34,12 @@
 import numpy
 import logging
 from abc import ABCMeta, abstractmethod, abstractproperty
-from six import with_metaclass
+from six import with_metaclass, reraise
+from six.moves import queue
 import numbers
 import itertools
+import sys
+import threading
 
 _logger = logging.getLogger(__name__)
 
@@ -184,13 +187,17 @@ def chunkIndexParameters(shape, nChunksMax, chunkAxes=None, axesOrder=None,
     return nChunksMax, chunkAxes, axesOrder, chunkAxesSlice
 
 
-def fullChunkIndex(shape, nChunksMax, **kwargs):
+def fullChunkIndex(shape, nChunksMax, chunkAlign=None, **kwargs):
     """
     Returns a number of lists (as many as there are dimensions)
     which cartesian product represents all chunk indices
 
     :param tuple shape: array shape to be sliced
     :param int nChunksMax: maximal number of chunks
+    :param tuple chunkAlign: chunk boundaries in the axesOrder dimensions
+                             are multiples of these (e.g. the HDF5 storage
+                             chunks). This may result in more than
+                             nChunksMax chunks.
     :param \**kwargs: see chunkIndexParameters
     :returns tuple: chunkIndex(list(list(slice,int))),
                     chunkAxes(tuple),
@@ -198,6 +205,8 @@ def fullChunkIndex(shape, nChunksMax, **kwargs):
                     nBuffer(may different from nChunksMax)
     """
     nChunksMax, chunkAxes, axesOrder, chunkAxesSlice = chunkIndexParameters(shape, nChunksMax, **kwargs)
+    if not chunkAlign:
+        chunkAlign = (1,)*len(shape)
 
     # List of indices for each chunkAxes dimension
     chunkIndex1 = []
@@ -212,23 +221,27 @@ def fullChunkIndex(shape, nChunksMax, **kwargs):
     chunkIndex2 = []
     for axis in axesOrder:
         nAxis = shape[axis]
+        nAlign = max(min(chunkAlign[axis], nAxis), 1)
         nItemsNew = nItems*nAxis
         if nItemsNew <= nChunksMax:
             idxAxis = [(slice(None), nAxis)]
             nBuffer *= nAxis
             #print('Axis {} (size={}): {}x{} chunks'.format(axis, nAxis, 1, nAxis))
         elif nItems > nChunksMax:
-            idxAxis = list(chunkIndexGen(0, nAxis, 1))
-            #print('Axis {} (size={}): {}x{} chunks'.format(axis, nAxis, len(idxAxis), 1))
+            idxAxis = list(chunkIndexGen(0, nAxis, nAlign))
+            nBuffer *= nAlign
+            #print('Axis {} (size={}): {}x{} chunks'.format(axis, nAxis, len(idxAxis), nAlign))
         else:
             # Axis will be split in pieces with length "step"
-            step = nChunksMax//nItems
+            # (a multiple of nAlign)
+            nBlocks = (nAxis//nAlign) + int(bool(nAxis % nAlign))
+            step = max(nChunksMax//(nItems*nAlign), 1)
             # We have "n" such pieces (last piece can have smaller length)
-            n = (nAxis//step) + int(bool(nAxis % step))
+            n = (nBlocks//step) + int(bool(nBlocks % step))
             # Maximize the length of the last piece
             # example: nAxis=51 and step=40 -> step = 26
-            step = (nAxis//n) + int(bool(nAxis % n))
-            nBuffer *= step
+            step = ((nBlocks//n) + int(bool(nBlocks % n)))*nAlign
+            nBuffer *= min(step, nAxis)
             idxAxis = list(chunkIndexGen(0, nAxis, step))
             #print('Axis {} (size={}): {}x{} chunks'.format(axis, nAxis, len(idxAxis), step))
         nItems = nItemsNew
@@ -400,6 +413,127 @@ def chunks_in_memory(shape, dtype, axis=-1, margin=0.01, maximal=None):
         return n_chunks
 
 
+def storageChunkInfo(data):
+    """
+    Storage chunk shape and compression of an HDF5 dataset
+
+    :param array data: numpy.ndarray or h5py.Dataset
+    :returns tuple: chunks(tuple or None), compression(str or None)
+    """
+    return getattr(data, 'chunks', None), getattr(data, 'compression', None)
+
+
+def chunkMemoryBudget(fraction=1/256., minimal=1024**2, maximal=256*1024**2):
+    """
+    Number of bytes to be used for one chunk: a fraction of the
+    physical memory
+
+    :param num fraction: fraction of the physical memory
+    :param int minimal: lower limit in bytes
+    :param int maximal: upper limit in bytes (None: no limit)
+    :returns int:
+    """
+    from PyMca5.PyMcaMisc.PhysicalMemory import getPhysicalMemoryOrNone
+    nbytes_mem = getPhysicalMemoryOrNone()
+    if nbytes_mem is None:
+        return minimal
+    nbytes = max(int(nbytes_mem*fraction), minimal)
+    if maximal:
+        nbytes = min(nbytes, maximal)
+    return nbytes
+
+
+def prefetchItems(chunks, buffers, read, write=None):
+    """
+    Yields chunks which are read ahead by a background thread. When
+    a write function is provided, chunks are written back by another
+    background thread after the consumer asks for the next chunk.
+
+    :param iterable chunks: yields key, args with args[-1] the number of
+                            rows of the chunk
+    :param list(array) buffers: at least 2 (+1 when writing) buffers
+    :param callable read: read(value, *args)
+    :param callable write: write(value, *args)
+    :returns generator: key, value
+    """
+    freeBuffers = queue.Queue()
+    for buffer in buffers:
+        freeBuffers.put(buffer)
+    readQueue = queue.Queue()
+    writeQueue = queue.Queue()
+    stopEvent = threading.Event()
+    errors = []
+
+    def reader():
+        try:
+            for key, args in chunks:
+                buffer = freeBuffers.get()
+                if stopEvent.is_set():
+                    break
+                value = buffer[:args[-1], :]
+                read(value, *args)
+                readQueue.put((key, value, args, buffer))
+        except Exception:
+            errors.append(sys.exc_info())
+        finally:
+            readQueue.put(None)
+
+    def writer():
+        while True:
+            item = writeQueue.get()
+            if item is None:
+                break
+            value, args, buffer = item
+            try:
+                if not errors:
+                    write(value, *args)
+            except Exception:
+                errors.append(sys.exc_info())
+            finally:
+                freeBuffers.put(buffer)
+
+    threads = [threading.Thread(target=reader)]
+    if write is not None:
+        threads.append(threading.Thread(target=writer))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    item = None
+    finished = False
+    try:
+        while True:
+            item = readQueue.get()
+            if item is None:
+                finished = True
+                break
+            if errors:
+                break
+            key, value, args, buffer = item
+            yield key, value
+            if write is None:
+                freeBuffers.put(buffer)
+            else:
+                writeQueue.put((value, args, buffer))
+            item = None
+    finally:
+        # Stop reading (the reader may wait for a free buffer)
+        stopEvent.set()
+        if item is not None:
+            freeBuffers.put(item[-1])
+        while not finished:
+            item = readQueue.get()
+            if item is None:
+                finished = True
+            else:
+                freeBuffers.put(item[-1])
+        writeQueue.put(None)
+        for thread in threads:
+            thread.join()
+    if errors:
+        exc_info = errors[0]
+        reraise(*exc_info)
+
+
 class ChunkedView(with_metaclass(ABCMeta, object)):
 
     def __init__(self, data, nMca=None, mcaAxis=None, mcaSlice=None,
@@ -498,13 +632,20 @@ def h5pyMultiListSet(data, value, idx, axesList):
 class MaskedView(ChunkedView):
 
     def __init__(self, data, mask=None, nMca=None, mcaAxis=None,
-                 mcaSlice=None, axesOrder=None, **kwargs):
+                 mcaSlice=None, axesOrder=None, chunkAlign=True, **kwargs):
         """
         :param array data: nD array (numpy.ndarray or h5py.Dataset)
         :param array or tuple(list(int)) mask: mask in axesOrder dimensions (bool array or list of indices)
         :param num nMca: number of spectra per chunk
         :param int mcaAxis: MCA channel dimension
         :param tuple axesOrder: order of other dimensions to be sliced (C order by default)
+        :param bool or tuple chunkAlign: chunk boundaries are aligned with
+                                         the storage chunks of data (True),
+                                         with the given chunk shape (tuple)
+                                         or not at all (False). Only used
+                                         without mask. A chunk may have
+                                         more than nMca spectra because
+                                         of this.
         :param \**kwargs: see ChunkedView
         """
         if mcaAxis is None:
@@ -513,10 +654,16 @@ def __init__(self, data, mask=None, nMca=None, mcaAxis=None,
             mcaSlice = slice(None)
         masked = mask is not None
         if mask is None:
+            if chunkAlign is True:
+                chunkAlign, compression = storageChunkInfo(data)
+                if chunkAlign:
+                    _logger.debug('Align with storage chunks {} (compression: {})'
+                                  .format(chunkAlign, compression))
             chunkInfo = fullChunkIndex(data.shape, nMca,
                                        chunkAxes=(mcaAxis,),
                                        chunkAxesSlice=(mcaSlice,),
-                                       axesOrder=axesOrder)
+                                       axesOrder=axesOrder,
+                                       chunkAlign=chunkAlign)
         else:
             chunkInfo = maskedChunkIndex(data.shape, nMca,
                                          mask=mask,
@@ -564,8 +711,15 @@ def _idxFullMask(self, idx, mask):
             idx[axis] = ind
         return idx
 
-    def items(self, keyType='all'):
+    def items(self, keyType='all', nPrefetch=0):
         """Yields (index(tuple), shape(tuple)), chunk(array))
+
+        :param str keyType: 'all' (key including mcaAxis) or
+                            'select' (key excluding mcaAxis)
+        :param int nPrefetch: number of chunks read ahead in a background
+                              thread (0 means no read-ahead). Chunks of a
+                              writable view are written back in another
+                              background thread.
         """
         nChan = self.nChan
         data = self._data
@@ -592,37 +746,59 @@ def items(self, keyType='all'):
             h5pyMultiList = False
         itransposeAxes = tuple(numpy.argsort(transposeAxes).tolist())
 
-        # Yield key, value pairs:
-        #  value: nMca x nChan chunk of buffer
-        #  key: index applied to data and resulting shape
-        #   keyType == 'all': including mcaAxis
-        #   keyType == 'select': excluding mcaAxis
-        post_copy = self._prepareAccess()
-        buffer = self._buffer
-        for idxChunk, idxShape, nMca in chunkGenerator:
-            value = buffer[:nMca, :]
+        def read(value, idxChunk, idxShape, nMca):
             if h5pyMultiList:
                 h5pyMultiListGet(data, value, idxChunk, axesOrder)
             else:
                 value[()] = numpy.transpose(data[idxChunk], transposeAxes)\
                                  .reshape(nMca, nChan)
-            if keyType == 'select':
-                if masked:
-                    key = tuple(idxChunk[i] for i in axesOrderSorted),\
-                          (nMca,)
+
+        def write(value, idxChunk, idxShape, nMca):
+            if h5pyMultiList:
+                h5pyMultiListSet(data, value, idxChunk, axesOrder)
+            else:
+                idxShape = tuple(idxShape[i] for i in transposeAxes)
+                data[idxChunk] = numpy.transpose(value.reshape(idxShape),
+                                                 itransposeAxes)
+
+        # Yield key, value pairs:
+        #  value: nMca x nChan chunk of buffer
+        #  key: index applied to data and resulting shape
+        #   keyType == 'all': including mcaAxis
+        #   keyType == 'select': excluding mcaAxis
+        def chunks():
+            for idxChunk, idxShape, nMca in chunkGenerator:
+                if keyType == 'select':
+                    if masked:
+                        key = tuple(idxChunk[i] for i in axesOrderSorted),\
+                              (nMca,)
+                    else:
+                        key = tuple(idxChunk[i] for i in axesOrderSorted),\
+                              tuple(idxShape[i] for i in axesOrderSorted)
                 else:
-                    key = tuple(idxChunk[i] for i in axesOrderSorted),\
-                          tuple(idxShape[i] for i in axesOrderSorted)
+                    key = idxChunk, idxShape
+                yield key, (idxChunk, idxShape, nMca)
+
+        post_copy = self._prepareAccess()
+        if nPrefetch > 0:
+            nBuffers = nPrefetch + 1 + int(post_copy)
+            buffers = [self._buffer] + [numpy.empty_like(self._buffer)
+                                        for i in range(nBuffers-1)]
+            if post_copy:
+                writeFunc = write
             else:
-                key = idxChunk, idxShape
+                writeFunc = None
+            for key, value in prefetchItems(chunks(), buffers, read,
+                                            write=writeFunc):
+                yield key, value
+            return
+        buffer = self._buffer
+        for key, args in chunks():
+            value = buffer[:args[-1], :]
+            read(value, *args)
             yield key, value
             if post_copy:
-                if h5pyMultiList:
-                    h5pyMultiListSet(data, value, idxChunk, axesOrder)
-                else:
-                    idxShape = tuple(idxShape[i] for i in transposeAxes)
-                    data[idxChunk] = numpy.transpose(value.reshape(idxShape),
-                                                     itransposeAxes)
+                write(value, *args)
 
 
 class FullView(MaskedView):
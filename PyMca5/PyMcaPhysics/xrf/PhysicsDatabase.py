@@ -0,0 +1,703 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2004-2019 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V.A. Sole - ESRF Data Analysis"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+"""
+Binary database of the physical tables read by the xrf modules (KShell,
+LShell, MShell, BindingEnergies, Scofield1973, PyMcaEPDL97, Coherent and
+Incoherent scattering, XCOM cross sections of Elements).
+
+The text files are parsed once and stored in a single uncompressed npz file:
+
+    index: JSON description of all the tables (uint8)
+    data: all the numerical arrays concatenated (float64)
+
+The data member is memory mapped and the arrays of a table are only
+decoded when needed, so that each module only pays for what it uses.
+The database records the size and modification time of its source files
+and it is rebuilt when one of them changes.
+
+The database is never written when importing PyMca. It has to be built
+explicitly once PyMca is installed:
+
+    python -m PyMca5.PyMcaPhysics.xrf.PhysicsDatabase --build [output]
+    python -m PyMca5.PyMcaPhysics.xrf.PhysicsDatabase --build --user
+
+and it is looked for in:
+
+    1 - The PYMCA_PHYSICS_DATABASE environment variable (an empty value
+        disables the database)
+    2 - The PyMca data directory (default output of --build)
+    3 - The user settings directory (output of --build --user)
+
+When the database is missing, outdated or cannot be read, the text files
+are parsed in memory as before.
+"""
+import os
+import sys
+import json
+import glob
+import time
+import logging
+import threading
+import zipfile
+import numpy
+from PyMca5.PyMcaIO import ConfigDict
+from PyMca5.PyMcaIO import specfile
+from PyMca5 import PyMcaDataDir
+from PyMca5 import getDataFile
+
+_logger = logging.getLogger(__name__)
+
+DATABASE_VERSION = 1
+DATABASE_NAME = "PyMcaPhysics.npz"
+
+SPEC_FILES = ["KShellRates.dat",
+              "KShellConstants.dat",
+              "LShellRates.dat",
+              "LShellConstants.dat",
+              "EADL97_LShellConstants.dat",
+              "MShellRates.dat",
+              "MShellConstants.dat",
+              "EADL97_MShellConstants.dat",
+              "BindingEnergies.dat",
+              "EADL97_BindingEnergies.dat",
+              "EPDL97_CrossSections.dat"]
+
+DICT_FILES = ["Scofield1973.dict",
+              "attdata/atomsf.dict",
+              "attdata/incoh.dict"]
+
+_MISSING = object()
+_DATABASE = None
+_DATABASE_LOCK = threading.RLock()
+
+
+def getAttDataFile(name):
+    """
+    Full path of a file in the attdata directory of PyMca
+
+    :param str name: file name
+    :returns str:
+    """
+    dirmod = PyMcaDataDir.PYMCA_DATA_DIR
+    ffile = os.path.join(dirmod, "attdata", name)
+    if not os.path.exists(ffile):
+        #freeze does bad things with the path ...
+        dirmod = os.path.dirname(dirmod)
+        ffile = os.path.join(dirmod, "attdata", name)
+        if not os.path.exists(ffile):
+            if dirmod.lower().endswith(".zip"):
+                dirmod = os.path.dirname(dirmod)
+                ffile = os.path.join(dirmod, "attdata", name)
+        if not os.path.exists(ffile):
+            print("Cannot find file ", ffile)
+            raise IOError("Cannot find file %s" % ffile)
+    return ffile
+
+
+def _getSources():
+    """
+    Source files of the database
+
+    :returns list: (name, full path, type)
+    """
+    sources = []
+    for name in SPEC_FILES:
+        sources.append((name, getDataFile(name), "spec"))
+    for name in DICT_FILES:
+        if name.startswith("attdata/"):
+            sources.append((name, getAttDataFile(name[8:]), "dict"))
+        else:
+            sources.append((name, getDataFile(name), "dict"))
+    dirname = os.path.dirname(getAttDataFile("atomsf.dict"))
+    for filename in sorted(glob.glob(os.path.join(dirname, "*.mat"))):
+        sources.append(("attdata/" + os.path.basename(filename),
+                        filename, "xcom"))
+    return sources
+
+
+def _stamp(filename):
+    stat = os.stat(filename)
+    return [os.path.abspath(filename), stat.st_size, int(stat.st_mtime)]
+
+
+def _version():
+    from PyMca5 import version
+    return version()
+
+
+# Text parsers ---------------------------------------------------------------
+
+def readSpecScanText(filename, index):
+    """
+    :param str filename: SPEC file
+    :param int index: scan index
+    :returns tuple: labels (list), data (2D array, one row per label)
+    """
+    sf = specfile.Specfile(filename)
+    scan = sf[index]
+    labels = scan.alllabels()
+    data = scan.data()
+    scan = None
+    sf = None
+    return labels, data
+
+
+def readConfigDictText(filename):
+    """
+    :param str filename:
+    :returns ConfigDict:
+    """
+    ddict = ConfigDict.ConfigDict()
+    ddict.read(filename)
+    return ddict
+
+
+def readXCOMFileText(filename):
+    """
+    Read the energies and cross sections of an XCOM .mat file
+
+    :param str filename:
+    :returns dict: energy (eV), coherent, compton, photo and pair arrays,
+                   sorted by energy
+    """
+    xcom = {}
+    for key in ['energy', 'coherent', 'compton', 'photo', 'pair']:
+        xcom[key] = []
+    f = open(filename, 'r')
+    line = f.readline()
+    while (line.split('ENERGY')[0] == line):
+        line = f.readline()
+    line = f.readline()
+    while (line.split('COHERENT')[0] == line):
+        line = line.split()
+        for value in line:
+            xcom['energy'].append(float(value)*1000.)
+        line = f.readline()
+    line = f.readline()
+    while (line.split('INCOHERENT')[0] == line):
+        line = line.split()
+        for value in line:
+            xcom['coherent'].append(float(value))
+        line = f.readline()
+    line = f.readline()
+    while (line.split('PHOTO')[0] == line):
+        line = line.split()
+        for value in line:
+            xcom['compton'].append(float(value))
+        line = f.readline()
+    line = f.readline()
+    while (line.split('PAIR')[0] == line):
+        line = line.split()
+        for value in line:
+            xcom['photo'].append(float(value))
+        line = f.readline()
+    line = f.readline()
+    while (line.split('PAIR')[0] == line):
+        line = line.split()
+        for value in line:
+            xcom['pair'].append(float(value))
+        line = f.readline()
+    i = 0
+    line = f.readline()
+    while (len(line)):
+        line = line.split()
+        for value in line:
+            xcom['pair'][i] += float(value)
+            i += 1
+        line = f.readline()
+    f.close()
+    if sys.version >= '3.0':
+        # next line gave problems under under windows
+        # just try numpy.argsort([1,1,1,1,1]) under linux and windows to see
+        # what I mean
+        # i1=numpy.argsort(xcom['energy']) did not work
+        # (uses quicksort and gives problems with Pb not passing tests)
+        i1 = numpy.argsort(xcom['energy'], kind='mergesort')
+    else:
+        sset = map(None, xcom['energy'], range(len(xcom['energy'])))
+        sset.sort()
+        i1 = numpy.array([x[1] for x in sset])
+    for key in xcom:
+        xcom[key] = numpy.take(numpy.array(xcom[key]), i1)
+    if xcom['coherent'][0] <= 0:
+        xcom['coherent'][0] = xcom['coherent'][1] * 1.0
+    return xcom
+
+
+# Public access --------------------------------------------------------------
+
+def getSpecScan(filename, index):
+    """
+    Labels and data of a scan of one of the SPEC files of SPEC_FILES.
+
+    :param str filename: SPEC file
+    :param int index: scan index
+    :returns tuple: labels (list), data (2D array, one row per label)
+    """
+    database = getDatabase()
+    if database is not None:
+        table = database.getTable(filename, "spec")
+        if table is not None:
+            scan = table[index]
+            return list(scan["labels"]), database.decode(scan["data"])
+    return readSpecScanText(filename, index)
+
+
+def getConfigDict(filename):
+    """
+    Content of one of the files of DICT_FILES. The sections are decoded
+    from the database when accessed for the first time.
+
+    :param str filename:
+    :returns dict:
+    """
+    database = getDatabase()
+    if database is not None:
+        table = database.getTable(filename, "dict")
+        if table is not None:
+            return LazyDict(database, table)
+    return readConfigDictText(filename)
+
+
+def getXCOM(filename):
+    """
+    XCOM cross sections of an attdata .mat file, see readXCOMFileText.
+
+    :param str filename:
+    :returns dict: with new arrays
+    """
+    database = getDatabase()
+    if database is not None:
+        table = database.getTable(filename, "xcom")
+        if table is not None:
+            return database.decode(table)
+    return readXCOMFileText(filename)
+
+
+def getDatabaseFile():
+    """
+    :returns str or None: the existing database file name or None when
+                          disabled or not built
+    """
+    filename = os.environ.get("PYMCA_PHYSICS_DATABASE", None)
+    if filename is not None:
+        return filename if filename else None
+    filename = os.path.join(PyMcaDataDir.PYMCA_DATA_DIR, DATABASE_NAME)
+    if os.path.exists(filename):
+        return filename
+    filename = getUserDatabaseFile()
+    if (filename is not None) and os.path.exists(filename):
+        return filename
+    return None
+
+
+def getUserDatabaseFile():
+    """
+    :returns str or None: database file name in the user settings directory
+    """
+    try:
+        from PyMca5 import getDefaultSettingsDirectory
+        return os.path.join(getDefaultSettingsDirectory(), DATABASE_NAME)
+    except Exception:
+        _logger.debug("Cannot use the settings directory", exc_info=True)
+        return None
+
+
+def getDatabase(filename=None, build=False):
+    """
+    Database shared by the xrf modules, opened on first use.
+
+    :param str filename: default from getDatabaseFile
+    :param bool build: (re)build the database when missing or outdated
+    :returns PhysicsDatabase or None: None when it cannot be used
+    """
+    global _DATABASE
+    if _DATABASE is not None:
+        return _DATABASE if _DATABASE else None
+    with _DATABASE_LOCK:
+        if _DATABASE is not None:
+            return _DATABASE if _DATABASE else None
+        database = None
+        if filename is None:
+            filename = getDatabaseFile()
+        if filename is not None:
+            database = openDatabase(filename, build=build)
+        _DATABASE = database if database is not None else False
+        return database
+
+
+def resetDatabase():
+    """
+    Close the shared database. It is reopened on next use.
+    """
+    global _DATABASE
+    with _DATABASE_LOCK:
+        _DATABASE = None
+
+
+def openDatabase(filename, build=False):
+    """
+    :param str filename:
+    :param bool build: (re)build the database when missing or outdated
+    :returns PhysicsDatabase or None: None when missing or outdated and it
+                                      could not be built
+    """
+    database = None
+    if os.path.exists(filename):
+        try:
+            database = PhysicsDatabase(filename)
+        except Exception:
+            _logger.warning("Cannot read physics database %s", filename)
+            _logger.debug("Backtrace", exc_info=True)
+        else:
+            if not database.isValid():
+                _logger.warning("Physics database %s is outdated, rebuild "
+                                "it with --build", filename)
+                database.close()
+                database = None
+    if database is None and build:
+        try:
+            buildDatabase(filename)
+            database = PhysicsDatabase(filename)
+        except Exception:
+            _logger.info("Cannot build physics database %s", filename)
+            _logger.debug("Backtrace", exc_info=True)
+            database = None
+    return database
+
+
+def buildDatabase(filename):
+    """
+    Parse all the text files and save them as a new database.
+
+    :param str filename:
+    """
+    t0 = time.time()
+    writer = _DatabaseWriter()
+    for name, source, ftype in _getSources():
+        if ftype == "spec":
+            sf = specfile.Specfile(source)
+            nscans = sf.scanno()
+            sf = None
+            table = []
+            for i in range(nscans):
+                labels, data = readSpecScanText(source, i)
+                table.append({"labels": list(labels),
+                              "data": writer.encode(data)})
+        elif ftype == "dict":
+            table = writer.encode(readConfigDictText(source))
+        else:
+            table = writer.encode(readXCOMFileText(source))
+        writer.addTable(name, source, ftype, table)
+    writer.save(filename)
+    _logger.info("Physics database %s built in %.2f s",
+                 filename, time.time() - t0)
+
+
+# Database -------------------------------------------------------------------
+
+class _DatabaseWriter(object):
+    def __init__(self):
+        self._arrays = []
+        self._offset = 0
+        self._index = {"version": DATABASE_VERSION,
+                       "pymca": _version(),
+                       "sources": {},
+                       "tables": {}}
+
+    def addTable(self, name, source, ftype, table):
+        self._index["sources"][name] = _stamp(source) + [ftype]
+        self._index["tables"][name] = table
+
+    def encode(self, value):
+        """
+        JSON description of a value. Numerical arrays are appended to the
+        data blob and described by their offset, shape and dtype.
+        """
+        if isinstance(value, dict):
+            return {"d": [[key, self.encode(item)]
+                          for key, item in value.items()]}
+        if isinstance(value, numpy.ndarray) and value.dtype.kind in "biuf":
+            data = numpy.ascontiguousarray(value, dtype=numpy.float64)
+            data = data.reshape(-1)
+            self._arrays.append(data)
+            description = {"a": [self._offset, list(value.shape),
+                                 value.dtype.str]}
+            self._offset += data.size
+            return description
+        if isinstance(value, numpy.ndarray):
+            value = value.tolist()
+        elif isinstance(value, numpy.generic):
+            value = value.item()
+        return {"v": value}
+
+    def save(self, filename):
+        dirname = os.path.dirname(os.path.abspath(filename))
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        if self._arrays:
+            data = numpy.concatenate(self._arrays)
+        else:
+            data = numpy.zeros((0,), dtype=numpy.float64)
+        index = json.dumps(self._index).encode("utf-8")
+        index = numpy.frombuffer(index, dtype=numpy.uint8)
+        # written next to the final file and renamed, so that concurrent
+        # processes never read an incomplete database
+        tmpname = filename + ".%d.tmp" % os.getpid()
+        try:
+            with open(tmpname, "wb") as f:
+                numpy.savez(f, index=index, data=data)
+            if hasattr(os, "replace"):
+                os.replace(tmpname, filename)
+            else:
+                if os.path.exists(filename):
+                    os.remove(filename)
+                os.rename(tmpname, filename)
+        finally:
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+
+
+class PhysicsDatabase(object):
+    """
+    Read access to a database written by buildDatabase. Only the index is
+    read when opening, the data are memory mapped.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        with numpy.load(filename) as npz:
+            self._index = json.loads(npz["index"].tobytes().decode("utf-8"))
+        with zipfile.ZipFile(filename) as zf:
+            info = zf.getinfo("data.npy")
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise IOError("Compressed physics database")
+        with open(filename, "rb") as f:
+            # local file header of the zip member
+            f.seek(info.header_offset)
+            header = f.read(30)
+            nname = numpy.frombuffer(header[26:28], dtype="<u2")[0]
+            nextra = numpy.frombuffer(header[28:30], dtype="<u2")[0]
+            f.seek(info.header_offset + 30 + nname + nextra)
+            major, minor = numpy.lib.format.read_magic(f)
+            if (major, minor) == (1, 0):
+                shape, fortran, dtype = \
+                    numpy.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran, dtype = \
+                    numpy.lib.format.read_array_header_2_0(f)
+            offset = f.tell()
+        if dtype != numpy.float64 or len(shape) != 1:
+            raise IOError("Invalid physics database")
+        if shape[0]:
+            self._data = numpy.memmap(filename, dtype=numpy.float64,
+                                      mode="r", offset=offset, shape=shape)
+        else:
+            self._data = numpy.zeros((0,), dtype=numpy.float64)
+        self._sources = {}
+        for name, stamp in self._index["sources"].items():
+            self._sources[stamp[0]] = name
+
+    def isValid(self):
+        """
+        :returns bool: True if the source files did not change
+        """
+        if self._index.get("version", None) != DATABASE_VERSION:
+            return False
+        if self._index.get("pymca", None) != _version():
+            return False
+        try:
+            for name, stamp in self._index["sources"].items():
+                if _stamp(stamp[0]) != stamp[:3]:
+                    return False
+        except OSError:
+            return False
+        return True
+
+    def sources(self):
+        """
+        :returns list: names of the tables
+        """
+        return list(self._index["sources"].keys())
+
+    def getTable(self, filename, ftype):
+        """
+        :param str filename: source file
+        :param str ftype: "spec", "dict" or "xcom"
+        :returns: table description or None if the file is not in the
+                  database
+        """
+        name = self._sources.get(os.path.abspath(filename), None)
+        if name is None:
+            return None
+        if self._index["sources"][name][3] != ftype:
+            return None
+        return self._index["tables"][name]
+
+    def decode(self, description):
+        """
+        :param dict description: see _DatabaseWriter.encode
+        :returns: new objects
+        """
+        if "a" in description:
+            offset, shape, dtype = description["a"]
+            size = int(numpy.prod(shape))
+            data = numpy.array(self._data[offset:offset + size],
+                               dtype=numpy.dtype(dtype))
+            data.shape = shape
+            return data
+        if "d" in description:
+            return dict((key, self.decode(item))
+                        for key, item in description["d"])
+        return description["v"]
+
+    def close(self):
+        self._data = None
+
+
+class LazyDict(dict):
+    """
+    Dictionary whose values are decoded from the database when accessed for
+    the first time.
+    """
+    def __init__(self, database, description):
+        dict.__init__(self)
+        self._database = database
+        self._encoded = {}
+        for key, item in description["d"]:
+            self._encoded[key] = item
+            dict.__setitem__(self, key, _MISSING)
+
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        if value is _MISSING:
+            value = self._database.decode(self._encoded[key])
+            dict.__setitem__(self, key, value)
+        return value
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def values(self):
+        return [self[key] for key in self]
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def pop(self, key, *args):
+        if key in self:
+            value = self[key]
+            dict.__delitem__(self, key)
+            return value
+        return dict.pop(self, key, *args)
+
+    def copy(self):
+        return dict(self.items())
+
+    def __eq__(self, other):
+        return dict(self.items()) == other
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+def benchmark(repeat=5):
+    """
+    Import time of the Elements module with and without database, each in
+    a new interpreter.
+
+    :param int repeat:
+    :returns dict: best import times in seconds
+    """
+    import subprocess
+    code = "import time; import numpy; t0 = time.time(); " \
+           "import PyMca5.PyMcaPhysics.xrf.Elements; " \
+           "print(time.time() - t0)"
+    result = {}
+    filename = getDatabaseFile()
+    for label, value in [("text", ""), ("database", filename)]:
+        if value is None:
+            continue
+        env = os.environ.copy()
+        env["PYMCA_PHYSICS_DATABASE"] = value
+        times = []
+        for i in range(repeat):
+            output = subprocess.check_output([sys.executable, "-c", code],
+                                             env=env)
+            times.append(float(output.decode().strip().split()[-1]))
+        result[label] = min(times)
+    return result
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description=
+                        "Build the binary database of the physics tables")
+    parser.add_argument("output", nargs="?", default=None,
+                        help="database file (default: %s in the PyMca "
+                             "data directory)" % DATABASE_NAME)
+    parser.add_argument("--build", action="store_true",
+                        help="parse the data files and write the database")
+    parser.add_argument("--user", action="store_true",
+                        help="write the database in the user settings "
+                             "directory")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="compare the import time of Elements "
+                             "with and without database")
+    args = parser.parse_args(argv)
+    if args.build:
+        filename = args.output
+        if filename is None:
+            if args.user:
+                filename = getUserDatabaseFile()
+            else:
+                filename = os.path.join(PyMcaDataDir.PYMCA_DATA_DIR,
+                                        DATABASE_NAME)
+        buildDatabase(filename)
+        print("Physics database written to %s" % filename)
+    if args.benchmark:
+        result = benchmark()
+        for label in ["text", "database"]:
+            if label in result:
+                print("Elements import time (%s): %.1f ms" %
+                      (label, 1000. * result[label]))
+    if not (args.build or args.benchmark):
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -33,9 +33,9 @@
 __doc__= "Interface to the PyMca EPDL97 description"
 import os
 import sys
-from PyMca5.PyMcaIO import specfile
 from PyMca5 import getDataFile
 import numpy
+from . import PhysicsDatabase
 log = numpy.log
 exp = numpy.exp
 ElementList = ['H', 'He',
@@ -72,12 +72,7 @@
 #fill the dictionnary with the binding energies
 def _initializeBindingEnergies():
     #read the specfile data
-    sf = specfile.Specfile(EADL97_FILE)
-    scan = sf[0]
-    labels = scan.alllabels()
-    data = scan.data()
-    scan = None
-    sf = None
+    labels, data = PhysicsDatabase.getSpecScan(EADL97_FILE, 0)
     i = -1
     for element in ElementList:
         if element == 'Md':
@@ -117,16 +112,12 @@ def _initializeElement(element):
     int the EPDL97 file into the internal dictionnary.
     """
     #read the specfile data
-    sf = specfile.Specfile(EPDL97_FILE)
     scan_index = ElementList.index(element)
     if scan_index > 99:
         #just to avoid a crash
         #I do not expect any fluorescent analysis of these elements ...
         scan_index = 99
-    scan = sf[scan_index]
-    labels = scan.alllabels()
-    data = scan.data()
-    scan = None
+    labels, data = PhysicsDatabase.getSpecScan(EPDL97_FILE, scan_index)
 
     #fill the information into the dictionnary
     i = -1
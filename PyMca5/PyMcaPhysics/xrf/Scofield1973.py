@@ -32,9 +32,8 @@
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
 import sys
 import os
-from PyMca5.PyMcaIO import ConfigDict
 from PyMca5 import getDataFile
+from . import PhysicsDatabase
 
-dict = ConfigDict.ConfigDict()
 dictfile = getDataFile("Scofield1973.dict")
-dict.read(dictfile)
+dict = PhysicsDatabase.getConfigDict(dictfile)
@@ -31,7 +31,8 @@
 
 The user can configure following parameters:
 
-  - PCA method (*Covariance, Expectation Max, Covariance Multiple Arrays*)
+  - PCA method (*Covariance, Expectation Max, Covariance Multiple Arrays,
+    Randomized SVD*)
   - Number of Principal Components
   - Spectral Binning
   - Spectral Regions
@@ -32,6 +32,7 @@
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
 import unittest
 import os
+import sys
 import numpy
 
 DEBUG = 0
@@ -295,6 +296,52 @@ def testMaterialCrossSectionsCalculation(self):
                     self.assertTrue((100.0 * abs(yTest-yRef)/yRef) < 0.01)
                 energyIndex += 1
 
+    def testCompiledMaterial(self):
+        Elements = self._elements
+        compounds = ["Fe2O3", "Pb", "Mylar"]
+        fractions = [0.3, 0.5, 0.2]
+        # energies in the grid, between grid points, at the Pb L3 edge
+        # and below 1 keV
+        energyList = [0.8, 1.5, 3.33, 10., 13.0352, 20.4, 30.6, 90.33]
+        material = Elements.CompiledMaterial(compounds, fractions)
+        self.assertEqual(material.massFractions,
+                         Elements.getMaterialMassFractions(compounds,
+                                                           fractions))
+        data = material.getMassAttenuationCoefficients(energyList)
+        for key in ['coherent', 'compton', 'photo', 'pair', 'total']:
+            self.assertEqual(len(data[key]), len(energyList))
+        # same as energy by energy
+        for i, energy in enumerate(energyList):
+            ddict = Elements.getMaterialMassAttenuationCoefficients(compounds,
+                                                                fractions,
+                                                                energy)
+            for key in ['coherent', 'compton', 'photo', 'pair', 'total']:
+                self.assertEqual(data[key][i], ddict[key][0])
+        # the element cross sections at grid points are the tabulated ones
+        xcom = Elements.getelementmassattcoef("Fe")
+        idx = numpy.nonzero((xcom['energy'] > 1.0) &
+                            (xcom['energy'] < 50.))[0]
+        # not at an absorption edge (repeated energy)
+        idx = [i for i in idx if xcom['energy'][i] not in \
+                        (xcom['energy'][i-1], xcom['energy'][i+1])]
+        ddict = Elements.getelementmassattcoef("Fe", xcom['energy'][idx])
+        for key in ['coherent', 'compton', 'photo', 'pair']:
+            self.assertTrue(numpy.array_equal(ddict[key], xcom[key][idx]))
+
+        # several materials at once
+        materialList = [material, "Water", "Fe2O3"]
+        mu = Elements.getMaterialsMassAttenuationCoefficients(materialList,
+                                                              energyList)
+        self.assertEqual(mu.shape, (3, len(energyList)))
+        self.assertTrue(numpy.array_equal(mu[0], data['total']))
+        for i, name in enumerate(["Water", "Fe2O3"]):
+            ddict = Elements.getMaterialMassAttenuationCoefficients(name,
+                                                    1.0, energyList)
+            self.assertTrue(numpy.array_equal(mu[i + 1], ddict['total']))
+        mu = Elements.getMaterialsMassAttenuationCoefficients(materialList,
+                                                energyList, key='photo')
+        self.assertTrue(numpy.array_equal(mu[0], data['photo']))
+
     def testMaterialCompositionCalculation(self):
         if DEBUG:
             print()
@@ -309,6 +356,148 @@ def testMaterialCompositionCalculation(self):
             self.assertTrue(abs(c1[key] - c2[key]) < 1.0e-7,
                             "Inconsistent calculation for element %s" % key)
 
+    def testElementRateTable(self):
+        import copy
+        import threading
+        Elements = self._elements
+        # reference: the global dictionary after an update
+        energy = 12.5
+        Elements.updateDict(energy=energy, cb=False)
+        try:
+            reference = copy.deepcopy(Elements.Element["Pb"])
+        finally:
+            Elements.updateDict(cb=False)
+        table = Elements.getElementRateTable("Pb", energy=energy)
+        self.assertEqual(table["buildparameters"]["energy"], energy)
+        self.assertEqual(list(table["rays"]), reference["rays"])
+        for rays in reference["rays"]:
+            self.assertEqual(list(table[rays]), reference[rays])
+            for transition in reference[rays]:
+                self.assertEqual(table[transition], reference[transition])
+
+        # the global dictionary is not modified
+        self.assertTrue(Elements.Element["Pb"]["buildparameters"]["energy"]\
+                        is None)
+
+        # cached and read-only
+        self.assertTrue(Elements.getElementRateTable("pb", energy=12.5) is \
+                        table)
+        self.assertRaises(TypeError, table.__setitem__, "rays", [])
+        self.assertRaises(TypeError, table["rays"].append, "K xrays")
+        self.assertRaises(TypeError, table["L3M5"].update, {"rate": 0.0})
+        modified = copy.deepcopy(table)
+        modified["L3M5"]["rate"] = 0.0
+        self.assertTrue(table["L3M5"]["rate"] > 0.0)
+
+        # concurrent use
+        energies = [10.0 + 0.5 * i for i in range(20)]
+        errors = []
+        def worker():
+            try:
+                for e in energies:
+                    t = Elements.getElementRateTable("Pb", energy=e)
+                    if t["buildparameters"]["energy"] != e:
+                        errors.append(e)
+            except:
+                errors.append(sys.exc_info()[1])
+        threads = [threading.Thread(target=worker) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def testPhysicsDatabase(self):
+        import shutil
+        import tempfile
+        from PyMca5 import getDataFile
+        from PyMca5.PyMcaPhysics.xrf import PhysicsDatabase
+        tmpDir = tempfile.mkdtemp(prefix="pymca_physics_")
+        try:
+            filename = os.path.join(tmpDir, "physics.npz")
+            PhysicsDatabase.buildDatabase(filename)
+            database = PhysicsDatabase.openDatabase(filename, build=False)
+            self.assertTrue(database is not None)
+            self.assertTrue(database.isValid())
+
+            # SPEC files
+            specFile = getDataFile("EPDL97_CrossSections.dat")
+            table = database.getTable(specFile, "spec")
+            for i in [0, 25, 81]:
+                labels, data = PhysicsDatabase.readSpecScanText(specFile, i)
+                self.assertEqual(table[i]["labels"], labels)
+                decoded = database.decode(table[i]["data"])
+                self.assertEqual(decoded.dtype, data.dtype)
+                self.assertTrue(numpy.array_equal(decoded, data))
+
+            # ConfigDict files decoded on access
+            dictFile = getDataFile("Scofield1973.dict")
+            reference = PhysicsDatabase.readConfigDictText(dictFile)
+            lazy = PhysicsDatabase.LazyDict(database,
+                                      database.getTable(dictFile, "dict"))
+            self.assertEqual(list(lazy.keys()), list(reference.keys()))
+            self.assertTrue(dict.__getitem__(lazy, "Fe") is \
+                            PhysicsDatabase._MISSING)
+            for key, value in reference["Fe"].items():
+                if isinstance(value, numpy.ndarray):
+                    self.assertTrue(numpy.array_equal(lazy["Fe"][key],
+                                                      value))
+                else:
+                    self.assertEqual(lazy["Fe"][key], value)
+            self.assertTrue(lazy.get("Fe") is lazy["Fe"])
+
+            # XCOM files
+            xcomFile = PhysicsDatabase.getAttDataFile("Pb.mat")
+            reference = PhysicsDatabase.readXCOMFileText(xcomFile)
+            xcom = database.decode(database.getTable(xcomFile, "xcom"))
+            self.assertEqual(sorted(xcom.keys()), sorted(reference.keys()))
+            for key in reference:
+                self.assertTrue(numpy.array_equal(xcom[key], reference[key]))
+            # new arrays on each call
+            xcom["energy"][0] = -1.0
+            xcom = database.decode(database.getTable(xcomFile, "xcom"))
+            self.assertEqual(xcom["energy"][0], reference["energy"][0])
+
+            # files not in the database
+            self.assertTrue(database.getTable(filename, "spec") is None)
+            self.assertTrue(database.getTable(dictFile, "spec") is None)
+            database.close()
+
+            # outdated database
+            database = PhysicsDatabase.PhysicsDatabase(filename)
+            database._index["pymca"] = "0.0.0"
+            self.assertFalse(database.isValid())
+            database.close()
+
+            # a missing database is not built on use, the text files are
+            # parsed instead
+            missing = os.path.join(tmpDir, "missing.npz")
+            oldValue = os.environ.get("PYMCA_PHYSICS_DATABASE", None)
+            os.environ["PYMCA_PHYSICS_DATABASE"] = missing
+            PhysicsDatabase.resetDatabase()
+            try:
+                self.assertTrue(PhysicsDatabase.getDatabase() is None)
+                labels, data = PhysicsDatabase.getSpecScan(specFile, 25)
+                reference = PhysicsDatabase.readSpecScanText(specFile, 25)
+                self.assertEqual(labels, reference[0])
+                self.assertTrue(numpy.array_equal(data, reference[1]))
+                self.assertFalse(os.path.exists(missing))
+            finally:
+                if oldValue is None:
+                    del os.environ["PYMCA_PHYSICS_DATABASE"]
+                else:
+                    os.environ["PYMCA_PHYSICS_DATABASE"] = oldValue
+                PhysicsDatabase.resetDatabase()
+
+            # explicit build
+            PhysicsDatabase.main(["--build", missing])
+            database = PhysicsDatabase.openDatabase(missing)
+            self.assertTrue(database is not None)
+            self.assertTrue(database.isValid())
+            database.close()
+        finally:
+            shutil.rmtree(tmpDir)
+
 def getSuite(auto=True):
     testSuite = unittest.TestSuite()
     if auto:
@@ -320,7 +509,10 @@ def getSuite(auto=True):
         testSuite.addTest(testElements("testElementCrossSectionsReadout"))
         testSuite.addTest(testElements("testElementCrossSectionsCalculation"))
         testSuite.addTest(testElements("testMaterialCrossSectionsCalculation"))
+        testSuite.addTest(testElements("testCompiledMaterial"))
         testSuite.addTest(testElements("testMaterialCompositionCalculation"))
+        testSuite.addTest(testElements("testElementRateTable"))
+        testSuite.addTest(testElements("testPhysicsDatabase"))
     return testSuite
 
 def test(auto=False):
@@ -0,0 +1,254 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2019 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "Wout De Nolf"
+__contact__ = "wout.de_nolf@esrf.eu"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+import unittest
+import tempfile
+import shutil
+import os
+import numpy
+try:
+    import h5py
+except ImportError:
+    h5py = None
+try:
+    from PyMca5 import PyMcaDataDir
+    from PyMca5.PyMcaIO import specfilewrapper as specfile
+    from PyMca5.PyMcaIO import ConfigDict
+    from PyMca5.PyMcaPhysics.xrf import FastXRFLinearFit
+    from PyMca5.PyMcaPhysics.xrf import FastXRFNonLinearFit
+    from PyMca5.PyMcaPhysics.xrf import ClassMcaTheory
+except ImportError:
+    FastXRFLinearFit = None
+
+
+class testFastXRFLinearFit(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='pymca')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _steelStack(self, shape):
+        dataDir = PyMcaDataDir.PYMCA_DATA_DIR
+        sf = specfile.Specfile(os.path.join(dataDir, "Steel.spe"))
+        counts = sf[0].mca(1)
+        sf = None
+        configuration = ConfigDict.ConfigDict()
+        configuration.read(os.path.join(dataDir, "Steel.cfg"))
+        configuration['fit']['stripalgorithm'] = 1
+        configuration["concentrations"]["usematrix"] = 0
+        configuration["concentrations"]["useautotime"] = 0
+        numpy.random.seed(0)
+        scale = numpy.random.uniform(0.1, 2, size=shape+(1,))
+        data = numpy.random.poisson(counts * scale).astype(numpy.float32)
+        return data, configuration
+
+    def _fit(self, data, configuration, chunkMemory=None, **kwargs):
+        ffit = FastXRFLinearFit.FastXRFLinearFit()
+        ffit.chunkMemory = chunkMemory
+        kwargs.setdefault('weight', 0)
+        kwargs.setdefault('refit', 1)
+        outbuffer = ffit.fitMultipleSpectra(y=data,
+                                            configuration=configuration,
+                                            concentrations=True,
+                                            **kwargs)
+        return {key: outbuffer[key] for key in
+                ['parameters', 'uncertainties', 'massfractions']}
+
+    @unittest.skipIf(FastXRFLinearFit is None,
+                     'PyMca5.PyMcaPhysics.xrf.FastXRFLinearFit cannot be imported')
+    def testParallelFit(self):
+        # Several chunks of spectra are needed
+        data, configuration = self._steelStack(shape=(20, 31))
+        expected = self._fit(data, configuration, chunkMemory=1024**2)
+        for nWorkers, useProcesses in [(3, False), (2, True)]:
+            result = self._fit(data, configuration, chunkMemory=1024**2,
+                               nWorkers=nWorkers,
+                               useProcesses=useProcesses)
+            for key, values in expected.items():
+                numpy.testing.assert_array_equal(values, result[key],
+                                                 err_msg=key)
+
+    @unittest.skipIf(FastXRFLinearFit is None,
+                     'PyMca5.PyMcaPhysics.xrf.FastXRFLinearFit cannot be imported')
+    @unittest.skipIf(h5py is None,
+                     'h5py cannot be imported')
+    def testStorageChunks(self):
+        # Fit chunks are aligned with the storage chunks
+        data, configuration = self._steelStack(shape=(10, 13))
+        expected = self._fit(data, configuration)
+        filename = os.path.join(self.path, 'testStorageChunks.h5')
+        with h5py.File(filename, mode='a') as f:
+            dset = f.create_dataset('data', data=data,
+                                    chunks=(3, 4, data.shape[-1]//2),
+                                    compression='gzip')
+            for chunkMemory in [None, 1024**2]:
+                result = self._fit(dset, configuration,
+                                   chunkMemory=chunkMemory)
+                for key, values in expected.items():
+                    numpy.testing.assert_array_equal(values, result[key],
+                                                     err_msg=key)
+
+    @unittest.skipIf(FastXRFLinearFit is None,
+                     'PyMca5.PyMcaPhysics.xrf.FastXRFLinearFit cannot be imported')
+    def testRefitCache(self):
+        data, configuration = self._steelStack(shape=(10, 13))
+        expected = self._fit(data, configuration, refitCache=False)
+        for refitCache in [True, 'memory', 'file']:
+            result = self._fit(data, configuration, refitCache=refitCache)
+            for key, values in expected.items():
+                numpy.testing.assert_array_equal(values, result[key],
+                                                 err_msg=key)
+        with self.assertRaises(ValueError):
+            self._fit(data, configuration, refitCache='unknown')
+
+    @unittest.skipIf(FastXRFLinearFit is None,
+                     'PyMca5.PyMcaPhysics.xrf.FastXRFLinearFit cannot be imported')
+    def testNonNegative(self):
+        data, configuration = self._steelStack(shape=(10, 13))
+        for weight in [0, 2]:
+            result = self._fit(data, configuration, nonNegative=True,
+                               refit=0, weight=weight)
+            self.assertTrue((result['parameters'] >= 0).all())
+        # Only one peak area is negative (As K) so removing it from
+        # the model gives the non-negative least-squares solution
+        expected = self._fit(data, configuration, refit=1, weight=0)
+        result = self._fit(data, configuration, nonNegative=True, weight=0)
+        for key, values in expected.items():
+            numpy.testing.assert_allclose(values, result[key],
+                                          rtol=1e-5, err_msg=key)
+
+    @unittest.skipIf(FastXRFLinearFit is None,
+                     'PyMca5.PyMcaPhysics.xrf.FastXRFLinearFit cannot be imported')
+    def testModelCache(self):
+        data, configuration = self._steelStack(shape=(5, 6))
+        cacheDir = os.path.join(self.path, 'cache')
+
+        def notConfigured(*args, **kwargs):
+            raise RuntimeError("The fit should not be configured")
+
+        results = []
+        for i in range(3):
+            ffit = FastXRFLinearFit.FastXRFLinearFit()
+            if i:
+                ffit.modelCache = FastXRFLinearFit.ModelCache(cacheDir)
+            if i == 2:
+                # Cached model: no need to configure the fit
+                ffit._mcaTheory.setConfiguration = notConfigured
+            outbuffer = ffit.fitMultipleSpectra(y=data,
+                                                configuration=configuration,
+                                                weight=0, refit=1)
+            results.append(outbuffer)
+        self.assertEqual(len(os.listdir(cacheDir)), 1)
+        for outbuffer in results[1:]:
+            self.assertEqual(outbuffer['parameter_names'],
+                             results[0]['parameter_names'])
+            for key in ['parameters', 'uncertainties']:
+                numpy.testing.assert_array_equal(outbuffer[key],
+                                                 results[0][key],
+                                                 err_msg=key)
+
+        # A cached model does not replace a missing configuration
+        ffit = FastXRFLinearFit.FastXRFLinearFit()
+        ffit.modelCache = FastXRFLinearFit.ModelCache(cacheDir)
+        self.assertRaises(ValueError, ffit.fitMultipleSpectra,
+                          y=data, weight=0, refit=1)
+
+        # Another model evicts the least recently used one
+        modelCache = FastXRFLinearFit.ModelCache(cacheDir, maxSize=1)
+        ffit = FastXRFLinearFit.FastXRFLinearFit()
+        ffit.modelCache = modelCache
+        ffit.fitMultipleSpectra(y=data, configuration=configuration,
+                                weight=0, refit=1, xmax=1000)
+        self.assertEqual(len(os.listdir(cacheDir)), 1)
+        key = modelCache.key(configuration=configuration)
+        self.assertEqual(key, modelCache.key(configuration=configuration))
+        self.assertIsNone(modelCache.load(key))
+        modelCache.clear()
+        self.assertEqual(os.listdir(cacheDir), [])
+
+    @unittest.skipIf(FastXRFLinearFit is None,
+                     'PyMca5.PyMcaPhysics.xrf.FastXRFLinearFit cannot be imported')
+    def testNonLinearFit(self):
+        data, configuration = self._steelStack(shape=(2, 3))
+        configuration['fit']['linearfitflag'] = 0
+        configuration['fit']['fitweight'] = 0
+        ffit = FastXRFNonLinearFit.FastXRFNonLinearFit()
+        ffit.chunkMemory = 1024**2
+        outbuffer = ffit.fitMultipleSpectra(y=data,
+                                            configuration=configuration)
+        names = outbuffer['parameter_names']
+        parameters = outbuffer['parameters']
+        chisq = outbuffer['chisq']
+        self.assertTrue((outbuffer['nIterations'] > 0).all())
+
+        # Same results as fitting the spectra one by one
+        mcafit = ClassMcaTheory.McaTheory()
+        mcafit.setConfiguration(configuration)
+        for idx in numpy.ndindex(data.shape[:-1]):
+            mcafit.setData(y=data[idx])
+            mcafit.estimate()
+            mcafit.startfit(digest=0)
+            for i, name in enumerate(names):
+                j = mcafit.PARAMETERS.index(name)
+                if j >= mcafit.NGLOBAL or \
+                   name in ['Zero', 'Gain', 'Noise', 'Fano']:
+                    numpy.testing.assert_allclose(parameters[(i,)+idx],
+                                                  mcafit.fittedpar[j],
+                                                  rtol=1e-2, err_msg=name)
+            numpy.testing.assert_allclose(chisq[idx], mcafit.chisq,
+                                          rtol=1e-2)
+
+
+def getSuite(auto=True):
+    testSuite = unittest.TestSuite()
+    if auto:
+        testSuite.addTest(
+            unittest.TestLoader().loadTestsFromTestCase(testFastXRFLinearFit))
+    else:
+        # use a predefined order
+        testSuite.addTest(testFastXRFLinearFit('testParallelFit'))
+        testSuite.addTest(testFastXRFLinearFit('testStorageChunks'))
+        testSuite.addTest(testFastXRFLinearFit('testRefitCache'))
+        testSuite.addTest(testFastXRFLinearFit('testNonNegative'))
+        testSuite.addTest(testFastXRFLinearFit('testModelCache'))
+        testSuite.addTest(testFastXRFLinearFit('testNonLinearFit'))
+    return testSuite
+
+
+def test(auto=False):
+    unittest.TextTestRunner(verbosity=2).run(getSuite(auto=auto))
+
+
+if __name__ == '__main__':
+    test()
@@ -70,6 +70,72 @@ def testGefitLeastSquares(self):
         for i in range(len(originalParameters)):
             self.assertTrue(abs(fittedpar[i] - originalParameters[i]) < 0.01)
 
+    def gaussianPlusLinearBackgroundJacobian(self, param, indices, t):
+        # numerical derivatives of all the spectra
+        result = numpy.zeros((param.shape[0], len(indices), t.size))
+        for k, index in enumerate(indices):
+            delta = (param[:, index] + (param[:, index] == 0)) * 1.0e-5
+            p1 = param.copy()
+            p1[:, index] += delta
+            p2 = param.copy()
+            p2[:, index] -= delta
+            for i in range(param.shape[0]):
+                result[i, k] = (self.gaussianPlusLinearBackground(p1[i], t) -
+                                self.gaussianPlusLinearBackground(p2[i], t)) \
+                               / (2.0 * delta[i])
+        return result
+
+    def testGefitMultipleLeastSquares(self):
+        self.testGefitImport()
+        x = numpy.arange(500.)
+        originalParameters = numpy.array([[10.5, 2, 1000.0, 200., 100],
+                                          [5.0, 1, 500.0, 250., 80],
+                                          [20.0, 0.5, 2000.0, 180., 120]],
+                                         numpy.float)
+        fitFunction = self.gaussianPlusLinearBackground
+        def model(param, t):
+            return numpy.array([fitFunction(p, t) for p in param])
+        y = model(originalParameters, x)
+        numpy.random.seed(0)
+        y = numpy.random.poisson(y).astype(numpy.float)
+        startingParameters = numpy.array([[0.0, 1.0, 900.0, 190., 90]] * 3)
+        constrains = [[self.gefit.CFREE, self.gefit.CFREE,
+                       self.gefit.CPOSITIVE, self.gefit.CQUOTED,
+                       self.gefit.CFREE],
+                      [0, 0, 0, 150., 0],
+                      [0, 0, 0, 300., 0]]
+        fittedpar, chisq, sigmapar, niter, lastdeltachi = \
+                    self.gefit.MultipleLeastSquaresFit(model,
+                            startingParameters, x, y,
+                            constrains=constrains, weightflag=1,
+                            model_jacobian=self.gaussianPlusLinearBackgroundJacobian,
+                            deltachi=1.0e-6)
+        self.assertEqual(fittedpar.shape, originalParameters.shape)
+        self.assertEqual(sigmapar.shape, originalParameters.shape)
+        self.assertEqual(chisq.shape, (3,))
+        # the same as fitting one spectrum after the other
+        for i in range(3):
+            result = self.gefit.LeastSquaresFit(fitFunction,
+                                                startingParameters[i],
+                                                xdata=x, ydata=y[i],
+                                                constrains=constrains,
+                                                weightflag=1,
+                                                deltachi=1.0e-6,
+                                                fulloutput=1)
+            for j in range(originalParameters.shape[1]):
+                delta = abs(fittedpar[i, j] - result[0][j])
+                self.assertTrue(delta < 1.0e-3 * max(abs(result[0][j]), 1.0),
+                                "Spectrum %d parameter %d: %f != %f" % \
+                                (i, j, fittedpar[i, j], result[0][j]))
+                if constrains[0][j] == self.gefit.CQUOTED:
+                    # getsigmaparameters takes the cosine of the parameter
+                    # instead of the one of its transformed value
+                    continue
+                delta = abs(sigmapar[i, j] - result[2][j])
+                self.assertTrue(delta < 0.01 * result[2][j])
+            self.assertTrue(abs(chisq[i] - result[1]) < 0.01 * result[1])
+            self.assertTrue(chisq[i] < 1.5)
+
 def getSuite(auto=True):
     testSuite = unittest.TestSuite()
     if auto:
@@ -79,6 +145,7 @@ def getSuite(auto=True):
         # use a predefined order
         testSuite.addTest(testGefit("testGefitImport"))
         testSuite.addTest(testGefit("testGefitLeastSquares"))
+        testSuite.addTest(testGefit("testGefitMultipleLeastSquares"))
     return testSuite
 
 def test(auto=False):
@@ -0,0 +1,177 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2004-2019 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V. Armando Sole - ESRF Data Analysis"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+import unittest
+import itertools
+import numpy
+
+class testLinalg(unittest.TestCase):
+    def setUp(self):
+        """
+        import the module
+        """
+        try:
+            from PyMca5.PyMcaMath import linalg
+            self.linalg = linalg
+        except:
+            self.linalg = None
+
+    def testLinalgImport(self):
+        self.assertTrue(self.linalg is not None)
+
+    def bruteForceNnls(self, a, b, free):
+        # try all subsets of non-zero parameters
+        n = a.shape[1]
+        best = None
+        for nPassive in range(n + 1):
+            for passive in itertools.combinations(range(n), nPassive):
+                if not set(free).issubset(passive):
+                    continue
+                x = numpy.zeros(n)
+                if passive:
+                    passive = list(passive)
+                    x[passive] = numpy.linalg.lstsq(a[:, passive], b,
+                                                    rcond=None)[0]
+                if (numpy.delete(x, free) < 0).any():
+                    continue
+                chisq = ((numpy.dot(a, x) - b)**2).sum()
+                if best is None or chisq < best[0]:
+                    best = chisq, x
+        return best[1]
+
+    def testLinalgNnls(self):
+        self.testLinalgImport()
+        numpy.random.seed(0)
+        m, n, k = 40, 5, 30
+        a = numpy.random.uniform(size=(m, n))
+        x = numpy.random.normal(size=(n, k))
+        b = numpy.dot(a, x) + numpy.random.normal(size=(m, k)) * 0.1
+        for free in [[], [0, 3]]:
+            # no weights
+            ddict = self.linalg.nnls(a, b, free=free, digested_output=True)
+            for i in range(k):
+                expected = self.bruteForceNnls(a, b[:, i], free)
+                numpy.testing.assert_allclose(ddict['parameters'][:, i],
+                                              expected, atol=1e-10)
+            nfree = (ddict['parameters'] != 0).sum(axis=0)
+            numpy.testing.assert_array_equal(ddict['nfree'], nfree)
+            # the SVD can be reused
+            result = self.linalg.nnls(a, b, free=free,
+                                      last_svd=ddict['svd'])
+            numpy.testing.assert_array_equal(result[0], ddict['parameters'])
+            # individual weights
+            c = numpy.abs(b) + 1
+            parameters, uncertainties = self.linalg.nnls(a, c, free=free,
+                                                         weight=1)
+            for i in range(k):
+                w = numpy.sqrt(c[:, i])
+                expected = self.bruteForceNnls(a / w[:, numpy.newaxis],
+                                               c[:, i] / w, free)
+                numpy.testing.assert_allclose(parameters[:, i],
+                                              expected, atol=1e-10)
+            self.assertTrue((uncertainties[parameters == 0] == 0).all())
+            self.assertTrue((uncertainties[parameters != 0] > 0).all())
+
+    def testLinalgIndividualWeights(self):
+        self.testLinalgImport()
+        numpy.random.seed(0)
+        m, n, k = 100, 6, 50
+        a = numpy.random.uniform(size=(m, n)) * numpy.logspace(0, 4, n)
+        x = numpy.random.uniform(1, 10, size=(n, k))
+        b = numpy.random.poisson(numpy.dot(a, x)).astype(numpy.float64)
+        for svd in [True, False]:
+            parameters, uncertainties, covariances = \
+                self.linalg.lstsq(a, b, weight=1, svd=svd, covariances=True)
+            self.assertEqual(covariances.shape, (k, n, n))
+            for i in range(k):
+                w = numpy.sqrt(b[:, i])
+                w[w == 0] = 1
+                U, s, V = numpy.linalg.svd(a / w[:, numpy.newaxis],
+                                           full_matrices=False)
+                expected = numpy.dot(V.T / s, numpy.dot(U.T, b[:, i] / w))
+                covariance = numpy.dot(V.T / (s * s), V)
+                numpy.testing.assert_allclose(parameters[:, i],
+                                              expected, rtol=1e-8)
+                numpy.testing.assert_allclose(covariances[i],
+                                              covariance, rtol=1e-6,
+                                              atol=1e-12)
+                numpy.testing.assert_allclose(uncertainties[:, i],
+                                              numpy.sqrt(numpy.diag(covariance)),
+                                              rtol=1e-8)
+            # one single column
+            result = self.linalg.lstsq(a, b[:, 0], weight=1, svd=svd)
+            numpy.testing.assert_allclose(result[0], parameters[:, 0])
+            numpy.testing.assert_allclose(result[1], uncertainties[:, 0])
+
+    def testLinalgSinglePrecision(self):
+        self.testLinalgImport()
+        numpy.random.seed(0)
+        m, n, k = 1000, 6, 50
+        a = numpy.random.uniform(size=(m, n)) * numpy.logspace(0, 4, n)
+        x = numpy.random.uniform(1, 10, size=(n, k))
+        b = numpy.random.poisson(numpy.dot(a, x)).astype(numpy.float32)
+        for weight in [0, 1]:
+            expected = self.linalg.lstsq(a, b, weight=weight,
+                                         digested_output=True)
+            result = self.linalg.lstsq(a, b, weight=weight,
+                                       digested_output=True,
+                                       dtype=numpy.float32)
+            # parameters and uncertainties are given in double precision
+            for key in ['parameters', 'uncertainties']:
+                self.assertEqual(result[key].dtype, numpy.float64)
+            # the rounding errors depend on the largest values
+            atol = 1e-3 * numpy.abs(expected['parameters']).max()
+            numpy.testing.assert_allclose(result['parameters'],
+                                          expected['parameters'],
+                                          rtol=1e-4, atol=atol)
+            numpy.testing.assert_allclose(result['uncertainties'],
+                                          expected['uncertainties'],
+                                          rtol=1e-5)
+
+def getSuite(auto=True):
+    testSuite = unittest.TestSuite()
+    if auto:
+        testSuite.addTest(\
+            unittest.TestLoader().loadTestsFromTestCase(testLinalg))
+    else:
+        # use a predefined order
+        testSuite.addTest(testLinalg("testLinalgImport"))
+        testSuite.addTest(testLinalg("testLinalgNnls"))
+        testSuite.addTest(testLinalg("testLinalgIndividualWeights"))
+        testSuite.addTest(testLinalg("testLinalgSinglePrecision"))
+    return testSuite
+
+def test(auto=False):
+    unittest.TextTestRunner(verbosity=2).run(getSuite(auto=auto))
+
+if __name__ == '__main__':
+    test()
@@ -113,6 +113,34 @@ def testfullChunkIndex(self):
                     lst2 = list(range(1, i+1))
                     self.assertEqual(lst1, lst2)
 
+    @unittest.skipIf(McaStackView is None,
+                     'PyMca5.PyMcaPhysics.xrf.McaStackView cannot be imported')
+    def testAlignedChunkIndex(self):
+        shape = (7, 10, 5)
+        chunkAlign = (2, 3, 5)
+        data = numpy.zeros(shape, dtype=int)
+        for nChunksMax in range(1, numpy.prod(shape[:-1])+2):
+            data[()] = 0
+            result = McaStackView.fullChunkIndex(shape, nChunksMax,
+                                                 chunkAxes=(-1,),
+                                                 chunkAlign=chunkAlign)
+            chunkIndex, chunkAxes, axesOrder, nChunksMax2 = result
+            it = McaStackView.chunkIndexProduct(chunkIndex,
+                                                chunkAxes,
+                                                axesOrder)
+            for i, (idxChunk, idxShape, nChunks) in enumerate(it, 1):
+                data[idxChunk] += i
+                self.assertTrue(nChunks <= nChunksMax2)
+                # Chunk boundaries are storage chunk boundaries
+                for axis in axesOrder:
+                    start, stop, _ = idxChunk[axis].indices(shape[axis])
+                    self.assertEqual(start % chunkAlign[axis], 0)
+                    if stop != shape[axis]:
+                        self.assertEqual(stop % chunkAlign[axis], 0)
+            # Verify data coverage and single element access:
+            lst1 = numpy.unique(data).tolist()
+            self.assertEqual(lst1, list(range(1, i+1)))
+
     def _chunkIndexAxes(self, shape, ndim):
         axes = set(range(ndim))
         for ndimChunk in range(ndim+1):
@@ -244,6 +272,37 @@ def testMaskedViewH5py(self):
                 f.create_dataset(name, data=data, chunks=(1,)*ndim)
                 self._assertMaskedView(f[name])
 
+    @unittest.skipIf(McaStackView is None,
+                     'PyMca5.PyMcaPhysics.xrf.McaStackView cannot be imported')
+    def testPrefetchItems(self):
+        data = numpy.random.uniform(size=(10, 4))
+        buffers = [numpy.empty((3, 4)) for i in range(4)]
+        chunks = [(i, (slice(i, i+3), 3)) for i in range(0, 9, 3)]
+
+        def read(value, idx, n):
+            value[()] = data[idx]
+
+        def write(value, idx, n):
+            data[idx] = value
+
+        def readError(value, idx, n):
+            raise RuntimeError('read')
+
+        # Stop iterating early
+        for key, value in McaStackView.prefetchItems(chunks, buffers, read,
+                                                      write=write):
+            numpy.testing.assert_array_equal(value, data[key:key+3])
+            value[()] = -1
+            if key == 3:
+                break
+        self.assertTrue((data[:3] == -1).all())
+        self.assertFalse((data[3:] == -1).any())
+        # Errors are raised by the consumer
+        with self.assertRaises(RuntimeError):
+            for key, value in McaStackView.prefetchItems(chunks, buffers,
+                                                          readError):
+                pass
+
     def _assertFullView(self, data):
         mcaSlice = slice(2, -1)
         for nMca in range(numpy.prod(data.shape[1:])+2):
@@ -260,10 +319,12 @@ def _assertFullView(self, data):
                                                 mcaSlice=mcaSlice,
                                                 nMca=nMca)
                 idxFull = dataView.idxFull
-                for readonly in [True, False]:
+                it = itertools.product([True, False], [0, 2])
+                for readonly, nPrefetch in it:
                     dataView.readonly = readonly
                     dataOrg = numpy.copy(data)
-                    iters = dataView.items(), addView.items()
+                    iters = dataView.items(nPrefetch=nPrefetch),\
+                            addView.items(nPrefetch=nPrefetch)
                     chunks = McaStackView.izipChunkItems(*iters)
                     for (key, chunk), (addKey, add) in chunks:
                         chunk += add
@@ -298,10 +359,12 @@ def _assertMaskedView(self, data):
                                                 mcaSlice=mcaSlice,
                                                 nMca=nMca)
                 idxFull = dataView.idxFull
-                for readonly in [True, False]:
+                it = itertools.product([True, False], [0, 2])
+                for readonly, nPrefetch in it:
                     dataView.readonly = readonly
                     dataOrg = numpy.copy(data)
-                    iters = dataView.items(), addView.items()
+                    iters = dataView.items(nPrefetch=nPrefetch),\
+                            addView.items(nPrefetch=nPrefetch)
                     chunks = McaStackView.izipChunkItems(*iters)
                     for (key, chunk), (addKey, add) in chunks:
                         chunk += add
@@ -335,11 +398,13 @@ def getSuite(auto=True):
         # use a predefined order
         testSuite.addTest(testMcaStackView('testViewUtils'))
         testSuite.addTest(testMcaStackView('testfullChunkIndex'))
+        testSuite.addTest(testMcaStackView('testAlignedChunkIndex'))
         testSuite.addTest(testMcaStackView('testFullViewNumpy'))
         testSuite.addTest(testMcaStackView('testFullViewH5py'))
         testSuite.addTest(testMcaStackView('testMaskedChunkIndex'))
         testSuite.addTest(testMcaStackView('testMaskedViewNumpy'))
         testSuite.addTest(testMcaStackView('testMaskedViewH5py'))
+        testSuite.addTest(testMcaStackView('testPrefetchItems'))
     return testSuite
 
 
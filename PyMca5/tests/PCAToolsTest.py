@@ -30,6 +30,9 @@
 __contact__ = "sole@esrf.fr"
 __license__ = "MIT"
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+import os
+import shutil
+import tempfile
 import unittest
 import numpy
 import numpy.linalg
@@ -41,6 +44,12 @@
     MDP = False
 
 class testPCATools(unittest.TestCase):
+    def setUp(self):
+        self.path = None
+
+    def tearDown(self):
+        if self.path is not None:
+            shutil.rmtree(self.path, ignore_errors=True)
     def testPCAToolsImport(self):
         from PyMca5.PyMcaMath.mva import PCATools
 
@@ -131,6 +140,93 @@ def testPCAToolsPCA(self):
             self.assertTrue(numpy.allclose(eigenvalues, numpyEigenvalues))
             self.assertTrue(numpy.allclose(eigenvectors, numpyEigenvectors))
 
+    def testPCAToolsRandomized(self):
+        from PyMca5.PyMcaMath.mva.PCATools import numpyPCA, randomizedPCA
+        # stack of 12 x 15 spectra of 64 channels from 4 components
+        nRows, nColumns, nChannels = 12, 15, 64
+        randomState = numpy.random.RandomState(10)
+        channels = numpy.arange(nChannels)
+        components = numpy.array([numpy.exp(-0.5 * ((channels - c) / 4.)**2)
+                                  for c in [10, 25, 40, 52]])
+        weights = randomState.uniform(0, 100,
+                                      (nRows * nColumns, components.shape[0]))
+        x = numpy.dot(weights, components)
+        x += randomState.normal(0, 0.1, x.shape)
+        x.shape = nRows, nColumns, nChannels
+        mask = numpy.ones((nRows, nColumns), numpy.uint8)
+        mask[2, 3:7] = 0
+        spectral_mask = numpy.ones((nChannels,), numpy.float64)
+        spectral_mask[55:] = 0
+
+        def check(result, reference):
+            self.assertEqual(result["pixels"], reference["pixels"])
+            self.assertTrue(numpy.allclose(result["variance"],
+                                           reference["variance"]))
+            self.assertTrue(numpy.allclose(result["eigenvalues"],
+                                           reference["eigenvalues"],
+                                           rtol=1.0e-4))
+            for i in range(result["eigenvectors"].shape[0]):
+                # the eigenvectors can be multiplied by -1
+                v = result["eigenvectors"][i]
+                vref = reference["eigenvectors"][i]
+                if numpy.dot(v, vref) < 0:
+                    v = -v
+                self.assertTrue(numpy.allclose(v, vref, atol=1.0e-4))
+
+        kw = {"ncomponents": 4, "center": True, "scale": False,
+              "legacy": False}
+        for binning in [1, 2]:
+            # reference calculated with numpy
+            spectra = x.reshape(-1, nChannels)[mask.reshape(-1) > 0]
+            spectra = spectra[:, ::binning] * spectral_mask[::binning]
+            cov = numpy.cov(spectra.T)
+            evalues, evectors = numpy.linalg.eigh(cov)
+            reference = {"pixels": spectra.shape[0],
+                         "variance": numpy.trace(cov),
+                         "eigenvalues": evalues[::-1][:4],
+                         "eigenvectors": evectors[:, ::-1][:, :4].T}
+            for index in [-1, 0]:
+                if index == 0:
+                    data = numpy.ascontiguousarray(x.transpose(2, 0, 1))
+                else:
+                    data = x
+                result = randomizedPCA(data, index=index,
+                                       binning=binning, mask=mask,
+                                       spectral_mask=spectral_mask,
+                                       chunksize=40, seed=0, **kw)
+                check(result, reference)
+                self.assertEqual(result["scores"].shape,
+                                 (4, nRows, nColumns))
+                # masked pixels do not contribute
+                self.assertTrue(numpy.all(result["scores"][:, 2, 3:7] == 0))
+
+        # dynamically loaded data against the covariance method
+        reference = numpyPCA(x.copy(), index=-1, **kw)
+        try:
+            import h5py
+        except ImportError:
+            h5py = None
+        if h5py is None:
+            result = randomizedPCA(x, index=-1, chunksize=40, seed=0, **kw)
+        else:
+            self.path = tempfile.mkdtemp(prefix="pymca_pca_")
+            fname = os.path.join(self.path, "stack.h5")
+            with h5py.File(fname, "w") as h5:
+                h5["data"] = x
+            with h5py.File(fname, "r") as h5:
+                result = randomizedPCA(h5["data"], index=-1, chunksize=40,
+                                       seed=0, **kw)
+        check(result, reference)
+        self.assertTrue(numpy.allclose(result["average"],
+                                       reference["average"]))
+        for i in range(4):
+            scores = result["scores"][i]
+            if numpy.dot(result["eigenvectors"][i],
+                         reference["eigenvectors"][i]) < 0:
+                scores = -scores
+            self.assertTrue(numpy.allclose(scores, reference["scores"][i],
+                                           rtol=1.0e-3, atol=1.0e-2))
+
     if MDP:
         def testPCAToolsMDP(self):
             from PyMca5.PyMcaMath.mva.PCATools import getCovarianceMatrix, numpyPCA
@@ -176,6 +272,7 @@ def getSuite(auto=True):
         testSuite.addTest(testPCATools("testPCAToolsImport"))
         testSuite.addTest(testPCATools("testPCAToolsCovariance"))
         testSuite.addTest(testPCATools("testPCAToolsPCA"))
+        testSuite.addTest(testPCATools("testPCAToolsRandomized"))
         if MDP:
             testSuite.addTest(testPCATools("testPCAToolsMDP"))
     return testSuite
@@ -0,0 +1,153 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2004-2024 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V. Armando Sole - ESRF Data Analysis"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+import unittest
+import numpy
+
+
+class testSNIPModule(unittest.TestCase):
+    def setUp(self):
+        """
+        import the module
+        """
+        try:
+            from PyMca5.PyMcaMath import SNIPModule
+            self.snip = SNIPModule
+        except:
+            self.snip = None
+        numpy.random.seed(0)
+        x = numpy.arange(500.)
+        spectra = []
+        for i in range(6):
+            y = 100 * numpy.exp(-0.5 * ((x - 100 - 10 * i) / 5.)**2)
+            y += 30 * numpy.exp(-0.5 * ((x - 300) / 8.)**2)
+            y += 20 * numpy.exp(-x / 200.)
+            spectra.append(numpy.random.poisson(y + 1))
+        self.spectra = numpy.array(spectra, dtype=numpy.float64)
+
+    def testSNIPModuleImport(self):
+        self.assertTrue(self.snip is not None)
+
+    def testSNIPModuleSavitskyGolayMultiple(self):
+        self.testSNIPModuleImport()
+        from PyMca5 import SpecfitFuns
+        for width in [1, 3, 4, 7, 15]:
+            for dtype, rtol in [(numpy.float64, 1e-12),
+                                (numpy.float32, 1e-5)]:
+                result = self.snip.getSavitskyGolayMultiple(self.spectra,
+                                                            width,
+                                                            dtype=dtype)
+                self.assertEqual(result.dtype, dtype)
+                self.assertEqual(result.shape, self.spectra.shape)
+                for i in range(self.spectra.shape[0]):
+                    expected = SpecfitFuns.SavitskyGolay(self.spectra[i],
+                                                         width)
+                    numpy.testing.assert_allclose(result[i], expected,
+                                                  rtol=rtol)
+                # one single spectrum
+                result = self.snip.getSavitskyGolayMultiple(self.spectra[0],
+                                                            width,
+                                                            dtype=dtype)
+                self.assertEqual(result.shape, (1, self.spectra.shape[1]))
+                expected = SpecfitFuns.SavitskyGolay(self.spectra[0], width)
+                numpy.testing.assert_allclose(result[0], expected,
+                                              rtol=rtol)
+
+    def _stripBackground(self, spectrum, snip_width, smoothing_width,
+                         anchorslist):
+        # spectrum by spectrum as FastXRFLinearFit used to do it
+        from PyMca5 import SpecfitFuns
+        background = SpecfitFuns.SavitskyGolay(spectrum, smoothing_width)
+        lastAnchor = 0
+        for anchor in anchorslist:
+            if (anchor > lastAnchor) and (anchor < background.size):
+                background[lastAnchor:anchor] = \
+                    self.snip.getSnip1DBackground(
+                            background[lastAnchor:anchor], snip_width,
+                            smoothing=0)
+                lastAnchor = anchor
+        if lastAnchor < background.size:
+            background[lastAnchor:] = \
+                self.snip.getSnip1DBackground(background[lastAnchor:],
+                                              snip_width, smoothing=0)
+        return background
+
+    def testSNIPModuleStripBackgroundMultiple(self):
+        self.testSNIPModuleImport()
+        for snip_width, smoothing_width in [(10, 1), (30, 5), (50, 8)]:
+            for anchorslist in [None, [0, 499], [150, 250, 499]]:
+                for dtype, rtol in [(numpy.float64, 1e-12),
+                                    (numpy.float32, 1e-5)]:
+                    result = self.snip.getStripBackgroundMultiple(
+                                            self.spectra, snip_width,
+                                            smoothing_width=smoothing_width,
+                                            anchorslist=anchorslist,
+                                            dtype=dtype)
+                    self.assertEqual(result.dtype, dtype)
+                    self.assertEqual(result.shape, self.spectra.shape)
+                    for i in range(self.spectra.shape[0]):
+                        expected = self._stripBackground(self.spectra[i],
+                                                snip_width, smoothing_width,
+                                                anchorslist or [])
+                        numpy.testing.assert_allclose(result[i], expected,
+                                                      rtol=rtol)
+                    # one single spectrum
+                    result = self.snip.getStripBackgroundMultiple(
+                                            self.spectra[-1], snip_width,
+                                            smoothing_width=smoothing_width,
+                                            anchorslist=anchorslist,
+                                            dtype=dtype)
+                    self.assertEqual(result.shape,
+                                     (1, self.spectra.shape[1]))
+                    expected = self._stripBackground(self.spectra[-1],
+                                                snip_width, smoothing_width,
+                                                anchorslist or [])
+                    numpy.testing.assert_allclose(result[0], expected,
+                                                  rtol=rtol)
+
+def getSuite(auto=True):
+    testSuite = unittest.TestSuite()
+    if auto:
+        testSuite.addTest(\
+            unittest.TestLoader().loadTestsFromTestCase(testSNIPModule))
+    else:
+        # use a predefined order
+        testSuite.addTest(testSNIPModule("testSNIPModuleImport"))
+        testSuite.addTest(testSNIPModule("testSNIPModuleSavitskyGolayMultiple"))
+        testSuite.addTest(testSNIPModule("testSNIPModuleStripBackgroundMultiple"))
+    return testSuite
+
+def test(auto=False):
+    unittest.TextTestRunner(verbosity=2).run(getSuite(auto=auto))
+
+if __name__ == '__main__':
+    test()
@@ -467,6 +467,71 @@ def testFitHdf5Stack(self):
         labels = sf[0].alllabels()
         scanData = sf[0].data()
         sf = None
+
+        # the same batch fit distributed over worker processes
+        parallelDir = os.path.join(self._outputDir, "parallel")
+        os.mkdir(parallelDir)
+        batch = McaAdvancedFitBatch.McaAdvancedFitBatch(cfgFile,
+                                        filelist=[self._h5File],
+                                        outputdir=parallelDir,
+                                        concentrations=True,
+                                        selection=selection,
+                                        quiet=True,
+                                        nworkers=2)
+        batch.processList()
+        imageFile = os.path.join(parallelDir, "IMAGES", "Steel.dat")
+        self.assertTrue(os.path.isfile(imageFile),
+                "Parallel batch fit result file <%s> not present" % imageFile)
+        sf = specfile.Specfile(imageFile)
+        self.assertEqual(sf[0].alllabels(), labels,
+                         "Parallel batch fit labels differ")
+        self.assertTrue(numpy.allclose(sf[0].data(), scanData,
+                                       rtol=1.0e-6, atol=1.0e-10),
+                        "Parallel batch fit results differ")
+        sf = None
+
+        # the same batch fit with a single HDF5 result file
+        storeDir = os.path.join(self._outputDir, "store")
+        os.mkdir(storeDir)
+        for overwrite in [1, 0]:
+            batch = McaAdvancedFitBatch.McaAdvancedFitBatch(cfgFile,
+                                        filelist=[self._h5File],
+                                        outputdir=storeDir,
+                                        concentrations=True,
+                                        selection=selection,
+                                        quiet=True,
+                                        overwrite=overwrite,
+                                        fitstore=True)
+            if not overwrite:
+                # all the results have to be taken from the store
+                def fitOneMca(*args, **kwargs):
+                    raise RuntimeError("Spectrum fitted again")
+                batch._fitOneMca = fitOneMca
+            batch.processList()
+            self.assertFalse(os.path.exists(os.path.join(storeDir, "FIT",
+                                                         "Steel_FITDIR")),
+                             "Individual .fit files written")
+            storeFile = batch.getFitStoreFile()
+            self.assertTrue(os.path.isfile(storeFile),
+                    "Fit result file <%s> not present" % storeFile)
+            h5 = h5py.File(storeFile, "r")
+            try:
+                results = h5["/mca_fit/xrf_fit/results"]
+                self.assertEqual(results["chisq"].shape, (nRows * nColumns,))
+                self.assertEqual(results["concentrations"].shape[0],
+                                 nRows * nColumns)
+                self.assertTrue(numpy.allclose(results["chisq"][()],
+                                        scanData[labels.index("chisq")]),
+                                "Incorrect chisq stored")
+            finally:
+                h5.close()
+                h5 = None
+            imageFile = os.path.join(storeDir, "IMAGES", "Steel.dat")
+            sf = specfile.Specfile(imageFile)
+            self.assertTrue(numpy.allclose(sf[0].data(), scanData,
+                                           rtol=1.0e-6, atol=1.0e-10),
+                            "Batch fit results with HDF5 store differ")
+            sf = None
         self.assertTrue(scanData.shape[-1] == (nRows * nColumns),
            "Expected %d values got %d" % (nRows * nColumns, scanData.shape[-1]))
 
@@ -0,0 +1,397 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2004-2019 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V.A. Sole - ESRF Data Analysis"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+import unittest
+import os
+import sys
+import numpy
+import shutil
+import tempfile
+
+
+class testXAS(unittest.TestCase):
+    def setUp(self):
+        """
+        import the module
+        """
+        try:
+            from PyMca5.PyMcaPhysics.xas import XASClass
+            self.XASClass = XASClass
+        except:
+            self.XASClass = None
+        try:
+            from PyMca5 import PyMcaDataDir
+            self.dataDir = PyMcaDataDir.PYMCA_DATA_DIR
+        except:
+            self.dataDir = None
+        self.path = None
+
+    def tearDown(self):
+        if self.path is not None:
+            shutil.rmtree(self.path)
+
+    def testXASImport(self):
+        self.assertTrue(self.XASClass is not None,
+                        "Unsuccessful PyMca5.PyMcaPhysics.xas.XASClass import")
+
+    def _getSpectra(self, nSpectra=10):
+        from PyMca5.PyMcaIO import specfilewrapper as specfile
+        dataFile = os.path.join(self.dataDir, "EXAFS_Cu.dat")
+        self.assertTrue(os.path.isfile(dataFile),
+                        "File %s is not an actual file" % dataFile)
+        data = specfile.Specfile(dataFile)[0].data()
+        energy = data[0, :]
+        mu = data[1, :]
+        # shifted, scaled and noisy copies of the spectrum
+        numpy.random.seed(0)
+        spectra = numpy.zeros((nSpectra, energy.size))
+        for i in range(nSpectra):
+            shift = numpy.random.uniform(-20., 20.)
+            spectra[i] = numpy.interp(energy, energy + shift, mu) * \
+                         numpy.random.uniform(0.5, 2.0)
+            spectra[i] += numpy.random.normal(0., 1.0e-3 * mu.max(),
+                                              energy.size)
+        return energy, spectra
+
+    def testXASPolsplMultiple(self):
+        self.testXASImport()
+        XASClass = self.XASClass
+        numpy.random.seed(1)
+        nSpectra = 5
+        npts = numpy.array([250, 300, 280, 300, 260], dtype=numpy.int32)
+        x = numpy.zeros((nSpectra, npts.max() + 1))
+        y = numpy.zeros((nSpectra, npts.max() + 1))
+        w = numpy.ones(x.shape)
+        xl = numpy.zeros((nSpectra, 10))
+        xh = numpy.zeros((nSpectra, 10))
+        nr = 3
+        nc = numpy.zeros((10,), dtype=numpy.int32)
+        nc[1:nr + 1] = [4, 3, 4]
+        for i in range(nSpectra):
+            k = numpy.sort(numpy.random.uniform(2., 16., npts[i]))
+            x[i, 1:npts[i] + 1] = k
+            y[i, 1:npts[i] + 1] = numpy.sin(2 * k) * numpy.exp(-0.1 * k) + \
+                                  0.05 * k + \
+                                  numpy.random.normal(0., 0.01, k.size)
+            knots = numpy.linspace(2., 16. - i, nr + 1)
+            xl[i, 1:nr + 1] = knots[:-1]
+            xh[i, 1:nr + 1] = knots[1:]
+        expected = numpy.zeros((nSpectra, 36))
+        for i in range(nSpectra):
+            expected[i] = XASClass.polspl(x[i], y[i], w[i], int(npts[i]),
+                                          xl[i].copy(), xh[i].copy(), nr, nc)
+        xl0 = xl.copy()
+        compiled = XASClass._XAS
+        try:
+            for useCompiled in set([compiled, False]):
+                XASClass._XAS = useCompiled
+                c = XASClass.polsplMultiple(x, y, w, npts, xl, xh, nr, nc)
+                numpy.testing.assert_allclose(c, expected, rtol=1.0e-8,
+                                              atol=1.0e-10)
+                # the ranges are not modified
+                self.assertTrue(numpy.array_equal(xl, xl0))
+                # shared ranges
+                c = XASClass.polsplMultiple(x, y, w, npts, xl[0], xh[0], nr, nc)
+                self.assertTrue(numpy.allclose(c[0], expected[0]))
+        finally:
+            XASClass._XAS = compiled
+
+        # the post-edge of several spectra
+        k = x[:, 1:]
+        mu = y[:, 1:]
+        kmax = numpy.array([15., 14., 13., 16., 15.])
+        fit, xNodes, yNodes = XASClass.postEdgeMultiple(k, mu, 3., kmax,
+                                                        [3, 2, 3], full=True)
+        for i in range(nSpectra):
+            fit0, xNodes0, yNodes0 = XASClass.postEdge0(k[i], mu[i], 3.,
+                                                        kmax[i], [3, 2, 3],
+                                                        full=True)
+            numpy.testing.assert_allclose(fit[i], fit0[:, 1],
+                                          rtol=1.0e-8, atol=1.0e-10)
+            numpy.testing.assert_allclose(xNodes[i], xNodes0)
+            numpy.testing.assert_allclose(yNodes[i], yNodes0, rtol=1.0e-6)
+
+    def testXASMultipleSpectra(self):
+        self.testXASImport()
+        energy, spectra = self._getSpectra()
+        configurations = [None,
+            {"Normalization": {"PostEdge": {"Polynomial": "Parabolic"},
+                               "E0Method": "Auto - No Smooth",
+                               "JumpNormalizationMethod": "Constant"},
+             "EXAFS": {"KWeight": 2, "KMax": 14.},
+             "FT": {"Window": "Hanning", "WindowRange": [3., 13.]}}]
+        for configuration in configurations:
+            xas = self.XASClass.XASClass()
+            if configuration is not None:
+                xas.setConfiguration(configuration)
+            result = xas.processMultipleSpectra(energy, spectra)
+            self.assertEqual(result["NormalizedMu"].shape, spectra.shape)
+            for i in range(spectra.shape[0]):
+                xas.setSpectrum(energy, spectra[i])
+                expected = xas.processSpectrum()
+                for key in ["Edge", "Jump", "KMax",
+                            "NormalizedPlotMin", "NormalizedPlotMax"]:
+                    self.assertAlmostEqual(result[key][i], expected[key],
+                                           places=6, msg=key)
+                for key in ["NormalizedMu", "EXAFSKValues",
+                            "PostEdgeB", "EXAFSNormalized"]:
+                    # the EXAFS values are not relevant before the edge
+                    idx = expected["EXAFSKValues"] >= expected["KMin"]
+                    reference = expected[key][idx]
+                    atol = 1.0e-6 * numpy.abs(reference).max()
+                    numpy.testing.assert_allclose(result[key][i][idx],
+                                                  reference,
+                                                  rtol=0, atol=atol,
+                                                  err_msg=key)
+                numpy.testing.assert_allclose(result["FT"]["FTRadius"],
+                                              expected["FT"]["FTRadius"])
+                for key in ["FTIntensity", "FTReal", "FTImaginary"]:
+                    reference = expected["FT"][key]
+                    atol = 1.0e-6 * numpy.abs(reference).max()
+                    numpy.testing.assert_allclose(result["FT"][key][i],
+                                                  reference,
+                                                  rtol=0, atol=atol,
+                                                  err_msg=key)
+
+    def testXASSharedEnergyAxis(self):
+        self.testXASImport()
+        energy, spectra = self._getSpectra()
+        xas = self.XASClass.XASClass()
+        first = xas.processMultipleSpectra(energy, spectra[:5])
+        # the work depending only on the axis is reused
+        second = xas.processMultipleSpectra(energy, spectra[5:])
+        reference = self.XASClass.XASClass().processMultipleSpectra(energy,
+                                                                  spectra[5:])
+        for key in ["Edge", "Jump", "NormalizedMu", "EXAFSNormalized"]:
+            numpy.testing.assert_array_equal(second[key], reference[key])
+
+        # unsorted axis
+        idx = numpy.random.permutation(energy.size)
+        result = xas.processMultipleSpectra(energy[idx], spectra[5:, idx])
+        for key in ["Edge", "Jump", "NormalizedMu", "EXAFSNormalized"]:
+            numpy.testing.assert_allclose(result[key], reference[key],
+                                          err_msg=key)
+
+        # the cache does not survive a change of configuration
+        configuration = {"Normalization": {"E0Method": "Auto - 9pt SG",
+                                           "PostEdge": {"Polynomial":
+                                                        "Parabolic"}}}
+        xas.setConfiguration(configuration)
+        result = xas.processMultipleSpectra(energy, spectra[5:])
+        xas = self.XASClass.XASClass()
+        xas.setConfiguration(configuration)
+        reference = xas.processMultipleSpectra(energy, spectra[5:])
+        for key in ["Edge", "Jump", "NormalizedMu", "EXAFSNormalized"]:
+            numpy.testing.assert_array_equal(result[key], reference[key])
+
+        # the product by the kernel is the FFT
+        kernel = self.XASClass.getFTKernel(npoints=2048, rrange=(0., 6.),
+                                           kstep=0.04)
+        k = first["EXAFSKValues"]
+        exafs = first["EXAFSNormalized"]
+        krange = (first["KMin"], first["KMax"])
+        fft = self.XASClass.getFTMultiple(k, exafs, krange, npoints=2048,
+                                          rrange=(0., 6.), kstep=0.04)
+        dft = self.XASClass.getFTMultiple(k, exafs, krange, npoints=2048,
+                                          rrange=(0., 6.), kstep=0.04,
+                                          kernel=kernel)
+        numpy.testing.assert_allclose(dft["FTRadius"], fft["FTRadius"])
+        for key in ["FTIntensity", "FTReal", "FTImaginary"]:
+            numpy.testing.assert_allclose(dft[key], fft[key], rtol=0,
+                                  atol=1.0e-10 * numpy.abs(fft[key]).max())
+
+    def testXASStackBatch(self):
+        self.testXASImport()
+        import h5py
+        from PyMca5.PyMcaPhysics.xas import XASStackBatch
+        energy, spectra = self._getSpectra(nSpectra=12)
+        stack = spectra.reshape(3, 4, -1)
+        mask = numpy.ones((3, 4), dtype=numpy.uint8)
+        mask[1, 2] = 0
+        mask[2, :] = 0
+        self.path = tempfile.mkdtemp(prefix="pymca_xas_")
+        batch = XASStackBatch.XASStackBatch()
+        result = batch.processMultipleSpectra(energy, stack, mask=mask,
+                                              directory=self.path,
+                                              name="stack")
+        self.assertEqual(result["names"], ["Jump", "Edge"])
+        xas = self.XASClass.XASClass()
+        with h5py.File(os.path.join(self.path, "stack.h5"), "r") as h5:
+            ftIntensity = h5["/xas_analysis/FT/Intensity"][()]
+        for i in range(3):
+            for j in range(4):
+                if not mask[i, j]:
+                    self.assertEqual(result["images"][1, i, j], 0.0)
+                    self.assertFalse(ftIntensity[i, j].any())
+                    continue
+                xas.setSpectrum(energy, stack[i, j])
+                expected = xas.processSpectrum()
+                self.assertAlmostEqual(result["images"][0, i, j] / \
+                                       expected["Jump"], 1.0, places=5)
+                self.assertAlmostEqual(result["images"][1, i, j] / \
+                                       expected["Edge"], 1.0, places=5)
+                reference = expected["FT"]["FTIntensity"]
+                numpy.testing.assert_allclose(ftIntensity[i, j], reference,
+                                    rtol=0, atol=1.0e-5 * reference.max())
+
+    def testXASStackBatchResume(self):
+        self.testXASImport()
+        import h5py
+        from PyMca5.PyMcaPhysics.xas import XASStackBatch
+        energy, spectra = self._getSpectra(nSpectra=12)
+        stack = spectra.reshape(4, 3, -1)
+        mask = numpy.ones((4, 3), dtype=numpy.uint8)
+        mask[3, :] = 0
+        self.path = tempfile.mkdtemp(prefix="pymca_xas_")
+        batch = XASStackBatch.XASStackBatch()
+        reference = batch.processMultipleSpectra(energy, stack, mask=mask,
+                                                 directory=self.path,
+                                                 name="reference")
+        # worker processes, one row per block
+        result = batch.processMultipleSpectra(energy, stack, mask=mask,
+                                              directory=self.path,
+                                              name="parallel",
+                                              nWorkers=2,
+                                              rowsPerBlock=1)
+        numpy.testing.assert_allclose(result["images"], reference["images"])
+        fname = os.path.join(self.path, "parallel.h5")
+        with h5py.File(fname, "r") as h5:
+            self.assertTrue(h5["/xas_analysis/progress"][()].all())
+            self.assertEqual(h5["/xas_analysis/exafs/signal"].chunks[:2],
+                             (1, 3))
+            ftIntensity = h5["/xas_analysis/FT/Intensity"][()]
+
+        # interrupted run: the second row was not written
+        with h5py.File(fname, "a") as h5:
+            h5["/xas_analysis/progress"][1] = 0
+            h5["/xas_analysis/edge"][1] = 0
+            h5["/xas_analysis/FT/Intensity"][1] = 0
+            # a processed row is not processed again
+            h5["/xas_analysis/edge"][0, 0] = -1
+        result = batch.processMultipleSpectra(energy, stack, mask=mask,
+                                              directory=self.path,
+                                              name="parallel",
+                                              rowsPerBlock=1,
+                                              resume=True)
+        self.assertEqual(result["images"][1, 0, 0], -1)
+        numpy.testing.assert_allclose(result["images"][:, 1:],
+                                      reference["images"][:, 1:])
+        with h5py.File(fname, "r") as h5:
+            self.assertTrue(h5["/xas_analysis/progress"][()].all())
+            numpy.testing.assert_allclose(h5["/xas_analysis/FT/Intensity"],
+                                          ftIntensity)
+
+        # a different stack is processed from scratch
+        with h5py.File(fname, "a") as h5:
+            h5["/xas_analysis/progress"][2] = 0
+        smallStack = numpy.ascontiguousarray(stack[:, :2])
+        reference = batch.processMultipleSpectra(energy, smallStack,
+                                                 mask=mask[:, :2],
+                                                 directory=self.path,
+                                                 name="small")
+        result = batch.processMultipleSpectra(energy, smallStack,
+                                              mask=mask[:, :2],
+                                              directory=self.path,
+                                              name="parallel",
+                                              rowsPerBlock=1,
+                                              resume=True)
+        numpy.testing.assert_allclose(result["images"], reference["images"])
+        with h5py.File(fname, "r") as h5:
+            self.assertEqual(h5["/xas_analysis/progress"].shape, (4,))
+            self.assertTrue(h5["/xas_analysis/progress"][()].all())
+            self.assertEqual(list(h5["/xas_analysis/stack_shape"][()]),
+                             list(smallStack.shape))
+
+        # so is the same stack with another configuration
+        with h5py.File(fname, "a") as h5:
+            h5["/xas_analysis/progress"][2] = 0
+            h5["/xas_analysis/edge"][0, 0] = -1
+        # (the output axes do not change with the k weight)
+        configuration = batch._analyzer.getConfiguration()
+        configuration["EXAFS"]["KWeight"] += 2
+        reference = batch.processMultipleSpectra(energy, smallStack,
+                                                 mask=mask[:, :2],
+                                                 configuration=configuration,
+                                                 directory=self.path,
+                                                 name="small")
+        result = batch.processMultipleSpectra(energy, smallStack,
+                                              mask=mask[:, :2],
+                                              directory=self.path,
+                                              name="parallel",
+                                              rowsPerBlock=1,
+                                              resume=True)
+        numpy.testing.assert_allclose(result["images"], reference["images"])
+        with h5py.File(fname, "r") as h5:
+            signal = h5["/xas_analysis/exafs/signal"][()]
+        with h5py.File(os.path.join(self.path, "small.h5"), "r") as h5:
+            numpy.testing.assert_allclose(signal,
+                                          h5["/xas_analysis/exafs/signal"])
+
+        # and the same stack with another mask
+        with h5py.File(fname, "a") as h5:
+            h5["/xas_analysis/progress"][2] = 0
+            h5["/xas_analysis/edge"][0, 0] = -1
+        # the last row was masked: it is marked as processed
+        newMask = numpy.ones((4, 2), dtype=numpy.uint8)
+        reference = batch.processMultipleSpectra(energy, smallStack,
+                                                 mask=newMask,
+                                                 directory=self.path,
+                                                 name="small")
+        result = batch.processMultipleSpectra(energy, smallStack,
+                                              mask=newMask,
+                                              directory=self.path,
+                                              name="parallel",
+                                              rowsPerBlock=1,
+                                              resume=True)
+        self.assertTrue(numpy.all(reference["images"][:, 3] != 0))
+        numpy.testing.assert_allclose(result["images"], reference["images"])
+
+def getSuite(auto=True):
+    testSuite = unittest.TestSuite()
+    if auto:
+        testSuite.addTest(\
+            unittest.TestLoader().loadTestsFromTestCase(testXAS))
+    else:
+        # use a predefined order
+        testSuite.addTest(testXAS("testXASImport"))
+        testSuite.addTest(testXAS("testXASPolsplMultiple"))
+        testSuite.addTest(testXAS("testXASMultipleSpectra"))
+        testSuite.addTest(testXAS("testXASSharedEnergyAxis"))
+        testSuite.addTest(testXAS("testXASStackBatch"))
+        testSuite.addTest(testXAS("testXASStackBatchResume"))
+    return testSuite
+
+def test(auto=False):
+    unittest.TextTestRunner(verbosity=2).run(getSuite(auto=auto))
+
+if __name__ == '__main__':
+    test()
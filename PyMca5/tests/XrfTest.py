@@ -237,6 +237,49 @@
 fixedstep_heightratio = 0"""
 
 
+def _loopPeakTables(mcaFit, param):
+    """
+    PEAKSW tables built group by group and escape line by escape line
+    """
+    PARAMETERS = mcaFit.PARAMETERS
+    gain = param[1]
+    noise = param[2] * param[2]
+    fano = param[3] * 2.3548 * 2.3548 * 0.00385
+    tables = []
+    for i in range(len(mcaFit.PEAKS0)):
+        peaks0 = mcaFit.PEAKS0[i]
+        (r, c) = peaks0.shape
+        peaksw = numpy.ones(mcaFit.PEAKSW[i].shape, numpy.float64)
+        peaksw[0:r, 0] = peaks0[:, 0] * param[mcaFit.NGLOBAL + i] * gain
+        peaksw[0:r, 1] = peaks0[:, 1] * 1.0
+        peaksw[0:r, 2] = numpy.sqrt(noise + peaks0[:, 1] * fano)
+        if mcaFit.ESCAPE:
+            ii = 0
+            j = 0
+            for esc_group in mcaFit.PEAKS0ESCAPE[i]:
+                for esc_line in esc_group:
+                    peaksw[j + r, 0] = peaksw[ii, 0] * esc_line[1]
+                    peaksw[j + r, 1] = esc_line[0] * 1.0
+                    j = j + 1
+                ii = ii + 1
+            peaksw[r:, 2] = numpy.sqrt(noise + \
+                                (peaksw[r:, 1] > 0) * peaksw[r:, 1] * fano)
+        if peaksw.shape[1] > 4:
+            peaksw[:, 3] = param[PARAMETERS.index('ST AreaR')]
+            peaksw[:, 4] = param[PARAMETERS.index('ST SlopeR')]
+            peaksw[:, 5] = param[PARAMETERS.index('LT AreaR')]
+            peaksw[:, 6] = param[PARAMETERS.index('LT SlopeR')]
+            peaksw[:, 7] = param[PARAMETERS.index('STEP HeightR')]
+            # no tails in escape peaks
+            peaksw[r:, 3] = 0.0
+            peaksw[r:, 5] = 0.0
+            peaksw[r:, 7] = 0.0
+        else:
+            peaksw[:, 3] = param[PARAMETERS.index('Eta Factor')]
+        tables.append(peaksw)
+    return tables
+
+
 class testXrf(unittest.TestCase):
     def setUp(self):
         """
@@ -546,6 +589,399 @@ def testStainlessSteelDataFit(self):
                 "Strategy: Element %s discrepancy too large %.1f %%" % \
                   (element.split()[0], delta))
 
+    def testPeakTables(self):
+        from PyMca5.PyMcaIO import specfilewrapper as specfile
+        from PyMca5.PyMcaMath.fitting import SpecfitFuns
+        from PyMca5.PyMcaPhysics.xrf import ClassMcaTheory
+        from PyMca5.PyMcaIO import ConfigDict
+
+        trainingDataFile = os.path.join(self.dataDir, "XRFSpectrum.mca")
+        sf = specfile.Specfile(trainingDataFile)
+        y = sf[1].mca(1)
+        x = numpy.arange(y.size).astype(numpy.float64)
+        sf = None
+        for hypermet in [1, 0]:
+            for escape in [1, 0]:
+                configuration = ConfigDict.ConfigDict()
+                configuration.readfp(StringIO(cfg))
+                configuration["fit"]["hypermetflag"] = hypermet
+                configuration["fit"]["escapeflag"] = escape
+                mcaFit = ClassMcaTheory.ClassMcaTheory()
+                configuration = mcaFit.configure(configuration)
+                mcaFit.setData(x, y,
+                               xmin=configuration["fit"]["xmin"],
+                               xmax=configuration["fit"]["xmax"])
+                mcaFit.estimate()
+                param = numpy.array(mcaFit.parameters, dtype=numpy.float64)
+                param[mcaFit.NGLOBAL:] = 1.0 + \
+                        numpy.arange(len(param) - mcaFit.NGLOBAL)
+                expected = _loopPeakTables(mcaFit, param)
+                current = mcaFit.getpeaksw(param)
+                self.assertEqual(len(current), len(expected))
+                for i in range(len(expected)):
+                    self.assertTrue(numpy.array_equal(current[i], expected[i]),
+                        "Different peak table for group %s" % \
+                        mcaFit.PARAMETERS[mcaFit.NGLOBAL + i])
+                # the fast model uses the concatenation of the tables
+                xw = mcaFit.datatofit[:, 0]
+                energy = param[0] + param[1] * xw
+                if hypermet:
+                    yExpected = SpecfitFuns.fastahypermet( \
+                                    numpy.concatenate(expected), energy,
+                                    mcaFit._McaTheory__HYPERMET)
+                else:
+                    yExpected = SpecfitFuns.apvoigt( \
+                                    numpy.concatenate(expected), energy)
+                yCurrent = mcaFit.mcatheory(param, xw, continuum=0, summing=0)
+                self.assertTrue(numpy.array_equal(yCurrent, yExpected),
+                                "Different model for the same peak tables")
+
+    def testRoiFitLowEnergy(self):
+        from PyMca5.PyMcaIO import specfilewrapper as specfile
+        from PyMca5.PyMcaPhysics.xrf import ClassMcaTheory
+        from PyMca5.PyMcaPhysics.xrf import Elements
+        from PyMca5.PyMcaIO import ConfigDict
+
+        trainingDataFile = os.path.join(self.dataDir, "XRFSpectrum.mca")
+        sf = specfile.Specfile(trainingDataFile)
+        y = sf[1].mca(1)
+        x = numpy.arange(y.size).astype(numpy.float64)
+        sf = None
+        # between the Pb L3 and L2 edges only the L3 lines are excited
+        energy = 14.0
+        configuration = ConfigDict.ConfigDict()
+        configuration.readfp(StringIO(cfg))
+        configuration["fit"]["energy"][0] = energy
+        configuration["peaks"] = {"Pb": ["L"]}
+        mcaFit = ClassMcaTheory.ClassMcaTheory()
+        try:
+            Elements.updateDict(energy=None)
+            mcaFit.configure(configuration)
+            self.assertEqual(mcaFit.getExcitationEnergy(), energy)
+            # configuring a fit does not modify the global dictionary
+            self.assertEqual(
+                Elements.Element["Pb"]["buildparameters"]["energy"], None)
+            unfiltered = Elements.getElementRateTable("Pb")["L xrays"]
+            self.assertTrue([t for t in unfiltered if not t.startswith("L3")])
+            result = mcaFit.roifit(x, y)
+            self.assertEqual(list(result.keys()), ["Pb L"])
+            lines = [key.replace(" ROI", "") for key in result["Pb L"]]
+            self.assertTrue(len(lines) > 0)
+            elementTable = Elements.getElementRateTable("Pb", energy=energy)
+            for line in lines:
+                self.assertTrue(line.startswith("L3"),
+                                "Line %s not excited at %.1f keV" % \
+                                (line, energy))
+                self.assertTrue(line in elementTable["L xrays"])
+        finally:
+            Elements.updateDict(energy=None)
+
+    def testStainlessSteelJacobian(self):
+        from PyMca5.PyMcaIO import specfilewrapper as specfile
+        from PyMca5.PyMcaPhysics.xrf import ClassMcaTheory
+        from PyMca5.PyMcaIO import ConfigDict
+
+        dataFile = os.path.join(self.dataDir, "Steel.spe")
+        sf = specfile.Specfile(dataFile)
+        y = sf[0].mca(1)
+        x = numpy.arange(y.size).astype(numpy.float64)
+        sf = None
+        configuration = ConfigDict.ConfigDict()
+        configuration.read(os.path.join(self.dataDir, "Steel.cfg"))
+        configuration["concentrations"]["usemultilayersecondary"] = 0
+        # exercise all the hypermet terms
+        configuration["fit"]["hypermetflag"] = 15
+        mcaFit = ClassMcaTheory.ClassMcaTheory()
+        configuration = mcaFit.configure(configuration)
+        mcaFit.setData(x, y,
+                       xmin=configuration["fit"]["xmin"],
+                       xmax=configuration["fit"]["xmax"])
+        mcaFit.estimate()
+        # exact model for the numerical derivatives
+        mcaFit.FASTER = 0
+        param = numpy.array(mcaFit.parameters, dtype=numpy.float64)
+        xw = mcaFit.datatofit[:, 0]
+        indices = list(range(len(param)))
+        jacobian = mcaFit.analyticalJacobian(param, indices, xw)
+        self.assertEqual(jacobian.shape, (len(param), xw.size))
+        for i in indices:
+            name = mcaFit.PARAMETERS[i]
+            if name == "Sum":
+                continue
+            delta = 1.0e-6 * max(abs(param[i]), 1.0e-3)
+            p1 = param.copy()
+            p1[i] += delta
+            p2 = param.copy()
+            p2[i] -= delta
+            expected = (mcaFit.mcatheory(p1, xw, summing=0) -
+                        mcaFit.mcatheory(p2, xw, summing=0)) / (2 * delta)
+            error = numpy.abs(jacobian[i] - expected).max() / \
+                    (numpy.abs(expected).max() + 1.0e-30)
+            self.assertTrue(error < 1.0e-4,
+                "Derivative with respect to %s off by %.2e" % (name, error))
+
+    def testFisxSession(self):
+        import copy
+        from PyMca5.PyMcaPhysics.xrf import FisxHelper
+        from PyMca5.PyMcaIO import ConfigDict
+
+        configFile = os.path.join(self.dataDir, "Steel.cfg")
+        configuration = ConfigDict.ConfigDict()
+        configuration.read(configFile)
+        configuration["concentrations"]["usemultilayersecondary"] = 2
+        FisxHelper.clearFisxSessions()
+        corrections = FisxHelper.getFisxCorrectionFactorsFromFitConfiguration(
+                                    configuration, elementsFromMatrix=False)
+        session = FisxHelper.getFisxSession(configuration)
+        self.assertEqual(len(session._results), 1)
+
+        # settings the calculation does not depend on are not relevant
+        configuration["fit"]["xmin"] += 1
+        self.assertTrue(FisxHelper.getFisxSession(configuration) is session)
+
+        # cached results are not affected by the caller
+        corrections["Cr"]["K"]["correction_factor"][-1] = 0.0
+        cached = FisxHelper.getFisxCorrectionFactorsFromFitConfiguration(
+                                    configuration, elementsFromMatrix=False)
+        self.assertTrue(cached["Cr"]["K"]["correction_factor"][-1] > 1.0)
+
+        # several sample matrices at once
+        configurations = []
+        for matrix in ["SRM_1155", "Fe"]:
+            config = copy.deepcopy(configuration)
+            config["attenuators"]["Matrix"][1] = matrix
+            configurations.append(config)
+        expected = [FisxHelper.getFisxCorrectionFactorsFromFitConfiguration(
+                                    config) for config in configurations]
+        self.assertNotEqual(expected[0]["Cr"]["K"]["correction_factor"],
+                            expected[1]["Cr"]["K"]["correction_factor"])
+        FisxHelper.clearFisxSessions()
+        result = FisxHelper.getFisxCorrectionFactorsFromFitConfigurations(
+                                    configurations, nWorkers=2)
+        self.assertEqual(result, expected)
+
+    def testFastXRFQuantification(self):
+        import copy
+        from PyMca5.PyMcaIO import specfilewrapper as specfile
+        from PyMca5.PyMcaPhysics.xrf import ClassMcaTheory
+        from PyMca5.PyMcaPhysics.xrf import ConcentrationsTool
+        from PyMca5.PyMcaPhysics.xrf import SingleLayerStrategy
+        from PyMca5.PyMcaPhysics.xrf import FastXRFQuantification
+        from PyMca5.PyMcaIO import ConfigDict
+
+        dataFile = os.path.join(self.dataDir, "Steel.spe")
+        sf = specfile.Specfile(dataFile)
+        y = sf[0].mca(1)
+        x = numpy.arange(y.size).astype(numpy.float64)
+        sf = None
+        configFile = os.path.join(self.dataDir, "Steel.cfg")
+        configuration = ConfigDict.ConfigDict()
+        configuration.read(configFile)
+        configuration["concentrations"]["usemultilayersecondary"] = 0
+        configuration["concentrations"]["usematrix"] = 0
+        configuration["concentrations"]["flux"] = 1.0e10
+        configuration["concentrations"]["time"] = 100.0
+        configuration["attenuators"]["Matrix"][1] = "Fe"
+        configuration["fit"]["strategyflag"] = 0
+        configuration["SingleLayerStrategy"] = {}
+        configuration["SingleLayerStrategy"]["layer"] = "Auto"
+        configuration["SingleLayerStrategy"]["iterations"] = 3
+        configuration["SingleLayerStrategy"]["completer"] = "-"
+        configuration["SingleLayerStrategy"]["flags"] = [1, 1, 1, 1, 0,
+                                                         0, 0, 0, 0, 0]
+        configuration["SingleLayerStrategy"]["peaks"] = ["Cr K",
+                                                         "Mn K", "Fe Ka",
+                                                         "Ni K", "-", "-",
+                                                         "-", "-", "-", "-"]
+        configuration["SingleLayerStrategy"]["materials"] = ["Cr",
+                                                         "Mn", "Fe",
+                                                         "Ni", "-", "-",
+                                                         "-", "-", "-"]
+        mcaFit = ClassMcaTheory.ClassMcaTheory()
+        configuration = mcaFit.configure(configuration)
+        mcaFit.setData(x, y,
+                       xmin=configuration["fit"]["xmin"],
+                       xmax=configuration["fit"]["xmax"])
+        mcaFit.estimate()
+        fitResult, result = mcaFit.startFit(digest=1)
+
+        # the strategy applied to the fitted areas of one spectrum
+        strategy = SingleLayerStrategy.SingleLayerStrategy()
+        cTool = ConcentrationsTool.ConcentrationsTool()
+        expected = []
+        newConfiguration = configuration
+        for iteration in range(4):
+            fitresult = copy.deepcopy(result)
+            fitresult['config'] = newConfiguration
+            cToolConfiguration = cTool.configure()
+            cToolConfiguration.update(newConfiguration['concentrations'])
+            concentrations = cTool.processFitResult(
+                                    config=cToolConfiguration,
+                                    fitresult={"result": fitresult},
+                                    elementsfrommatrix=False)
+            expected.append(concentrations["mass fraction"])
+            newConfiguration, n = strategy.applyStrategy(fitresult, None,
+                                                         3 - iteration)
+
+        # the same areas in all pixels of an image
+        names = result['groups']
+        parameters = numpy.array([result[group]['fitarea']
+                                  for group in names])
+        parameters = parameters[:, numpy.newaxis, numpy.newaxis] * \
+                     numpy.ones((1, 2, 3))
+        quantification = FastXRFQuantification.FastXRFQuantification(
+                                                            configuration)
+        for iterations in [0, 3]:
+            output = quantification.processFitResult(parameters, names,
+                                            strategy=bool(iterations),
+                                            tolerance=0)
+            self.assertTrue((output['nIterations'] == iterations).all())
+            for i, group in enumerate(output['massfraction_names']):
+                numpy.testing.assert_allclose(output['massfractions'][i],
+                                              expected[iterations][group],
+                                              rtol=1.0e-5, err_msg=group)
+
+    def testEscapeCache(self):
+        import tempfile
+        import shutil
+        from PyMca5.PyMcaPhysics.xrf import ClassMcaTheory
+        from PyMca5.PyMcaPhysics.xrf import Elements
+        from PyMca5.PyMcaIO import ConfigDict
+
+        configFile = os.path.join(self.dataDir, "Steel.cfg")
+        configuration = ConfigDict.ConfigDict()
+        configuration.read(configFile)
+        self.assertTrue(configuration["fit"]["escapeflag"])
+        ClassMcaTheory.clearEscapeCache()
+        mcaFit = ClassMcaTheory.ClassMcaTheory()
+        configuration = mcaFit.configure(configuration)
+        expected = mcaFit.PEAKS0ESCAPE
+        escapes = configuration["escapes"]
+        self.assertEqual(escapes["detele"], "Si")
+        self.assertTrue(len(escapes["energy"]) > 0)
+
+        # same escape peaks as without table
+        energy = escapes["energy"][0]
+        direct = Elements.getEscape(["Si", 1.0, 1.0], energy,
+                    ethreshold=configuration["detector"]["ethreshold"],
+                    ithreshold=configuration["detector"]["ithreshold"],
+                    nthreshold=configuration["detector"]["nthreshold"])
+        self.assertEqual(escapes["nescapes"][0], len(direct))
+        numpy.testing.assert_allclose(
+                    escapes["escape_energy"][:len(direct)],
+                    [x[0] for x in direct])
+
+        # the table is saved with the configuration and reused
+        tmpDir = tempfile.mkdtemp(prefix="pymcaTmp")
+        try:
+            fname = os.path.join(tmpDir, "escapes.cfg")
+            ConfigDict.ConfigDict(initdict=configuration).write(fname)
+            configuration = ConfigDict.ConfigDict()
+            configuration.read(fname)
+        finally:
+            shutil.rmtree(tmpDir)
+        ClassMcaTheory.clearEscapeCache()
+        calls = []
+        getEscape = Elements.getEscape
+        def countingGetEscape(*args, **kw):
+            calls.append(args[1])
+            return getEscape(*args, **kw)
+        Elements.getEscape = countingGetEscape
+        try:
+            mcaFit = ClassMcaTheory.ClassMcaTheory()
+            mcaFit.configure(configuration)
+            self.assertEqual(calls, [])
+            for group, expectedGroup in zip(mcaFit.PEAKS0ESCAPE, expected):
+                for escape, expectedEscape in zip(group, expectedGroup):
+                    self.assertEqual(len(escape), len(expectedEscape))
+                    for line, expectedLine in zip(escape, expectedEscape):
+                        self.assertAlmostEqual(line[0], expectedLine[0])
+                        self.assertAlmostEqual(line[1], expectedLine[1])
+                        self.assertEqual(line[2], expectedLine[2])
+
+            # other thresholds give other escape peaks
+            configuration["detector"]["nthreshold"] = 2
+            configuration = mcaFit.configure(configuration)
+            self.assertTrue(len(calls) > 0)
+            self.assertEqual(configuration["escapes"]["nthreshold"], 2)
+            self.assertTrue(max(configuration["escapes"]["nescapes"]) <= 2)
+        finally:
+            Elements.getEscape = getEscape
+
+    def testPileup(self):
+        from PyMca5.PyMcaIO import specfilewrapper as specfile
+        from PyMca5.PyMcaPhysics.xrf import ClassMcaTheory
+        from PyMca5.PyMcaMath.fitting import SpecfitFuns
+
+        dataFile = os.path.join(self.dataDir, "Steel.spe")
+        sf = specfile.Specfile(dataFile)
+        y = sf[0].mca(1)
+        sf = None
+        pileup = ClassMcaTheory.PileupModel()
+        for xmin in [0, 10, 300]:
+            for zero, gain in [(0.0, 0.01), (-0.05, 0.01), (0.2, 0.02)]:
+                expected = SpecfitFuns.pileup(y[xmin:], xmin, zero, gain)
+                result = pileup(y[xmin:], xmin, zero, gain)
+                numpy.testing.assert_allclose(result, expected,
+                        atol=1.0e-12 * expected.max())
+
+        # several spectra with their own calibration
+        spectra = numpy.array([y[10:], 2 * y[10:], y[10:]])
+        zero = numpy.array([0.0, -0.05, 0.2])
+        gain = numpy.array([0.01, 0.01, 0.02])
+        result = pileup(spectra, 10, zero, gain)
+        for i in range(spectra.shape[0]):
+            expected = SpecfitFuns.pileup(spectra[i], 10, zero[i], gain[i])
+            numpy.testing.assert_allclose(result[i], expected,
+                        atol=1.0e-12 * expected.max())
+
+    def testFastXRFLinearFitSinglePrecision(self):
+        from PyMca5.PyMcaIO import specfilewrapper as specfile
+        from PyMca5.PyMcaIO import ConfigDict
+        from PyMca5.PyMcaPhysics.xrf import FastXRFLinearFit
+
+        datasets = []
+        sf = specfile.Specfile(os.path.join(self.dataDir, "XRFSpectrum.mca"))
+        y = sf[1].mca(1)
+        sf = None
+        configuration = ConfigDict.ConfigDict()
+        configuration.readfp(StringIO(cfg))
+        datasets.append((y, configuration))
+        sf = specfile.Specfile(os.path.join(self.dataDir, "Steel.spe"))
+        y = sf[0].mca(1)
+        sf = None
+        configuration = ConfigDict.ConfigDict()
+        configuration.read(os.path.join(self.dataDir, "Steel.cfg"))
+        configuration["concentrations"]["usematrix"] = 0
+        datasets.append((y, configuration))
+
+        for y, configuration in datasets:
+            configuration["fit"]["stripalgorithm"] = 1
+            configuration["concentrations"]["useautotime"] = 0
+            numpy.random.seed(0)
+            scale = numpy.random.uniform(0.5, 2, size=(3, 4, 1))
+            data = numpy.random.poisson(y * scale).astype(numpy.float32)
+            for weight in [0, 2]:
+                results = []
+                for singlePrecision in [False, True]:
+                    ffit = FastXRFLinearFit.FastXRFLinearFit()
+                    ffit.singlePrecision = singlePrecision
+                    outbuffer = ffit.fitMultipleSpectra(y=data,
+                                            configuration=configuration,
+                                            concentrations=True,
+                                            weight=weight, refit=1)
+                    results.append(outbuffer)
+                expected, result = results
+                self.assertEqual(result["parameter_names"],
+                                 expected["parameter_names"])
+                for key, rtol in [("parameters", 1.0e-3),
+                                  ("uncertainties", 1.0e-4),
+                                  ("massfractions", 1.0e-3)]:
+                    numpy.testing.assert_allclose(result[key],
+                            expected[key], rtol=rtol,
+                            atol=1.0e-4 * numpy.abs(expected[key]).max(),
+                            err_msg="%s (weight=%d)" % (key, weight))
+
 def getSuite(auto=True):
     testSuite = unittest.TestSuite()
     if auto:
@@ -556,6 +992,14 @@ def getSuite(auto=True):
         testSuite.addTest(testXrf("testTrainingDataFilePresence"))
         testSuite.addTest(testXrf("testTrainingDataFit"))
         testSuite.addTest(testXrf("testStainlessSteelDataFit"))
+        testSuite.addTest(testXrf("testStainlessSteelJacobian"))
+        testSuite.addTest(testXrf("testPeakTables"))
+        testSuite.addTest(testXrf("testRoiFitLowEnergy"))
+        testSuite.addTest(testXrf("testFisxSession"))
+        testSuite.addTest(testXrf("testFastXRFQuantification"))
+        testSuite.addTest(testXrf("testEscapeCache"))
+        testSuite.addTest(testXrf("testPileup"))
+        testSuite.addTest(testXrf("testFastXRFLinearFitSinglePrecision"))
     return testSuite
 
 def test(auto=False):
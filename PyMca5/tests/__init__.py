@@ -37,10 +37,13 @@
 from PyMca5.tests.EdfFileTest import test as testEdfFile
 from PyMca5.tests.ElementsTest import test as testElements
 from PyMca5.tests.GefitTest import test as testGefit
+from PyMca5.tests.LinalgTest import test as testLinalg
 from PyMca5.tests.PCAToolsTest import test as testPCATools
+from PyMca5.tests.SNIPModuleTest import test as testSNIPModule
 from PyMca5.tests.SpecfileTest import test as testSpecfile
 from PyMca5.tests.specfilewrapperTest import test as testSpecfilewrapper
 from PyMca5.tests.XrfTest import test as testXrf
 from PyMca5.tests.McaStackViewTest import test as testMcaStackView
 from PyMca5.tests.NexusUtilsTest import test as testNexusUtils
 from PyMca5.tests.StackInfoTest import test as testStackInfo
+from PyMca5.tests.FastXRFLinearFitTest import test as testFastXRFLinearFit